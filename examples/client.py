@@ -3,9 +3,61 @@
 import argparse
 import json
 import socket
+from tornado.ioloop import IOLoop
 import urllib.request
 import urllib.error
 
+from geoproxy.encoding import MSGPACK_CONTENT_TYPE
+from geoproxy.encoding import unpackb
+from geoproxy.loadgen import run_open_loop
+
+
+def build_uri(query, service=None, bounds=None):
+    """Path and query string of a geocode request
+    """
+    uri = "/geocode?address={}".format(query)
+    # optionally add bounds
+    if bounds:
+        uri += "&bounds={}".format(bounds)
+    # optionally add primary service
+    if service:
+        uri += "&service={}".format(service)
+    # clean up the query string and remove spaces to properly format request
+    return uri.replace(" ", "+")
+
+
+def print_interval(report):
+    """Prints one line of a load test's progress
+    """
+    print("{:7.1f}s {:8.1f} req/s {:6d} errors   p50 {:8.2f} ms   p99 {:8.2f} ms   "
+          "max {:8.2f} ms".format(report["time"], report["rps"], report["errors"],
+                                  1000.0 * report["p50"], 1000.0 * report["p99"],
+                                  1000.0 * report["max"]))
+
+
+def load_test(args, queries):
+    """Drives the server at a fixed arrival rate with a corpus of queries, see run_open_loop
+    """
+    uris = [build_uri(query, args.service, args.bounds) for query in queries]
+    headers = {"Accept": MSGPACK_CONTENT_TYPE} if args.msgpack else None
+    print("Sending {} queries at {:g} req/s for {:g}s over up to {} connections".format(
+        len(uris), args.rate, args.duration, args.connections))
+    report = IOLoop.current().run_sync(lambda: run_open_loop(
+        "http://{}:{}".format(args.address, args.port), uris, args.rate, args.duration,
+        connections=args.connections, interval=args.interval, headers=headers,
+        on_interval=print_interval))
+    print("Sent:       {}".format(report["sent"]))
+    print("Completed:  {}".format(report["requests"]))
+    print("Errors:     {} ({:0.2f}%)".format(
+        report["errors"], 100.0 * report["errors"] / max(1, report["requests"])))
+    print("Throughput: {:0.1f} requests/s".format(report["rps"]))
+    # latencies are measured from each request's scheduled send time
+    histogram = report["histogram"]
+    for fraction in (0.5, 0.75, 0.9, 0.99, 0.999, 0.9999):
+        print("p{:<9g} {:0.2f} ms".format(100 * fraction, 1000.0 * histogram.percentile(fraction)))
+    print("max        {:0.2f} ms".format(1000.0 * report["max"]))
+    print("mean       {:0.2f} ms".format(1000.0 * report["mean"]))
+
 
 def main():
     # Parse arguments from the command line
@@ -13,30 +65,51 @@ def main():
     parser.add_argument("-a", "--address", default="localhost",
                         help="IP address of the server (default: localhost)")
     parser.add_argument("-p", "--port", default=8080, help="Port of the server (default: 8080)")
-    parser.add_argument("-q", "--query", required=True, help="Query string to geocode, quoted")
+    parser.add_argument("-q", "--query", help="Query string to geocode, quoted")
     parser.add_argument("-s", "--service",
                         help="Primary third party service to use (falls back on other available\
                               services automatically (options: google/here) (default: google)")
     parser.add_argument("-b", "--bounds",
                         help="Bounds for viewport (external service corner ordering: \
                               \"lat,long|lat,long\")")
+    parser.add_argument("-m", "--msgpack", action="store_true",
+                        help="Request a MessagePack encoded response instead of JSON")
+    parser.add_argument("--rate", default=None, type=float,
+                        help="Load test the server by sending this many requests per second, \
+                              regardless of how fast it responds")
+    parser.add_argument("--duration", default=10.0, type=float,
+                        help="Seconds to load test for (default: 10)")
+    parser.add_argument("--corpus", default=None,
+                        help="File of queries to cycle through when load testing, one per line")
+    parser.add_argument("--connections", default=64, type=int,
+                        help="Maximum concurrent connections when load testing (default: 64)")
+    parser.add_argument("--interval", default=1.0, type=float,
+                        help="Seconds between load test progress reports (default: 1)")
     args = parser.parse_args()
 
-    query = "http://{}:{}/geocode?address={}".format(args.address, args.port, args.query)
-    # optionally add bounds
-    if args.bounds:
-        query += "&bounds={}".format(args.bounds)
-    # optionally add primary service
-    if args.service:
-        query += "&service={}".format(args.service)
-    # clean up the query string and remove spaces to properly format request
-    query = query.replace(" ", "+")
+    queries = [args.query] if args.query else []
+    if args.corpus:
+        with open(args.corpus) as corpus_file:
+            queries = [line.strip() for line in corpus_file
+                       if line.strip() and not line.startswith("#")]
+    if not queries:
+        parser.error("a query (-q) or a corpus (--corpus) is required")
+    if args.rate:
+        load_test(args, queries)
+        return
+
+    query = "http://{}:{}{}".format(args.address, args.port,
+                                    build_uri(queries[0], args.service, args.bounds))
 
     print("Sending query: {}".format(query))
 
+    request = urllib.request.Request(query)
+    if args.msgpack:
+        request.add_header("Accept", MSGPACK_CONTENT_TYPE)
+
     response = None
     try:
-        response = urllib.request.urlopen(query, timeout=2).read().decode('utf-8')
+        response = urllib.request.urlopen(request, timeout=2).read()
     except (urllib.error.HTTPError, urllib.error.URLError) as error:
         print("Error in request: {}".format(error))
     except socket.timeout:
@@ -44,7 +117,10 @@ def main():
 
     # if our response succeeds, then parse it and pass the parser back upstream
     if response:
-        response_json = json.loads(response)
+        if args.msgpack:
+            response_json = unpackb(response)
+        else:
+            response_json = json.loads(response.decode('utf-8'))
         print(json.dumps(response_json, indent=4, sort_keys=True))
 
 
@@ -1,14 +1,30 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
 import logging
 import os
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 
 from geoproxy import Geoproxy
+from geoproxy.access_log import configure_logging
 
-logging.basicConfig(
-    format="[%(asctime)s][%(name)s](%(levelname)s) %(message)s", level=logging.DEBUG)
+
+def split_keys(value):
+    """Splits a comma separated list of API keys from the environment
+
+    Args:
+        value (string): Value of the environment variable, None if it is not set
+
+    Returns:
+        None/[string]: Keys in the order given, None if the variable is not set
+
+    """
+    if not value:
+        return None
+    return [key.strip() for key in value.split(",") if key.strip()]
 
 
 def main():
@@ -18,18 +34,257 @@ def main():
                         help="IP address where the service is running (default: localhost)")
     parser.add_argument("-p", "--port", default=8080,
                         help="Port that the service runs on (default: 8080)")
+    parser.add_argument("-t", "--timeout", default=3.0, type=float,
+                        help="Maximum number of seconds to spend servicing a request \
+                              (default: 3.0)")
+    parser.add_argument("-r", "--max-attempts", default=3, type=int,
+                        help="Maximum attempts per third party service on transient errors \
+                              (default: 3)")
+    parser.add_argument("--max-in-flight", default=None, type=int,
+                        help="Maximum concurrent requests before shedding load \
+                              (default: unlimited)")
+    parser.add_argument("--max-queue-wait", default=None, type=float,
+                        help="Maximum seconds work may wait for an executor thread before \
+                              shedding load (default: unlimited)")
+    parser.add_argument("--codel", action="store_true",
+                        help="Apply --max-queue-wait using CoDel-style queue management")
+    parser.add_argument("--bulkhead-size", default=4, type=int,
+                        help="Number of threads reserved for each third party service \
+                              (default: 4)")
+    parser.add_argument("--bulkhead-sizes", default=None,
+                        help="Comma separated per service thread counts overriding \
+                              --bulkhead-size, eg google=8,here=2")
+    parser.add_argument("--bulkhead-queue", default=16, type=int,
+                        help="Requests per third party service that may wait for a thread \
+                              before failing over to the next service (default: 16)")
+    parser.add_argument("--fair-scheduling", action="store_true",
+                        help="Share each third party service's threads between tenants with \
+                              weighted fair queueing")
+    parser.add_argument("--tenant-weights", default=None,
+                        help="Comma separated tenant weights for --fair-scheduling, eg \
+                              search=3,reports=1 (other tenants share a weight of 1), tenants \
+                              are authenticated by the GEOPROXY_TENANT_TOKENS environment \
+                              variable, eg search=token1,reports=token2")
+    parser.add_argument("--timeout-quantile", default=0.99, type=float,
+                        help="Latency quantile that upstream timeouts adapt to (default: 0.99)")
+    parser.add_argument("--timeout-multiplier", default=1.5, type=float,
+                        help="Headroom applied to the latency quantile (default: 1.5)")
+    parser.add_argument("--timeout-floor", default=0.05, type=float,
+                        help="Smallest upstream timeout in seconds (default: 0.05)")
+    parser.add_argument("--timeout-ceiling", default=None, type=float,
+                        help="Largest upstream timeout in seconds (default: --timeout)")
+    parser.add_argument("--batch-services", default=None,
+                        help="Comma separated services to send concurrent queries to as batch \
+                              jobs, eg here (default: none)")
+    parser.add_argument("--batch-window", default=0.01, type=float,
+                        help="Seconds a query may wait for others to join its batch \
+                              (default: 0.01)")
+    parser.add_argument("--batch-size", default=100, type=int,
+                        help="Maximum number of queries per batch job (default: 100)")
+    parser.add_argument("--batch-poll-interval", default=0.1, type=float,
+                        help="Seconds between status queries of a running batch job \
+                              (default: 0.1)")
+    parser.add_argument("--shadow-rate", default=0.0, type=float,
+                        help="Fraction of requests also sent to the other third party services \
+                              in the background, to compare their latency and results \
+                              (default: 0, disabled)")
+    parser.add_argument("--shadow-concurrency", default=2, type=int,
+                        help="Maximum number of shadow queries in flight (default: 2)")
+    parser.add_argument("--region-routing", action="store_true",
+                        help="Order the services of requests with bounds by how they have done \
+                              in the region of the bounds")
+    parser.add_argument("--region-precision", default=4, type=int,
+                        help="Geohash length of the smallest routing regions (default: 4)")
+    parser.add_argument("--region-min-samples", default=20, type=int,
+                        help="Outcomes a service needs in a region before the region orders \
+                              it (default: 20)")
+    parser.add_argument("--region-explore-rate", default=0.05, type=float,
+                        help="Fraction of the routed requests that try another service first, \
+                              so that every service keeps being sampled (default: 0.05)")
+    parser.add_argument("--job-dir", default=None,
+                        help="Directory to store bulk geocoding jobs in, enables /jobs \
+                              (requires the GEOPROXY_ADMIN_TOKEN environment variable, or \
+                              loopback requests)")
+    parser.add_argument("--job-rate", default=10.0, type=float,
+                        help="Maximum number of job lines started per second (default: 10)")
+    parser.add_argument("--job-concurrency", default=4, type=int,
+                        help="Maximum number of job lines resolved concurrently (default: 4)")
+    parser.add_argument("--job-max-jobs", default=20, type=int,
+                        help="Maximum number of jobs stored, uploads included (default: 20)")
+    parser.add_argument("--job-retention", default=7 * 86400, type=float,
+                        help="Seconds a finished job is kept before it is removed \
+                              (default: 604800, 7 days)")
+    parser.add_argument("--ws-max-in-flight", default=64, type=int,
+                        help="Maximum queries resolved concurrently per WebSocket connection \
+                              (default: 64)")
+    parser.add_argument("--consensus-radius", default=250.0, type=float,
+                        help="Maximum distance in meters between agreeing results in consensus \
+                              mode (default: 250)")
+    parser.add_argument("-i", "--local-index", default=None,
+                        help="Path of an offline address index to query before third party \
+                              services (see tools/build_address_index)")
+    parser.add_argument("--centroid-index", default=None,
+                        help="Path of a postal code and locality centroid index, used to answer \
+                              approximately when every service fails (see \
+                              tools/build_centroid_index)")
+    parser.add_argument("--cache-size", default=0, type=int,
+                        help="Maximum number of cached results, eg 10000, 0 to disable \
+                              (default: 0, disabled)")
+    parser.add_argument("--fuzzy-threshold", default=None, type=float,
+                        help="Answer cache misses from cached queries at least this similar, \
+                              between 0 and 1, eg 0.8 (default: disabled)")
+    parser.add_argument("--shared-cache", default=None,
+                        help="Path of a cache file shared by the worker processes of the host, \
+                              eg /dev/shm/geoproxy.cache")
+    parser.add_argument("--shared-cache-slot-size", default=512, type=int,
+                        help="Bytes per result in the shared cache, larger results are not \
+                              cached (default: 512)")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of worker processes serving the port, 0 for one per CPU \
+                              (default: 1)")
+    parser.add_argument("--peers", default=None,
+                        help="Comma separated base URLs of every node in the cluster to share \
+                              the cache with, eg http://localhost:8080,http://localhost:8081 \
+                              (requires the GEOPROXY_PEER_TOKEN environment variable)")
+    parser.add_argument("--self-url", default=None,
+                        help="Base URL of this node as it appears in --peers \
+                              (default: http://address:port)")
+    parser.add_argument("--record", default=None,
+                        help="Record requests and third party traffic to a trace file \
+                              (see tools/replay)")
+    parser.add_argument("--google-url", default=None,
+                        help="Alternative Google Maps geocoding endpoint, eg a replay stub")
+    parser.add_argument("--here-url", default=None,
+                        help="Alternative Here geocoding endpoint, eg a replay stub")
+    parser.add_argument("--here-batch-url", default=None,
+                        help="Alternative Here batch geocoding jobs endpoint, eg a stub")
+    parser.add_argument("--google-key-weights", default=None,
+                        help="Comma separated share of the Google queries sent with each key of \
+                              GOOGLE_MAPS_API_KEY, eg their quotas (default: equal shares)")
+    parser.add_argument("--here-key-weights", default=None,
+                        help="Comma separated share of the Here queries sent with each app of \
+                              HERE_API_APP_ID (default: equal shares)")
+    parser.add_argument("--key-cooldown", default=1.0, type=float,
+                        help="Seconds an API key is out of rotation after it is rate limited, \
+                              doubled for each consecutive error (default: 1.0)")
+    parser.add_argument("--profiling", action="store_true",
+                        help="Serve the CPU and memory profiling endpoints under /admin/profile \
+                              (requires the GEOPROXY_ADMIN_TOKEN environment variable, or \
+                              loopback requests)")
+    parser.add_argument("--uvloop", action="store_true",
+                        help="Run the event loop on uvloop (requires pip install uvloop)")
+    parser.add_argument("--log-level", default="DEBUG",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging level (default: DEBUG)")
+    parser.add_argument("--debug-sample-rate", default=1.0, type=float,
+                        help="Fraction of debug log lines to keep, between 0 and 1 (default: 1.0)")
     args = parser.parse_args()
 
-    google_maps_api_key = os.environ.get('GOOGLE_MAPS_API_KEY')
-    here_api_app_id = os.environ.get('HERE_API_APP_ID')
-    here_api_app_code = os.environ.get('HERE_API_APP_CODE')
+    if args.uvloop:
+        # the policy must be installed before tornado creates its event loop
+        try:
+            import uvloop
+        except ImportError:
+            print("Failed to start server: --uvloop requires the uvloop package")
+            return
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    if args.cache_size <= 0 and (args.fuzzy_threshold or args.shared_cache or args.peers):
+        print("Failed to start server: --fuzzy-threshold, --shared-cache and --peers need "
+              "--cache-size")
+        return
+
+    sockets = None
+    if args.workers != 1:
+        if args.record or args.job_dir:
+            print("Failed to start server: --record and --job-dir need a single worker")
+            return
+        # bind before forking so that every worker accepts connections on the same sockets,
+        # and fork before any threads or event loops are started
+        sockets = bind_sockets(args.port, address=args.address)
+        fork_processes(args.workers)
+
+    bulkhead_sizes = {}
+    if args.bulkhead_sizes:
+        for entry in args.bulkhead_sizes.split(","):
+            service, _, size = entry.partition("=")
+            bulkhead_sizes[service.strip()] = int(size)
+    tenant_weights = {}
+    if args.tenant_weights:
+        for entry in args.tenant_weights.split(","):
+            tenant, _, weight = entry.partition("=")
+            tenant_weights[tenant.strip()] = float(weight)
+    # the tenants' tokens are secrets, so they are read from the environment, eg
+    # GEOPROXY_TENANT_TOKENS=search=token1,reports=token2
+    tenant_tokens = {}
+    for entry in split_keys(os.environ.get('GEOPROXY_TENANT_TOKENS')) or []:
+        tenant, _, token = entry.partition("=")
+        if token:
+            tenant_tokens[token.strip()] = tenant.strip()
+
+    # write logs from a background thread so the ioloop never blocks on them
+    log_listener = configure_logging(level=getattr(logging, args.log_level),
+                                     debug_sample_rate=args.debug_sample_rate)
+
+    # comma separated lists of keys are rotated between
+    google_maps_api_key = split_keys(os.environ.get('GOOGLE_MAPS_API_KEY'))
+    here_api_app_id = split_keys(os.environ.get('HERE_API_APP_ID'))
+    here_api_app_code = split_keys(os.environ.get('HERE_API_APP_CODE'))
 
     # Create server object and tell it to listen on the desired port
     try:
         geo_proxy = Geoproxy(args.address, args.port, google_maps_api_key,
-                             here_api_app_id, here_api_app_code)
+                             here_api_app_id, here_api_app_code,
+                             request_timeout=args.timeout, max_attempts=args.max_attempts,
+                             max_in_flight=args.max_in_flight, max_queue_wait=args.max_queue_wait,
+                             codel=args.codel, local_index_path=args.local_index,
+                             cache_size=args.cache_size,
+                             peers=args.peers.split(",") if args.peers else None,
+                             self_url=args.self_url,
+                             peer_token=os.environ.get('GEOPROXY_PEER_TOKEN'),
+                             service_urls={"google": args.google_url, "here": args.here_url,
+                                           "here_batch": args.here_batch_url},
+                             trace_path=args.record,
+                             websocket_max_in_flight=args.ws_max_in_flight,
+                             consensus_radius=args.consensus_radius,
+                             profiling=args.profiling,
+                             admin_token=os.environ.get('GEOPROXY_ADMIN_TOKEN'),
+                             bulkhead_size=args.bulkhead_size, bulkhead_sizes=bulkhead_sizes,
+                             bulkhead_queue=args.bulkhead_queue,
+                             fair_scheduling=args.fair_scheduling,
+                             tenant_weights=tenant_weights, tenant_tokens=tenant_tokens,
+                             timeout_quantile=args.timeout_quantile,
+                             timeout_multiplier=args.timeout_multiplier,
+                             timeout_floor=args.timeout_floor,
+                             timeout_ceiling=args.timeout_ceiling,
+                             batch_services=(args.batch_services.split(",")
+                                             if args.batch_services else None),
+                             batch_window=args.batch_window, batch_size=args.batch_size,
+                             batch_poll_interval=args.batch_poll_interval,
+                             shadow_rate=args.shadow_rate,
+                             shadow_concurrency=args.shadow_concurrency,
+                             region_routing=args.region_routing,
+                             region_precision=args.region_precision,
+                             region_min_samples=args.region_min_samples,
+                             region_explore_rate=args.region_explore_rate,
+                             job_dir=args.job_dir, job_rate=args.job_rate,
+                             job_concurrency=args.job_concurrency,
+                             job_max_jobs=args.job_max_jobs,
+                             job_retention=args.job_retention,
+                             centroid_index_path=args.centroid_index,
+                             google_key_weights=(
+                                 [float(weight) for weight in args.google_key_weights.split(",")]
+                                 if args.google_key_weights else None),
+                             here_key_weights=(
+                                 [float(weight) for weight in args.here_key_weights.split(",")]
+                                 if args.here_key_weights else None),
+                             key_cooldown=args.key_cooldown,
+                             shared_cache_path=args.shared_cache,
+                             shared_cache_slot_size=args.shared_cache_slot_size,
+                             sockets=sockets, fuzzy_threshold=args.fuzzy_threshold)
     except Exception as e:
         print("Failed to start server: {}".format(e))
+        log_listener.stop()
         return
 
     try:
@@ -38,6 +293,11 @@ def main():
     except KeyboardInterrupt:
         # ensure that the event loop stops cleanly on interrupt
         IOLoop.instance().stop()
+    finally:
+        if geo_proxy.recorder is not None:
+            geo_proxy.recorder.close()
+        # flush any queued log records
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -1,51 +1,360 @@
 #!/usr/bin/env python
 
-from concurrent.futures import ThreadPoolExecutor
 import logging
+from tornado.httpserver import HTTPServer
 import tornado.web
 
+from geoproxy.access_log import log_request
+from geoproxy.admission import AdmissionController
+from geoproxy.bulkhead import Bulkheads
+from geoproxy.cache import ResultCache
+from geoproxy.centroids import CentroidIndex
+from geoproxy.deadline import RetryPolicy
+from geoproxy.fuzzy import FuzzyIndex
+from geoproxy.handlers.admin import CpuProfileRequestHandler
+from geoproxy.handlers.admin import MemoryProfileRequestHandler
+from geoproxy.handlers.admin import StatsRequestHandler
+from geoproxy.handlers.cache_request import CacheRequestHandler
 from geoproxy.handlers.geoproxy_request import GeoproxyRequestHandler
+from geoproxy.handlers.geoproxy_websocket import GeoproxyWebSocketHandler
+from geoproxy.handlers.jobs import JobRequestHandler
+from geoproxy.handlers.jobs import JobResultsRequestHandler
+from geoproxy.handlers.jobs import JobsRequestHandler
+from geoproxy.jobs import JobQueue
+from geoproxy.jobs import JobStore
+from geoproxy.latency import AdaptiveTimeout
+from geoproxy.peer_cache import PeerCache
+from geoproxy.profiling import MemoryProfiler
+from geoproxy.replay import TraceRecorder
+from geoproxy.resolver import GeoproxyResolver
+from geoproxy.routing import RegionRouter
+from geoproxy.shadow import ShadowTraffic
+from geoproxy.shared_cache import SharedResultCache
 from geoproxy.third_party_services.google_maps import GoogleMapsServiceHelper
 from geoproxy.third_party_services.here import HereServiceHelper
+from geoproxy.third_party_services.local import LocalServiceHelper
 
 
 class Geoproxy(tornado.web.Application):
     """Main tornado web application servicing request handlers
 
     Simple wrapper for tornado.web.Application, packages additional member items such as
-    a logger instance and a thread pool executor for coroutines. Establishes a HTTP request
-    handler for "/geocode" GET commands and sets up the handler class.
+    a logger instance and a thread pool per remote service. Establishes a HTTP request
+    handler for "/geocode" GET commands, and a WebSocket handler on "/geocode/ws" for clients
+    that stream many queries over one connection; both resolve requests through the same
+    GeoproxyResolver. When a job directory is configured, files of addresses posted to "/jobs"
+    are geocoded in the background (see JobQueue). Each completed request is reported as one
+    structured line on the "geoproxy.access" logger, and operational statistics are served on
+    "/stats".
+
+    Several worker processes can serve the same port from sockets bound before forking, in
+    which case a shared cache file lets them share their cached results (see
+    SharedResultCache).
 
     Attributes:
         logger (logging.logger): Logging instance
-        executor (ThreadPoolExecutor): Thread pool for coroutines
+        bulkheads (Bulkheads): Thread pools for third party requests, one per remote service
+        timeouts (dict): Map from remote service name to its AdaptiveTimeout
+        admission (AdmissionController): Load shedding policy shared by request handlers
+        cache (ResultCache/SharedResultCache): Cache of resolved results, None if caching is
+                                               disabled
+        peer_cache (PeerCache): Cluster cache layer, None if the node has no peers
+        recorder (TraceRecorder): Records requests and third party traffic, None if disabled
+        shadow (ShadowTraffic): Shadow query sampler, None if shadow mode is disabled
+        router (RegionRouter): Per region service statistics, None if routing is disabled
+        resolver (GeoproxyResolver): Resolves requests through the cache and the services
+        job_queue (JobQueue): Bulk geocoding jobs, None if no job directory is configured
 
     """
 
-    def __init__(self, address, port, google_maps_api_key, here_api_app_id, here_api_app_code):
+    def __init__(self, address, port, google_maps_api_key, here_api_app_id, here_api_app_code,
+                 request_timeout=3.0, max_attempts=3, max_in_flight=None, max_queue_wait=None,
+                 codel=False, retry_after=1, local_index_path=None, cache_size=0,
+                 cache_ttl=86400, peers=None, self_url=None, peer_replica_size=1024,
+                 peer_timeout=0.05, peer_token=None, service_urls=None, trace_path=None,
+                 websocket_max_in_flight=64, consensus_radius=250.0, profiling=False,
+                 admin_token=None, bulkhead_size=4, bulkhead_sizes=None, bulkhead_queue=16,
+                 timeout_quantile=0.99, timeout_multiplier=1.5, timeout_floor=0.05,
+                 timeout_ceiling=None, batch_services=None, batch_window=0.01, batch_size=100,
+                 batch_poll_interval=0.1, fair_scheduling=False, tenant_weights=None,
+                 tenant_tokens=None,
+                 shadow_rate=0.0, shadow_concurrency=2, region_routing=False,
+                 region_precision=4, region_min_samples=20, region_explore_rate=0.05,
+                 job_dir=None, job_rate=10.0,
+                 job_concurrency=4, job_max_size=4 << 30, job_max_jobs=20,
+                 job_retention=7 * 86400, centroid_index_path=None,
+                 google_key_weights=None, here_key_weights=None, key_cooldown=1.0,
+                 shared_cache_path=None, shared_cache_slot_size=512, sockets=None,
+                 fuzzy_threshold=None):
         """Constructor for application
 
         Args:
             address (string): IP address for the tcp socket to bind to
-            port (int): Port for the service to bind to
-            google_maps_api_key (string): Google maps geocoder api key
-            here_api_app_id (string): Here geocoder app id
-            here_api_app_code (string): Here geocoder app code
+            port (int): Port for the service to bind to, unused if sockets are given
+            google_maps_api_key (string/[string]): Google maps geocoder api key, or a list of
+                                                   keys to rotate between
+            here_api_app_id (string/[string]): Here geocoder app id, or a list of app ids to
+                                               rotate between
+            here_api_app_code (string/[string]): Here geocoder app code, or a list with the
+                                                 app code of each app id
+            request_timeout (float): Maximum number of seconds to spend servicing a request
+            max_attempts (int): Maximum number of attempts per third party service when
+                                transient errors occur
+            max_in_flight (int): Maximum number of concurrent requests before shedding load,
+                                 None for unlimited
+            max_queue_wait (float): Maximum number of seconds work may wait for an executor
+                                    thread before shedding load, None for unlimited
+            codel (bool): Apply max_queue_wait using CoDel-style queue management
+            retry_after (int): Seconds that shed clients are asked to wait before retrying
+            local_index_path (string): Path of an offline address index, which is queried
+                                       before any third party service when provided
+            cache_size (int): Maximum number of results cached, 0 to disable caching
+            cache_ttl (float): Number of seconds a cached result remains valid
+            peers ([string]): Base URLs of every node in the cluster to share the cache with,
+                              eg ["http://10.0.0.1:8080", "http://10.0.0.2:8080"]
+            self_url (string): Base URL of this node as it appears in peers, defaults to
+                               http://address:port
+            peer_replica_size (int): Maximum number of results kept locally for keys owned by
+                                     other nodes
+            peer_timeout (float): Seconds to wait for a peer before going upstream
+            peer_token (string): Shared secret required on cache requests between peers, the
+                                 cache is not shared without one
+            service_urls (dict): Map from service name to an alternative geocoding endpoint,
+                                 eg to point the proxy at a stub upstream, "here_batch" sets
+                                 the Here batch jobs endpoint
+            trace_path (string): Path of a trace file to record requests and third party
+                                 traffic to, None to disable recording
+            websocket_max_in_flight (int): Maximum number of queries resolved concurrently on
+                                           a single WebSocket connection
+            consensus_radius (float): Maximum distance in meters between two results that
+                                      agree, for requests in consensus mode
+            profiling (bool): Serve the CPU and memory profiling endpoints under
+                              "/admin/profile"
+            admin_token (string): Shared secret required on admin requests (profiling and
+                                  statistics), None to only accept admin requests from the
+                                  loopback interface
+            bulkhead_size (int): Number of threads reserved for each remote service
+            bulkhead_sizes (dict): Map from service name to its number of threads, overriding
+                                   bulkhead_size
+            bulkhead_queue (int): Number of requests per remote service that may wait for a
+                                  thread, further requests fail over to the next service
+            timeout_quantile (float): Latency quantile that upstream timeouts adapt to
+            timeout_multiplier (float): Headroom applied to the latency quantile
+            timeout_floor (float): Smallest upstream timeout in seconds
+            timeout_ceiling (float): Largest upstream timeout in seconds, defaults to
+                                     request_timeout
+            batch_services ([string]): Services to send concurrent queries to as batch jobs,
+                                       only services with a batch API (here) are supported
+            batch_window (float): Seconds that a query may wait for others to join its batch
+            batch_size (int): Maximum number of queries per batch job
+            batch_poll_interval (float): Seconds between status queries of a running batch job
+            fair_scheduling (bool): Share each remote service's threads between tenants with
+                                    weighted fair queueing, instead of first come, first served
+            tenant_weights (dict): Map from tenant name to its share of the threads, eg
+                                   {"search": 3, "reports": 1}, other tenants share the
+                                   "default" tenant with a weight of 1
+            tenant_tokens (dict): Map from a client token, sent in the X-Geoproxy-Tenant-Token
+                                  header, to the tenant it authenticates; requests without a
+                                  known token are scheduled as the default tenant in the bulk
+                                  lane
+            shadow_rate (float): Fraction of the requests answered by a remote service that
+                                 are also sent to the other remote services in the
+                                 background, to compare the services, 0 to disable
+            shadow_concurrency (int): Maximum number of shadow queries in flight, further
+                                      sampled queries are dropped
+            region_routing (bool): Order the services of requests with bounds by how they
+                                   have done in the region of the bounds
+            region_precision (int): Geohash length of the smallest regions, eg 4 for
+                                    regions of about 39km by 20km
+            region_min_samples (int): Outcomes a service needs in a region before the region
+                                      orders it
+            region_explore_rate (float): Fraction of the routed requests that try another
+                                         service first, so that every service keeps being
+                                         sampled
+            job_dir (string): Directory to store bulk geocoding jobs in, None to disable
+                              "/jobs"
+            job_rate (float): Maximum number of job lines started per second
+            job_concurrency (int): Maximum number of job lines resolved concurrently
+            job_max_size (int): Maximum size of a job's input file in bytes
+            job_max_jobs (int): Maximum number of jobs stored, further uploads are rejected
+            job_retention (float): Number of seconds a finished job is kept
+            centroid_index_path (string): Path of a postal code and locality centroid index,
+                                          used to answer approximately when every service
+                                          fails, None to return an error instead
+            google_key_weights ([float]): Relative share of the Google queries sent with each
+                                          key, eg the keys' quotas, equal shares if None
+            here_key_weights ([float]): Relative share of the Here queries sent with each app,
+                                        equal shares if None
+            key_cooldown (float): Seconds a key is out of rotation after it is first rate
+                                  limited, doubled for each consecutive rate limiting error
+            shared_cache_path (string): Path of a cache file shared with the other worker
+                                        processes of the host, eg on /dev/shm, holding
+                                        cache_size results, None for a cache of this process
+            shared_cache_slot_size (int): Bytes per result in the shared cache, larger results
+                                          are not cached
+            sockets ([socket]): Listening sockets to serve, eg bound before forking worker
+                                processes (see tornado.netutil.bind_sockets), None to bind
+                                address and port
+            fuzzy_threshold (float): Lowest similarity, between 0 and 1, at which a cache miss
+                                     is answered from the result of a similar cached query
+                                     with the same numbers, None to disable fuzzy lookups
 
         """
         self.logger = logging.getLogger("Geoproxy")
-        self.executor = ThreadPoolExecutor(max_workers=4)
-        available_services = {"google": GoogleMapsServiceHelper(google_maps_api_key),
-                              "here": HereServiceHelper(here_api_app_id, here_api_app_code)}
+        available_services = {}
+        if local_index_path:
+            # the offline index is free and fast, so it goes first in the default service order
+            available_services["local"] = LocalServiceHelper(local_index_path)
+        service_urls = service_urls or {}
+        available_services["google"] = GoogleMapsServiceHelper(
+            google_maps_api_key, service_urls.get("google"), key_weights=google_key_weights,
+            key_cooldown=key_cooldown)
+        available_services["here"] = HereServiceHelper(
+            here_api_app_id, here_api_app_code, service_urls.get("here"),
+            service_urls.get("here_batch"), key_weights=here_key_weights,
+            key_cooldown=key_cooldown)
+        self.bulkheads = Bulkheads([service for service, helper in available_services.items()
+                                    if helper.is_remote], size=bulkhead_size,
+                                   sizes=bulkhead_sizes, max_queue=bulkhead_queue,
+                                   fair=fair_scheduling, tenant_weights=tenant_weights)
+        self.timeouts = {service: AdaptiveTimeout(timeout_quantile, timeout_multiplier,
+                                                  timeout_floor, timeout_ceiling or request_timeout)
+                         for service, helper in available_services.items() if helper.is_remote}
+        # the queue wait limit applies to the longest queue of any service
+        self.admission = AdmissionController(self.bulkheads, max_in_flight=max_in_flight,
+                                             max_queue_wait=max_queue_wait, codel=codel,
+                                             retry_after=retry_after)
+        self.recorder = TraceRecorder(trace_path) if trace_path else None
+        self.cache = None
+        if cache_size > 0:
+            self.cache = (SharedResultCache(shared_cache_path, cache_size,
+                                            slot_size=shared_cache_slot_size, ttl=cache_ttl)
+                          if shared_cache_path else ResultCache(cache_size, cache_ttl))
+        self.shadow = None
+        if shadow_rate > 0:
+            self.shadow = ShadowTraffic(shadow_rate, concurrency=shadow_concurrency,
+                                        timeout=timeout_ceiling or request_timeout,
+                                        radius=consensus_radius)
+        self.router = None
+        if region_routing:
+            self.router = RegionRouter(precision=region_precision,
+                                       min_samples=region_min_samples,
+                                       explore_rate=region_explore_rate)
+        self.peer_cache = None
+        if peers and self.cache is not None and not peer_token:
+            self.logger.warning("Sharing the cache with peers requires a peer token, disabled")
+        elif peers and self.cache is not None:
+            self.peer_cache = PeerCache(self_url or "http://{}:{}".format(address, port), peers,
+                                        self.cache, replica_size=peer_replica_size,
+                                        ttl=cache_ttl, timeout=peer_timeout, token=peer_token)
+        self.resolver = GeoproxyResolver(self.logger, self.bulkheads, available_services,
+                                         retry_policy=RetryPolicy(max_attempts),
+                                         cache=self.cache, peer_cache=self.peer_cache,
+                                         recorder=self.recorder,
+                                         consensus_radius=consensus_radius,
+                                         timeouts=self.timeouts,
+                                         batch_services=batch_services,
+                                         batch_window=batch_window, batch_size=batch_size,
+                                         batch_timeout=request_timeout,
+                                         batch_poll_interval=batch_poll_interval,
+                                         shadow=self.shadow, router=self.router,
+                                         centroids=(CentroidIndex(centroid_index_path)
+                                                    if centroid_index_path else None),
+                                         fuzzy=(FuzzyIndex(fuzzy_threshold, cache_size)
+                                                if fuzzy_threshold and self.cache is not None
+                                                else None))
         handlers = [
             # (r"/", IndexHandler, dict()),
             (r"/geocode", GeoproxyRequestHandler, dict(logger=self.logger,
-                                                       executor=self.executor,
-                                                       available_services=available_services))
+                                                       resolver=self.resolver,
+                                                       request_timeout=request_timeout,
+                                                       admission=self.admission,
+                                                       recorder=self.recorder,
+                                                       tenant_tokens=tenant_tokens)),
+            (r"/geocode/ws", GeoproxyWebSocketHandler,
+             dict(logger=self.logger, resolver=self.resolver, request_timeout=request_timeout,
+                  admission=self.admission, max_in_flight=websocket_max_in_flight,
+                  tenant_tokens=tenant_tokens)),
+            (r"/stats", StatsRequestHandler, dict(stats=self.stats, token=admin_token)),
         ]
-        super(Geoproxy, self).__init__(handlers)
-        self.logger.info("Geoproxy listening on {}:{}".format(address, port))
-        self.listen(port, address=address)
+        self.job_queue = None
+        if job_dir:
+            self.job_queue = JobQueue(JobStore(job_dir), self.resolver, rate=job_rate,
+                                      concurrency=job_concurrency, max_jobs=job_max_jobs,
+                                      retention=job_retention,
+                                      request_timeout=request_timeout)
+            handlers.extend([
+                (r"/jobs", JobsRequestHandler, dict(logger=self.logger, job_queue=self.job_queue,
+                                                    max_size=job_max_size,
+                                                    token=admin_token)),
+                (r"/jobs/([0-9a-f]+)", JobRequestHandler,
+                 dict(job_queue=self.job_queue, token=admin_token)),
+                (r"/jobs/([0-9a-f]+)/results", JobResultsRequestHandler,
+                 dict(job_queue=self.job_queue, token=admin_token)),
+            ])
+            self.job_queue.start()
+        if self.peer_cache is not None:
+            # serve the entries this node owns to the rest of the cluster
+            handlers.append((PeerCache.CACHE_PATH, CacheRequestHandler,
+                             dict(cache=self.cache, token=peer_token)))
+        if profiling:
+            # operator only endpoints, not registered at all unless asked for
+            handlers.append((r"/admin/profile/cpu", CpuProfileRequestHandler,
+                             dict(token=admin_token)))
+            handlers.append((r"/admin/profile/memory", MemoryProfileRequestHandler,
+                             dict(memory_profiler=MemoryProfiler(), token=admin_token)))
+        # replace tornado's access log with a single structured line per request
+        super(Geoproxy, self).__init__(handlers, log_function=log_request)
+        if sockets is not None:
+            HTTPServer(self).add_sockets(sockets)
+            self.logger.info("Geoproxy listening on %s",
+                             ", ".join(str(sock.getsockname()) for sock in sockets))
+        else:
+            self.logger.info("Geoproxy listening on %s:%s", address, port)
+            self.listen(port, address=address)
+
+    def stats(self):
+        """Collects operational statistics, served on "/stats"
+
+        Returns:
+            dict: Statistics of the admission controller, the bulkheads, the upstream timeouts,
+                  the API keys, the batchers, shadow mode, the router, the job queue, the
+                  centroid index, the fuzzy index and the cache
+
+        """
+        stats = {
+            "admission": {"in_flight": self.admission.in_flight,
+                          "rejected": self.admission.rejected},
+            "bulkheads": self.bulkheads.stats(),
+            "timeouts": {service: timeout.stats() for service, timeout in self.timeouts.items()},
+            "keys": {service: helper.key_pool.stats()
+                     for service, helper in self.resolver.available_services.items()
+                     if helper.key_pool is not None},
+        }
+        if self.resolver.batchers:
+            stats["batchers"] = {service: batcher.stats()
+                                 for service, batcher in self.resolver.batchers.items()}
+        if self.shadow is not None:
+            stats["shadow"] = self.shadow.stats()
+        if self.router is not None:
+            stats["routing"] = self.router.stats()
+        if self.job_queue is not None:
+            stats["jobs"] = self.job_queue.stats()
+        if self.resolver.centroids is not None:
+            stats["centroids"] = {"size": len(self.resolver.centroids),
+                                  "approximations": self.resolver.approximations}
+        if self.resolver.fuzzy is not None:
+            stats["fuzzy"] = {"size": len(self.resolver.fuzzy),
+                              "threshold": self.resolver.fuzzy.threshold,
+                              "hits": self.resolver.fuzzy_hits}
+        if self.cache is not None:
+            stats["cache"] = {"size": len(self.cache), "hits": self.cache.hits,
+                              "misses": self.cache.misses}
+            if isinstance(self.cache, SharedResultCache):
+                # the counters are this worker's, the size is the whole host's
+                stats["cache"].update(capacity=self.cache.slots, evictions=self.cache.evictions,
+                                      oversize=self.cache.oversize)
+        return stats
 
     def __del__(self):
         """Deconstructor
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""Collection of helpers for logging off the IOLoop thread
+
+Log records are handed to a bounded in-memory queue and written by a background listener
+thread, so that slow log sinks never stall request handling. Each completed request produces a
+single compact, structured (logfmt style key=value) line on the "geoproxy.access" logger.
+
+"""
+
+import logging
+import logging.handlers
+import queue
+import random
+
+
+# logger used for the one line per request access log
+access_logger = logging.getLogger("geoproxy.access")
+
+# types that are safe to hand across threads without formatting them first
+_IMMUTABLE_TYPES = (str, int, float, bool, type(None))
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that defers message formatting to the listener thread
+
+    The standard QueueHandler formats every record before enqueueing it, which keeps the
+    formatting cost on the calling (IOLoop) thread. This handler only converts mutable
+    arguments to strings, and leaves the actual %-formatting to the listener. If the queue is
+    full, the record is dropped and counted rather than blocking the caller.
+
+    Attributes:
+        dropped (int): Number of records dropped because the queue was full
+
+    """
+
+    def __init__(self, log_queue):
+        """Constructor for the handler
+
+        Args:
+            log_queue (queue.Queue): Queue shared with the QueueListener
+
+        """
+        super(NonBlockingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Readies a record for crossing threads without formatting its message
+
+        Args:
+            record (logging.LogRecord): Record to be enqueued
+
+        Returns:
+            logging.LogRecord: Record safe to be formatted on another thread
+
+        """
+        if isinstance(record.args, tuple):
+            record.args = tuple(arg if isinstance(arg, _IMMUTABLE_TYPES) else str(arg)
+                                for arg in record.args)
+        if record.exc_info:
+            # tracebacks reference live frames, render them while they are still valid
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        """Enqueues a record without blocking, dropping it if the queue is full
+
+        Args:
+            record (logging.LogRecord): Record to be enqueued
+
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """Filter that passes only a fraction of low severity records
+
+    Records at or below the sampled level are passed with probability rate, everything more
+    severe is always passed. Used to keep high-volume debug lines affordable in production.
+
+    Attributes:
+        rate (float): Fraction of sampled records to keep, between 0 and 1
+        level (int): Most severe logging level that is subject to sampling
+
+    """
+
+    def __init__(self, rate, level=logging.DEBUG):
+        """Constructor for the filter
+
+        Args:
+            rate (float): Fraction of sampled records to keep, between 0 and 1
+            level (int): Most severe logging level that is subject to sampling
+
+        """
+        super(SamplingFilter, self).__init__()
+        self.rate = min(1.0, max(0.0, float(rate)))
+        self.level = level
+
+    def filter(self, record):
+        """Decides if a record should be logged
+
+        Args:
+            record (logging.LogRecord): Record to be checked
+
+        Returns:
+            bool: If the record should be logged
+
+        """
+        if record.levelno > self.level or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+def configure_logging(level=logging.INFO, fmt=None, debug_sample_rate=1.0, max_queue_size=10000,
+                      handlers=None):
+    """Routes all logging through a queue serviced by a background writer thread
+
+    Replaces the handlers of the root logger with a single NonBlockingQueueHandler, and starts a
+    QueueListener that writes records to the given handlers (stderr by default).
+
+    Args:
+        level (int): Root logging level
+        fmt (string): Log format string used by the default handler
+        debug_sample_rate (float): Fraction of debug records to keep, between 0 and 1
+        max_queue_size (int): Maximum number of records buffered before dropping
+        handlers ([logging.Handler]): Handlers used by the background writer
+
+    Returns:
+        logging.handlers.QueueListener: Started listener, stop() it to flush on shutdown
+
+    """
+    if handlers is None:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(
+            fmt or "[%(asctime)s][%(name)s](%(levelname)s) %(message)s"))
+        handlers = [stream_handler]
+    log_queue = queue.Queue(maxsize=max_queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    if debug_sample_rate < 1.0:
+        queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def log_request(handler):
+    """Writes a single structured access log line for a completed request
+
+    Used as the tornado application's log_function, which replaces tornado's own access log.
+    Handlers that service geocode requests may expose a geo_proxy_response and the name of the
+    service that produced the result, which are included when available.
+
+    Args:
+        handler (tornado.web.RequestHandler): Handler that serviced the request
+
+    """
+    status_code = handler.get_status()
+    if status_code < 400:
+        log_method = access_logger.info
+        level = logging.INFO
+    elif status_code < 500:
+        log_method = access_logger.warning
+        level = logging.WARNING
+    else:
+        log_method = access_logger.error
+        level = logging.ERROR
+    if not access_logger.isEnabledFor(level):
+        return
+    request = handler.request
+    geo_proxy_response = getattr(handler, "geo_proxy_response", None)
+    if geo_proxy_response is not None:
+        status = geo_proxy_response.status
+        source = geo_proxy_response.result['source'] if geo_proxy_response.result else None
+    else:
+        status = source = None
+    log_method("method=%s path=%s code=%d status=%s source=%s attempts=%d duration_ms=%.1f "
+               "remote=%s", request.method, request.path, status_code, status, source,
+               getattr(handler, "attempts", 0), 1000.0 * request.request_time(),
+               request.remote_ip)
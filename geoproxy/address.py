@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""Collection of helpers for working with free-form address strings
+"""
+
+import re
+
+# anything that is not a letter, digit or whitespace is treated as a separator
+_PUNCTUATION = re.compile(r"[^\w\s]+", re.UNICODE)
+
+
+def normalize_address(address):
+    """Reduces an address string to a canonical form suitable for use as a lookup key
+
+    The normalized form is lowercase, treats "+" (used by geoproxy in place of spaces) and
+    punctuation as whitespace, and collapses runs of whitespace into single spaces, eg:
+    "350 5th Ave,+New York" -> "350 5th ave new york"
+
+    Args:
+        address (string): Free-form address string
+
+    Returns:
+        string: Normalized address
+
+    """
+    address = address.replace("+", " ").lower()
+    address = _PUNCTUATION.sub(" ", address).replace("_", " ")
+    return " ".join(address.split())
+
+# spelled out words and their usual abbreviations, as in USPS Publication 28
+ABBREVIATIONS = {
+    # street suffixes
+    "alley": "aly", "avenue": "ave", "av": "ave", "boulevard": "blvd", "circle": "cir",
+    "court": "ct", "drive": "dr", "expressway": "expy", "freeway": "fwy", "highway": "hwy",
+    "lane": "ln", "parkway": "pkwy", "place": "pl", "plaza": "plz", "road": "rd",
+    "square": "sq", "street": "st", "terrace": "ter", "trail": "trl",
+    # directions
+    "north": "n", "south": "s", "east": "e", "west": "w", "northeast": "ne",
+    "northwest": "nw", "southeast": "se", "southwest": "sw",
+    # ordinals
+    "first": "1st", "second": "2nd", "third": "3rd", "fourth": "4th", "fifth": "5th",
+    "sixth": "6th", "seventh": "7th", "eighth": "8th", "ninth": "9th", "tenth": "10th",
+    # units and places
+    "apartment": "apt", "building": "bldg", "floor": "fl", "suite": "ste", "fort": "ft",
+    "mount": "mt", "usa": "us",
+}
+# abbreviated street suffixes and directions, the words that delimit and qualify a street name
+STREET_SUFFIXES = frozenset(["aly", "ave", "blvd", "cir", "ct", "dr", "expy", "fwy", "hwy", "ln",
+                             "pkwy", "pl", "plz", "rd", "sq", "st", "ter", "trl"])
+DIRECTIONS = frozenset(["n", "s", "e", "w", "ne", "nw", "se", "sw"])
+# multi word names and their abbreviations, eg US states (single word state names are left
+# alone, as they are also common street names, eg "Washington St")
+PHRASE_ABBREVIATIONS = {
+    ("new", "york"): "ny", ("new", "jersey"): "nj", ("new", "mexico"): "nm",
+    ("new", "hampshire"): "nh", ("north", "carolina"): "nc", ("south", "carolina"): "sc",
+    ("north", "dakota"): "nd", ("south", "dakota"): "sd", ("west", "virginia"): "wv",
+    ("rhode", "island"): "ri", ("district", "of", "columbia"): "dc",
+    ("united", "states"): "us", ("united", "states", "of", "america"): "us",
+}
+# longest phrase in PHRASE_ABBREVIATIONS
+_LONGEST_PHRASE = max(len(phrase) for phrase in PHRASE_ABBREVIATIONS)
+
+
+def canonicalize_address(address):
+    """Reduces an address string to a canonical form that is independent of abbreviations
+
+    The address is normalized (see normalize_address), spelled out words that have a usual
+    abbreviation are abbreviated (longest phrases first, eg "new york" -> "ny",
+    "fifth avenue" -> "5th ave"), and repeated words are collapsed, eg:
+    "350 Fifth Avenue, New York, NY" -> "350 5th ave ny"
+
+    Args:
+        address (string): Free-form address string
+
+    Returns:
+        string: Canonical address
+
+    """
+    words = normalize_address(address).split()
+    canonical = []
+    index = 0
+    while index < len(words):
+        for length in range(min(_LONGEST_PHRASE, len(words) - index), 0, -1):
+            word = PHRASE_ABBREVIATIONS.get(tuple(words[index:index + length]))
+            if word is not None:
+                index += length
+                break
+        else:
+            word = ABBREVIATIONS.get(words[index], words[index])
+            index += 1
+        if not canonical or canonical[-1] != word:
+            canonical.append(word)
+    return " ".join(canonical)
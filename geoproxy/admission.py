@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to shed load when the proxy is overloaded
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+import time
+
+
+class MonitoredThreadPoolExecutor(ThreadPoolExecutor):
+    """Thread pool executor that keeps track of how long tasks wait before they start
+
+    The standard executor hides its work queue, so this subclass records the enqueue time of
+    every submitted task, and forgets it when the task starts or is cancelled before starting
+    (eg when an awaiting coroutine is cancelled, or on shutdown with cancel_futures). Times are
+    kept in submission order, and since the underlying work queue is FIFO, the oldest recorded
+    time always belongs to the next task to start, which gives a cheap measure of the current
+    queueing delay.
+
+    Attributes:
+        enqueue_times (dict): Monotonic enqueue times of tasks that have not started yet, by
+                              task, in submission order
+
+    """
+
+    def __init__(self, max_workers=None, thread_name_prefix=''):
+        """Constructor for the executor
+
+        Args:
+            max_workers (int): Maximum number of threads in the pool
+            thread_name_prefix (string): Name prefix for the pool's threads
+
+        """
+        super(MonitoredThreadPoolExecutor, self).__init__(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.enqueue_times = {}
+        # the times are added on the submitting thread and removed on the worker threads
+        self._enqueue_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules a callable, recording when it was queued
+
+        Args:
+            fn (callable): Function to run on the thread pool
+
+        Returns:
+            concurrent.futures.Future: Future for the result of the callable
+
+        """
+        # the task may start before submit() returns its future, so it is tracked by a token
+        task = object()
+        with self._enqueue_lock:
+            self.enqueue_times[task] = time.monotonic()
+        try:
+            future = super(MonitoredThreadPoolExecutor, self).submit(self._run, task, fn,
+                                                                     *args, **kwargs)
+        except BaseException:
+            self._started(task)
+            raise
+        # a task cancelled before it starts never runs _run()
+        future.add_done_callback(lambda _: self._started(task))
+        return future
+
+    def _started(self, task):
+        """Forgets the enqueue time of a task that started or will never start
+        """
+        with self._enqueue_lock:
+            self.enqueue_times.pop(task, None)
+
+    def _run(self, task, fn, *args, **kwargs):
+        """Wrapper run on the worker thread that marks the task as started
+        """
+        self._started(task)
+        return fn(*args, **kwargs)
+
+    def queue_depth(self):
+        """Number of submitted tasks that have not started yet
+
+        Returns:
+            int: Current queue depth
+
+        """
+        return len(self.enqueue_times)
+
+    def queue_wait(self):
+        """Time that the oldest queued task has spent waiting for a thread
+
+        Returns:
+            float: Seconds waited by the head of the queue, 0 if the queue is empty
+
+        """
+        with self._enqueue_lock:
+            oldest = next(iter(self.enqueue_times.values()), None)
+        if oldest is None:
+            return 0.0
+        return max(0.0, time.monotonic() - oldest)
+
+
+class AdmissionController:
+    """Decides whether newly arriving requests should be admitted or shed
+
+    Two independent limits are supported, either of which may be disabled by passing None:
+    - max_in_flight: A hard cap on the number of requests being serviced concurrently
+    - max_queue_wait: A cap on how long work waits for a thread in the executor
+
+    When codel is enabled, the queue wait limit is applied CoDel-style: a standing queue must
+    persist above max_queue_wait for a full interval before shedding starts, and once in the
+    shedding state, rejections are spaced at interval / sqrt(count), so the shedding rate rises
+    gradually until the queue drains back below the target. Without codel, requests are shed
+    whenever the current queue wait exceeds max_queue_wait.
+
+    All methods are expected to be called from the IOLoop thread.
+
+    Attributes:
+        executor (MonitoredThreadPoolExecutor): Executor whose queue wait is monitored
+        max_in_flight (int): Maximum number of concurrent requests, None for unlimited
+        max_queue_wait (float): Maximum executor queue wait in seconds, None for unlimited
+        codel (bool): If the queue wait limit uses CoDel-style shedding
+        interval (float): CoDel interval in seconds
+        retry_after (int): Seconds that shed clients are asked to wait before retrying
+        in_flight (int): Number of requests currently admitted
+        rejected (int): Total number of requests shed
+
+    """
+
+    def __init__(self, executor=None, max_in_flight=None, max_queue_wait=None, codel=False,
+                 interval=0.1, retry_after=1):
+        """Constructor for the admission controller
+
+        Args:
+            executor (MonitoredThreadPoolExecutor): Executor whose queue wait is monitored
+            max_in_flight (int): Maximum number of concurrent requests, None for unlimited
+            max_queue_wait (float): Maximum executor queue wait in seconds, None for unlimited
+            codel (bool): If the queue wait limit uses CoDel-style shedding
+            interval (float): CoDel interval in seconds
+            retry_after (int): Seconds that shed clients are asked to wait before retrying
+
+        """
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait
+        self.codel = codel
+        self.interval = interval
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rejected = 0
+        # CoDel state
+        self.first_above_time = None
+        self.dropping = False
+        self.drop_next = 0.0
+        self.drop_count = 0
+
+    def try_acquire(self):
+        """Attempts to admit a new request
+
+        A successful call must be paired with a call to release() when the request completes.
+
+        Returns:
+            bool: If the request was admitted
+
+        """
+        if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+            self.rejected += 1
+            return False
+        if self.max_queue_wait is not None and self.executor is not None:
+            if self.should_shed(self.executor.queue_wait(), time.monotonic()):
+                self.rejected += 1
+                return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        """Marks a previously admitted request as complete
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def should_shed(self, queue_wait, now):
+        """Decides if a request should be shed given the current executor queue wait
+
+        Args:
+            queue_wait (float): Seconds that the head of the executor queue has waited
+            now (float): Current monotonic time
+
+        Returns:
+            bool: If the request should be rejected
+
+        """
+        if not self.codel:
+            return queue_wait > self.max_queue_wait
+
+        if queue_wait < self.max_queue_wait:
+            # the queue is draining normally, leave the shedding state
+            self.first_above_time = None
+            self.dropping = False
+            return False
+        if self.first_above_time is None:
+            # give the queue one interval to drain before reacting to it
+            self.first_above_time = now + self.interval
+            return False
+        if now < self.first_above_time:
+            return False
+        if not self.dropping:
+            self.dropping = True
+            self.drop_count = 1
+            self.drop_next = now + self.interval
+            return True
+        if now >= self.drop_next:
+            self.drop_count += 1
+            self.drop_next = now + self.interval / math.sqrt(self.drop_count)
+            return True
+        return False
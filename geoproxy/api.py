@@ -1,11 +1,105 @@
 #!/usr/bin/env python
 
 import json
+from json.encoder import encode_basestring_ascii
 import logging
+import math
 
+from geoproxy.encoding import pack
+from geoproxy.encoding import pack_map_header
+from geoproxy.encoding import packb
+from geoproxy.fair_queue import LANES
 from geoproxy.geometry import BoundingBox
 from geoproxy.geometry import Coordinate
 
+# fields of a result dict, in the order they are serialized
+RESULT_FIELDS = ('source', 'lat', 'lon', 'resolved_address')
+
+# pre-encoded MessagePack keys of the response fields
+_MSGPACK_ERROR = packb('error')
+_MSGPACK_STATUS = packb('status')
+_MSGPACK_QUERY = packb('query')
+_MSGPACK_RESULT = packb('result')
+_MSGPACK_RESULT_HEADER = bytes([0x80 | len(RESULT_FIELDS)])
+_MSGPACK_RESULT_KEYS = tuple(packb(name) for name in RESULT_FIELDS)
+
+_json_encode = json.JSONEncoder().encode
+
+_logger = logging.getLogger("GeoproxyRequestParser")
+
+
+def _json_value(value):
+    """Serializes a single value exactly as json.dumps() would, with a fast path for strings
+    and finite floats
+    """
+    value_type = type(value)
+    if value_type is str:
+        return encode_basestring_ascii(value)
+    if value_type is float and math.isfinite(value):
+        return float.__repr__(value)
+    return _json_encode(value)
+
+
+def service_orders(available_services):
+    """Builds the order in which services are queried, for each service a request can name
+
+    The orders are built once for the available services and shared by every request, rather
+    than worked out for each request.
+
+    Args:
+        available_services (dict): Maps from service name to ThirdPartyServiceHelper
+
+    Returns:
+        dict: Maps from the name of the primary service to the list of all services, the
+              primary first and then the others in the order of available_services, and from
+              None to the order of available_services
+
+    """
+    names = list(available_services)
+    orders = {None: names}
+    for name in names:
+        orders[name] = [name] + [other for other in names if other != name]
+    return orders
+
+
+def _is_number(value):
+    return type(value) in (int, float)
+
+
+def valid_result(result):
+    """Checks that a result received from outside the process can be passed to set_result()
+
+    Args:
+        result (object): Decoded result, eg a result stored by a peer
+
+    Returns:
+        bool: If the result has exactly the RESULT_FIELDS, optionally followed by the candidates
+              and agreement of cached candidate and consensus results, with values of the
+              expected types
+
+    """
+    if type(result) is not dict or tuple(result)[:len(RESULT_FIELDS)] != RESULT_FIELDS:
+        return False
+    if type(result['source']) is not str or type(result['resolved_address']) is not str or \
+            not _is_number(result['lat']) or not _is_number(result['lon']):
+        return False
+    for name in tuple(result)[len(RESULT_FIELDS):]:
+        if name == 'agreement':
+            if not _is_number(result['agreement']):
+                return False
+        elif name == 'candidates':
+            if type(result['candidates']) is not list:
+                return False
+            for candidate in result['candidates']:
+                if type(candidate) is not dict or \
+                        set(candidate) != {'lat', 'lon', 'resolved_address'} or \
+                        not _is_number(candidate['lat']) or not _is_number(candidate['lon']) or \
+                        type(candidate['resolved_address']) is not str:
+                    return False
+        else:
+            return False
+    return True
+
 
 class GeoproxyRequestParser:
     """Assisting methods for parsing a RESTful request to the API
@@ -16,36 +110,66 @@ class GeoproxyRequestParser:
     member variables are populated.
 
     Attributes:
-        logger (logging.logger): Logger instance
+        logger (logging.logger): Logger instance, shared by all request parsers
         address (string): Address string from the request, populated by parse()
-        services ([string]): Services list in order of priority, populated by parse()
+        services ([string]): Services list in order of priority, populated by parse() (shared
+                             between requests, it must not be modified)
+        requested_service (string): Primary service named by the request, None if it did not
+                                    name one
         available_services (dict): Full list of available services, used to populate
             extra backup services if primary fails
+        service_orders (dict): Service order for each primary service (see service_orders),
+                               None to build them from available_services when parsing
         bounds (BoundingBox): Optional bounding box coordinates to use in the query
+        mode (string): How services are queried, one of GeoproxyRequestParser.MODES
         geo_proxy_response (GeoproxyResponse): Reference to the geoproxy API response
+        attempts (int): Number of third party requests made while resolving the request
+        tenant (string): Tenant the request is scheduled for, set before parsing from the
+                         client's credential, None for an unauthenticated request
+        lane (string): Scheduling lane of the request, one of LANES
+        limit (int): Number of candidate results requested, from 1 to MAX_LIMIT
 
     """
 
-    def __init__(self, available_services, geo_proxy_response):
+    __slots__ = ("logger", "address", "services", "requested_service", "available_services",
+                 "service_orders", "bounds", "mode", "geo_proxy_response", "attempts", "tenant",
+                 "lane", "limit")
+
+    # "fallback" queries services in turn until one succeeds, "consensus" queries all of them
+    MODES = ("fallback", "consensus")
+    # most candidate results a request can ask for
+    MAX_LIMIT = 10
+
+    def __init__(self, available_services, geo_proxy_response, service_orders=None):
         """Constructor for the request parser
 
         Args:
             available_services (dict): Maps from service name to ThirdPartyServiceHelper
             geo_proxy_response (GeoproxyResponse): Reference to the geoproxy API response
+            service_orders (dict): Service order for each primary service, built once for the
+                                   available services (see service_orders), None to build
+                                   them when parsing
 
         """
-        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger = _logger
         self.address = None
-        self.services = []
+        self.services = ()
+        self.requested_service = None
         self.available_services = available_services
+        self.service_orders = service_orders
         self.bounds = None
+        self.mode = "fallback"
         self.geo_proxy_response = geo_proxy_response
+        self.attempts = 0
+        self.tenant = None
+        self.lane = "bulk"
+        self.limit = 1
 
     def __str__(self):
         """Human readable representation of the request parser
         """
-        return "Address: {}\nServices: {}\nBounds: {}".format(
-            self.address, self.services, self.bounds)
+        return "Address: {}\nServices: {}\nBounds: {}\nMode: {}\nTenant: {}\nLane: {}".format(
+            self.address, self.services, self.bounds, self.mode, self.tenant, self.lane)
 
     def parse_bounding_coordinates(self, bounds_string):
         """Extracts coordinates (floats) from a bounds string
@@ -57,40 +181,19 @@ class GeoproxyRequestParser:
             bounds_string (string): Input from http request to be parsed
 
         Returns:
-            [floats]: List of 4 floats representing coord1.lat, coord1.long,
+            (floats): Tuple of 4 floats representing coord1.lat, coord1.long,
                       coord2.lat, coord2.long.
 
         """
-        corners = bounds_string.split("|")
-        if len(corners) != 2:
-            # TODO(pickledgator): Consider bubbling up exceptions here instead
-            return None
-        coordinates = []
-        for corner in corners:
-            corner_coords = corner.split(",")
-            if len(corner_coords) != 2:
-                # TODO(pickledgator): Consider bubbling up exceptions here instead
-                return None
-            for coord in corner_coords:
-                coordinates.append(float(coord))
-        if len(coordinates) == 4:
-            return coordinates
-        else:
+        # partitioned in place rather than split into lists of corners and coordinates
+        corner_1, _, corner_2 = bounds_string.partition("|")
+        latitude_1, _, longitude_1 = corner_1.partition(",")
+        latitude_2, _, longitude_2 = corner_2.partition(",")
+        if not longitude_1 or not longitude_2 or "," in longitude_1 or "," in longitude_2 \
+                or "|" in longitude_2:
             # TODO(pickledgator): Consider bubbling up exceptions here instead
             return None
-
-    def find_missing_elements(self, full_list, partial_list):
-        """Compares two lists and finds the differences
-
-        Args:
-            full_list [obj]: Complete list
-            partial_list [obj]: Partial list to compare against complete list
-
-        Returns:
-            [obj]: List of objs that are in complete list but not partial list
-
-        """
-        return list(set(full_list) - set(partial_list))
+        return float(latitude_1), float(longitude_1), float(latitude_2), float(longitude_2)
 
     def parse(self, request):
         """Parses a tornado HTTP request and populates the class's members variables
@@ -114,8 +217,19 @@ class GeoproxyRequestParser:
         to create a bounding box object. It is assumed that the geoproxy API expects the bounds to
         be formatted as bottom_left.lat,bottom_left.lon|top_right.lat,top_right.lon.
 
+        If the mode argument is provided, it must be one of GeoproxyRequestParser.MODES.
+
+        The tenant is never taken from the arguments, it is set before parsing from the
+        client's credential. Requests of a tenant are in the interactive lane unless the
+        priority argument asks for another one of LANES, and requests without a tenant are
+        always in the bulk lane, so that unauthenticated clients cannot claim the interactive
+        lane.
+
+        If the limit argument is provided, it must be an integer from 1 to MAX_LIMIT.
+
         Args:
-            request (tornado.web.RequestHandler): Object containing the request data
+            request (tornado.web.RequestHandler/GeoproxyArguments): Object containing the request
+                                                                   data
 
         Returns:
             bool: If the parse is successful or not
@@ -142,17 +256,50 @@ class GeoproxyRequestParser:
             return False
 
         # optional field
+        orders = self.service_orders
+        if orders is None:
+            orders = self.service_orders = service_orders(self.available_services)
         service = request.get_arguments("service")
         if len(service) == 1 and service[0] in self.available_services:
-                # add the desired primary service to our ordered list
-            self.services.append(service[0])
-            # backfill additional services from the available services as fallback
-            # options after the primary
-            [self.services.append(s) for s in self.find_missing_elements(
-                self.available_services.keys(), self.services)]
+            # the desired primary service, with the additional services from the available
+            # services backfilled as fallback options after the primary
+            self.requested_service = service[0]
+            self.services = orders[service[0]]
         else:
             # if un-specified, just default the ordered services to the available services
-            [self.services.append(s) for s in self.available_services.keys()]
+            self.services = orders[None]
+
+        # optional field
+        mode = request.get_arguments("mode")
+        if len(mode) == 1:
+            if mode[0] not in self.MODES:
+                self.logger.error("Mode is invalid")
+                self.geo_proxy_response.set_error("Mode is invalid", "INVALID_REQUEST")
+                return False
+            self.mode = mode[0]
+
+        # optional field, only honored for authenticated tenants
+        self.lane = "interactive" if self.tenant is not None else "bulk"
+        priority = request.get_arguments("priority")
+        if len(priority) == 1:
+            if priority[0] not in LANES:
+                self.logger.error("Priority is invalid")
+                self.geo_proxy_response.set_error("Priority is invalid", "INVALID_REQUEST")
+                return False
+            if self.tenant is not None:
+                self.lane = priority[0]
+
+        # optional field
+        limit = request.get_arguments("limit")
+        if len(limit) == 1:
+            try:
+                self.limit = int(limit[0])
+            except ValueError:
+                self.limit = 0
+            if not 1 <= self.limit <= self.MAX_LIMIT:
+                self.logger.error("Limit is invalid")
+                self.geo_proxy_response.set_error("Limit is invalid", "INVALID_REQUEST")
+                return False
 
         # optional field
         bounds = request.get_arguments("bounds")
@@ -169,6 +316,44 @@ class GeoproxyRequestParser:
         return True
 
 
+class GeoproxyArguments:
+    """Request arguments that did not arrive as an HTTP query string
+
+    Wraps a dict of arguments (eg a decoded WebSocket message) with the get_arguments() method
+    of tornado.web.RequestHandler, so that it can be parsed by GeoproxyRequestParser.
+
+    Attributes:
+        arguments (dict): Map from argument name to value
+
+    """
+
+    def __init__(self, arguments):
+        """Constructor
+
+        Args:
+            arguments (dict): Map from argument name to a string or a list of strings
+
+        """
+        self.arguments = arguments
+
+    def get_arguments(self, name):
+        """Returns a list of the arguments with the given name
+
+        Args:
+            name (string): Argument name
+
+        Returns:
+            [string]: Argument values, empty if the argument is missing
+
+        """
+        value = self.arguments.get(name)
+        if value is None:
+            return []
+        if isinstance(value, (list, tuple)):
+            return [str(v) for v in value]
+        return [str(value)]
+
+
 class GeoproxyResponse:
     """Container for preparing an API response
 
@@ -197,6 +382,11 @@ class GeoproxyResponse:
         lon: Longitude of the geocoded result
         resolved_address: Full address of the geocoded result
     )
+    Approximate results, located by postal code or locality when no service could answer, also
+    carry a precision field ("postal_code" or "locality"), exact results never do. Results of a
+    similar cached query (see FuzzyIndex) carry a match field, "fuzzy". Requests with
+    a limit above 1 also get a candidates field, the list of the service's results, most likely
+    first (the first being the result itself), each a dict of lat, lon and resolved_address.
 
     Attributes:
         query (string): Original, unformatted query string from the request
@@ -206,6 +396,8 @@ class GeoproxyResponse:
 
     """
 
+    __slots__ = ("query", "error", "status", "result")
+
     def __init__(self):
         self.query = None
         self.error = None
@@ -223,24 +415,42 @@ class GeoproxyResponse:
         self.error = message
         self.status = status_type
 
-    def set_result(self, source, lat, lon, resolved_address):
+    def set_result(self, source, lat, lon, resolved_address, candidates=None, agreement=None,
+                   precision=None, match=None):
         """Sets the response members associated with a valid result response
 
         Args:
             source (string): Third party service that was used to complete the query
             lat (float): Latitude of the geocoded result
             lon (float): Longitude of the geocoded result
+            resolved_address (string): Full address of the geocoded result
+            candidates ([dict]): Results of the service, most likely first, None if the
+                                 request did not ask for candidates
+            agreement (float): Fraction of services that agree with the result, only set in
+                               consensus mode
+            precision (string): Precision of an approximate result, eg "postal_code", None
+                                for an exact result
+            match (string): "fuzzy" for the result of a similar query, None for a result of
+                            the query itself
 
         """
         self.result = {'source': source, 'lat': lat, 'lon': lon,
                        'resolved_address': resolved_address}
+        if candidates is not None:
+            self.result['candidates'] = candidates
+        if agreement is not None:
+            self.result['agreement'] = agreement
+        if precision is not None:
+            self.result['precision'] = precision
+        if match is not None:
+            self.result['match'] = match
         self.status = "OK"
 
-    def to_json(self):
-        """Converts class members into a serialized JSON object, based on status
+    def to_dict(self):
+        """Converts class members into a dict, based on status
 
         Returns:
-            json: JSON string rep of response
+            dict: Response fields, in the order they are serialized
 
         """
         d = dict()
@@ -251,5 +461,72 @@ class GeoproxyResponse:
             d['query'] = self.query
             d['status'] = self.status
             d['result'] = self.result
+        return d
+
+    def to_json(self):
+        """Converts class members into a serialized JSON object, based on status
+
+        The fields are written directly, the output is identical to json.dumps(self.to_dict()).
 
-        return json.dumps(d)
+        Returns:
+            json: JSON string rep of response
+
+        """
+        if self.error:
+            return '{"error": %s, "status": %s}' % (_json_value(self.error),
+                                                     _json_value(self.status))
+        result = self.result
+        if result is None or tuple(result) != RESULT_FIELDS:
+            result_json = _json_value(result)
+        else:
+            result_json = '{"source": %s, "lat": %s, "lon": %s, "resolved_address": %s}' % (
+                _json_value(result['source']), _json_value(result['lat']),
+                _json_value(result['lon']), _json_value(result['resolved_address']))
+        return '{"query": %s, "status": %s, "result": %s}' % (
+            _json_value(self.query), _json_value(self.status), result_json)
+
+    def to_msgpack(self, fields=None):
+        """Converts class members into a MessagePack map, based on status
+
+        The map has the same fields, in the same order, as the JSON response.
+
+        Args:
+            fields (dict): Extra fields written at the start of the map, eg a query id
+
+        Returns:
+            bytes: MessagePack rep of response
+
+        """
+        buf = bytearray()
+        extra = len(fields) if fields else 0
+        if self.error:
+            pack_map_header(buf, 2 + extra)
+            self._pack_fields(buf, fields)
+            buf += _MSGPACK_ERROR
+            pack(buf, self.error)
+            buf += _MSGPACK_STATUS
+            pack(buf, self.status)
+        else:
+            pack_map_header(buf, 3 + extra)
+            self._pack_fields(buf, fields)
+            buf += _MSGPACK_QUERY
+            pack(buf, self.query)
+            buf += _MSGPACK_STATUS
+            pack(buf, self.status)
+            buf += _MSGPACK_RESULT
+            result = self.result
+            if result is None or tuple(result) != RESULT_FIELDS:
+                pack(buf, result)
+            else:
+                buf += _MSGPACK_RESULT_HEADER
+                for key, name in zip(_MSGPACK_RESULT_KEYS, RESULT_FIELDS):
+                    buf += key
+                    pack(buf, result[name])
+        return bytes(buf)
+
+    @staticmethod
+    def _pack_fields(buf, fields):
+        if fields:
+            for name, value in fields.items():
+                pack(buf, name)
+                pack(buf, value)
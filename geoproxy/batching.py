@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to combine concurrent third party queries into batch jobs
+
+Some third party services accept many queries in a single batch job, which costs one request
+(and often less quota) instead of one per query. A MicroBatcher sits in front of such a
+service: queries that arrive within a short window are gathered into one batch, up to a
+maximum size, the batch is sent as a single upstream job, and each waiting request receives
+its own result. Every batched request pays up to one window of extra latency.
+
+"""
+
+from collections import OrderedDict
+import logging
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+
+class MicroBatcher:
+    """Gathers concurrent items into batches and fans the batch results back out
+
+    The first item of a batch starts a timer of window seconds, and the batch is sent when the
+    timer fires or as soon as it holds max_size items, whichever comes first. Identical items
+    submitted while a batch is open share a single entry (and a single future). Items are
+    submitted and results delivered on the IOLoop thread, so no locking is needed.
+
+    Attributes:
+        send (callable): Coroutine taking a list of items, and returning a list with one
+                         result per item, or None if the whole batch failed
+        window (float): Seconds to wait for more items once a batch is started
+        max_size (int): Maximum number of items per batch
+        batches (int): Number of batches sent
+        items (int): Number of items sent in batches
+        failures (int): Number of batches that failed
+
+    """
+
+    def __init__(self, send, window=0.01, max_size=100):
+        """Constructor for the batcher
+
+        Args:
+            send (callable): Coroutine taking a list of items, and returning a list with one
+                             result per item, or None if the whole batch failed
+            window (float): Seconds to wait for more items once a batch is started
+            max_size (int): Maximum number of items per batch
+
+        """
+        self.send = send
+        self.window = max(0.0, window)
+        self.max_size = max(1, max_size)
+        self.batches = 0
+        self.items = 0
+        self.failures = 0
+        self.logger = logging.getLogger("MicroBatcher")
+        self._pending = OrderedDict()
+        self._timer = None
+
+    def submit(self, item):
+        """Adds an item to the open batch
+
+        Args:
+            item (hashable): Item to send, eg a query string
+
+        Returns:
+            Future: Resolves to the item's result, or None if its batch failed
+
+        """
+        future = self._pending.get(item)
+        if future is None:
+            future = Future()
+            self._pending[item] = future
+            if len(self._pending) >= self.max_size:
+                self.flush()
+            elif self._timer is None:
+                self._timer = IOLoop.current().call_later(self.window, self.flush)
+        return future
+
+    def flush(self):
+        """Sends the open batch now, if it holds any items
+        """
+        if self._timer is not None:
+            IOLoop.current().remove_timeout(self._timer)
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, OrderedDict()
+        self.batches += 1
+        self.items += len(pending)
+        IOLoop.current().spawn_callback(self._send_batch, pending)
+
+    async def _send_batch(self, pending):
+        items = list(pending)
+        try:
+            results = await self.send(items)
+        except Exception as error:
+            self.logger.error("Error sending a batch of %d items: %s", len(items), error)
+            results = None
+        if results is None or len(results) != len(items):
+            self.failures += 1
+            results = [None] * len(items)
+        for future, result in zip(pending.values(), results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        """Current state of the batcher
+
+        Returns:
+            dict: Batches sent and failed, items sent, items waiting for the open batch, and
+                  the mean batch size
+
+        """
+        return {"batches": self.batches, "items": self.items, "failures": self.failures,
+                "pending": len(self._pending),
+                "mean_size": round(self.items / self.batches, 3) if self.batches else 0.0}
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to isolate third party services from each other
+
+Every remote service gets its own thread pool (a bulkhead), so that a slow service can only
+tie up its own threads. When a service's pool and its queue are full, new requests for that
+service are rejected immediately and the resolver fails over to the next service, instead of
+queueing behind the slow one.
+
+With fair scheduling enabled, requests wait for a thread in a per-service FairScheduler rather
+than in the thread pool's queue, so that the service's threads are shared between tenants by
+weight instead of first come, first served.
+
+"""
+
+from geoproxy.admission import MonitoredThreadPoolExecutor
+from geoproxy.fair_queue import FairScheduler
+
+
+class Bulkhead:
+    """Bounded thread pool reserved for a single third party service
+
+    A request must acquire a slot before it is submitted, and release it once it completes.
+    There are max_workers slots for running requests and max_queue slots for requests waiting
+    for a thread. Slots are only acquired and released on the IOLoop thread, so the counters
+    need no locking.
+
+    When the bulkhead has a scheduler, the queue slots are replaced by the scheduler's queue:
+    requests wait in weighted fair order for one of the max_workers threads (see acquire),
+    and the thread pool itself never queues.
+
+    Attributes:
+        name (string): Name of the service
+        max_workers (int): Number of threads in the pool
+        max_queue (int): Number of requests that may wait for a thread
+        executor (MonitoredThreadPoolExecutor): Thread pool for the service's requests
+        in_flight (int): Number of requests holding a slot
+        rejected (int): Number of requests rejected because the bulkhead was full
+        scheduler (FairScheduler): Weighted fair queue for the threads, None for first come,
+                                   first served
+
+    """
+
+    def __init__(self, name, max_workers=4, max_queue=16, fair=False, tenant_weights=None):
+        """Constructor for the bulkhead
+
+        Args:
+            name (string): Name of the service
+            max_workers (int): Number of threads in the pool
+            max_queue (int): Number of requests that may wait for a thread
+            fair (bool): Share the threads between tenants with a FairScheduler
+            tenant_weights (dict): Map from tenant name to its weight, when fair
+
+        """
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.executor = MonitoredThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="bulkhead-{}".format(name))
+        self.in_flight = 0
+        self.rejected = 0
+        self.scheduler = None
+        if fair:
+            self.scheduler = FairScheduler(self.max_workers, self.max_queue, tenant_weights)
+
+    def try_acquire(self, tenant=None, lane="interactive"):
+        """Attempts to take a slot for a request, without waiting
+
+        Args:
+            tenant (string): Tenant making the request, when fair
+            lane (string): Lane of the request, when fair
+
+        Returns:
+            bool: If the request may be submitted, False if the bulkhead is full
+
+        """
+        if self.scheduler is not None:
+            granted = self.scheduler.try_acquire(tenant, lane)
+        else:
+            granted = self.in_flight < self.max_workers + self.max_queue
+        if not granted:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    async def acquire(self, tenant=None, lane="interactive", timeout=None):
+        """Takes a slot for a request, waiting for it in weighted fair order when fair
+
+        Without a scheduler, this is the same as try_acquire.
+
+        Args:
+            tenant (string): Tenant making the request
+            lane (string): Lane of the request, "interactive" or "bulk"
+            timeout (float): Maximum number of seconds to wait, None to wait indefinitely
+
+        Returns:
+            bool: If the request may be submitted, False if the bulkhead is full or the
+                  timeout expired
+
+        """
+        if self.scheduler is None:
+            return self.try_acquire()
+        if not await self.scheduler.acquire(tenant, lane, timeout):
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        """Returns the slot of a completed request
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+        if self.scheduler is not None:
+            self.scheduler.release()
+
+    def submit(self, fn, *args):
+        """Runs a callable on the bulkhead's threads, the caller must hold a slot
+
+        Args:
+            fn (callable): Function to run on the thread pool
+
+        Returns:
+            concurrent.futures.Future: Future for the result of the callable
+
+        """
+        return self.executor.submit(fn, *args)
+
+    def queue_depth(self):
+        """Number of submitted requests waiting for a thread
+
+        Returns:
+            int: Current queue depth
+
+        """
+        if self.scheduler is not None:
+            return self.scheduler.queue_depth() + self.executor.queue_depth()
+        return self.executor.queue_depth()
+
+    def queue_wait(self):
+        """Time that the oldest queued request has spent waiting for a thread
+
+        Returns:
+            float: Seconds waited by the head of the queue, 0 if the queue is empty
+
+        """
+        if self.scheduler is not None:
+            return max(self.scheduler.queue_wait(), self.executor.queue_wait())
+        return self.executor.queue_wait()
+
+    def saturation(self):
+        """Share of the bulkhead's capacity in use
+
+        Returns:
+            float: Slots in use over total slots, 1.0 when new requests are rejected
+
+        """
+        return self.in_flight / (self.max_workers + self.max_queue)
+
+    def stats(self):
+        """Current state of the bulkhead
+
+        Returns:
+            dict: Pool size, queue size, in flight requests, queue depth, queue wait,
+                  saturation and rejections, and the statistics of each tenant when fair
+
+        """
+        stats = {"max_workers": self.max_workers, "max_queue": self.max_queue,
+                 "in_flight": self.in_flight, "queue_depth": self.queue_depth(),
+                 "queue_wait": round(self.queue_wait(), 6),
+                 "saturation": round(self.saturation(), 3), "rejected": self.rejected}
+        if self.scheduler is not None:
+            stats["tenants"] = self.scheduler.stats()
+        return stats
+
+
+class Bulkheads:
+    """The bulkheads of every remote service
+
+    Also stands in for a single executor where only the overall queueing delay matters, eg
+    for the AdmissionController's queue wait limit.
+
+    Attributes:
+        bulkheads (dict): Map from service name to Bulkhead
+
+    """
+
+    def __init__(self, services, size=4, sizes=None, max_queue=16, fair=False,
+                 tenant_weights=None):
+        """Constructor
+
+        Args:
+            services ([string]): Names of the remote services
+            size (int): Number of threads for services without an explicit size
+            sizes (dict): Map from service name to its number of threads
+            max_queue (int): Number of requests that may wait for a thread, per service
+            fair (bool): Share each service's threads between tenants by weight
+            tenant_weights (dict): Map from tenant name to its weight, when fair
+
+        """
+        sizes = sizes or {}
+        self.bulkheads = {service: Bulkhead(service, sizes.get(service, size), max_queue,
+                                            fair=fair, tenant_weights=tenant_weights)
+                          for service in services}
+
+    def __getitem__(self, service):
+        return self.bulkheads[service]
+
+    def __contains__(self, service):
+        return service in self.bulkheads
+
+    def queue_depth(self):
+        """Number of requests waiting for a thread, across all services
+
+        Returns:
+            int: Total queue depth
+
+        """
+        return sum(bulkhead.queue_depth() for bulkhead in self.bulkheads.values())
+
+    def queue_wait(self):
+        """Longest time that a queued request has spent waiting for a thread
+
+        Returns:
+            float: Largest queue wait of any service, in seconds
+
+        """
+        return max([bulkhead.queue_wait() for bulkhead in self.bulkheads.values()] or [0.0])
+
+    def stats(self):
+        """Current state of every bulkhead
+
+        Returns:
+            dict: Map from service name to Bulkhead.stats()
+
+        """
+        return {service: bulkhead.stats() for service, bulkhead in self.bulkheads.items()}
+
+    def shutdown(self, wait=True):
+        """Stops the thread pools of every bulkhead
+
+        Args:
+            wait (bool): Wait for running requests to complete
+
+        """
+        for bulkhead in self.bulkheads.values():
+            bulkhead.executor.shutdown(wait=wait)
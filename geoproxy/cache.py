@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to cache geocoding results
+"""
+
+from collections import OrderedDict
+import time
+
+from geoproxy.address import normalize_address
+
+
+def cache_key(address, bounds=None, mode=None, limit=1):
+    """Builds the cache key for a geocoding query
+
+    Queries are keyed by their normalized address, so that trivially different spellings of
+    the same address (case, punctuation, whitespace) share an entry. Bounds bias the results of
+    third party services, so they are part of the key when provided, as are a non-default
+    resolution mode and a limit above 1, whose results carry different fields.
+
+    Args:
+        address (string): Address string from the request
+        bounds (BoundingBox): Optional bounding box from the request
+        mode (string): Optional resolution mode, eg "consensus"
+        limit (int): Number of candidate results requested
+
+    Returns:
+        string: Cache key
+
+    """
+    key = normalize_address(address)
+    if bounds:
+        key += "|{},{}|{},{}".format(bounds.bottom_left.latitude, bounds.bottom_left.longitude,
+                                     bounds.top_right.latitude, bounds.top_right.longitude)
+    if mode:
+        key += "|" + mode
+    if limit > 1:
+        key += "|limit={}".format(limit)
+    return key
+
+
+class ResultCache:
+    """Bounded, least recently used cache of geoproxy results with expiry
+
+    Values are the result dicts of successful GeoproxyResponses. A cache with a max_size of 0
+    stores nothing.
+
+    Attributes:
+        max_size (int): Maximum number of entries held
+        ttl (float): Number of seconds an entry remains valid, None for no expiry
+        hits (int): Number of successful lookups
+        misses (int): Number of failed lookups
+
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        """Constructor for the cache
+
+        Args:
+            max_size (int): Maximum number of entries held
+            ttl (float): Number of seconds an entry remains valid, None for no expiry
+
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Looks up a result, refreshing its recency
+
+        Args:
+            key (string): Cache key
+
+        Returns:
+            None/dict: Cached result, None if missing or expired
+
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, result = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        """Stores a result, evicting the least recently used entry if the cache is full
+
+        Args:
+            key (string): Cache key
+            result (dict): Result to store
+
+        """
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (expires_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
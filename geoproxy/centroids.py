@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to answer requests approximately when no service can
+
+When every service in a request's chain fails or times out, a coarse answer is usually more
+useful than an error. A CentroidIndex holds the centroid of every postal code and locality of
+a dataset, and locates a free-form address by the most specific postal code or locality it
+mentions, without any network requests.
+
+Postal codes and locality names are reused around the world ("Springfield", or the postal code
+10115 in both Berlin and New York), and the mean of places far apart is no place at all, so keys
+whose rows are far apart are left out of the index as ambiguous.
+
+The index has the layout of the offline address index (see write_index), with its own file
+type, and keys prefixed by their precision ("p:" for postal codes, "l:" for localities).
+
+"""
+
+import csv
+
+from geoproxy.address import ABBREVIATIONS
+from geoproxy.address import STREET_SUFFIXES
+from geoproxy.address import normalize_address
+from geoproxy.geometry import Coordinate
+from geoproxy.geometry import haversine_distance
+from geoproxy.third_party_services.local import AddressIndex
+from geoproxy.third_party_services.local import write_index
+
+CENTROID_MAGIC = b"GPXCTRD1"
+# precision of the results located by postal code and by locality, as flagged in responses
+POSTAL_CODE = "postal_code"
+LOCALITY = "locality"
+_PRECISIONS = {b"p": POSTAL_CODE, b"l": LOCALITY}
+# most words in a locality name that are looked up, eg "new york ny"
+MAX_LOCALITY_WORDS = 4
+# largest distance in meters between the rows of a postal code or locality that is indexed
+MAX_SPREAD = 100000.0
+# words followed by a unit number rather than a postal code
+UNIT_WORDS = frozenset(["apt", "apartment", "ste", "suite", "unit", "fl", "floor", "bldg",
+                        "building", "rm", "room", "no"])
+
+
+def build_centroid_index(csv_path, index_path, max_spread=MAX_SPREAD):
+    """Builds a centroid index file from a CSV of postal codes and localities
+
+    The CSV must have a header row containing the LAT and LON columns, and at least one of the
+    POSTCODE and LOCALITY columns, and may contain a REGION column (column names are case
+    insensitive), eg a GeoNames postal code export. Every postal code and locality is located
+    at the mean of the coordinates of its rows. Localities are indexed both alone and followed
+    by their region, eg "springfield" and "springfield il". Keys whose rows span more than
+    max_spread meters (the diagonal of their bounding box) are ambiguous, and are left out: a
+    locality name shared by several regions can then only be looked up with its region.
+
+    Args:
+        csv_path (string): Path to the input CSV
+        index_path (string): Path of the index file to write
+        max_spread (float): Largest distance in meters between the rows of a key
+
+    Returns:
+        int: Number of keys written to the index
+
+    """
+    sums = {}
+
+    def add(key, label, lat, lon):
+        entry = sums.get(key)
+        if entry is None:
+            sums[key] = [lat, lon, 1, label, lat, lat, lon, lon]
+        else:
+            entry[0] += lat
+            entry[1] += lon
+            entry[2] += 1
+            entry[4] = min(entry[4], lat)
+            entry[5] = max(entry[5], lat)
+            entry[6] = min(entry[6], lon)
+            entry[7] = max(entry[7], lon)
+
+    with open(csv_path, newline='', encoding='utf-8') as csv_file:
+        for row in csv.DictReader(csv_file):
+            row = {k.strip().upper(): (v or "").strip() for k, v in row.items() if k}
+            try:
+                lat = float(row["LAT"])
+                lon = float(row["LON"])
+            except (KeyError, ValueError):
+                continue
+            postcode, locality, region = row.get("POSTCODE", ""), row.get("LOCALITY", ""), \
+                row.get("REGION", "")
+            if normalize_address(postcode):
+                label = ", ".join(part for part in (locality, " ".join(
+                    part for part in (region, postcode) if part)) if part)
+                add(b"p:" + normalize_address(postcode).encode("utf-8"), label, lat, lon)
+            if normalize_address(locality):
+                add(b"l:" + normalize_address(locality).encode("utf-8"), locality, lat, lon)
+                if region:
+                    add(b"l:" + normalize_address(locality + " " + region).encode("utf-8"),
+                        "{}, {}".format(locality, region), lat, lon)
+
+    records = {}
+    for key, (lat, lon, count, label, min_lat, max_lat, min_lon, max_lon) in sums.items():
+        if count > 1 and haversine_distance(Coordinate(min_lat, min_lon),
+                                            Coordinate(max_lat, max_lon)) > max_spread:
+            continue
+        records[key] = (lat / count, lon / count, label.encode("utf-8"))
+    return write_index(records, index_path, magic=CENTROID_MAGIC)
+
+
+def place_start(words):
+    """Index of the first word of an address that may be part of its postal code or locality
+
+    Args:
+        words ([string]): Words of the normalized address
+
+    Returns:
+        int: Index of the first word after the street's suffix, or without a street suffix,
+             of the first word after a leading house number
+
+    """
+    # the first word is never a suffix ("St Louis")
+    for index in range(1, len(words)):
+        if ABBREVIATIONS.get(words[index], words[index]) in STREET_SUFFIXES:
+            return index + 1
+    if words and any(character.isdigit() for character in words[0]):
+        return 1
+    return 0
+
+
+def _follows_unit(words, index):
+    return index > 0 and words[index - 1] in UNIT_WORDS
+
+
+class CentroidIndex(AddressIndex):
+    """Read-only, memory mapped view of a centroid index file
+    """
+
+    def __init__(self, path):
+        """Constructor, maps the index file into memory
+
+        Args:
+            path (string): Path of an index file created by build_centroid_index
+
+        Raises:
+            ValueError: If the file is not a geoproxy centroid index
+
+        """
+        super(CentroidIndex, self).__init__(path, magic=CENTROID_MAGIC)
+
+    def locate(self, address):
+        """Locates an address by the postal code or locality it mentions
+
+        Only the words after the street (its suffix, eg "st") are tried, or without a street,
+        the words after a leading house number, so that neither the house number nor the
+        street name (eg "washington" in "100 Washington St") is taken for the place. Postal
+        codes are tried first, from the end of the address, as words containing a digit or two
+        such words together (eg "sw1a 1aa"), and unit numbers (eg "apt 2000") are never tried.
+        Localities are tried next, longest names first and from the end of the address within
+        each length, so that "Springfield, IL" matches "springfield il" before "springfield".
+
+        Args:
+            address (string): Free-form address
+
+        Returns:
+            None/tuple: (latitude, longitude, label, precision) with a precision of
+                        POSTAL_CODE or LOCALITY, None if nothing in the address is indexed
+
+        """
+        words = normalize_address(address).split()
+        start = place_start(words)
+        candidates = []
+        for end in range(len(words), start, -1):
+            if any(character.isdigit() for character in words[end - 1]) and \
+                    not _follows_unit(words, end - 1):
+                if end - 1 > start and not _follows_unit(words, end - 2):
+                    candidates.append(b"p:" + " ".join(words[end - 2:end]).encode("utf-8"))
+                candidates.append(b"p:" + words[end - 1].encode("utf-8"))
+        for length in range(min(MAX_LOCALITY_WORDS, len(words) - start), 0, -1):
+            for end in range(len(words), start + length - 1, -1):
+                candidates.append(b"l:" + " ".join(words[end - length:end]).encode("utf-8"))
+        for key in candidates:
+            result = self.lookup_key(key)
+            if result is not None:
+                return result + (_PRECISIONS[key[:1]],)
+        return None
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""Collection of helpers for bounding the time spent on a single geoproxy request
+"""
+
+import random
+import time
+
+
+class Deadline:
+    """Container for a request-level time budget
+
+    A deadline is created when a request arrives and is consulted before every third party
+    service attempt, so that the total time spent servicing a request is bounded regardless
+    of how many services or retries are involved.
+
+    Attributes:
+        budget (float): Total number of seconds granted when the deadline was created
+        expires_at (float): Monotonic clock time at which the budget is exhausted
+
+    """
+    __slots__ = ("budget", "expires_at")
+
+    def __init__(self, budget):
+        """Constructor for a deadline
+
+        Args:
+            budget (float): Number of seconds from now until the deadline expires
+
+        """
+        self.budget = max(0.0, float(budget))
+        self.expires_at = time.monotonic() + self.budget
+
+    def remaining(self):
+        """Number of seconds left before the deadline expires
+
+        Returns:
+            float: Remaining seconds, never negative
+
+        """
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        """Checks if the deadline has been used up
+
+        Returns:
+            bool: If there is no time left in the budget
+
+        """
+        return self.remaining() <= 0.0
+
+    def share(self, parts):
+        """Splits the remaining budget evenly between a number of consumers
+
+        Used to hand each remaining third party service an equal slice of whatever time is
+        left, so that a slow primary cannot consume the budget of its fallbacks.
+
+        Args:
+            parts (int): Number of consumers still to be serviced
+
+        Returns:
+            float: Number of seconds allotted to the next consumer
+
+        """
+        if parts < 1:
+            return self.remaining()
+        return self.remaining() / parts
+
+    def __str__(self):
+        """Human readable representation of the deadline
+        """
+        return "Deadline: {:0.3f}s of {:0.3f}s remaining".format(self.remaining(), self.budget)
+
+
+class RetryPolicy:
+    """Retry parameters for transient third party service errors
+
+    Retries are spaced using exponential backoff with "full jitter", ie, the delay before retry n
+    is drawn uniformly from [0, min(max_delay, base_delay * 2^n)]. Randomizing the whole interval
+    keeps many proxies that failed at the same time from retrying in lockstep.
+
+    Attributes:
+        max_attempts (int): Maximum number of attempts per service, including the first
+        base_delay (float): Backoff delay in seconds before jitter for the first retry
+        max_delay (float): Upper bound in seconds for any single backoff delay
+        min_timeout (float): Smallest upstream timeout worth attempting, in seconds
+
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.05, max_delay=0.5, min_timeout=0.05):
+        """Constructor for a retry policy
+
+        Args:
+            max_attempts (int): Maximum number of attempts per service, including the first
+            base_delay (float): Backoff delay in seconds before jitter for the first retry
+            max_delay (float): Upper bound in seconds for any single backoff delay
+            min_timeout (float): Smallest upstream timeout worth attempting, in seconds
+
+        """
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.min_timeout = float(min_timeout)
+
+    def backoff(self, retry):
+        """Computes a jittered delay to wait before a retry
+
+        Args:
+            retry (int): Zero-based index of the retry about to be made
+
+        Returns:
+            float: Number of seconds to wait
+
+        """
+        ceiling = min(self.max_delay, self.base_delay * (2 ** retry))
+        return random.uniform(0.0, ceiling)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""Collection of helpers used to encode geoproxy responses
+
+Responses are JSON by default. Clients that send "Accept: application/msgpack" receive
+MessagePack (https://msgpack.org) instead, which is more compact and cheaper to decode.
+
+Only the small subset of MessagePack that geoproxy responses need is implemented here (nil,
+booleans, integers, float64, strings, binary, arrays and maps), so the format does not add a
+dependency. The output is standard MessagePack and can be read by any msgpack library.
+
+"""
+
+import struct
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+# media types that select MessagePack in an Accept header
+MSGPACK_MEDIA_TYPES = (MSGPACK_CONTENT_TYPE, "application/x-msgpack")
+
+_FLOAT64 = struct.Struct(">Bd")
+
+
+def accepts_msgpack(accept):
+    """Checks if an Accept header prefers MessagePack over JSON
+
+    MessagePack must be named explicitly, wildcards keep the default JSON encoding. When both
+    are named, the one with the higher quality wins, with ties going to MessagePack.
+
+    Args:
+        accept (string): Value of the Accept header, None if it was not sent
+
+    Returns:
+        bool: If the response should be encoded as MessagePack
+
+    """
+    if not accept:
+        return False
+    msgpack_quality = 0.0
+    json_quality = 0.0
+    for media_range in accept.split(","):
+        media_type, _, parameters = media_range.partition(";")
+        media_type = media_type.strip().lower()
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type in MSGPACK_MEDIA_TYPES:
+            msgpack_quality = max(msgpack_quality, quality)
+        elif media_type == JSON_CONTENT_TYPE:
+            json_quality = max(json_quality, quality)
+    return msgpack_quality > 0 and msgpack_quality >= json_quality
+
+
+def pack_map_header(buf, size):
+    """Appends the header of a map with size key/value pairs
+
+    Args:
+        buf (bytearray): Output buffer
+        size (int): Number of key/value pairs that follow
+
+    """
+    if size < 16:
+        buf.append(0x80 | size)
+    elif size < 0x10000:
+        buf += struct.pack(">BH", 0xde, size)
+    else:
+        buf += struct.pack(">BI", 0xdf, size)
+
+
+def pack_array_header(buf, size):
+    """Appends the header of an array with size items
+
+    Args:
+        buf (bytearray): Output buffer
+        size (int): Number of items that follow
+
+    """
+    if size < 16:
+        buf.append(0x90 | size)
+    elif size < 0x10000:
+        buf += struct.pack(">BH", 0xdc, size)
+    else:
+        buf += struct.pack(">BI", 0xdd, size)
+
+
+def pack_str(buf, value):
+    """Appends a string
+
+    Args:
+        buf (bytearray): Output buffer
+        value (string): String to append
+
+    """
+    data = value.encode("utf-8")
+    size = len(data)
+    if size < 32:
+        buf.append(0xa0 | size)
+    elif size < 0x100:
+        buf += struct.pack(">BB", 0xd9, size)
+    elif size < 0x10000:
+        buf += struct.pack(">BH", 0xda, size)
+    else:
+        buf += struct.pack(">BI", 0xdb, size)
+    buf += data
+
+
+def pack_int(buf, value):
+    """Appends an integer, in its smallest encoding
+
+    Args:
+        buf (bytearray): Output buffer
+        value (int): Integer between -2**63 and 2**64 - 1
+
+    """
+    if 0 <= value < 0x80:
+        buf.append(value)
+    elif -32 <= value < 0:
+        buf.append(value & 0xff)
+    elif value >= 0:
+        if value < 0x100:
+            buf += struct.pack(">BB", 0xcc, value)
+        elif value < 0x10000:
+            buf += struct.pack(">BH", 0xcd, value)
+        elif value < 0x100000000:
+            buf += struct.pack(">BI", 0xce, value)
+        else:
+            buf += struct.pack(">BQ", 0xcf, value)
+    elif value >= -0x80:
+        buf += struct.pack(">Bb", 0xd0, value)
+    elif value >= -0x8000:
+        buf += struct.pack(">Bh", 0xd1, value)
+    elif value >= -0x80000000:
+        buf += struct.pack(">Bi", 0xd2, value)
+    else:
+        buf += struct.pack(">Bq", 0xd3, value)
+
+
+def pack(buf, value):
+    """Appends any supported value
+
+    Args:
+        buf (bytearray): Output buffer
+        value (obj): None, bool, int, float, string, bytes, list, tuple or dict
+
+    Raises:
+        TypeError: If the value (or an item inside it) cannot be encoded
+
+    """
+    # exact type checks first, for the strings and floats that make up most of a response
+    value_type = type(value)
+    if value_type is str:
+        pack_str(buf, value)
+    elif value_type is float:
+        buf += _FLOAT64.pack(0xcb, value)
+    elif value is None:
+        buf.append(0xc0)
+    elif value is True:
+        buf.append(0xc3)
+    elif value is False:
+        buf.append(0xc2)
+    elif isinstance(value, str):
+        pack_str(buf, value)
+    elif isinstance(value, float):
+        buf += _FLOAT64.pack(0xcb, value)
+    elif isinstance(value, int):
+        pack_int(buf, value)
+    elif isinstance(value, dict):
+        pack_map_header(buf, len(value))
+        for key, item in value.items():
+            pack(buf, key)
+            pack(buf, item)
+    elif isinstance(value, (list, tuple)):
+        pack_array_header(buf, len(value))
+        for item in value:
+            pack(buf, item)
+    elif isinstance(value, (bytes, bytearray)):
+        size = len(value)
+        if size < 0x100:
+            buf += struct.pack(">BB", 0xc4, size)
+        elif size < 0x10000:
+            buf += struct.pack(">BH", 0xc5, size)
+        else:
+            buf += struct.pack(">BI", 0xc6, size)
+        buf += value
+    else:
+        raise TypeError("Cannot encode {} as MessagePack".format(type(value).__name__))
+
+
+def packb(value):
+    """Encodes a value as MessagePack
+
+    Args:
+        value (obj): Value supported by pack()
+
+    Returns:
+        bytes: Encoded value
+
+    """
+    buf = bytearray()
+    pack(buf, value)
+    return bytes(buf)
+
+
+# deepest nesting of arrays and maps that unpackb decodes, well below the recursion limit
+MAX_DEPTH = 32
+
+# fixed size formats read by unpackb: type byte -> (struct format, size)
+_FIXED_FORMATS = {
+    0xca: (">f", 4), 0xcb: (">d", 8),
+    0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+    0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8),
+}
+# variable length formats read by unpackb: type byte -> (kind, length format, length size)
+_SIZED_FORMATS = {
+    0xc4: ("bin", ">B", 1), 0xc5: ("bin", ">H", 2), 0xc6: ("bin", ">I", 4),
+    0xd9: ("str", ">B", 1), 0xda: ("str", ">H", 2), 0xdb: ("str", ">I", 4),
+    0xdc: ("array", ">H", 2), 0xdd: ("array", ">I", 4),
+    0xde: ("map", ">H", 2), 0xdf: ("map", ">I", 4),
+}
+
+
+def _unpack(data, offset, depth=0):
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xe0:
+        return code - 0x100, offset
+    if code == 0xc0:
+        return None, offset
+    if code in (0xc2, 0xc3):
+        return code == 0xc3, offset
+    if code in _FIXED_FORMATS:
+        fmt, size = _FIXED_FORMATS[code]
+        return struct.unpack_from(fmt, data, offset)[0], offset + size
+    if 0xa0 <= code < 0xc0:
+        kind, size = "str", code & 0x1f
+    elif 0x90 <= code < 0xa0:
+        kind, size = "array", code & 0x0f
+    elif 0x80 <= code < 0x90:
+        kind, size = "map", code & 0x0f
+    elif code in _SIZED_FORMATS:
+        kind, fmt, length = _SIZED_FORMATS[code]
+        size = struct.unpack_from(fmt, data, offset)[0]
+        offset += length
+    else:
+        raise ValueError("Unsupported MessagePack type 0x{:02x}".format(code))
+    if kind in ("str", "bin"):
+        value = bytes(data[offset:offset + size])
+        if len(value) != size:
+            raise ValueError("Truncated MessagePack data")
+        return (value.decode("utf-8") if kind == "str" else value), offset + size
+    if depth >= MAX_DEPTH:
+        raise ValueError("MessagePack data nested too deeply")
+    if kind == "array":
+        items = []
+        for _ in range(size):
+            item, offset = _unpack(data, offset, depth + 1)
+            items.append(item)
+        return items, offset
+    result = {}
+    for _ in range(size):
+        key, offset = _unpack(data, offset, depth + 1)
+        if isinstance(key, (list, dict)):
+            raise ValueError("Unsupported MessagePack map key")
+        result[key], offset = _unpack(data, offset, depth + 1)
+    return result, offset
+
+
+def unpackb(data):
+    """Decodes a MessagePack value
+
+    Args:
+        data (bytes): Encoded value
+
+    Returns:
+        obj: Decoded value, maps are returned as dicts and arrays as lists
+
+    Raises:
+        ValueError: If the data is not a single, supported MessagePack value, or its arrays and
+                    maps are nested more than MAX_DEPTH deep
+
+    """
+    try:
+        value, offset = _unpack(data, 0)
+    except (IndexError, struct.error):
+        raise ValueError("Truncated MessagePack data")
+    if offset != len(data):
+        raise ValueError("Extra data after MessagePack value")
+    return value
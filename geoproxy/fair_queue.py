@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to share upstream capacity fairly between tenants
+
+Without scheduling, a service's threads go to whoever asks first, so a tenant sending a bulk
+job can take all of them and leave interactive requests from other tenants waiting. A
+FairScheduler hands out a fixed number of slots using weighted fair queueing: each tenant
+receives a share of the slots proportional to its weight while tenants compete, and any tenant
+may use all of the slots while the others are idle.
+
+Requests are also placed in one of two lanes. Waiting interactive requests are always served
+before waiting bulk requests, and within a lane tenants are served in weighted fair order.
+
+"""
+
+from datetime import timedelta
+import heapq
+import itertools
+import time
+from tornado.concurrent import Future
+from tornado.gen import with_timeout
+import tornado.gen
+
+# lanes in the order they are served
+LANES = ("interactive", "bulk")
+# tenant of requests that do not name one, or name an unknown one
+DEFAULT_TENANT = "default"
+
+
+class TenantStats:
+    """Scheduling statistics of a single tenant
+
+    Attributes:
+        weight (float): Share of the slots relative to other tenants
+        requests (int): Number of slots requested
+        granted (dict): Map from lane to the number of slots granted
+        rejected (int): Number of requests rejected because the queue was full
+        timed_out (int): Number of requests that gave up waiting
+        waiting (int): Number of requests currently waiting
+        total_wait (float): Seconds waited by the granted requests
+        max_wait (float): Longest wait of a granted request in seconds
+
+    """
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.requests = 0
+        self.granted = {lane: 0 for lane in LANES}
+        self.rejected = 0
+        self.timed_out = 0
+        self.waiting = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def to_dict(self):
+        """Statistics as a dict, as reported on "/stats"
+
+        Returns:
+            dict: Weight, requests, slots granted per lane, rejections, timeouts, waiting
+                  requests, and the mean and maximum wait in seconds
+
+        """
+        granted = sum(self.granted.values())
+        return {"weight": self.weight, "requests": self.requests, "granted": dict(self.granted),
+                "rejected": self.rejected, "timed_out": self.timed_out,
+                "waiting": self.waiting,
+                "mean_wait": round(self.total_wait / granted, 6) if granted else 0.0,
+                "max_wait": round(self.max_wait, 6)}
+
+
+class FairScheduler:
+    """Weighted fair queue of requests for a fixed number of slots
+
+    Slots are granted immediately while any are free and nobody is waiting. Otherwise the
+    request waits, unless max_queue requests are already waiting, in which case it is
+    rejected. Waiting requests are ordered with self-clocked fair queueing: each request is
+    tagged with a virtual finish time, its tenant's previous tag (or the current virtual time,
+    if later) plus 1 / weight, and the request with the smallest tag in the highest lane is
+    served first. A tenant that was idle does not accumulate credit, so it cannot starve the
+    others when it comes back.
+
+    Only tenants listed in the weights have their own queue and statistics, other tenant names
+    share the default tenant, so that clients cannot grow the scheduler's state without bound.
+    Slots are acquired and released on the IOLoop thread, so no locking is needed.
+
+    Attributes:
+        capacity (int): Number of slots
+        max_queue (int): Maximum number of waiting requests
+        in_use (int): Number of slots granted and not yet released
+        virtual_time (float): Tag of the request served last
+        tenants (dict): Map from tenant name to its TenantStats
+
+    """
+
+    def __init__(self, capacity, max_queue=16, weights=None, default_weight=1.0):
+        """Constructor for the scheduler
+
+        Args:
+            capacity (int): Number of slots
+            max_queue (int): Maximum number of waiting requests
+            weights (dict): Map from tenant name to its weight, eg {"search": 3, "batch": 1}
+            default_weight (float): Weight of the default tenant
+
+        """
+        self.capacity = max(1, capacity)
+        self.max_queue = max(0, max_queue)
+        self.in_use = 0
+        self.virtual_time = 0.0
+        self.tenants = {tenant: TenantStats(float(weight))
+                        for tenant, weight in (weights or {}).items() if weight > 0}
+        self.tenants.setdefault(DEFAULT_TENANT, TenantStats(float(default_weight)))
+        self._finish_tags = {}
+        self._lanes = {lane: [] for lane in LANES}
+        self._waiting = 0
+        self._sequence = itertools.count()
+
+    def tenant(self, name):
+        """Name under which a tenant is scheduled
+
+        Args:
+            name (string): Tenant named by the request, None if it did not name one
+
+        Returns:
+            string: The tenant's name if it has a weight, otherwise the default tenant
+
+        """
+        return name if name in self.tenants else DEFAULT_TENANT
+
+    def try_acquire(self, tenant=None, lane="interactive"):
+        """Takes a slot if one is free and nobody is waiting, without waiting
+
+        Args:
+            tenant (string): Tenant making the request
+            lane (string): Lane of the request, one of LANES
+
+        Returns:
+            bool: If a slot was granted
+
+        """
+        stats = self.tenants[self.tenant(tenant)]
+        stats.requests += 1
+        if self.in_use < self.capacity and self._waiting == 0:
+            self.in_use += 1
+            stats.granted[lane] += 1
+            return True
+        stats.rejected += 1
+        return False
+
+    async def acquire(self, tenant=None, lane="interactive", timeout=None):
+        """Waits for a slot in weighted fair order
+
+        Args:
+            tenant (string): Tenant making the request
+            lane (string): Lane of the request, one of LANES
+            timeout (float): Maximum number of seconds to wait, None to wait indefinitely
+
+        Returns:
+            bool: If a slot was granted, False if the queue was full or the timeout expired
+
+        """
+        tenant = self.tenant(tenant)
+        stats = self.tenants[tenant]
+        stats.requests += 1
+        if self.in_use < self.capacity and self._waiting == 0:
+            self.in_use += 1
+            stats.granted[lane] += 1
+            return True
+        if self._waiting >= self.max_queue or (timeout is not None and timeout <= 0):
+            stats.rejected += 1
+            return False
+
+        tag = max(self.virtual_time, self._finish_tags.get(tenant, 0.0)) + 1.0 / stats.weight
+        self._finish_tags[tenant] = tag
+        future = Future()
+        heapq.heappush(self._lanes[lane], (tag, next(self._sequence), tenant, lane, future,
+                                           time.monotonic()))
+        self._waiting += 1
+        stats.waiting += 1
+        try:
+            if timeout is None:
+                await future
+            else:
+                await with_timeout(timedelta(seconds=timeout), future)
+        except tornado.gen.TimeoutError:
+            if future.done():
+                # granted just as the timeout expired, hand the slot on
+                self.release()
+            else:
+                # the entry stays in its lane and is skipped when it reaches the head
+                future.cancel()
+                self._waiting -= 1
+                stats.waiting -= 1
+            stats.timed_out += 1
+            return False
+        return True
+
+    def release(self):
+        """Returns a granted slot, and grants it to the next waiting request
+        """
+        self.in_use = max(0, self.in_use - 1)
+        while self.in_use < self.capacity:
+            entry = self._next_waiting()
+            if entry is None:
+                return
+            tag, _, tenant, lane, future, enqueue_time = entry
+            self.virtual_time = tag
+            self.in_use += 1
+            self._waiting -= 1
+            stats = self.tenants[tenant]
+            stats.waiting -= 1
+            stats.granted[lane] += 1
+            wait = time.monotonic() - enqueue_time
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            future.set_result(True)
+
+    def _next_waiting(self):
+        for lane in LANES:
+            queue = self._lanes[lane]
+            while queue:
+                entry = heapq.heappop(queue)
+                if not entry[4].cancelled():
+                    return entry
+        return None
+
+    def queue_depth(self):
+        """Number of waiting requests
+
+        Returns:
+            int: Current queue depth
+
+        """
+        return self._waiting
+
+    def queue_wait(self):
+        """Time that the longest waiting request has spent in the queue
+
+        Returns:
+            float: Seconds waited, 0 if nobody is waiting
+
+        """
+        now = time.monotonic()
+        waits = [now - entry[5] for queue in self._lanes.values() for entry in queue
+                 if not entry[4].cancelled()]
+        return max(waits or [0.0])
+
+    def stats(self):
+        """Current state of the scheduler
+
+        Returns:
+            dict: Map from tenant name to TenantStats.to_dict()
+
+        """
+        return {tenant: stats.to_dict() for tenant, stats in self.tenants.items()}
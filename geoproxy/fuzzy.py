@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to answer cache misses from similar cached queries
+
+Many cache misses are near duplicates of cached queries, spelled differently ("350 5th Ave NY"
+and "350 Fifth Avenue, New York") or with a typo in the street name ("1600 Amphitheater Pkwy"
+and "1600 Amphitheatre Parkway"). A FuzzyIndex holds the canonical form of every cached query
+(see canonicalize_address), and finds the cached query most similar to a missed one, by the
+overlap of the character trigrams of their streets.
+
+Similar looking addresses are often different places, so only the street name may differ.
+Queries are only compared when they have the same house, street and unit numbers in the same
+order ("350 5th Ave" is not "350 6th Ave" or "530 5th Ave"), the same directions ("100 S Main
+St" is not "100 N Main St"), the same street suffix ("Main St" is not "Main Ave") and the same
+words after the street, ie the locality and state ("Portland, ME" is not "Portland, OR").
+Addresses without a street suffix cannot be split into a street and a locality, so they are only
+compared when all their words are the same. Postal codes are only compared when both queries
+have one. Queries with different bounds or resolution modes are never compared either.
+
+"""
+
+from collections import OrderedDict
+
+from geoproxy.address import DIRECTIONS
+from geoproxy.address import STREET_SUFFIXES
+from geoproxy.address import canonicalize_address
+
+# shortest run of digits treated as a postal code rather than a house or street number
+POSTAL_CODE_DIGITS = 5
+
+
+def trigrams(text):
+    """Character trigrams of a string, padded so that short words have some
+
+    Args:
+        text (string): Canonical address
+
+    Returns:
+        frozenset: Trigrams of the string
+
+    """
+    padded = " {} ".format(text)
+    return frozenset(padded[index:index + 3] for index in range(len(padded) - 2))
+
+
+def address_numbers(canonical):
+    """Splits the numbers out of a canonical address
+
+    Args:
+        canonical (string): Canonical address
+
+    Returns:
+        tuple: Tuple of the words containing digits other than postal codes, in order (eg
+               ("350", "5th")), and the frozenset of postal codes
+
+    """
+    numbers = []
+    postal_codes = []
+    for word in canonical.split():
+        if word.isdigit() and len(word) >= POSTAL_CODE_DIGITS:
+            postal_codes.append(word)
+        elif any(character.isdigit() for character in word):
+            numbers.append(word)
+    return tuple(numbers), frozenset(postal_codes)
+
+
+class FuzzyIndex:
+    """Index of cached query keys, searched for the key most similar to a missed query
+
+    Keys are grouped by everything but their street name (numbers, directions, street suffix,
+    locality, bounds and mode), and only the keys of a query's group are compared with it, so a
+    lookup compares at most max_group keys whatever the size of the index. The similarity of two
+    queries is the Dice coefficient of the trigrams of their streets, between 0 and 1. The
+    number of keys is bounded, the least recently added keys are evicted first.
+
+    The index is used from the IOLoop thread only, so no locking is needed.
+
+    Attributes:
+        threshold (float): Lowest similarity at which a cached query answers a missed one
+        max_size (int): Maximum number of keys held
+        max_group (int): Maximum number of keys held per group
+
+    """
+
+    def __init__(self, threshold=0.8, max_size=10000, max_group=64):
+        """Constructor for the index
+
+        Args:
+            threshold (float): Lowest similarity at which a cached query answers a missed one
+            max_size (int): Maximum number of keys held
+            max_group (int): Maximum number of keys held per group
+
+        """
+        self.threshold = threshold
+        self.max_size = max(1, max_size)
+        self.max_group = max(1, max_group)
+        # map from key to its group, in the order the keys were added
+        self._keys = OrderedDict()
+        # map from group to a map from key to its trigrams and postal codes
+        self._groups = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    @staticmethod
+    def describe(key):
+        """Breaks a cache key down into what the index compares
+
+        Args:
+            key (string): Cache key (see cache_key)
+
+        Returns:
+            tuple: Group of the key (the words that must be the same, and its bounds and mode),
+                   the trigrams of its street, and its postal codes
+
+        """
+        address, _, qualifiers = key.partition("|")
+        canonical = canonicalize_address(address)
+        numbers, postal_codes = address_numbers(canonical)
+        words = canonical.split()
+        # the street ends at its suffix, the first word is never a suffix ("St Louis")
+        end = next((index for index in range(1, len(words)) if words[index] in STREET_SUFFIXES),
+                   None)
+        if end is None:
+            street, rest = (), words
+        else:
+            street, rest = words[:end + 1], words[end + 1:]
+        directions = tuple(word for word in street if word in DIRECTIONS)
+        suffix = street[-1] if street else None
+        # postal codes are compared on their own, a query without one is still similar
+        locality = tuple(word for word in rest if word not in postal_codes)
+        group = (numbers, directions, suffix, locality, qualifiers)
+        return group, trigrams(" ".join(street)) if street else frozenset(), postal_codes
+
+    def add(self, key):
+        """Adds the key of a freshly cached result
+
+        Args:
+            key (string): Cache key
+
+        """
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            self._groups[self._keys[key]].move_to_end(key)
+            return
+        group, key_trigrams, postal_codes = self.describe(key)
+        entries = self._groups.setdefault(group, OrderedDict())
+        entries[key] = (key_trigrams, postal_codes)
+        self._keys[key] = group
+        if len(entries) > self.max_group:
+            self.discard(next(iter(entries)))
+        while len(self._keys) > self.max_size:
+            self.discard(next(iter(self._keys)))
+
+    def discard(self, key):
+        """Removes a key, eg one whose result has expired from the cache
+
+        Args:
+            key (string): Cache key
+
+        """
+        group = self._keys.pop(key, None)
+        if group is None:
+            return
+        entries = self._groups[group]
+        del entries[key]
+        if not entries:
+            del self._groups[group]
+
+    def lookup(self, key):
+        """Finds the indexed key most similar to a query's key
+
+        Args:
+            key (string): Cache key of the query
+
+        Returns:
+            None/tuple: (key, similarity) of the most similar key at or above the threshold,
+                        None if there is none
+
+        """
+        group, key_trigrams, postal_codes = self.describe(key)
+        best, best_similarity = None, self.threshold
+        for candidate, (candidate_trigrams, candidate_postal_codes) in \
+                self._groups.get(group, {}).items():
+            if postal_codes and candidate_postal_codes and \
+                    postal_codes != candidate_postal_codes:
+                continue
+            total = len(key_trigrams) + len(candidate_trigrams)
+            # keys without a street are only grouped with keys of the same words
+            similarity = 2.0 * len(key_trigrams & candidate_trigrams) / total if total else 1.0
+            if similarity >= best_similarity and candidate != key:
+                best, best_similarity = candidate, similarity
+        if best is None:
+            return None
+        return best, best_similarity
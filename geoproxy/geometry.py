@@ -3,6 +3,70 @@
 """Collection of geometric support classes
 """
 
+import math
+
+# mean radius of the earth, in meters
+EARTH_RADIUS = 6371008.8
+# base 32 alphabet of geohashes
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def haversine_distance(a, b):
+    """Great circle distance between two coordinates, using the haversine formula
+
+    Args:
+        a (Coordinate): First coordinate
+        b (Coordinate): Second coordinate
+
+    Returns:
+        float: Distance in meters, elevation is ignored
+
+    """
+    lat_a = math.radians(a.latitude)
+    lat_b = math.radians(b.latitude)
+    d_lat = lat_b - lat_a
+    d_lon = math.radians(b.longitude - a.longitude)
+    h = math.sin(d_lat / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def geohash(latitude, longitude, precision=5):
+    """Geohash of a location, a cell of a hierarchical grid over the earth
+
+    Every character halves the cell five times, alternating between longitude and latitude,
+    so a geohash is a prefix of the geohashes of all the locations within its cell (eg a
+    precision of 4 gives cells of about 39km by 20km at the equator).
+
+    Args:
+        latitude (float): Latitude of the location, between -90 and 90
+        longitude (float): Longitude of the location, between -180 and 180
+        precision (int): Number of characters in the geohash
+
+    Returns:
+        string: Geohash of the cell containing the location
+
+    """
+    latitude_range = [-90.0, 90.0]
+    longitude_range = [-180.0, 180.0]
+    characters = []
+    bits, value, even = 0, 0, True
+    while len(characters) < precision:
+        value_range, position = ((longitude_range, longitude) if even
+                                 else (latitude_range, latitude))
+        middle = (value_range[0] + value_range[1]) / 2
+        if position >= middle:
+            value = value << 1 | 1
+            value_range[0] = middle
+        else:
+            value = value << 1
+            value_range[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            characters.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return "".join(characters)
+
 
 class Coordinate:
     """Container class for a geometric waypoint
@@ -16,6 +80,7 @@ class Coordinate:
         elevation (float): Value representing the elevation of the coordinate
 
     """
+    __slots__ = ("latitude", "longitude", "elevation")
 
     def __init__(self, lat, lon, elev=0.0):
         """Constructor for a coordinate
@@ -64,6 +129,8 @@ class BoundingBox:
         bottom_right (Coordinate): Corner coordinate of the box
 
     """
+    __slots__ = ("top_left", "top_right", "bottom_left", "bottom_right")
+
     def __init__(self):
         self.top_left = None
         self.top_right = None
@@ -102,6 +169,34 @@ class BoundingBox:
         self.top_right = Coordinate(tl.latitude, br.longitude)
         self.bottom_left = Coordinate(br.latitude, tl.longitude)
 
+    def center(self):
+        """Center of the box
+
+        Returns:
+            Coordinate: Coordinate halfway between the bottom left and top right corners
+
+        """
+        return Coordinate((self.bottom_left.latitude + self.top_right.latitude) / 2,
+                          (self.bottom_left.longitude + self.top_right.longitude) / 2)
+
+    def geohash(self, precision=5):
+        """Smallest geohash cell, up to a precision, that contains the whole box
+
+        Args:
+            precision (int): Maximum number of characters in the geohash
+
+        Returns:
+            string: Geohash of the cell, an empty string if no cell smaller than the whole
+                    earth contains the box
+
+        """
+        bottom_left = geohash(self.bottom_left.latitude, self.bottom_left.longitude, precision)
+        top_right = geohash(self.top_right.latitude, self.top_right.longitude, precision)
+        length = 0
+        while length < precision and bottom_left[length] == top_right[length]:
+            length += 1
+        return bottom_left[:length]
+
     def __str__(self):
         """String representation of a Bounding Box
 
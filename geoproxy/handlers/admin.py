@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import hmac
+import ipaddress
+import json
+from tornado.gen import sleep
+import tornado.web
+
+from geoproxy.profiling import SamplingProfiler
+from geoproxy.profiling import TracingProfiler
+
+
+class AdminRequestHandler(tornado.web.RequestHandler):
+    """Base tornado handler class for operator only endpoints
+
+    Requests must carry the admin token in the X-Geoproxy-Admin-Token header. When the server
+    has no admin token configured, only requests from the loopback interface are accepted.
+
+    Attributes:
+        token (string): Shared secret expected from operators, None to only accept loopback
+                        requests
+
+    """
+
+    # header carrying the operator's shared secret
+    TOKEN_HEADER = "X-Geoproxy-Admin-Token"
+
+    def initialize(self, token=None):
+        """Constructor for AdminRequestHandler
+
+        Args:
+            token (string): Shared secret expected from operators, None to only accept loopback
+                            requests
+
+        """
+        self.token = token
+
+    def prepare(self):
+        """Rejects requests that are not from an operator
+        """
+        if self.token:
+            token = self.request.headers.get(self.TOKEN_HEADER, "")
+            if not hmac.compare_digest(token.encode("utf-8"), self.token.encode("utf-8")):
+                raise tornado.web.HTTPError(403)
+        else:
+            try:
+                loopback = ipaddress.ip_address(self.request.remote_ip).is_loopback
+            except ValueError:
+                loopback = False
+            if not loopback:
+                raise tornado.web.HTTPError(403)
+
+    def get_float_argument(self, name, default, minimum, maximum):
+        """Reads a numeric argument, clamped to a range
+
+        Args:
+            name (string): Argument name
+            default (float): Value when the argument is missing
+            minimum (float): Smallest accepted value
+            maximum (float): Largest accepted value
+
+        Returns:
+            float: Argument value
+
+        Raises:
+            tornado.web.HTTPError: 400 if the argument is not a number
+
+        """
+        try:
+            value = float(self.get_argument(name, default))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "{} must be a number".format(name))
+        return min(maximum, max(minimum, value))
+
+
+class CpuProfileRequestHandler(AdminRequestHandler):
+    """Tornado handler class that profiles the server's CPU usage for a number of seconds
+
+    GET "/admin/profile/cpu" accepts the following arguments:
+        seconds: Duration of the profile (default: 10, at most MAX_SECONDS)
+        format: "collapsed" (default) samples the stacks of every thread and returns collapsed
+                stacks as text, "pstats" traces the IOLoop thread with cProfile and returns a
+                binary pstats dump
+        interval: Seconds between samples in the collapsed format (default: 0.005)
+
+    Only one CPU profile runs at a time, concurrent requests receive a 409.
+
+    """
+
+    # longest profile that may be requested
+    MAX_SECONDS = 300
+    # set while a profile is running, shared by every handler instance
+    running = False
+
+    async def get(self):
+        """Request handler for method=GET
+        """
+        seconds = self.get_float_argument("seconds", 10, 0, self.MAX_SECONDS)
+        profile_format = self.get_argument("format", "collapsed")
+        if profile_format == "collapsed":
+            profiler = SamplingProfiler(self.get_float_argument("interval", 0.005, 0.001, 1))
+        elif profile_format == "pstats":
+            profiler = TracingProfiler()
+        else:
+            raise tornado.web.HTTPError(400, "format must be collapsed or pstats")
+        if CpuProfileRequestHandler.running:
+            raise tornado.web.HTTPError(409, "A CPU profile is already running")
+
+        CpuProfileRequestHandler.running = True
+        try:
+            profiler.start()
+            try:
+                await sleep(seconds)
+            finally:
+                profiler.stop()
+        finally:
+            CpuProfileRequestHandler.running = False
+
+        if profile_format == "collapsed":
+            self.set_header("Content-Type", "text/plain; charset=UTF-8")
+            self.write(profiler.collapsed())
+        else:
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Disposition", 'attachment; filename="geoproxy.pstats"')
+            self.write(profiler.dump())
+
+
+class MemoryProfileRequestHandler(AdminRequestHandler):
+    """Tornado handler class that traces the server's memory allocations
+
+    "/admin/profile/memory" supports the following methods:
+        POST: Starts tracing allocations, the frames argument sets the traceback depth
+              (default: 1)
+        GET: Reports the traced memory, the top allocations and the difference since the
+             previous GET as JSON, the limit argument sets the number of entries (default: 25)
+             and key_type their grouping ("lineno", "filename" or "traceback")
+        DELETE: Stops tracing allocations
+
+    Attributes:
+        memory_profiler (MemoryProfiler): Tracer shared by every request
+
+    """
+
+    def initialize(self, memory_profiler, token=None):
+        """Constructor for MemoryProfileRequestHandler
+
+        Args:
+            memory_profiler (MemoryProfiler): Tracer shared by every request
+            token (string): Shared secret expected from operators, None to only accept loopback
+                            requests
+
+        """
+        super(MemoryProfileRequestHandler, self).initialize(token)
+        self.memory_profiler = memory_profiler
+        self.set_header("Content-Type", "application/json")
+
+    def post(self):
+        """Request handler for method=POST, starts tracing
+        """
+        frames = int(self.get_float_argument("frames", 1, 1, 100))
+        self.memory_profiler.start(frames)
+        self.write(json.dumps({"tracing": True, "frames": frames}))
+
+    def get(self):
+        """Request handler for method=GET, reports a snapshot and its diff
+        """
+        if not self.memory_profiler.tracing:
+            raise tornado.web.HTTPError(409, "Memory tracing is not started")
+        key_type = self.get_argument("key_type", "lineno")
+        if key_type not in ("lineno", "filename", "traceback"):
+            raise tornado.web.HTTPError(400, "key_type must be lineno, filename or traceback")
+        limit = int(self.get_float_argument("limit", 25, 1, 1000))
+        self.write(json.dumps(self.memory_profiler.report(limit, key_type)))
+
+    def delete(self):
+        """Request handler for method=DELETE, stops tracing
+        """
+        self.memory_profiler.stop()
+        self.write(json.dumps({"tracing": False}))
+
+
+class StatsRequestHandler(AdminRequestHandler):
+    """Tornado handler class reporting the server's operational statistics as JSON
+
+    GET "/stats" returns the statistics collected by the application, eg the number of
+    requests in flight and shed, and the queue depth and saturation of each service's
+    bulkhead.
+
+    Attributes:
+        stats (callable): Returns the statistics as a dict
+
+    """
+
+    def initialize(self, stats, token=None):
+        """Constructor for StatsRequestHandler
+
+        Args:
+            stats (callable): Returns the statistics as a dict
+            token (string): Shared secret expected from operators, None to only accept loopback
+                            requests
+
+        """
+        super(StatsRequestHandler, self).initialize(token)
+        self.stats = stats
+        self.set_header("Content-Type", "application/json")
+
+    def get(self):
+        """Request handler for method=GET
+        """
+        self.write(json.dumps(self.stats()))
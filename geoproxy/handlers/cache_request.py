@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import hmac
+import json
+import tornado.web
+
+from geoproxy.api import valid_result
+from geoproxy.peer_cache import PeerCache
+
+
+class CacheRequestHandler(tornado.web.RequestHandler):
+    """Tornado handler class used by peers to share cached results
+
+    This class is responsible for handling requests made to "/cache" by other geoproxy nodes in
+    the cluster. GET returns the cached result for the "key" argument (or a 404 on a miss), and
+    PUT stores the JSON result in the request body under "key" (or responds with a 400 if it is
+    not a valid result, see valid_result). Only the entries that this node owns on the hash
+    ring are served from and stored in its cache.
+
+    Attributes:
+        cache (ResultCache): Cache of entries owned by this node
+        token (string): Shared secret expected from peers, None to reject every request
+
+    """
+
+    def initialize(self, cache, token=None):
+        """Constructor for CacheRequestHandler
+
+        Args:
+            cache (ResultCache): Cache of entries owned by this node
+            token (string): Shared secret expected from peers, None to reject every request
+
+        """
+        self.cache = cache
+        self.token = token
+        self.set_header("Content-Type", "application/json")
+
+    def prepare(self):
+        """Rejects requests that do not carry the peers' shared secret
+        """
+        # without a secret, anyone reaching the port could store results under any key
+        token = self.request.headers.get(PeerCache.TOKEN_HEADER, "")
+        if not self.token or not hmac.compare_digest(token.encode("utf-8"),
+                                                     self.token.encode("utf-8")):
+            raise tornado.web.HTTPError(403)
+
+    def get(self):
+        """Request handler for method=GET, returns a cached result
+        """
+        result = self.cache.get(self.get_argument("key"))
+        if result is None:
+            raise tornado.web.HTTPError(404)
+        self.write(json.dumps(result))
+
+    def put(self):
+        """Request handler for method=PUT, stores a result
+        """
+        try:
+            result = json.loads(self.request.body.decode('utf-8'))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        # a cache hit passes the result to GeoproxyResponse.set_result()
+        if not valid_result(result):
+            raise tornado.web.HTTPError(400)
+        self.cache.put(self.get_argument("key"), result)
+        self.set_status(204)
@@ -1,16 +1,27 @@
 #!/usr/bin/env python
 
-import json
-import socket
-import time
-from tornado.concurrent import run_on_executor
-from tornado.gen import coroutine
 import tornado.web
-import urllib.request
-import urllib.error
 
 from geoproxy.api import GeoproxyResponse
 from geoproxy.api import GeoproxyRequestParser
+from geoproxy.deadline import Deadline
+from geoproxy.encoding import MSGPACK_CONTENT_TYPE
+from geoproxy.encoding import accepts_msgpack
+
+
+def authenticate_tenant(request, tenant_tokens):
+    """Finds the tenant that a request's X-Geoproxy-Tenant-Token header authenticates
+
+    Args:
+        request (tornado.httputil.HTTPServerRequest): Incoming request
+        tenant_tokens (dict): Map from a client token to the tenant it authenticates
+
+    Returns:
+        string: Tenant of the request, None without a known token
+
+    """
+    token = request.headers.get(GeoproxyRequestHandler.TENANT_TOKEN_HEADER)
+    return tenant_tokens.get(token) if token else None
 
 
 class GeoproxyRequestHandler(tornado.web.RequestHandler):
@@ -21,135 +32,171 @@ class GeoproxyRequestHandler(tornado.web.RequestHandler):
     services, parsing response messages from those third party services, packaging a response
     back to the geoproxy client and handling errors conditions.
 
-    The handler utilizes an asynchronous get coroutine that tasks the third party service query
-    on a thread pool executor to allow the tornado server to simultaneously serve other connections
-    without blocking on slow third party service responses.
+    The handler utilizes a native get coroutine that hands the parsed request to the
+    shared GeoproxyResolver, which consults the cache and the third party services without
+    blocking the tornado server.
+
+    Every request is bounded by a deadline, taken from the server configuration and optionally
+    shortened by the client through the X-Geoproxy-Deadline-Ms header.
+
+    Responses are JSON, unless the client's Accept header asks for MessagePack.
+
+    Before any work is done, the request must be admitted by the shared AdmissionController.
+    Requests that arrive while the proxy is overloaded are rejected immediately with a 503 and
+    a Retry-After header, rather than queueing behind the executor.
 
     The class inherits from a tranditional tornado.web.RequestHandler and overwrites initialize()
     and get().
 
     Attributes:
         logger (logging.logger): Logger instances
-        executor (ThreadPoolExecutor): Thread pool for async tasks
-        available_services (dict): Map from service name to ThirdPartyServiceHelper
+        resolver (GeoproxyResolver): Resolves parsed requests through the cache and services
+        request_timeout (float): Maximum number of seconds to spend servicing a request
+        admission (AdmissionController): Shared load shedding policy
+        admitted (bool): If this request was admitted and holds an in-flight slot
+        geo_proxy_response (GeoproxyResponse): Response for the current request, read by the
+                                               access log
+        attempts (int): Number of third party requests made for the current request
+        use_msgpack (bool): If the response is encoded as MessagePack instead of JSON
+        recorder (TraceRecorder): Records incoming requests, None if disabled
+        tenant_tokens (dict): Map from a client token to the tenant it authenticates
 
     """
 
-    def initialize(self, logger, executor, available_services):
+    # header that clients can use to shorten the server's request deadline
+    DEADLINE_HEADER = "X-Geoproxy-Deadline-Ms"
+    # header carrying the client's token, which names the tenant that upstream capacity is
+    # scheduled for
+    TENANT_TOKEN_HEADER = "X-Geoproxy-Tenant-Token"
+
+    def initialize(self, logger, resolver, request_timeout=3.0, admission=None, recorder=None,
+                   tenant_tokens=None):
         """Constructor for GeoproxyRequestHandler
 
         Args:
             logger (logging.logger): Logger instances
-            executor (ThreadPoolExecutor): Thread pool for async tasks
-            available_services (dict): Map from service name to ThirdPartyServiceHelper
+            resolver (GeoproxyResolver): Resolves parsed requests through the cache and services
+            request_timeout (float): Maximum number of seconds to spend servicing a request
+            admission (AdmissionController): Shared load shedding policy
+            recorder (TraceRecorder): Records incoming requests, None if disabled
+            tenant_tokens (dict): Map from a client token to the tenant it authenticates,
+                                  requests without a known token have no tenant
 
         """
         self.logger = logger
-        self.executor = executor
+        self.resolver = resolver
         self.set_header("Content-Type", "application/json")
-        self.available_services = available_services
+        self.request_timeout = request_timeout
+        self.admission = admission
+        self.admitted = False
+        self.geo_proxy_response = None
+        self.attempts = 0
+        self.use_msgpack = False
+        self.recorder = recorder
+        self.tenant_tokens = tenant_tokens or {}
+
+    def prepare(self):
+        """Content negotiation and admission control, run by tornado before the request method
+
+        Rejects the request with a 503 if the admission controller reports that the proxy is
+        overloaded. Finishing the request here prevents tornado from calling get().
+
+        """
+        self.set_header("Vary", "Accept")
+        self.use_msgpack = accepts_msgpack(self.request.headers.get("Accept"))
+        if self.use_msgpack:
+            self.set_header("Content-Type", MSGPACK_CONTENT_TYPE)
+        if self.admission is None:
+            return
+        self.admitted = self.admission.try_acquire()
+        if not self.admitted:
+            self.logger.warning("Shedding request, server is overloaded")
+            self.geo_proxy_response = GeoproxyResponse()
+            self.geo_proxy_response.set_error("Server is overloaded, retry later", "UNAVAILABLE")
+            self.set_status(503)
+            self.set_header("Retry-After", str(self.admission.retry_after))
+            self.finish(self.encode_response(self.geo_proxy_response))
+
+    def on_finish(self):
+        """Releases the request's in-flight slot once the response has been sent
+        """
+        if self.admitted:
+            self.admitted = False
+            self.admission.release()
+
+    def encode_response(self, geo_proxy_response):
+        """Serializes a response in the negotiated encoding
+
+        Args:
+            geo_proxy_response (GeoproxyResponse): Response to serialize
 
-    @coroutine
-    def get(self):
+        Returns:
+            string/bytes: JSON string, or MessagePack bytes if the client accepts them
+
+        """
+        if self.use_msgpack:
+            return geo_proxy_response.to_msgpack()
+        return geo_proxy_response.to_json()
+
+    def create_deadline(self):
+        """Creates the deadline for the current request
+
+        The server's configured request timeout is the upper bound; clients may only ask for a
+        shorter deadline through the X-Geoproxy-Deadline-Ms header.
+
+        Returns:
+            Deadline: Time budget for the request
+
+        """
+        budget = self.request_timeout
+        header = self.request.headers.get(self.DEADLINE_HEADER)
+        if header is not None:
+            try:
+                budget = min(budget, max(0.0, float(header) / 1000.0))
+            except ValueError:
+                self.logger.warning("Ignoring invalid %s header: %s", self.DEADLINE_HEADER, header)
+        return Deadline(budget)
+
+    async def get(self):
         """Request handler for method=GET
 
-        Responsible for spawning third party geocoder query tasks based on parsed request data
+        Responsible for parsing the request and resolving it through the shared resolver
 
         Pseudo code:
         - Create empty response
+        - Create request deadline
         - Parse incoming request
         - If parse success:
-            - For each third party service:
-                - Build third party service query from incoming request data
-                - Spawn query task and wait on future for third party response
-                - Parse third party response
-                - If success:
-                    - Set response result
-                    - Break
-                - Next service in loop
+            - Resolve the request (see GeoproxyResolver.resolve)
         - Else:
             - Set response error
         - Send response
 
         """
-        start_time = time.time()
+        deadline = self.create_deadline()
+        if self.recorder is not None:
+            self.recorder.record_request(self.request.uri)
         # Create an empty API response
-        geo_proxy_response = GeoproxyResponse()
+        geo_proxy_response = self.geo_proxy_response = GeoproxyResponse()
 
         try:
             # Next, parse the inputs from the RESTful query and ensure they are all valid
-            geo_proxy_request = GeoproxyRequestParser(self.available_services, geo_proxy_response)
+            geo_proxy_request = GeoproxyRequestParser(self.resolver.available_services,
+                                                      geo_proxy_response,
+                                                      self.resolver.service_orders)
+            geo_proxy_request.tenant = authenticate_tenant(self.request, self.tenant_tokens)
             # if our request parse succeeds, we have valid input data and can proceed
             if geo_proxy_request.parse(self):
-                self.logger.info("Incoming request:\n{}".format(geo_proxy_request))
-                # iterate through each service in request.services until we get a successful result
-                for service in geo_proxy_request.services:
-                    self.logger.info("Querying third-party service: {}".format(service))
-                    # Grab the third party helper object, associated with the service
-                    # The helper assists with third party query construction and parsing
-                    service_helper = self.available_services[service]
-                    # build the third party query based on our request inputs
-                    service_helper.build_query(geo_proxy_request.address, geo_proxy_request.bounds)
-                    # run the query and yield the response
-                    response_json = yield self.query_third_party_geocoder(service_helper.query)
-                    if response_json:
-                        # if we got a valid response from the third party query, parse it!
-                        parse_success = service_helper.parser.parse(response_json)
-                        # fragile detection if there was a valid response, but zero results
-                        if parse_success == 0:
-                            geo_proxy_response.set_error("Zero results", "ZERO_RESULTS")
-                        # otherwise assume the parse was successful, and we extracted data
-                        # package it into our response object to be sent out.
-                        elif parse_success is not None:
-                            geo_proxy_response.error = None
-                            geo_proxy_response.set_result(
-                                service, service_helper.parser.latitude,
-                                service_helper.parser.longitude,
-                                service_helper.parser.address)
-                            # if we get a valid result, don't keep querying the other third
-                            # party services
-                            # NOTE: Making an assumption that we are only returning results from the
-                            # first valid third party service
-                            break
-
-            # if we had an error with both service requests, but no error has been set, do it now
-            # this handles cases like wrong API keys, offline services, etc.
-            if not geo_proxy_response.status == "OK" and geo_proxy_response.error is None:
-                geo_proxy_response.set_error("Error in third-party API requests", "UNKNOWN_ERROR")
+                self.logger.debug("Incoming request:\n%s", geo_proxy_request)
+                try:
+                    await self.resolver.resolve(geo_proxy_request, geo_proxy_response, deadline)
+                finally:
+                    self.attempts = geo_proxy_request.attempts
 
         except Exception as e:
             geo_proxy_response.set_error(
                 "Caught general exception in server: {}".format(e), "UNKNOWN_ERROR")
 
         # Ensure that a response is always sent so the socket doesn't bind
-        self.write(geo_proxy_response.to_json())
-        self.logger.info("Response completed in {:0.2f} seconds".format(time.time() - start_time))
-
-    @run_on_executor
-    def query_third_party_geocoder(self, query, timeout=1):
-        """Sends HTTP request to third party geocoding service
-
-        Args:
-            query (string): Query string to third party API including API keys
-            timeout (int): Number of seconds to wait for response before handling timeout exception
-
-        Returns:
-            None/dict: JSON data as dict on query success, otherwise None
-
-        """
-        response = None
-        # TODO(pickledagator): Consider bubbling up exceptions here
-        try:
-            response = urllib.request.urlopen(query, timeout=timeout).read().decode('utf-8')
-        except (urllib.error.HTTPError, urllib.error.URLError) as error:
-            self.logger.error("Error in API request: {}".format(error))
-        except socket.timeout:
-            self.logger.info("Timeout in API request")
-        # if our response succeeds, pass the data back upstream for the parsers to use
-        if response:
-            response_json = json.loads(response)
-            # deserialized the data before it goes out so that can use it easily
-            return response_json
-        # third party API query failed
-        else:
-            return None
+        # (request timing is reported by the access log once the response is finished)
+        self.write(self.encode_response(geo_proxy_response))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import json
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+import tornado.websocket
+
+from geoproxy.api import GeoproxyArguments
+from geoproxy.api import GeoproxyRequestParser
+from geoproxy.api import GeoproxyResponse
+from geoproxy.deadline import Deadline
+from geoproxy.encoding import unpackb
+from geoproxy.handlers.geoproxy_request import authenticate_tenant
+
+
+class GeoproxyWebSocketHandler(tornado.websocket.WebSocketHandler):
+    """Tornado handler class for a persistent geocoding channel
+
+    This class is responsible for WebSocket connections made to "/geocode/ws". Once connected, a
+    client sends a stream of JSON queries, each tagged with an id of its choosing and carrying
+    the same arguments as a "/geocode" request, eg:
+        {"id": 1, "address": "101 North St", "service": "here", "bounds": "...",
+         "deadline_ms": 500}
+
+    Queries are resolved concurrently through the shared GeoproxyResolver, and every query gets
+    exactly one reply as soon as it is resolved, so replies may arrive out of order. A reply is
+    the "/geocode" response with the query's id added, eg:
+        {"id": 1, "query": "101 North St", "status": "OK", "result": {...}}
+
+    Queries sent as binary messages are decoded as MessagePack, and answered with MessagePack
+    encoded binary replies carrying the same fields.
+
+    Each connection may have at most max_in_flight queries being resolved. Once the limit is
+    reached the handler stops reading from the connection until a query completes, which
+    pushes back on the client through TCP flow control instead of buffering unbounded work.
+    Each query is also subject to the shared AdmissionController, shed queries are answered
+    with the UNAVAILABLE status. The connection's queries are scheduled for the tenant that
+    the X-Geoproxy-Tenant-Token header of the handshake authenticates.
+
+    Attributes:
+        logger (logging.logger): Logger instances
+        resolver (GeoproxyResolver): Resolves parsed requests through the cache and services
+        request_timeout (float): Maximum number of seconds to spend servicing a query
+        admission (AdmissionController): Shared load shedding policy
+        max_in_flight (int): Maximum number of queries resolved concurrently per connection
+        in_flight (Semaphore): Slots for the connection's concurrent queries
+        tenant (string): Tenant of the connection's queries, None for an unauthenticated client
+
+    """
+
+    def initialize(self, logger, resolver, request_timeout=3.0, admission=None, max_in_flight=64,
+                   tenant_tokens=None):
+        """Constructor for GeoproxyWebSocketHandler
+
+        Args:
+            logger (logging.logger): Logger instances
+            resolver (GeoproxyResolver): Resolves parsed requests through the cache and services
+            request_timeout (float): Maximum number of seconds to spend servicing a query
+            admission (AdmissionController): Shared load shedding policy
+            max_in_flight (int): Maximum number of queries resolved concurrently per connection
+            tenant_tokens (dict): Map from a client token to the tenant it authenticates
+
+        """
+        self.logger = logger
+        self.resolver = resolver
+        self.request_timeout = request_timeout
+        self.admission = admission
+        self.max_in_flight = max_in_flight
+        self.in_flight = Semaphore(max_in_flight)
+        self.tenant = authenticate_tenant(self.request, tenant_tokens or {})
+
+    def create_deadline(self, query):
+        """Creates the deadline for a query
+
+        The server's configured request timeout is the upper bound; clients may only ask for a
+        shorter deadline through the query's "deadline_ms" field.
+
+        Args:
+            query (dict): Decoded query message
+
+        Returns:
+            Deadline: Time budget for the query
+
+        """
+        budget = self.request_timeout
+        deadline_ms = query.get("deadline_ms")
+        if deadline_ms is not None:
+            try:
+                budget = min(budget, max(0.0, float(deadline_ms) / 1000.0))
+            except (TypeError, ValueError):
+                self.logger.warning("Ignoring invalid deadline_ms: %s", deadline_ms)
+        return Deadline(budget)
+
+    async def on_message(self, message):
+        """Schedules a query, waiting for a free slot first
+
+        Tornado does not deliver the next message until the coroutine returned here completes,
+        so waiting on the semaphore applies backpressure to the connection.
+
+        Args:
+            message (string/bytes): JSON encoded query, or MessagePack encoded binary query
+
+        """
+        binary = isinstance(message, bytes)
+        try:
+            query = unpackb(message) if binary else json.loads(message)
+            if not isinstance(query, dict):
+                raise ValueError("query is not an object")
+        except (ValueError, RecursionError) as e:
+            # the JSON decoder recurses on nested arrays, unpackb limits its nesting instead
+            geo_proxy_response = GeoproxyResponse()
+            geo_proxy_response.set_error("Invalid query message: {}".format(e), "INVALID_REQUEST")
+            self.reply(None, geo_proxy_response, binary)
+            return
+        await self.in_flight.acquire()
+        IOLoop.current().spawn_callback(self.handle_query, query, binary)
+
+    async def handle_query(self, query, binary=False):
+        """Resolves a single query and sends its reply
+
+        Args:
+            query (dict): Decoded query message
+            binary (bool): If the reply is encoded as MessagePack
+
+        """
+        geo_proxy_response = GeoproxyResponse()
+        admitted = False
+        try:
+            if self.admission is not None:
+                admitted = self.admission.try_acquire()
+                if not admitted:
+                    self.logger.warning("Shedding query, server is overloaded")
+                    geo_proxy_response.set_error("Server is overloaded, retry later",
+                                                 "UNAVAILABLE")
+                    return
+            deadline = self.create_deadline(query)
+            geo_proxy_request = GeoproxyRequestParser(self.resolver.available_services,
+                                                      geo_proxy_response,
+                                                      self.resolver.service_orders)
+            geo_proxy_request.tenant = self.tenant
+            if geo_proxy_request.parse(GeoproxyArguments(query)):
+                self.logger.debug("Incoming query:\n%s", geo_proxy_request)
+                await self.resolver.resolve(geo_proxy_request, geo_proxy_response, deadline)
+        except Exception as e:
+            geo_proxy_response.set_error(
+                "Caught general exception in server: {}".format(e), "UNKNOWN_ERROR")
+        finally:
+            if admitted:
+                self.admission.release()
+            self.in_flight.release()
+            self.reply(query.get("id"), geo_proxy_response, binary)
+
+    def reply(self, tag, geo_proxy_response, binary=False):
+        """Sends the reply to a query, if the connection is still open
+
+        Args:
+            tag (obj): Id of the query, as sent by the client
+            geo_proxy_response (GeoproxyResponse): Response to the query
+            binary (bool): If the reply is encoded as MessagePack
+
+        """
+        try:
+            if binary:
+                self.write_message(geo_proxy_response.to_msgpack({"id": tag}), binary=True)
+                return
+            reply = {"id": tag}
+            reply.update(geo_proxy_response.to_dict())
+            self.write_message(json.dumps(reply))
+        except tornado.websocket.WebSocketClosedError:
+            self.logger.debug("Dropping reply to query %s, connection closed", tag)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+import json
+from tornado.ioloop import IOLoop
+import tornado.web
+
+from geoproxy.handlers.admin import AdminRequestHandler
+
+
+@tornado.web.stream_request_body
+class JobsRequestHandler(AdminRequestHandler):
+    """Tornado handler class that accepts bulk geocoding jobs
+
+    POST "/jobs" takes a file with one address per line as the request body, and the optional
+    "service" and "bounds" arguments of a "/geocode" request, and the "tenant" that the lines
+    are scheduled for, in the query string, which apply to every line. The body is streamed to
+    the job store as it arrives, rather than buffered in memory, and the job is queued once
+    the upload completes. The response is a 201 with the job's state, and a Location header
+    pointing at "/jobs/<id>", or a 429 when the job store is full. Like every "/jobs"
+    endpoint, it is only open to operators (see AdminRequestHandler).
+
+    Attributes:
+        logger (logging.logger): Logger instance
+        job_queue (JobQueue): Queue and store of the jobs
+        max_size (int): Maximum size of an uploaded file in bytes
+        upload (JobUpload): Upload of the current request's input file
+
+    """
+
+    def initialize(self, logger, job_queue, max_size, token=None):
+        """Constructor for JobsRequestHandler
+
+        Args:
+            logger (logging.logger): Logger instance
+            job_queue (JobQueue): Queue and store of the jobs
+            max_size (int): Maximum size of an uploaded file in bytes
+            token (string): Shared secret expected from operators, None to only accept
+                            loopback requests
+
+        """
+        super(JobsRequestHandler, self).initialize(token)
+        self.logger = logger
+        self.job_queue = job_queue
+        self.max_size = max_size
+        self.upload = None
+        self.set_header("Content-Type", "application/json")
+
+    def prepare(self):
+        """Starts writing the upload to the job store, run once the headers have arrived
+        """
+        super(JobsRequestHandler, self).prepare()
+        if self.request.method != "POST":
+            return
+        self.request.connection.set_max_body_size(self.max_size)
+        self.upload = self.job_queue.start_upload()
+        if self.upload is None:
+            raise tornado.web.HTTPError(429, "Too many jobs stored")
+
+    async def data_received(self, chunk):
+        """Writes the next chunk of the request body to the job store
+
+        Args:
+            chunk (bytes): Chunk of the request body
+
+        """
+        await self.job_queue.write_upload(self.upload, chunk)
+
+    def on_connection_close(self):
+        """Removes the partial upload of a request that was interrupted
+        """
+        if self.upload is not None:
+            self.job_queue.abort_upload(self.upload)
+            self.upload = None
+
+    async def post(self):
+        """Request handler for method=POST, queues the uploaded job
+        """
+        job = await self.job_queue.create(
+            self.upload, service=self.get_query_argument("service", None),
+            bounds=self.get_query_argument("bounds", None),
+            tenant=self.get_query_argument("tenant", None))
+        self.upload = None
+        self.logger.info("Queued bulk geocoding job %s of %d lines", job.id, job.total)
+        self.set_status(201)
+        self.set_header("Location", "/jobs/{}".format(job.id))
+        self.write(json.dumps(job.to_dict()))
+
+
+class JobRequestHandler(AdminRequestHandler):
+    """Tornado handler class reporting the progress of a bulk geocoding job
+
+    GET "/jobs/<id>" returns the job's state as JSON, including the number of lines in the
+    input, the number of lines resolved so far and how many of them have a result. DELETE
+    removes the job and its results, or is a 409 while the job is running.
+
+    Attributes:
+        job_queue (JobQueue): Queue and store of the jobs
+
+    """
+
+    def initialize(self, job_queue, token=None):
+        """Constructor for JobRequestHandler
+
+        Args:
+            job_queue (JobQueue): Queue and store of the jobs
+            token (string): Shared secret expected from operators, None to only accept
+                            loopback requests
+
+        """
+        super(JobRequestHandler, self).initialize(token)
+        self.job_queue = job_queue
+        self.set_header("Content-Type", "application/json")
+
+    def get(self, job_id):
+        """Request handler for method=GET
+        """
+        job = self.job_queue.jobs.get(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404)
+        self.write(json.dumps(job.to_dict()))
+
+    async def delete(self, job_id):
+        """Request handler for method=DELETE
+        """
+        if job_id not in self.job_queue.jobs:
+            raise tornado.web.HTTPError(404)
+        if not await self.job_queue.delete(job_id):
+            raise tornado.web.HTTPError(409, "The job is running")
+        self.set_status(204)
+
+
+class JobResultsRequestHandler(AdminRequestHandler):
+    """Tornado handler class streaming the results of a bulk geocoding job
+
+    GET "/jobs/<id>/results" returns the results checkpointed so far, one "/geocode" JSON
+    response per input line, in input order. The results are sent with chunked transfer
+    encoding, CHUNK_SIZE bytes at a time, and the response carries the job's state and the
+    size of the results in the X-Geoproxy-Job-State and X-Geoproxy-Results-Size headers. An
+    interrupted download, or the results of a job still running, can be fetched from where
+    the previous download stopped with the "offset" argument, a byte offset into the results.
+    The results are read on the IOLoop's default executor, and a job deleted before its results
+    are opened receives a 404.
+
+    Attributes:
+        job_queue (JobQueue): Queue and store of the jobs
+
+    """
+
+    # bytes sent per chunk
+    CHUNK_SIZE = 65536
+
+    def initialize(self, job_queue, token=None):
+        """Constructor for JobResultsRequestHandler
+
+        Args:
+            job_queue (JobQueue): Queue and store of the jobs
+            token (string): Shared secret expected from operators, None to only accept
+                            loopback requests
+
+        """
+        super(JobResultsRequestHandler, self).initialize(token)
+        self.job_queue = job_queue
+        self.set_header("Content-Type", "application/x-ndjson")
+
+    async def get(self, job_id):
+        """Request handler for method=GET
+        """
+        job = self.job_queue.jobs.get(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404)
+        try:
+            offset = int(self.get_argument("offset", 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "offset must be an integer")
+        # only whole lines up to the last checkpoint are sent
+        size = job.results_size
+        self.set_header("X-Geoproxy-Job-State", job.state)
+        self.set_header("X-Geoproxy-Results-Size", str(size))
+        if offset >= size:
+            return
+        io_loop = IOLoop.current()
+        path = self.job_queue.store.job_path(job.id, self.job_queue.store.RESULTS_FILE)
+        try:
+            results_file = await io_loop.run_in_executor(None, open, path, "rb")
+        except FileNotFoundError:
+            # the job was deleted since the request started
+            raise tornado.web.HTTPError(404)
+        try:
+            await io_loop.run_in_executor(None, results_file.seek, max(0, offset))
+            remaining = size - max(0, offset)
+            while remaining > 0:
+                chunk = await io_loop.run_in_executor(None, results_file.read,
+                                                      min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.write(chunk)
+                await self.flush()
+        finally:
+            results_file.close()
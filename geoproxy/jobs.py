@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to geocode large files of addresses in the background
+
+Clients upload a file with one address per line, which is stored in a job directory on local
+disk and resolved in the background through the same GeoproxyResolver as "/geocode" requests,
+at a limited rate and concurrency so that bulk work cannot crowd out interactive traffic. The
+results are written to a second file, one "/geocode" JSON response per input line, in input
+order, which clients download while the job runs or after it completes.
+
+Jobs are processed in chunks of lines. After each chunk, the results are flushed to disk and
+the job's checkpoint (lines done, and the matching offsets in the input and results files) is
+saved atomically, so that a job interrupted by a restart resumes from its last checkpoint
+rather than from the start.
+
+The store holds a limited number of jobs, and finished jobs are removed once they have been
+kept for a retention period, or when a client deletes them.
+
+"""
+
+from collections import deque
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from tornado.gen import multi
+from tornado.gen import sleep
+from tornado.ioloop import IOLoop
+from tornado.ioloop import PeriodicCallback
+from tornado.locks import Condition
+from tornado.locks import Semaphore
+
+from geoproxy.api import GeoproxyArguments
+from geoproxy.api import GeoproxyRequestParser
+from geoproxy.api import GeoproxyResponse
+from geoproxy.deadline import Deadline
+
+# states of a job, in the order they are reached
+JOB_STATES = ("queued", "running", "completed", "failed")
+
+
+class Job:
+    """State of a bulk geocoding job, as saved in its job directory
+
+    Attributes:
+        id (string): Job id
+        state (string): One of JOB_STATES
+        created (float): Epoch time at which the job was uploaded
+        started (float): Epoch time at which processing first started, None until then
+        finished (float): Epoch time at which the job completed or failed, None until then
+        total (int): Number of lines in the input file
+        completed (int): Number of lines resolved, as of the last checkpoint
+        succeeded (int): Number of lines resolved with a result, as of the last checkpoint
+        input_offset (int): Offset in the input file of the first line not yet resolved
+        results_size (int): Size of the results file as of the last checkpoint, anything
+                            written after it is discarded when the job resumes
+        service (string): Primary service for every line, None for the default order
+        bounds (string): Bounds for every line, as in a "/geocode" request, None for none
+        tenant (string): Tenant that the job's upstream queries are scheduled for
+        error (string): Reason that the job failed, None unless it failed
+
+    """
+
+    FIELDS = ("id", "state", "created", "started", "finished", "total", "completed",
+              "succeeded", "input_offset", "results_size", "service", "bounds", "tenant",
+              "error")
+
+    def __init__(self, job_id, total, service=None, bounds=None, tenant=None):
+        """Constructor for a newly uploaded job
+
+        Args:
+            job_id (string): Job id
+            total (int): Number of lines in the input file
+            service (string): Primary service for every line, None for the default order
+            bounds (string): Bounds for every line, None for none
+            tenant (string): Tenant that the job's upstream queries are scheduled for
+
+        """
+        self.id = job_id
+        self.state = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.total = total
+        self.completed = 0
+        self.succeeded = 0
+        self.input_offset = 0
+        self.results_size = 0
+        self.service = service
+        self.bounds = bounds
+        self.tenant = tenant
+        self.error = None
+
+    @classmethod
+    def from_dict(cls, fields):
+        """Restores a job saved with to_dict(private=True)
+
+        Args:
+            fields (dict): Saved job fields
+
+        Returns:
+            Job: The restored job
+
+        """
+        job = cls(fields["id"], fields["total"])
+        for field in cls.FIELDS:
+            if field in fields:
+                setattr(job, field, fields[field])
+        return job
+
+    def to_dict(self, private=False):
+        """Job state as a dict
+
+        Args:
+            private (bool): Include the checkpoint offsets, as saved in the job directory
+
+        Returns:
+            dict: Job fields, with the fraction of lines completed as "progress"
+
+        """
+        fields = {field: getattr(self, field) for field in self.FIELDS}
+        if not private:
+            del fields["input_offset"]
+            del fields["results_size"]
+            fields["progress"] = round(self.completed / self.total, 4) if self.total else 1.0
+        return fields
+
+
+class JobUpload:
+    """Input file of a job being uploaded, written as its chunks arrive
+
+    Attributes:
+        job_id (string): Id of the job being uploaded
+        path (string): Path of the partial input file
+        lines (int): Number of lines received so far
+
+    """
+
+    def __init__(self, job_id, path):
+        """Constructor for the upload
+
+        Args:
+            job_id (string): Id of the job being uploaded
+            path (string): Path of the partial input file
+
+        """
+        self.job_id = job_id
+        self.path = path
+        self.lines = 0
+        self._file = open(path, "wb")
+        self._last_byte = b"\n"
+
+    def write(self, chunk):
+        """Appends a chunk of the input file
+
+        Args:
+            chunk (bytes): Next chunk of the request body
+
+        """
+        if chunk:
+            self._file.write(chunk)
+            self.lines += chunk.count(b"\n")
+            self._last_byte = chunk[-1:]
+
+    def close(self):
+        """Closes the partial input file
+
+        Returns:
+            int: Number of lines in the file, counting a last line without a line break
+
+        """
+        self._file.close()
+        return self.lines + (0 if self._last_byte == b"\n" else 1)
+
+
+class JobStore:
+    """Directory of jobs on local disk
+
+    Each job has its own directory, named after the job id, holding its input file
+    ("input.txt"), its results file ("results.jsonl") and its state ("job.json"). The state is
+    replaced atomically, so a crash leaves either the previous or the next checkpoint. Uploads
+    that did not complete have no state, and are removed when the store is loaded.
+
+    Attributes:
+        path (string): Directory holding the job directories
+
+    """
+
+    INPUT_FILE = "input.txt"
+    RESULTS_FILE = "results.jsonl"
+    STATE_FILE = "job.json"
+
+    def __init__(self, path):
+        """Constructor for the store
+
+        Args:
+            path (string): Directory holding the job directories, created if missing
+
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def job_path(self, job_id, name=""):
+        """Path of a job's directory, or of a file in it
+
+        Args:
+            job_id (string): Job id
+            name (string): Name of the file in the job directory, eg INPUT_FILE
+
+        Returns:
+            string: Path
+
+        """
+        return os.path.join(self.path, job_id, name)
+
+    def start_upload(self):
+        """Creates the directory of a new job, ready to receive its input file
+
+        Returns:
+            JobUpload: Upload of the job's input file
+
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_path(job_id))
+        return JobUpload(job_id, self.job_path(job_id, self.INPUT_FILE))
+
+    def abort_upload(self, upload):
+        """Removes the directory of a job whose upload did not complete
+
+        Args:
+            upload (JobUpload): Upload to abort
+
+        """
+        upload.close()
+        shutil.rmtree(self.job_path(upload.job_id), ignore_errors=True)
+
+    def remove(self, job_id):
+        """Removes a job's directory
+
+        Args:
+            job_id (string): Job id
+
+        """
+        shutil.rmtree(self.job_path(job_id), ignore_errors=True)
+
+    def save(self, job):
+        """Replaces the saved state of a job
+
+        Args:
+            job (Job): Job to save
+
+        """
+        path = self.job_path(job.id, self.STATE_FILE)
+        with open(path + ".tmp", "w") as state_file:
+            json.dump(job.to_dict(private=True), state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(path + ".tmp", path)
+
+    def load(self):
+        """Loads every job in the store, removing incomplete uploads
+
+        Returns:
+            [Job]: Jobs in the order they were uploaded
+
+        """
+        jobs = []
+        for job_id in os.listdir(self.path):
+            state_path = self.job_path(job_id, self.STATE_FILE)
+            if not os.path.isdir(self.job_path(job_id)):
+                continue
+            if not os.path.exists(state_path):
+                shutil.rmtree(self.job_path(job_id), ignore_errors=True)
+                continue
+            with open(state_path) as state_file:
+                jobs.append(Job.from_dict(json.load(state_file)))
+        return sorted(jobs, key=lambda job: job.created)
+
+    def read_lines(self, job, count):
+        """Reads the next lines to resolve from a job's input file
+
+        Args:
+            job (Job): Job to read from, starting at its input offset
+            count (int): Maximum number of lines to read
+
+        Returns:
+            tuple: List of lines as bytes, and the offset after the last line read
+
+        """
+        lines = []
+        with open(self.job_path(job.id, self.INPUT_FILE), "rb") as input_file:
+            input_file.seek(job.input_offset)
+            while len(lines) < count:
+                line = input_file.readline()
+                if not line:
+                    break
+                lines.append(line)
+            return lines, input_file.tell()
+
+    def checkpoint(self, job, results, input_offset, succeeded):
+        """Appends the results of a chunk of lines and saves the job's new checkpoint
+
+        Anything written to the results file after the previous checkpoint (by a run that was
+        interrupted) is discarded first.
+
+        Args:
+            job (Job): Job the results belong to
+            results ([string]): JSON response for each line of the chunk
+            input_offset (int): Offset in the input file after the chunk
+            succeeded (int): Number of lines of the chunk resolved with a result
+
+        """
+        path = self.job_path(job.id, self.RESULTS_FILE)
+        with open(path, "r+b" if os.path.exists(path) else "wb") as results_file:
+            results_file.truncate(job.results_size)
+            results_file.seek(job.results_size)
+            results_file.write("".join(result + "\n" for result in results).encode("utf-8"))
+            results_file.flush()
+            os.fsync(results_file.fileno())
+            job.results_size = results_file.tell()
+        job.input_offset = input_offset
+        job.completed += len(results)
+        job.succeeded += succeeded
+        self.save(job)
+
+
+class JobQueue:
+    """Processes stored jobs one at a time, in the order they were uploaded
+
+    Lines are resolved concurrently, at most concurrency at a time, and started no faster than
+    rate per second across all jobs. Their upstream queries are scheduled in the bulk lane
+    (see FairScheduler). Disk access happens on the IOLoop's default executor. At most max_jobs
+    jobs, uploads included, are stored at a time, and finished jobs are removed retention
+    seconds after they finished.
+
+    Attributes:
+        store (JobStore): Job directory on local disk
+        resolver (GeoproxyResolver): Resolves the lines through the cache and the services
+        rate (float): Maximum number of lines started per second
+        concurrency (int): Maximum number of lines resolved concurrently
+        request_timeout (float): Maximum number of seconds to spend resolving a line
+        chunk_size (int): Number of lines resolved between checkpoints
+        max_jobs (int): Maximum number of jobs stored, uploads included
+        retention (float): Number of seconds a finished job is kept
+        jobs (dict): Map from job id to every Job in the store
+        lines (int): Number of lines resolved since the queue started
+        expired (int): Number of finished jobs removed after their retention period
+
+    """
+
+    def __init__(self, store, resolver, rate=10.0, concurrency=4, request_timeout=3.0,
+                 chunk_size=100, max_jobs=20, retention=7 * 86400):
+        """Constructor for the queue
+
+        Args:
+            store (JobStore): Job directory on local disk
+            resolver (GeoproxyResolver): Resolves the lines through the cache and the services
+            rate (float): Maximum number of lines started per second
+            concurrency (int): Maximum number of lines resolved concurrently
+            request_timeout (float): Maximum number of seconds to spend resolving a line
+            chunk_size (int): Number of lines resolved between checkpoints
+            max_jobs (int): Maximum number of jobs stored, uploads included
+            retention (float): Number of seconds a finished job is kept
+
+        """
+        self.store = store
+        self.resolver = resolver
+        self.rate = rate
+        self.concurrency = max(1, concurrency)
+        self.request_timeout = request_timeout
+        self.chunk_size = max(1, chunk_size)
+        self.max_jobs = max_jobs
+        self.retention = retention
+        self.jobs = {}
+        self.lines = 0
+        self.expired = 0
+        self.logger = logging.getLogger("JobQueue")
+        self._queue = deque()
+        self._ready = Condition()
+        self._slots = Semaphore(self.concurrency)
+        self._next_start = 0.0
+        self._running = None
+        self._stopped = False
+        self._uploads = set()
+        self._expiry = None
+
+    def start(self):
+        """Loads the stored jobs, and starts processing the ones that are not done
+        """
+        for job in self.store.load():
+            if job.id in self.jobs:
+                # created before the queue started
+                continue
+            self.jobs[job.id] = job
+            if job.state in ("queued", "running"):
+                self._queue.append(job.id)
+        if self._queue:
+            self.logger.info("Resuming %d bulk geocoding jobs", len(self._queue))
+        IOLoop.current().spawn_callback(self._run)
+        IOLoop.current().spawn_callback(self.expire)
+        self._expiry = PeriodicCallback(self.expire, min(self.retention, 3600) * 1000)
+        self._expiry.start()
+
+    def stop(self):
+        """Stops processing after the current chunk, the running job resumes on restart
+        """
+        self._stopped = True
+        self._ready.notify_all()
+        if self._expiry is not None:
+            self._expiry.stop()
+
+    def start_upload(self):
+        """Starts the upload of a new job, unless the store is full
+
+        Returns:
+            JobUpload: Upload of the job's input file, None if max_jobs jobs are already stored
+
+        """
+        if len(self.jobs) + len(self._uploads) >= self.max_jobs:
+            return None
+        upload = self.store.start_upload()
+        self._uploads.add(upload.job_id)
+        return upload
+
+    def abort_upload(self, upload):
+        """Removes an upload that did not complete, on the IOLoop's default executor
+
+        Args:
+            upload (JobUpload): Upload to abort
+
+        """
+        self._uploads.discard(upload.job_id)
+        IOLoop.current().run_in_executor(None, self.store.abort_upload, upload)
+
+    async def write_upload(self, upload, chunk):
+        """Appends a chunk to an upload, on the IOLoop's default executor
+
+        Args:
+            upload (JobUpload): Upload of the job's input file
+            chunk (bytes): Next chunk of the request body
+
+        """
+        await IOLoop.current().run_in_executor(None, upload.write, chunk)
+
+    async def create(self, upload, service=None, bounds=None, tenant=None):
+        """Creates a job from a completed upload and queues it
+
+        Args:
+            upload (JobUpload): Upload of the job's input file
+            service (string): Primary service for every line, None for the default order
+            bounds (string): Bounds for every line, None for none
+            tenant (string): Tenant that the job's upstream queries are scheduled for
+
+        Returns:
+            Job: The queued job
+
+        """
+        io_loop = IOLoop.current()
+        total = await io_loop.run_in_executor(None, upload.close)
+        job = Job(upload.job_id, total, service=service, bounds=bounds, tenant=tenant)
+        await io_loop.run_in_executor(None, self.store.save, job)
+        self.jobs[job.id] = job
+        self._uploads.discard(upload.job_id)
+        self._queue.append(job.id)
+        self._ready.notify()
+        return job
+
+    async def delete(self, job_id):
+        """Removes a job that is not running from the queue and the store
+
+        Args:
+            job_id (string): Id of the job to remove
+
+        Returns:
+            bool: True if the job was removed, False if it is running
+
+        """
+        if job_id == self._running:
+            return False
+        self.jobs.pop(job_id, None)
+        if job_id in self._queue:
+            self._queue.remove(job_id)
+        await IOLoop.current().run_in_executor(None, self.store.remove, job_id)
+        return True
+
+    async def expire(self):
+        """Removes the jobs that finished more than retention seconds ago
+        """
+        now = time.time()
+        for job in list(self.jobs.values()):
+            if job.finished is not None and now - job.finished > self.retention:
+                if await self.delete(job.id):
+                    self.expired += 1
+
+    async def _run(self):
+        while not self._stopped:
+            if not self._queue:
+                await self._ready.wait()
+                continue
+            job = self.jobs[self._queue.popleft()]
+            self._running = job.id
+            try:
+                await self.process(job)
+            finally:
+                self._running = None
+
+    async def process(self, job):
+        """Resolves a job's lines from its last checkpoint until the job is done
+
+        Args:
+            job (Job): Job to process
+
+        """
+        io_loop = IOLoop.current()
+        job.state = "running"
+        job.started = job.started or time.time()
+        try:
+            await io_loop.run_in_executor(None, self.store.save, job)
+            while not self._stopped:
+                lines, input_offset = await io_loop.run_in_executor(
+                    None, self.store.read_lines, job, self.chunk_size)
+                if not lines:
+                    break
+                responses = await multi([self.resolve_line(job, line) for line in lines])
+                succeeded = sum(1 for response in responses if response.status == "OK")
+                await io_loop.run_in_executor(
+                    None, self.store.checkpoint, job,
+                    [response.to_json() for response in responses], input_offset, succeeded)
+                self.lines += len(lines)
+            if self._stopped:
+                return
+            job.state = "completed"
+            job.total = job.completed
+        except Exception as error:
+            self.logger.error("Bulk geocoding job %s failed: %s", job.id, error)
+            job.state = "failed"
+            job.error = str(error)
+        job.finished = time.time()
+        await io_loop.run_in_executor(None, self.store.save, job)
+        self.logger.info("Bulk geocoding job %s %s, %d of %d lines resolved", job.id, job.state,
+                         job.succeeded, job.completed)
+
+    async def resolve_line(self, job, line):
+        """Resolves one line of a job, like a "/geocode" request for its address
+
+        Args:
+            job (Job): Job the line belongs to
+            line (bytes): Line of the input file
+
+        Returns:
+            GeoproxyResponse: Response for the line
+
+        """
+        async with self._slots:
+            await self._pace()
+            geo_proxy_response = GeoproxyResponse()
+            arguments = GeoproxyArguments({"address": line.decode("utf-8", "replace").strip(),
+                                           "service": job.service, "bounds": job.bounds,
+                                           "priority": "bulk"})
+            try:
+                geo_proxy_request = GeoproxyRequestParser(self.resolver.available_services,
+                                                          geo_proxy_response,
+                                                          self.resolver.service_orders)
+                geo_proxy_request.tenant = job.tenant
+                if geo_proxy_request.parse(arguments):
+                    await self.resolver.resolve(geo_proxy_request, geo_proxy_response,
+                                                Deadline(self.request_timeout))
+            except Exception as e:
+                geo_proxy_response.set_error(
+                    "Caught general exception in server: {}".format(e), "UNKNOWN_ERROR")
+            return geo_proxy_response
+
+    async def _pace(self):
+        # lines start at least 1 / rate seconds apart
+        if self.rate <= 0:
+            return
+        now = IOLoop.current().time()
+        start_time = max(now, self._next_start)
+        self._next_start = start_time + 1.0 / self.rate
+        if start_time > now:
+            await sleep(start_time - now)
+
+    def stats(self):
+        """Current state of the queue
+
+        Returns:
+            dict: Number of jobs known and queued, the id of the running job, the number of
+                  lines resolved since the queue started, and the number of jobs expired
+
+        """
+        return {"jobs": len(self.jobs), "queued": len(self._queue), "running": self._running,
+                "lines": self.lines, "expired": self.expired}
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to derive upstream timeouts from observed latencies
+
+Each third party service's latency is tracked with a streaming quantile estimate (the P²
+algorithm, which keeps five markers instead of the samples themselves), and the service's
+upstream timeout is a multiple of its estimated high percentile, within a floor and a ceiling.
+A request that takes longer than nearly every recent request to the same service is then
+abandoned early, leaving the rest of the deadline for a retry or the next service.
+
+"""
+
+import threading
+
+
+class P2Quantile:
+    """Streaming estimate of a single quantile using the P² algorithm
+
+    See R. Jain and I. Chlamtac, "The P² algorithm for dynamic calculation of quantiles and
+    histograms without storing observations", Communications of the ACM, 1985.
+
+    Attributes:
+        p (float): Quantile being estimated, between 0 and 1
+        count (int): Number of observations
+
+    """
+
+    def __init__(self, p):
+        """Constructor for the estimator
+
+        Args:
+            p (float): Quantile to estimate, between 0 and 1, eg 0.99 for the 99th percentile
+
+        """
+        self.p = p
+        self.count = 0
+        self._heights = []
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+        self._increments = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def add(self, value):
+        """Adds an observation
+
+        Args:
+            value (float): Observed value
+
+        """
+        self.count += 1
+        heights = self._heights
+        if self.count <= 5:
+            heights.append(value)
+            if self.count == 5:
+                heights.sort()
+            return
+        positions = self._positions
+        # find the cell the value falls in, extending the extreme markers if needed
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+        # move the middle markers towards their desired positions
+        for i in range(1, 4):
+            offset = self._desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        q, n = self._heights, self._positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def _linear(self, i, step):
+        q, n = self._heights, self._positions
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    def value(self):
+        """Current estimate of the quantile
+
+        Returns:
+            None/float: Estimated quantile, None before the first observation
+
+        """
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            ordered = sorted(self._heights)
+            return ordered[min(len(ordered) - 1, int(self.p * len(ordered)))]
+        return self._heights[2]
+
+
+class AdaptiveTimeout:
+    """Upstream timeout for a service, adapted from its observed latencies
+
+    The timeout is the estimated latency quantile multiplied by a headroom factor, clamped to
+    [floor, ceiling]. Until min_samples latencies have been observed, the ceiling is used.
+
+    To follow changes in a service's latency, estimates are kept over windows of observations:
+    once the current window is full it replaces the previous one, and the previous window's
+    estimate is used until the new one has min_samples observations. Observations may come
+    from any thread.
+
+    Attributes:
+        quantile (float): Latency quantile the timeout is derived from, eg 0.99
+        multiplier (float): Headroom applied to the estimated quantile
+        floor (float): Smallest timeout in seconds
+        ceiling (float): Largest timeout in seconds
+        min_samples (int): Observations needed before the estimate is used
+        window (int): Number of observations per estimation window
+
+    """
+
+    def __init__(self, quantile=0.99, multiplier=1.5, floor=0.05, ceiling=3.0, min_samples=20,
+                 window=1000):
+        """Constructor
+
+        Args:
+            quantile (float): Latency quantile the timeout is derived from, eg 0.99
+            multiplier (float): Headroom applied to the estimated quantile
+            floor (float): Smallest timeout in seconds
+            ceiling (float): Largest timeout in seconds
+            min_samples (int): Observations needed before the estimate is used
+            window (int): Number of observations per estimation window
+
+        """
+        self.quantile = quantile
+        self.multiplier = multiplier
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.min_samples = max(5, min_samples)
+        self.window = max(self.min_samples, window)
+        self._lock = threading.Lock()
+        self._current = P2Quantile(quantile)
+        self._previous = None
+
+    def observe(self, latency):
+        """Records the latency of a completed (or timed out) upstream request
+
+        Args:
+            latency (float): Seconds taken by the request
+
+        """
+        with self._lock:
+            self._current.add(latency)
+            if self._current.count >= self.window:
+                self._previous = self._current
+                self._current = P2Quantile(self.quantile)
+
+    def estimate(self):
+        """Estimated latency quantile
+
+        Returns:
+            None/float: Latency in seconds, None until min_samples latencies are observed
+
+        """
+        with self._lock:
+            for estimator in (self._current, self._previous):
+                if estimator is not None and estimator.count >= self.min_samples:
+                    return estimator.value()
+        return None
+
+    def timeout(self):
+        """Current upstream timeout
+
+        Returns:
+            float: Timeout in seconds, between floor and ceiling
+
+        """
+        estimate = self.estimate()
+        if estimate is None:
+            return self.ceiling
+        return min(self.ceiling, max(self.floor, estimate * self.multiplier))
+
+    def stats(self):
+        """Current state of the timeout
+
+        Returns:
+            dict: Current timeout and latency estimate in seconds
+
+        """
+        estimate = self.estimate()
+        return {"timeout": round(self.timeout(), 6),
+                "estimate": round(estimate, 6) if estimate is not None else None}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to measure a geoproxy server's capacity under an open loop
+
+A closed loop load generator (see run_load) waits for each response before sending the next
+request, so when the server stalls, the generator stops sending and the stall only shows up
+as a single slow request. This is known as coordinated omission, and it hides exactly the
+latencies that matter when looking for a server's capacity.
+
+run_open_loop instead sends requests at a fixed arrival rate, whether or not earlier requests
+have completed, and measures each latency from the time the request was scheduled to be sent
+rather than from the time it was actually sent. Latencies are recorded in a LatencyHistogram,
+a log-linear histogram in the style of HdrHistogram, which has a bounded relative error at any
+magnitude and a fixed cost per recorded value.
+
+"""
+
+from collections import Counter
+import logging
+from tornado.gen import multi
+from tornado.gen import sleep
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.ioloop import PeriodicCallback
+
+
+class LatencyHistogram:
+    """Log-linear histogram of latencies with a bounded relative error
+
+    Values are recorded in integer microseconds. Values below sub_bucket_count are counted
+    exactly, and every power of two above that is split into sub_bucket_count / 2 linear
+    buckets, so a recorded value is off by at most 1 / 10**significant_digits of itself.
+    Percentiles report the highest value equivalent to their bucket, as HdrHistogram does.
+
+    Attributes:
+        significant_digits (int): Number of significant decimal digits kept
+        count (int): Number of recorded values
+        total (int): Sum of the recorded values in microseconds
+        min (int): Smallest recorded value in microseconds, None if empty
+        max (int): Largest recorded value in microseconds, None if empty
+
+    """
+
+    def __init__(self, significant_digits=2):
+        """Constructor for the histogram
+
+        Args:
+            significant_digits (int): Number of significant decimal digits kept, between 1
+                                      and 5
+
+        """
+        self.significant_digits = min(5, max(1, significant_digits))
+        self._sub_bucket_bits = (2 * 10 ** self.significant_digits - 1).bit_length()
+        self._sub_bucket_count = 1 << self._sub_bucket_bits
+        self._half_count = self._sub_bucket_count >> 1
+        self._counts = Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self._sub_bucket_count:
+            return value
+        shift = value.bit_length() - self._sub_bucket_bits
+        return self._sub_bucket_count + (shift - 1) * self._half_count + \
+            (value >> shift) - self._half_count
+
+    def _highest_equivalent(self, index):
+        if index < self._sub_bucket_count:
+            return index
+        offset = index - self._sub_bucket_count
+        shift = offset // self._half_count + 1
+        sub_bucket = offset % self._half_count + self._half_count
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Records a latency
+
+        Args:
+            seconds (float): Latency in seconds, negative values are recorded as 0
+
+        """
+        value = max(0, int(seconds * 1000000))
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds the values recorded by another histogram with the same precision
+
+        Args:
+            other (LatencyHistogram): Histogram to add
+
+        """
+        self._counts.update(other._counts)
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, fraction):
+        """Value below which a fraction of the recorded latencies fall
+
+        Args:
+            fraction (float): Percentile to compute, between 0 and 1
+
+        Returns:
+            float: Latency in seconds, 0 if the histogram is empty
+
+        """
+        if self.count == 0:
+            return 0.0
+        rank = max(1, int(round(fraction * self.count)))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                return min(self._highest_equivalent(index), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def mean(self):
+        """Mean of the recorded latencies
+
+        Returns:
+            float: Mean latency in seconds, 0 if the histogram is empty
+
+        """
+        return self.total / self.count / 1000000.0 if self.count else 0.0
+
+    def summary(self, fractions=(0.5, 0.9, 0.99, 0.999)):
+        """Percentiles of the recorded latencies
+
+        Args:
+            fractions ((float)): Percentiles to report, between 0 and 1
+
+        Returns:
+            dict: Map from "p50", "p90", ... to the latency in seconds, with "max" and "mean"
+
+        """
+        summary = {"p{:g}".format(100 * fraction): self.percentile(fraction)
+                   for fraction in fractions}
+        summary["max"] = self.max / 1000000.0 if self.max is not None else 0.0
+        summary["mean"] = self.mean()
+        return summary
+
+
+async def run_open_loop(proxy_url, uris, rate, duration, connections=64, interval=1.0,
+                        headers=None, request_timeout=10.0, on_interval=None):
+    """Sends requests to a geoproxy server at a fixed arrival rate and reports their latency
+
+    Request i is scheduled to be sent at i / rate seconds after the start, cycling through the
+    uris, and its latency is measured from that scheduled time, so time spent waiting for a
+    free connection, or behind a stalled event loop, is counted against the server. Requests
+    answered with anything but a 200 (including shed requests and timeouts) are errors.
+
+    Args:
+        proxy_url (string): Base URL of the geoproxy server, eg http://localhost:8080
+        uris ([string]): Request paths and query strings, eg "/geocode?address=..."
+        rate (float): Requests per second
+        duration (float): Seconds to send requests for
+        connections (int): Maximum number of concurrent connections
+        interval (float): Seconds between interval reports
+        headers (dict): Headers added to every request, eg Accept
+        request_timeout (float): Seconds after which a request is abandoned
+        on_interval (callable): Called with each interval report
+
+    Returns:
+        dict: Report with sent, requests, errors, elapsed, rps, the latency summary (see
+              LatencyHistogram.summary) and the histogram itself
+
+    """
+    io_loop = IOLoop.current()
+    client = AsyncHTTPClient(force_instance=True, max_clients=connections)
+    base_url = proxy_url.rstrip("/")
+    total = LatencyHistogram()
+    window = [LatencyHistogram(), 0]
+    errors = [0]
+    start_time = io_loop.time()
+    last_report = [start_time]
+
+    def report_interval():
+        histogram, window_errors = window
+        window[:] = [LatencyHistogram(), 0]
+        now = io_loop.time()
+        report = {"time": now - start_time, "requests": histogram.count,
+                  "errors": window_errors,
+                  "rps": histogram.count / (now - last_report[0]) if now > last_report[0] else 0}
+        report.update(histogram.summary())
+        last_report[0] = now
+        total.merge(histogram)
+        if on_interval is not None:
+            on_interval(report)
+
+    async def send(uri, scheduled_time):
+        try:
+            response = await client.fetch(base_url + uri, headers=headers, raise_error=False,
+                                          request_timeout=request_timeout)
+            failed = response.code != 200
+        except Exception as error:
+            logging.getLogger("loadgen").debug("Request failed: %s", error)
+            failed = True
+        window[0].record(io_loop.time() - scheduled_time)
+        if failed:
+            window[1] += 1
+            errors[0] += 1
+
+    reporter = PeriodicCallback(report_interval, interval * 1000)
+    reporter.start()
+    requests = []
+    for index in range(int(rate * duration)):
+        scheduled_time = start_time + index / rate
+        delay = scheduled_time - io_loop.time()
+        if delay > 0:
+            await sleep(delay)
+        # sent without waiting for earlier requests, which keeps the loop open
+        requests.append(send(uris[index % len(uris)], scheduled_time))
+    await multi(requests)
+    reporter.stop()
+    report_interval()
+    elapsed = io_loop.time() - start_time
+    client.close()
+
+    report = {"sent": len(requests), "requests": total.count, "errors": errors[0],
+              "elapsed": elapsed, "rps": total.count / elapsed if elapsed > 0 else 0.0,
+              "histogram": total}
+    report.update(total.summary())
+    return report
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to share cached results across a cluster of geoproxy nodes
+
+Every node in the cluster is placed on a consistent hash ring, and each cache key is owned by
+exactly one node. A node keeps the entries it owns in its local ResultCache, and serves them to
+its peers over HTTP (see CacheRequestHandler). Entries owned by other nodes are fetched from the
+owner on a local miss and kept in a small replica cache, so hot keys stay local.
+
+Peers that fail or time out are skipped for a cooldown period, and a failed peer request is
+simply treated as a miss, so losing a node only costs hit rate.
+
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import time
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import HTTPError
+from tornado.ioloop import IOLoop
+import urllib.parse
+
+from geoproxy.cache import ResultCache
+
+
+def _ring_hash(value):
+    """Maps a string onto the hash ring
+
+    Args:
+        value (string): Node identifier or cache key
+
+    Returns:
+        int: Position on the ring
+
+    """
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring mapping cache keys to nodes
+
+    Each node is placed on the ring at several virtual positions, which evens out the share of
+    keys that each node owns. Adding or removing a node only moves the keys adjacent to its
+    positions.
+
+    Attributes:
+        nodes ([string]): Node identifiers on the ring
+        replicas (int): Number of virtual positions per node
+
+    """
+
+    def __init__(self, nodes, replicas=100):
+        """Constructor for the ring
+
+        Args:
+            nodes ([string]): Node identifiers to place on the ring
+            replicas (int): Number of virtual positions per node
+
+        """
+        self.nodes = sorted(set(nodes))
+        self.replicas = replicas
+        positions = sorted((_ring_hash("{}#{}".format(node, i)), node)
+                           for node in self.nodes for i in range(replicas))
+        self._hashes = [position for position, _ in positions]
+        self._owners = [node for _, node in positions]
+
+    def get_node(self, key):
+        """Finds the node that owns a key
+
+        Args:
+            key (string): Cache key
+
+        Returns:
+            None/string: Owning node, None if the ring is empty
+
+        """
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _ring_hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class PeerCache:
+    """Cache layer that consults the owning peer before going upstream
+
+    Attributes:
+        self_url (string): Base URL of this node, as it appears in the peer list
+        ring (HashRing): Consistent hash ring of all nodes, including this one
+        local_cache (ResultCache): Cache of entries owned by this node
+        replica (ResultCache): Small cache of hot entries owned by other nodes
+        timeout (float): Seconds to wait for a peer before treating the request as a miss
+        cooldown (float): Seconds to skip a peer after it fails
+        token (string): Shared secret sent to peers, None if peers are not authenticated
+        peer_hits (int): Number of lookups answered by a peer
+        peer_errors (int): Number of failed peer requests
+
+    """
+
+    # path of the cache endpoint served by every node
+    CACHE_PATH = "/cache"
+    # header carrying the shared secret between peers
+    TOKEN_HEADER = "X-Geoproxy-Peer-Token"
+
+    def __init__(self, self_url, peers, local_cache, replica_size=1024, ttl=None, timeout=0.05,
+                 cooldown=5.0, token=None):
+        """Constructor for the peer cache
+
+        Args:
+            self_url (string): Base URL of this node, eg http://10.0.0.1:8080
+            peers ([string]): Base URLs of every node in the cluster
+            local_cache (ResultCache): Cache of entries owned by this node
+            replica_size (int): Maximum number of entries kept for keys owned by other nodes
+            ttl (float): Number of seconds a replicated entry remains valid
+            timeout (float): Seconds to wait for a peer before treating the request as a miss
+            cooldown (float): Seconds to skip a peer after it fails
+            token (string): Shared secret sent to peers
+
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.self_url = self_url.rstrip("/")
+        self.ring = HashRing([self.self_url] + [peer.rstrip("/") for peer in peers])
+        self.local_cache = local_cache
+        self.replica = ResultCache(replica_size, ttl)
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self.token = token
+        self.peer_hits = 0
+        self.peer_errors = 0
+        self._down_until = {}
+
+    def owner(self, key):
+        """Finds the node that owns a key
+
+        Args:
+            key (string): Cache key
+
+        Returns:
+            string: Base URL of the owning node
+
+        """
+        return self.ring.get_node(key)
+
+    def is_available(self, peer):
+        """Checks if a peer is outside of its failure cooldown
+
+        Args:
+            peer (string): Base URL of the peer
+
+        Returns:
+            bool: If requests may be sent to the peer
+
+        """
+        return self._down_until.get(peer, 0.0) <= time.monotonic()
+
+    def mark_failed(self, peer):
+        """Takes a peer out of use for the cooldown period
+
+        Args:
+            peer (string): Base URL of the peer
+
+        """
+        self.peer_errors += 1
+        self._down_until[peer] = time.monotonic() + self.cooldown
+
+    def _peer_url(self, peer, key):
+        return "{}{}?{}".format(peer, self.CACHE_PATH, urllib.parse.urlencode({"key": key}))
+
+    def _headers(self):
+        return {self.TOKEN_HEADER: self.token} if self.token else None
+
+    async def get(self, key):
+        """Looks up a key that missed the local cache
+
+        Keys owned by this node only live in the local cache, which the caller has already
+        checked. Other keys are looked up in the replica, and then requested from the owning
+        peer.
+
+        Args:
+            key (string): Cache key
+
+        Returns:
+            None/dict: Cached result, None on a miss or a peer failure
+
+        """
+        owner = self.owner(key)
+        if owner == self.self_url:
+            return None
+        result = self.replica.get(key)
+        if result is not None or not self.is_available(owner):
+            return result
+        try:
+            response = await AsyncHTTPClient().fetch(
+                self._peer_url(owner, key), headers=self._headers(),
+                connect_timeout=self.timeout, request_timeout=self.timeout)
+        except HTTPError as error:
+            if error.code != 404:
+                self.logger.warning("Cache request to peer %s failed: %s", owner, error)
+                self.mark_failed(owner)
+            return None
+        except Exception as error:
+            self.logger.warning("Cache request to peer %s failed: %s", owner, error)
+            self.mark_failed(owner)
+            return None
+        result = json.loads(response.body.decode('utf-8'))
+        self.peer_hits += 1
+        self.replica.put(key, result)
+        return result
+
+    def put(self, key, result):
+        """Stores a result resolved by this node
+
+        Keys owned by this node are stored locally. Other keys are kept in the replica and
+        pushed to the owning peer in the background.
+
+        Args:
+            key (string): Cache key
+            result (dict): Result to store
+
+        """
+        owner = self.owner(key)
+        if owner == self.self_url:
+            self.local_cache.put(key, result)
+            return
+        self.replica.put(key, result)
+        if self.is_available(owner):
+            IOLoop.current().spawn_callback(self._push, owner, key, result)
+
+    async def _push(self, peer, key, result):
+        """Sends a result to the peer that owns it
+
+        Args:
+            peer (string): Base URL of the owning peer
+            key (string): Cache key
+            result (dict): Result to store
+
+        """
+        try:
+            await AsyncHTTPClient().fetch(
+                self._peer_url(peer, key), method="PUT", body=json.dumps(result),
+                headers=self._headers(), connect_timeout=self.timeout,
+                request_timeout=self.timeout)
+        except Exception as error:
+            self.logger.warning("Cache push to peer %s failed: %s", peer, error)
+            self.mark_failed(peer)
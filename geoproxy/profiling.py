@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to profile a running geoproxy server on demand
+
+Nothing in this module runs unless a profile is requested: the sampling thread only exists
+for the duration of a CPU profile, cProfile is only enabled while a pstats profile is taken,
+and tracemalloc only traces allocations between an explicit start and stop.
+
+"""
+
+from collections import Counter
+import cProfile
+import marshal
+import os
+import sys
+import threading
+import tracemalloc
+
+
+def format_frame(frame):
+    """Formats a stack frame for a collapsed stack
+
+    Args:
+        frame (frame): Python stack frame
+
+    Returns:
+        string: Function name, file name and line number, eg "get (geoproxy_request.py:120)"
+
+    """
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+
+
+class SamplingProfiler:
+    """Statistical CPU profiler covering every thread of the process
+
+    While running, a background thread wakes up every interval and records the current stack
+    of every other thread (the IOLoop, executor threads, the log writer, ...). The samples are
+    reported as collapsed stacks, one line per distinct stack with the number of times it was
+    seen, which is the input format of flame graph tools. Samples are taken from outside the
+    profiled threads, so the profiled code runs unmodified.
+
+    Attributes:
+        interval (float): Seconds between samples
+        samples (int): Number of samples taken
+        stacks (Counter): Map from collapsed stack to the number of times it was sampled
+
+    """
+
+    def __init__(self, interval=0.005):
+        """Constructor for the profiler
+
+        Args:
+            interval (float): Seconds between samples
+
+        """
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts sampling in a background thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and waits for the sampling thread to exit
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(own_ident)
+
+    def sample(self, exclude=None):
+        """Records the current stack of every thread
+
+        Args:
+            exclude (int): Identifier of a thread to leave out, eg the sampling thread
+
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == exclude:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(format_frame(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        """Reports the samples as collapsed stacks
+
+        Returns:
+            string: One "thread;outer;...;inner count" line per stack, most frequent first
+
+        """
+        return "".join("{} {}\n".format(stack, count) for stack, count in
+                       self.stacks.most_common())
+
+
+class TracingProfiler:
+    """Deterministic profile of the thread it is started on, as a pstats dump
+
+    cProfile only sees the thread that enabled it, so when started on the IOLoop thread it
+    covers the handlers, parsers and everything else run by the IOLoop, but not the work done
+    on executor threads (see SamplingProfiler for those).
+
+    """
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        """Starts profiling the calling thread
+        """
+        self._profile.enable()
+
+    def stop(self):
+        """Stops profiling
+        """
+        self._profile.disable()
+
+    def dump(self):
+        """Serializes the profile in the format written by pstats.Stats.dump_stats()
+
+        Returns:
+            bytes: Profile that can be loaded with pstats.Stats(path) once written to a file
+
+        """
+        self._profile.create_stats()
+        return marshal.dumps(self._profile.stats)
+
+
+class MemoryProfiler:
+    """Allocation tracing with tracemalloc snapshots and diffs
+
+    Tracing is started and stopped explicitly, and only costs memory and time in between. Each
+    report compares a new snapshot with the one taken by the previous report, which shows the
+    code that allocated the memory retained in the meantime.
+
+    Attributes:
+        frames (int): Number of frames stored per allocation traceback
+        previous (tracemalloc.Snapshot): Snapshot taken by the last report, None if there is
+                                         none yet
+
+    """
+
+    # allocations made by tracemalloc itself, or by the profiler, are not reported
+    FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, __file__))
+
+    def __init__(self):
+        self.frames = 1
+        self.previous = None
+
+    @property
+    def tracing(self):
+        """bool: If allocations are being traced
+        """
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        """Starts tracing allocations
+
+        Args:
+            frames (int): Number of frames stored per allocation traceback
+
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.frames = frames
+        self.previous = None
+
+    def stop(self):
+        """Stops tracing allocations and drops the stored snapshot
+        """
+        tracemalloc.stop()
+        self.previous = None
+
+    def report(self, limit=25, key_type="lineno"):
+        """Takes a snapshot and reports the top allocations and the change since the last one
+
+        Args:
+            limit (int): Maximum number of entries per section
+            key_type (string): Grouping of the statistics, "lineno", "filename" or "traceback"
+
+        Returns:
+            dict: Traced memory (current and peak bytes), the top allocations, and the top
+                  differences with the previous snapshot (empty on the first report)
+
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        top = [str(stat) for stat in snapshot.statistics(key_type)[:limit]]
+        diff = []
+        if self.previous is not None:
+            diff = [str(stat) for stat in snapshot.compare_to(self.previous, key_type)[:limit]]
+        self.previous = snapshot
+        return {"current": current, "peak": peak, "top": top, "diff": diff}
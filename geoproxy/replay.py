@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to record third party traffic and replay it offline
+
+A geoproxy server started with a TraceRecorder writes every incoming geocode request, and
+every third party request/response pair (with its latency), to a gzipped JSON lines trace.
+
+The trace can then be served by a stub upstream (see StubUpstream), which answers the proxy's
+third party requests with the recorded responses after the recorded (optionally scaled)
+latency, and the recorded request mix can be replayed against the proxy (see run_load) to
+benchmark it offline and reproducibly.
+
+Trace entries take one of two forms:
+    {"type": "request", "uri": "/geocode?address=..."}
+    {"type": "upstream", "service": "google", "query": "/maps/api/geocode/json?address=...",
+     "code": 200, "body": "...", "latency": 0.123}
+Credentials are stripped from recorded queries, and a code of None records a timeout.
+
+"""
+
+import gzip
+import json
+import logging
+import threading
+import time
+from tornado.gen import multi
+from tornado.gen import sleep
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import HTTPError
+import tornado.web
+import urllib.parse
+
+
+# query parameters that carry third party credentials, never written to a trace
+CREDENTIAL_PARAMETERS = ("key", "app_id", "app_code", "apiKey")
+
+
+def sanitize_query(url):
+    """Canonical, credential free form of a third party query used to match recordings
+
+    Args:
+        url (string): Full third party query URL, or a path with a query string
+
+    Returns:
+        string: Path and sorted query string, without scheme, host or credentials
+
+    """
+    parts = urllib.parse.urlsplit(url)
+    parameters = sorted((name, value) for name, value in
+                        urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+                        if name not in CREDENTIAL_PARAMETERS)
+    return "{}?{}".format(parts.path, urllib.parse.urlencode(parameters))
+
+
+def load_trace(path):
+    """Reads the entries of a recorded trace
+
+    Args:
+        path (string): Path of the trace file
+
+    Returns:
+        generator: Trace entries as dicts, in recording order
+
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as trace_file:
+        for line in trace_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of a sorted list
+
+    Args:
+        sorted_values ([float]): Values in ascending order
+        fraction (float): Percentile to compute, between 0 and 1
+
+    Returns:
+        float: Percentile value, 0 for an empty list
+
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class TraceRecorder:
+    """Writes incoming requests and third party traffic to a trace file
+
+    Upstream requests are made from executor threads, so writes are serialized with a lock.
+
+    Attributes:
+        path (string): Path of the trace file
+        entries (int): Number of entries written
+
+    """
+
+    def __init__(self, path):
+        """Constructor, opens the trace file for writing
+
+        Args:
+            path (string): Path of the trace file
+
+        """
+        self.path = path
+        self.entries = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(",", ":"))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+                self.entries += 1
+
+    def record_request(self, uri):
+        """Records an incoming geocode request
+
+        Args:
+            uri (string): Request path and query string
+
+        """
+        self._write({"type": "request", "uri": uri})
+
+    def record_upstream(self, service, query, code, body, latency):
+        """Records a third party request and its response
+
+        Args:
+            service (string): Name of the third party service
+            query (string): Full third party query URL, credentials are stripped
+            code (int): HTTP status code of the response, None on timeout
+            body (string): Response body
+            latency (float): Seconds taken to receive the response
+
+        """
+        self._write({"type": "upstream", "service": service, "query": sanitize_query(query),
+                     "code": code, "body": body, "latency": round(latency, 6)})
+
+    def close(self):
+        """Flushes and closes the trace file
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class StubUpstreamHandler(tornado.web.RequestHandler):
+    """Tornado handler class that answers third party queries from a recorded trace
+
+    Requests are matched on their sanitized path and query. Each match replays the next
+    recorded response for that query in turn, after sleeping for the recorded latency
+    multiplied by the stub's latency scale. Queries that were never recorded receive a 404.
+
+    Attributes:
+        stub (StubUpstream): Recorded responses and call counters
+
+    """
+
+    def initialize(self, stub):
+        """Constructor for StubUpstreamHandler
+
+        Args:
+            stub (StubUpstream): Recorded responses and call counters
+
+        """
+        self.stub = stub
+
+    async def get(self):
+        """Request handler for method=GET
+        """
+        entry = self.stub.next_response(self.request.uri)
+        if entry is None:
+            raise tornado.web.HTTPError(404)
+        await sleep(entry["latency"] * self.stub.latency_scale)
+        self.set_status(entry["code"] or 504)
+        self.set_header("Content-Type", "application/json")
+        self.write(entry["body"] or "")
+
+
+class StubStatsHandler(tornado.web.RequestHandler):
+    """Tornado handler class reporting the stub's call counters as JSON
+    """
+
+    def initialize(self, stub):
+        self.stub = stub
+
+    def get(self):
+        """Request handler for method=GET
+        """
+        self.write({"calls": self.stub.calls, "misses": self.stub.misses})
+
+
+class StubUpstream:
+    """Recorded third party responses, served by a stub tornado application
+
+    Attributes:
+        responses (dict): Map from sanitized query to its recorded entries
+        latency_scale (float): Multiplier applied to recorded latencies
+        calls (dict): Map from service name to the number of requests answered
+        misses (int): Number of requests for queries that were never recorded
+
+    """
+
+    # path reporting the stub's counters
+    STATS_PATH = "/_stub/stats"
+
+    def __init__(self, entries, latency_scale=1.0):
+        """Constructor for the stub
+
+        Args:
+            entries (iterable): Trace entries, only upstream entries are used
+            latency_scale (float): Multiplier applied to recorded latencies
+
+        """
+        self.latency_scale = latency_scale
+        self.responses = {}
+        self.calls = {}
+        self.misses = 0
+        self._cursors = {}
+        for entry in entries:
+            if entry.get("type") == "upstream":
+                self.responses.setdefault(entry["query"], []).append(entry)
+
+    def next_response(self, uri):
+        """Picks the recorded response for a query, cycling through repeated recordings
+
+        Args:
+            uri (string): Path and query string of the stub request
+
+        Returns:
+            None/dict: Recorded trace entry, None if the query was never recorded
+
+        """
+        query = sanitize_query(uri)
+        recorded = self.responses.get(query)
+        if not recorded:
+            self.misses += 1
+            return None
+        cursor = self._cursors.get(query, 0)
+        self._cursors[query] = cursor + 1
+        entry = recorded[cursor % len(recorded)]
+        self.calls[entry["service"]] = self.calls.get(entry["service"], 0) + 1
+        return entry
+
+    def create_app(self):
+        """Creates the tornado application serving the recorded responses
+
+        Returns:
+            tornado.web.Application: Stub application
+
+        """
+        return tornado.web.Application([
+            (self.STATS_PATH, StubStatsHandler, dict(stub=self)),
+            (r"/.*", StubUpstreamHandler, dict(stub=self)),
+        ])
+
+
+async def run_load(proxy_url, uris, concurrency=10, repeat=1, stub_url=None):
+    """Replays a request mix against a geoproxy server and reports its performance
+
+    Requests are issued by a fixed number of concurrent workers, each sending its next request
+    as soon as the previous one completes.
+
+    Args:
+        proxy_url (string): Base URL of the geoproxy server, eg http://localhost:8080
+        uris ([string]): Request paths and query strings, eg from the trace's request entries
+        concurrency (int): Number of concurrent workers
+        repeat (int): Number of times to replay the request mix
+        stub_url (string): Base URL of the stub upstream, to report upstream call counts
+
+    Returns:
+        dict: Report with requests, errors, elapsed, rps, p50 and p99 (seconds) and
+              upstream_calls
+
+    """
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    pending = [uri for _ in range(repeat) for uri in uris]
+    pending.reverse()
+    latencies = []
+    errors = [0]
+
+    async def worker():
+        while pending:
+            uri = pending.pop()
+            start_time = time.monotonic()
+            try:
+                await client.fetch(proxy_url.rstrip("/") + uri)
+            except Exception as error:
+                logging.getLogger("replay").debug("Request failed: %s", error)
+                errors[0] += 1
+            latencies.append(time.monotonic() - start_time)
+
+    start_time = time.monotonic()
+    await multi([worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - start_time
+
+    upstream_calls = None
+    if stub_url:
+        try:
+            response = await client.fetch(stub_url.rstrip("/") + StubUpstream.STATS_PATH)
+            upstream_calls = json.loads(response.body.decode('utf-8'))["calls"]
+        except HTTPError as error:
+            logging.getLogger("replay").warning("Failed to read stub stats: %s", error)
+    client.close()
+
+    latencies.sort()
+    return {"requests": len(latencies), "errors": errors[0], "elapsed": elapsed,
+            "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+            "p50": percentile(latencies, 0.50), "p99": percentile(latencies, 0.99),
+            "upstream_calls": upstream_calls}
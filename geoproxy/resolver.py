@@ -0,0 +1,834 @@
+#!/usr/bin/env python
+
+import asyncio
+from datetime import timedelta
+import json
+import socket
+import time
+from tornado.gen import multi
+from tornado.gen import sleep
+from tornado.gen import with_timeout
+import tornado.gen
+from tornado.ioloop import IOLoop
+import urllib.request
+import urllib.error
+
+from geoproxy.api import service_orders
+from geoproxy.batching import MicroBatcher
+from geoproxy.cache import cache_key
+from geoproxy.deadline import Deadline
+from geoproxy.deadline import RetryPolicy
+from geoproxy.geometry import Coordinate
+from geoproxy.geometry import haversine_distance
+from geoproxy.third_party_services.key_pool import DENIED
+from geoproxy.third_party_services.key_pool import RATE_LIMITED
+from geoproxy.third_party_services.service_base import TransientServiceError
+
+
+class GeoproxyResolver:
+    """Resolves parsed geoproxy requests through the cache and the third party service chain
+
+    The resolver holds everything needed to answer a request that is shared between the
+    endpoints exposing geoproxy (HTTP, WebSocket), so that they all go through the same cache,
+    service order, deadline handling and retry policy.
+
+    Third party queries are tasked on the service's own thread pool (its bulkhead) to allow the
+    tornado server to simultaneously serve other connections without blocking on slow third
+    party service responses, and to keep a slow service from tying up the threads of the
+    others. A service whose bulkhead is full is skipped immediately. The deadline's remaining
+    budget is split evenly across the services that have yet to be tried, and transient errors
+    are retried with jittered exponential backoff for as long as the service's share of the
+    budget allows. Each attempt's upstream timeout is further capped by the service's adaptive
+    timeout, derived from the service's observed latencies (see AdaptiveTimeout).
+
+    Requests in consensus mode query every service in parallel instead, and respond with the
+    result that most services agree on (see query_consensus).
+
+    When the bulkheads schedule fairly, requests wait for a thread in the order given by their
+    tenant's weight and their lane (see FairScheduler).
+
+    Services with a batch API may be put behind a MicroBatcher, in which case queries without
+    bounds are gathered over batch_window seconds and sent to the service as one batch job.
+
+    In shadow mode, a sample of the requests answered by a remote service are also sent to the
+    other remote services in the background, to compare their latency and results with the
+    primary service's (see ShadowTraffic).
+
+    With a router, the outcome of every remote query is recorded against the region of the
+    request, and requests with bounds that do not name a service query the remote services in
+    the order that has worked best in the region of their bounds (see RegionRouter).
+
+    When no service could answer a request, it is answered approximately from the centroid
+    index, if there is one, by the postal code or locality in its address (see CentroidIndex).
+
+    With a fuzzy index, a request that misses the cache is answered from the cached result of
+    the most similar query, if it is similar enough and has the same numbers (see FuzzyIndex).
+
+    Services with several API keys rotate between them (see KeyPool). The outcome of each query
+    is reported to the service's key pool, so that a key that is rate limited or not authorized
+    is taken out of rotation, and a retry is sent with the next key in the rotation.
+
+    Attributes:
+        logger (logging.logger): Logger instance
+        bulkheads (Bulkheads): Thread pools for third party queries, one per remote service
+        available_services (dict): Map from service name to ThirdPartyServiceHelper
+        service_orders (dict): Order in which the services are queried for each primary
+                               service, built once for the request parsers (see service_orders)
+        retry_policy (RetryPolicy): Backoff parameters for transient third party errors
+        cache (ResultCache): Cache of resolved results, None if caching is disabled
+        peer_cache (PeerCache): Cluster cache layer, None if the node has no peers
+        recorder (TraceRecorder): Records third party traffic, None if disabled
+        consensus_radius (float): Maximum distance in meters between two agreeing results
+        timeouts (dict): Map from service name to its AdaptiveTimeout
+        batchers (dict): Map from service name to the MicroBatcher in front of it
+        batch_timeout (float): Maximum number of seconds to wait for a batch job
+        batch_poll_interval (float): Seconds between status queries of a running batch job
+        shadow (ShadowTraffic): Shadow query sampler, None if shadow mode is disabled
+        router (RegionRouter): Per region service statistics, None if routing is disabled
+        centroids (CentroidIndex): Postal code and locality centroids, None if disabled
+        approximations (int): Number of requests answered from the centroid index
+        fuzzy (FuzzyIndex): Index of the cached queries, None if fuzzy lookups are disabled
+        fuzzy_hits (int): Number of requests answered from the result of a similar query
+
+    """
+
+    # upstream HTTP status codes that are worth retrying
+    TRANSIENT_HTTP_CODES = (429, 500, 502, 503, 504)
+    # upstream HTTP status codes caused by the API key of the query
+    KEY_HTTP_CODES = {401: DENIED, 403: DENIED, 429: RATE_LIMITED}
+
+    def __init__(self, logger, bulkheads, available_services, retry_policy=None, cache=None,
+                 peer_cache=None, recorder=None, consensus_radius=250.0, timeouts=None,
+                 batch_services=None, batch_window=0.01, batch_size=100, batch_timeout=3.0,
+                 batch_poll_interval=0.1, shadow=None, router=None, centroids=None,
+                 fuzzy=None):
+        """Constructor for the resolver
+
+        Args:
+            logger (logging.logger): Logger instance
+            bulkheads (Bulkheads): Thread pools for third party queries, one per remote service
+            available_services (dict): Map from service name to ThirdPartyServiceHelper
+            retry_policy (RetryPolicy): Backoff parameters for transient third party errors
+            cache (ResultCache): Cache of resolved results, None if caching is disabled
+            peer_cache (PeerCache): Cluster cache layer, None if the node has no peers
+            recorder (TraceRecorder): Records third party traffic, None if disabled
+            consensus_radius (float): Maximum distance in meters between two agreeing results
+            timeouts (dict): Map from service name to its AdaptiveTimeout, services without
+                             one only use the deadline
+            batch_services ([string]): Names of the services to batch queries for, services
+                                       without a batch API are ignored
+            batch_window (float): Seconds that a query may wait for others to join its batch
+            batch_size (int): Maximum number of queries per batch job
+            batch_timeout (float): Maximum number of seconds to wait for a batch job
+            batch_poll_interval (float): Seconds between status queries of a running batch job
+            shadow (ShadowTraffic): Shadow query sampler, None to disable shadow mode
+            router (RegionRouter): Per region service statistics, None to disable routing
+            centroids (CentroidIndex): Postal code and locality centroids to answer requests
+                                       approximately when no service can, None to disable
+            fuzzy (FuzzyIndex): Index of the cached queries, to answer cache misses from
+                                similar queries, None to disable
+
+        """
+        self.logger = logger
+        self.bulkheads = bulkheads
+        self.available_services = available_services
+        self.service_orders = service_orders(available_services)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.cache = cache
+        self.peer_cache = peer_cache
+        self.recorder = recorder
+        self.consensus_radius = consensus_radius
+        self.timeouts = timeouts or {}
+        self.batchers = {}
+        for service in batch_services or []:
+            helper = available_services.get(service)
+            if helper is None or not helper.supports_batch or service not in bulkheads:
+                self.logger.warning("Service %s does not support batching", service)
+                continue
+            self.batchers[service] = MicroBatcher(
+                lambda addresses, service=service: self.query_batch(service, addresses),
+                window=batch_window, max_size=batch_size)
+        self.batch_timeout = batch_timeout
+        self.batch_poll_interval = batch_poll_interval
+        self.shadow = shadow
+        self.router = router
+        self.centroids = centroids
+        self.approximations = 0
+        self.fuzzy = fuzzy
+        self.fuzzy_hits = 0
+
+    async def resolve(self, geo_proxy_request, geo_proxy_response, deadline):
+        """Populates the response for a successfully parsed request
+
+        Pseudo code:
+        - Look up the request in the cache (local, then peers) and respond if found
+        - Look up the most similar cached query in the fuzzy index and respond if found
+        - If consensus mode:
+            - Query all services in parallel and pick the result most of them agree on
+        - Else, if the request has bounds, order the services by their region's statistics
+        - For each third party service:
+            - Build third party service query from incoming request data
+            - Split the remaining deadline across the services left to try
+            - Spawn query task and wait on future for third party response, retrying
+              transient errors within the service's share of the deadline
+            - Parse third party response
+            - If success:
+                - Set response result
+                - If sampled for shadow mode, query the other services in the background
+                - Break
+            - Next service in loop
+        - Record each service's outcome against the request's region
+        - Cache the result
+        - If every service failed, answer approximately from the centroid index
+        - If no result or error was set, set an error
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request
+            geo_proxy_response (GeoproxyResponse): Response to populate
+            deadline (Deadline): Time budget for the request
+
+        """
+        consensus = geo_proxy_request.mode == "consensus"
+        key = cache_key(geo_proxy_request.address, geo_proxy_request.bounds,
+                        geo_proxy_request.mode if consensus else None, geo_proxy_request.limit)
+        cached_result = await self.cache_lookup(key)
+        if cached_result is None and self.fuzzy is not None:
+            cached_result = self.fuzzy_lookup(key)
+        if cached_result is not None:
+            geo_proxy_response.set_result(**cached_result)
+        elif consensus:
+            await self.query_consensus(geo_proxy_request, geo_proxy_response, deadline)
+            if geo_proxy_response.status == "OK":
+                self.cache_store(key, geo_proxy_response.result)
+        else:
+            await self.query_services(geo_proxy_request, geo_proxy_response, deadline)
+            if geo_proxy_response.status == "OK":
+                self.cache_store(key, geo_proxy_response.result)
+
+        # services that answered with zero results are trusted, only failures are approximated
+        # (including services skipped because the deadline was nearly used up)
+        if self.centroids is not None and geo_proxy_response.status not in ("OK",
+                                                                            "ZERO_RESULTS"):
+            self.approximate(geo_proxy_request, geo_proxy_response)
+
+        # if we had an error with both service requests, but no error has been set, do it now
+        # this handles cases like wrong API keys, offline services, etc.
+        if not geo_proxy_response.status == "OK" and geo_proxy_response.error is None:
+            if deadline.expired():
+                geo_proxy_response.set_error("Request deadline exceeded", "UNKNOWN_ERROR")
+            else:
+                geo_proxy_response.set_error("Error in third-party API requests", "UNKNOWN_ERROR")
+
+    def approximate(self, geo_proxy_request, geo_proxy_response):
+        """Answers a request from the centroid of the postal code or locality in its address
+
+        Approximate results are flagged with their precision, and are not cached, so that the
+        request is answered exactly again once the services recover.
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request
+            geo_proxy_response (GeoproxyResponse): Response to populate
+
+        """
+        located = self.centroids.locate(geo_proxy_request.address)
+        if located is None:
+            return
+        latitude, longitude, label, precision = located
+        self.logger.info("Answering approximately from the centroid index: %s", label)
+        self.approximations += 1
+        geo_proxy_response.error = None
+        geo_proxy_response.set_result("centroids", latitude, longitude, label,
+                                      precision=precision)
+
+    async def cache_lookup(self, key):
+        """Looks up a previously resolved result
+
+        The local cache is checked first, then, when the node is part of a cluster, the replica
+        of peer owned entries and the owning peer.
+
+        Args:
+            key (string): Cache key for the request
+
+        Returns:
+            None/dict: Cached result, None on a miss
+
+        """
+        if self.cache is None:
+            return None
+        result = self.cache.get(key)
+        if result is None and self.peer_cache is not None:
+            result = await self.peer_cache.get(key)
+        return result
+
+    def fuzzy_lookup(self, key):
+        """Looks up the cached result of the query most similar to the request
+
+        Only results in this node's cache are used. A similar key whose result has since been
+        evicted or has expired is removed from the index.
+
+        Args:
+            key (string): Cache key for the request
+
+        Returns:
+            None/dict: Cached result of a similar query, marked as a fuzzy match, None if there
+                       is none
+
+        """
+        match = self.fuzzy.lookup(key)
+        if match is None:
+            return None
+        similar_key, similarity = match
+        result = self.cache.get(similar_key)
+        if result is None:
+            self.fuzzy.discard(similar_key)
+            return None
+        self.logger.debug("Answering \"%s\" from \"%s\" (similarity %.2f)", key, similar_key,
+                          similarity)
+        self.fuzzy_hits += 1
+        return dict(result, match="fuzzy")
+
+    def cache_store(self, key, result):
+        """Stores a freshly resolved result
+
+        Args:
+            key (string): Cache key for the request
+            result (dict): Result from the geoproxy response
+
+        """
+        if self.peer_cache is not None:
+            self.peer_cache.put(key, result)
+        elif self.cache is not None:
+            self.cache.put(key, result)
+        if self.fuzzy is not None:
+            self.fuzzy.add(key)
+
+    async def query_services(self, geo_proxy_request, geo_proxy_response, deadline):
+        """Queries each service in the request's order until one provides a result
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request
+            geo_proxy_response (GeoproxyResponse): Response to populate
+            deadline (Deadline): Time budget for the request
+
+        """
+        # iterate through each service in request.services until we get a successful result
+        services = geo_proxy_request.services
+        if self.router is not None and geo_proxy_request.bounds is not None and \
+                geo_proxy_request.requested_service is None:
+            services = self.route(geo_proxy_request.bounds, services)
+        outcomes = []
+        for index, service in enumerate(services):
+            if deadline.expired():
+                self.logger.info("Request deadline exceeded before querying: %s", service)
+                break
+            # give this service an even share of whatever budget is left, so that a slow
+            # service cannot starve the fallbacks behind it
+            service_deadline = Deadline(deadline.share(len(services) - index))
+            start_time = time.monotonic()
+            result = await self.query_service(geo_proxy_request, service, service_deadline)
+            latency = time.monotonic() - start_time
+            outcomes.append((service, bool(result), latency))
+            # fragile detection if there was a valid response, but zero results
+            if result == 0:
+                geo_proxy_response.set_error("Zero results", "ZERO_RESULTS")
+            # otherwise assume the parse was successful, and we extracted data
+            # package it into our response object to be sent out.
+            elif result is not None:
+                geo_proxy_response.error = None
+                geo_proxy_response.set_result(service, *result)
+                if self.shadow is not None and self.available_services[service].is_remote:
+                    self.start_shadow(geo_proxy_request, service, result, latency)
+                # if we get a valid result, don't keep querying the other third party services
+                # NOTE: Making an assumption that we are only returning results from the
+                # first valid third party service
+                break
+        if self.router is not None:
+            self.record_outcomes(geo_proxy_request, geo_proxy_response, outcomes)
+
+    def route(self, bounds, services):
+        """Orders the remote services by the statistics of the region containing the bounds
+
+        Services answered in-process (the offline index) keep their place, since they cost
+        next to nothing to try.
+
+        Args:
+            bounds (BoundingBox): Bounds of the request
+            services ([string]): Names of the services in the request's order
+
+        Returns:
+            [string]: Names of the services in the order to query them
+
+        """
+        remote = [service for service in services if self.available_services[service].is_remote]
+        ordered = iter(self.router.order(bounds, remote))
+        return [next(ordered) if self.available_services[service].is_remote else service
+                for service in services]
+
+    def record_outcomes(self, geo_proxy_request, geo_proxy_response, outcomes):
+        """Records the outcome of each remote query against the request's region
+
+        The region is the center of the request's bounds, or for requests without bounds, the
+        location of the result, in which case the outcomes of requests without a result
+        cannot be placed and are not recorded.
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request
+            geo_proxy_response (GeoproxyResponse): Populated response
+            outcomes ([tuple]): Service name, if it returned a result, and seconds taken, for
+                                each service queried
+
+        """
+        if geo_proxy_request.bounds is not None:
+            location = geo_proxy_request.bounds.center()
+        elif geo_proxy_response.status == "OK":
+            location = Coordinate(geo_proxy_response.result['lat'],
+                                  geo_proxy_response.result['lon'])
+        else:
+            return
+        for service, success, latency in outcomes:
+            if self.available_services[service].is_remote:
+                self.router.record(service, location, success, latency)
+
+    async def query_consensus(self, geo_proxy_request, geo_proxy_response, deadline):
+        """Queries every service in parallel and responds with the result most of them agree on
+
+        All services share the full deadline, so the request takes as long as the slowest
+        service (or the deadline), rather than the sum of the services' latencies. Two results
+        agree when they are within consensus_radius meters of each other. The result with the
+        most agreeing results wins, ties going to the earlier service in the request's order,
+        and its agreement score is the fraction of all queried services that agree with it.
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request
+            geo_proxy_response (GeoproxyResponse): Response to populate
+            deadline (Deadline): Time budget for the request
+
+        """
+        services = geo_proxy_request.services
+        # each query is built and read before its coroutine first awaits, so the services'
+        # shared helpers can be used concurrently
+        futures = [self.query_service(geo_proxy_request, service, deadline)
+                   for service in services]
+        results = await multi(futures)
+        candidates = [(service, result) for service, result in zip(services, results) if result]
+        if not candidates:
+            if 0 in results:
+                geo_proxy_response.set_error("Zero results", "ZERO_RESULTS")
+            return
+        points = [Coordinate(result[0], result[1]) for _, result in candidates]
+        best_index, best_support = 0, 0
+        for index, point in enumerate(points):
+            support = sum(1 for other in points
+                          if haversine_distance(point, other) <= self.consensus_radius)
+            if support > best_support:
+                best_index, best_support = index, support
+        service, result = candidates[best_index]
+        self.logger.debug("Consensus on %s, %d of %d services agree", service, best_support,
+                          len(services))
+        geo_proxy_response.error = None
+        geo_proxy_response.set_result(service, *result,
+                                      agreement=round(best_support / len(services), 3))
+
+    async def query_service(self, geo_proxy_request, service, deadline):
+        """Queries a single service for the request
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request
+            service (string): Name of the service to query
+            deadline (Deadline): Time budget for the service
+
+        Returns:
+            None/0/tuple: None if error, 0 if zero results, otherwise a tuple of
+                          (latitude, longitude, resolved address), followed by the list of
+                          candidate results if the request has a limit above 1
+
+        """
+        self.logger.debug("Querying third-party service: %s", service)
+        # Grab the third party helper object, associated with the service
+        # The helper assists with third party query construction and parsing
+        service_helper = self.available_services[service]
+        limit = geo_proxy_request.limit
+        if service in self.batchers and geo_proxy_request.bounds is None and limit == 1:
+            # batch jobs take plain addresses and return a single match, so only queries
+            # without bounds or candidates are batched
+            response_json = await self.query_batched(geo_proxy_request, service, deadline)
+        else:
+            # build the third party query based on our request inputs
+            # (helpers are shared, so the query is read before yielding)
+            service_helper.build_query(geo_proxy_request.address, geo_proxy_request.bounds,
+                                       limit)
+            if service_helper.is_remote:
+                # run the query (with retries) and await the response
+                response_json = await self.query_with_retries(
+                    geo_proxy_request, service, service_helper.query, deadline,
+                    key=service_helper.key)
+            else:
+                # local services answer in-process, without a thread pool
+                response_json = service_helper.lookup(service_helper.query)
+        if not response_json:
+            return None
+        # if we got a valid response from the third party query, parse it!
+        parser = service_helper.parser
+        parse_success = parser.parse(response_json)
+        if parse_success is None or parse_success == 0:
+            return parse_success
+        if limit > 1:
+            candidates = [{'lat': lat, 'lon': lon, 'resolved_address': address}
+                          for lat, lon, address in parser.candidates[:limit]]
+            return parser.latitude, parser.longitude, parser.address, candidates
+        return parser.latitude, parser.longitude, parser.address
+
+    def start_shadow(self, geo_proxy_request, primary, result, primary_latency):
+        """Sends the request to the other remote services in the background, if it is sampled
+
+        The shadow queries are spawned on the IOLoop and the request does not wait for them.
+        Each one is dropped if the shadow concurrency budget is used up.
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request
+            primary (string): Name of the service that answered the request
+            result (tuple): Primary result, (latitude, longitude, resolved address)
+            primary_latency (float): Seconds taken by the primary service
+
+        """
+        if not self.shadow.sample():
+            return
+        for service, helper in self.available_services.items():
+            if service != primary and helper.is_remote:
+                IOLoop.current().spawn_callback(
+                    self.query_shadow, service, geo_proxy_request.address,
+                    geo_proxy_request.bounds, result, primary_latency)
+
+    async def query_shadow(self, service, address, bounds, primary_result, primary_latency):
+        """Sends a shadow query to a service and records how it compares to the primary result
+
+        Args:
+            service (string): Name of the shadow service
+            address (string): Address of the request
+            bounds (BoundingBox): Bounds of the request, None if unbounded
+            primary_result (tuple): Primary result, (latitude, longitude, resolved address)
+            primary_latency (float): Seconds taken by the primary service
+
+        """
+        if not self.shadow.try_acquire():
+            return
+        service_helper = self.available_services[service]
+        # helpers are shared, so the query is read before yielding
+        service_helper.build_query(address, bounds)
+        start_time = time.monotonic()
+        try:
+            response_json = await asyncio.wrap_future(
+                self.shadow.executor.submit(self.shadow.fetch, service_helper.query))
+        finally:
+            self.shadow.release()
+        latency = time.monotonic() - start_time
+        result, distance = None, None
+        if response_json:
+            parser = service_helper.parser
+            result = parser.parse(response_json)
+            if result:
+                result = parser.latitude, parser.longitude, parser.address
+                distance = haversine_distance(Coordinate(primary_result[0], primary_result[1]),
+                                              Coordinate(result[0], result[1]))
+        self.shadow.record(service, latency, primary_latency, result, distance)
+        if self.router is not None:
+            # shadow queries are as good a sample of the service as real ones
+            location = bounds.center() if bounds is not None else \
+                Coordinate(primary_result[0], primary_result[1])
+            self.router.record(service, location, bool(result), latency)
+
+    async def query_with_retries(self, geo_proxy_request, service, query, deadline, key=None):
+        """Queries a third party service, retrying transient errors within a deadline
+
+        Each attempt uses the time left in the deadline as its upstream timeout, or the
+        service's adaptive timeout if that is shorter, so that a hung request is abandoned as
+        soon as it is slower than nearly all recent requests to the service. Transient
+        errors (5xx, rate limiting, timeouts, or a response that the parser reports as
+        transient) are retried after a jittered exponential backoff, as long as the retry
+        policy allows another attempt and the backoff fits within the remaining budget. If the
+        service's bulkhead is full, the service is given up on without waiting. With fair
+        scheduling, the request instead waits for its tenant's share of the service's threads,
+        for as long as the deadline allows. Services with a key pool are retried with a query
+        built with the next key in the rotation.
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request, counts the attempts made
+            service (string): Name of the third party service
+            query (string): Query string to third party API including API keys
+            deadline (Deadline): Time budget for all attempts against this service
+            key (string/tuple): Credentials used in the query, None if the service has no keys
+
+        Returns:
+            None/dict: JSON data as dict on query success, otherwise None
+
+        """
+        policy = self.retry_policy
+        service_helper = self.available_services[service]
+        parser = service_helper.parser
+        bulkhead = self.bulkheads[service]
+        adaptive_timeout = self.timeouts.get(service)
+        for attempt in range(policy.max_attempts):
+            if deadline.remaining() < policy.min_timeout:
+                self.logger.info("Insufficient time left in deadline for another attempt")
+                return None
+            if not await bulkhead.acquire(geo_proxy_request.tenant, geo_proxy_request.lane,
+                                          deadline.remaining() - policy.min_timeout):
+                # the service is saturated, fail over rather than queue behind it
+                self.logger.warning("Bulkhead for %s is full, skipping the service", service)
+                return None
+            # the wait for a fair share of the service may have used some of the deadline
+            timeout = deadline.remaining()
+            if adaptive_timeout is not None:
+                timeout = min(timeout, adaptive_timeout.timeout())
+            if attempt > 0 and key is not None:
+                # the key may have been taken out of rotation by the previous attempt
+                service_helper.build_query(geo_proxy_request.address, geo_proxy_request.bounds,
+                                           geo_proxy_request.limit)
+                query, key = service_helper.query, service_helper.key
+            geo_proxy_request.attempts += 1
+            try:
+                response_json = await asyncio.wrap_future(bulkhead.submit(
+                    self.query_third_party_geocoder, query, timeout, service, key,
+                    geo_proxy_request.limit))
+            except TransientServiceError as error:
+                self.logger.warning("Transient error in API request: %s", error)
+            else:
+                if response_json is None or not parser.is_transient(response_json):
+                    return response_json
+                self.logger.warning("Transient error reported in API response")
+            finally:
+                bulkhead.release()
+            if attempt + 1 < policy.max_attempts:
+                delay = policy.backoff(attempt)
+                if delay >= deadline.remaining():
+                    break
+                await sleep(delay)
+        return None
+
+    async def query_batched(self, geo_proxy_request, service, deadline):
+        """Adds the request's address to the service's open batch and waits for its result
+
+        Batch jobs are not retried, and the request gives up on its batch when the deadline
+        expires (the batch job itself carries on for the other requests).
+
+        Args:
+            geo_proxy_request (GeoproxyRequestParser): Parsed request, counts the attempts made
+            service (string): Name of the third party service
+            deadline (Deadline): Time budget for the service
+
+        Returns:
+            None/dict: JSON data as dict on query success, otherwise None
+
+        """
+        remaining = deadline.remaining()
+        if remaining < self.retry_policy.min_timeout:
+            self.logger.info("Insufficient time left in deadline for a batch")
+            return None
+        geo_proxy_request.attempts += 1
+        future = self.batchers[service].submit(geo_proxy_request.address)
+        try:
+            response_json = await with_timeout(timedelta(seconds=remaining), future)
+        except tornado.gen.TimeoutError:
+            self.logger.warning("Request deadline exceeded waiting for a %s batch", service)
+            return None
+        return response_json
+
+    async def query_batch(self, service, addresses):
+        """Sends a batch of addresses to a service as one batch job, on the service's bulkhead
+
+        Args:
+            service (string): Name of the third party service
+            addresses ([string]): Addresses to geocode
+
+        Returns:
+            None/[dict]: One JSON response per address (None for an address missing from the
+                         results), None if the batch failed
+
+        """
+        bulkhead = self.bulkheads[service]
+        # a batch carries requests from any tenant, it waits in the bulk lane
+        if not await bulkhead.acquire(lane="bulk", timeout=self.batch_timeout):
+            self.logger.warning("Bulkhead for %s is full, dropping a batch", service)
+            return None
+        try:
+            responses = await asyncio.wrap_future(
+                bulkhead.submit(self.query_batch_geocoder, service, addresses))
+        finally:
+            bulkhead.release()
+        return responses
+
+    def query_batch_geocoder(self, service, addresses):
+        """Runs a batch job on a third party service, run on the service's bulkhead
+
+        The job is submitted, its status polled every batch_poll_interval seconds until it
+        completes, and its result file downloaded, all within batch_timeout seconds.
+
+        Args:
+            service (string): Name of the third party service
+            addresses ([string]): Addresses to geocode
+
+        Returns:
+            None/[dict]: One JSON response per address (None for an address missing from the
+                         result file), None if the job failed or timed out
+
+        """
+        helper = self.available_services[service]
+        give_up_time = time.monotonic() + self.batch_timeout
+        # the status and result of a job are queried with the key that ran it
+        key = helper.key_pool.acquire() if helper.key_pool is not None else None
+        try:
+            url, body = helper.build_batch_job(addresses, key)
+            job_id, status = helper.parse_batch_status(
+                self.batch_request(url, give_up_time, data=body))
+            self.logger.debug("Batch job %s of %d addresses: %s", job_id, len(addresses),
+                              status)
+            while job_id and status != "completed":
+                if status in helper.BATCH_FAILED:
+                    self.logger.error("Batch job %s %s", job_id, status)
+                    return None
+                if time.monotonic() + self.batch_poll_interval >= give_up_time:
+                    self.logger.error("Batch job %s timed out", job_id)
+                    return None
+                time.sleep(self.batch_poll_interval)
+                _, status = helper.parse_batch_status(self.batch_request(
+                    helper.build_batch_status_query(job_id, key), give_up_time))
+            if not job_id:
+                self.logger.error("Batch job was not accepted")
+                return None
+            result = self.batch_request(helper.build_batch_result_query(job_id, key),
+                                        give_up_time)
+        except urllib.error.HTTPError as error:
+            self.report_key(service, key, error.code, None)
+            self.logger.error("Error in batch API request: %s", error)
+            return None
+        except (OSError, ValueError) as error:
+            # URLError and socket.timeout are both OSErrors
+            self.logger.error("Error in batch API request: %s", error)
+            return None
+        return helper.parse_batch_result(result, len(addresses))
+
+    def batch_request(self, url, give_up_time, data=None):
+        """Sends one HTTP request of a batch job
+
+        Args:
+            url (string): Request URL including API keys
+            give_up_time (float): Monotonic time by which the whole job must be done
+            data (bytes): Body of a POST request, None for a GET request
+
+        Returns:
+            string: Response body
+
+        Raises:
+            ValueError: If there is no time left for the request
+            urllib.error.URLError: If the request failed
+
+        """
+        timeout = give_up_time - time.monotonic()
+        if timeout <= 0:
+            raise ValueError("Batch timeout exceeded")
+        request = urllib.request.Request(url, data=data)
+        if data is not None:
+            request.add_header("Content-Type", "text/plain; charset=UTF-8")
+        return urllib.request.urlopen(request, timeout=timeout).read().decode("utf-8")
+
+    def query_third_party_geocoder(self, query, timeout=1, service=None, key=None, limit=1):
+        """Sends HTTP request to third party geocoding service, run on the service's bulkhead
+
+        The response is decoded by the service's parser, which only decodes the results that
+        will be parsed.
+
+        Args:
+            query (string): Query string to third party API including API keys
+            timeout (float): Number of seconds to wait for response before handling timeout
+                             exception
+            service (string): Name of the third party service, used when recording traffic
+            key (string/tuple): Credentials used in the query, reported to the service's key
+                                pool with the outcome of the query
+            limit (int): Number of results that will be parsed
+
+        Returns:
+            None/dict: JSON data as dict on query success, otherwise None
+
+        Raises:
+            TransientServiceError: If the service responded with a retryable HTTP status or
+                                   timed out
+
+        """
+        response = None
+        start_time = time.monotonic()
+        try:
+            http_response = urllib.request.urlopen(query, timeout=timeout)
+            response = http_response.read().decode('utf-8')
+            self.record_upstream(service, query, http_response.getcode(), response, start_time)
+        except urllib.error.HTTPError as error:
+            self.record_upstream(service, query, error.code,
+                                 error.read().decode('utf-8', 'replace'), start_time)
+            self.report_key(service, key, error.code, None)
+            if error.code in self.TRANSIENT_HTTP_CODES:
+                raise TransientServiceError("HTTP {}".format(error.code))
+            self.logger.error("Error in API request: %s", error)
+        except urllib.error.URLError as error:
+            if isinstance(error.reason, socket.timeout):
+                self.record_upstream(service, query, None, None, start_time)
+                raise TransientServiceError("Timeout in API request")
+            self.logger.error("Error in API request: %s", error)
+        except socket.timeout:
+            self.record_upstream(service, query, None, None, start_time)
+            raise TransientServiceError("Timeout in API request")
+        # if our response succeeds, pass the data back upstream for the parsers to use
+        if response:
+            helper = self.available_services.get(service)
+            if helper is not None:
+                response_json = helper.parser.decode(response, limit)
+            else:
+                response_json = json.loads(response)
+            self.report_key(service, key, http_response.getcode(), response_json)
+            # deserialized the data before it goes out so that can use it easily
+            return response_json
+        # third party API query failed
+        else:
+            return None
+
+    def report_key(self, service, key, code, response_json):
+        """Reports the outcome of a third party request to the key pool of the service
+
+        Args:
+            service (string): Name of the third party service
+            key (string/tuple): Credentials used in the request, None if the service has no
+                                keys
+            code (int): HTTP status code of the response
+            response_json (dict): JSON response as dict, None if the request failed
+
+        """
+        if key is None:
+            return
+        helper = self.available_services.get(service)
+        if helper is None or helper.key_pool is None:
+            return
+        error = self.KEY_HTTP_CODES.get(code)
+        if error is None and response_json is not None:
+            error = helper.parser.key_error(response_json)
+        if error is not None or response_json is not None:
+            helper.key_pool.report(key, error)
+
+    def record_upstream(self, service, query, code, body, start_time):
+        """Records the latency of a third party request, and writes the request and its
+        response to the trace when recording
+
+        Timed out requests are recorded with the time waited, so a service that starts hanging
+        pushes its adaptive timeout up towards the ceiling rather than down.
+
+        Args:
+            service (string): Name of the third party service
+            query (string): Query string to third party API including API keys
+            code (int): HTTP status code of the response, None on timeout
+            body (string): Response body
+            start_time (float): Monotonic time at which the request was sent
+
+        """
+        latency = time.monotonic() - start_time
+        adaptive_timeout = self.timeouts.get(service)
+        if adaptive_timeout is not None:
+            adaptive_timeout.observe(latency)
+        if self.recorder is not None:
+            self.recorder.record_upstream(service, query, code, body, latency)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to route requests to the service that does best in their region
+
+Third party services differ in coverage and latency from one region to the next, so a single
+service order is a compromise everywhere. A RegionRouter keeps success and latency statistics
+of each service per geohash cell, learned from past results, and orders the services of a
+request with bounds by how they have done in the cell containing those bounds.
+
+Statistics are kept for every level of the geohash hierarchy, up to the router's precision,
+so that a region with little traffic of its own falls back to the statistics of the larger
+region around it.
+
+A service that is ordered after another is rarely queried, so its statistics would stop
+changing and it could never win its place back. A small fraction of the routed requests try
+one of the other services first instead, so that every service keeps being sampled.
+
+"""
+
+from collections import OrderedDict
+import random
+
+from geoproxy.geometry import geohash
+
+
+class RegionStats:
+    """Success rate and latency of a service in a region
+
+    Both are exponentially weighted moving averages, so that the statistics follow changes in
+    a service's performance.
+
+    Attributes:
+        samples (int): Number of outcomes recorded
+        success_rate (float): Average fraction of queries that returned a result
+        latency (float): Average seconds per query
+
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.success_rate = 0.0
+        self.latency = 0.0
+
+    def record(self, success, latency, alpha):
+        """Records the outcome of a query
+
+        Args:
+            success (bool): If the query returned a result
+            latency (float): Seconds taken by the query
+            alpha (float): Weight of the new outcome in the moving averages
+
+        """
+        self.samples += 1
+        # the first outcomes are averaged evenly, so the first one does not dominate
+        weight = max(alpha, 1.0 / self.samples)
+        self.success_rate += weight * ((1.0 if success else 0.0) - self.success_rate)
+        self.latency += weight * (latency - self.latency)
+
+    def cost(self):
+        """Expected seconds spent on the service per result it returns
+
+        Returns:
+            float: Average latency divided by the success rate, lower is better
+
+        """
+        return self.latency / max(self.success_rate, 0.01)
+
+
+class RegionRouter:
+    """Spatial index of per-region service statistics, used to order the services of requests
+
+    Outcomes are recorded on the IOLoop thread, so no locking is needed. The number of cells is
+    bounded, the least recently used cells are evicted first.
+
+    Attributes:
+        precision (int): Length of the geohashes of the smallest cells
+        min_samples (int): Outcomes needed before a service's statistics in a cell are used
+        alpha (float): Weight of each new outcome in the moving averages
+        max_regions (int): Maximum number of cells kept
+        explore_rate (float): Fraction of the routed requests that try one of the services
+                              ordered after the cheapest first
+        regions (OrderedDict): Map from geohash to a dict from service name to RegionStats,
+                               least recently used first
+        routed (int): Number of requests ordered from region statistics
+        unrouted (int): Number of requests with bounds and no statistics for their region
+        explored (int): Number of routed requests that tried another service first
+
+    """
+
+    def __init__(self, precision=4, min_samples=20, alpha=0.05, max_regions=10000,
+                 explore_rate=0.05):
+        """Constructor for the router
+
+        Args:
+            precision (int): Length of the geohashes of the smallest cells, eg 4 for cells
+                             of about 39km by 20km
+            min_samples (int): Outcomes needed before a service's statistics in a cell are
+                               used
+            alpha (float): Weight of each new outcome in the moving averages
+            max_regions (int): Maximum number of cells kept
+            explore_rate (float): Fraction of the routed requests that try one of the
+                                  services ordered after the cheapest first, 0 to disable
+
+        """
+        self.precision = max(1, precision)
+        self.min_samples = max(1, min_samples)
+        self.alpha = alpha
+        self.max_regions = max(self.precision, max_regions)
+        self.regions = OrderedDict()
+        self.explore_rate = explore_rate
+        self.routed = 0
+        self.unrouted = 0
+        self.explored = 0
+
+    def record(self, service, location, success, latency):
+        """Records the outcome of a query in the cells containing a location
+
+        Args:
+            service (string): Name of the service queried
+            location (Coordinate): Location of the query, eg the center of its bounds or the
+                                   location of its result
+            success (bool): If the query returned a result
+            latency (float): Seconds taken by the query
+
+        """
+        cell = geohash(location.latitude, location.longitude, self.precision)
+        # the larger regions are touched last, so they are the last to be evicted
+        for length in range(len(cell), 0, -1):
+            region = self.regions.get(cell[:length])
+            if region is None:
+                region = self.regions[cell[:length]] = {}
+            else:
+                self.regions.move_to_end(cell[:length])
+            stats = region.get(service)
+            if stats is None:
+                stats = region[service] = RegionStats()
+            stats.record(success, latency, self.alpha)
+        while len(self.regions) > self.max_regions:
+            self.regions.popitem(last=False)
+
+    def order(self, bounds, services):
+        """Orders services by their cost in the smallest known region containing the bounds
+
+        Services with at least min_samples outcomes in the region go first, cheapest first (see
+        RegionStats.cost), followed by the other services in their original order. If no
+        service has enough outcomes in any region containing the bounds, the order is kept.
+        A fraction explore_rate of the routed requests move one of the services after the
+        first, picked at random, to the front.
+
+        Args:
+            bounds (BoundingBox): Bounds of the request
+            services ([string]): Names of the services in their default order
+
+        Returns:
+            [string]: Names of the services in the order to query them
+
+        """
+        cell = bounds.geohash(self.precision)
+        for length in range(len(cell), 0, -1):
+            region = self.regions.get(cell[:length])
+            if region is None:
+                continue
+            known = [service for service in services
+                     if service in region and region[service].samples >= self.min_samples]
+            if known:
+                self.routed += 1
+                known.sort(key=lambda service: region[service].cost())
+                ordered = known + [service for service in services if service not in known]
+                if len(ordered) > 1 and random.random() < self.explore_rate:
+                    self.explored += 1
+                    ordered.insert(0, ordered.pop(random.randrange(1, len(ordered))))
+                return ordered
+        self.unrouted += 1
+        return services
+
+    def stats(self):
+        """Current state of the router
+
+        Returns:
+            dict: Number of cells, of requests routed and not routed, and of routed requests
+                  that tried another service first
+
+        """
+        return {"regions": len(self.regions), "routed": self.routed, "unrouted": self.unrouted,
+                "explored": self.explored}
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""Collection of classes used to compare third party services on live traffic
+
+Only the first service to answer a request is normally queried, so there is little data on how
+the fallback services would have done on the same requests. In shadow mode, a sample of the
+requests answered by a service is mirrored to every other remote service in the background,
+after the response has been sent. Each shadow query's latency is compared to the primary
+service's latency on the same request, and its result to the primary result, which gives a
+like for like comparison of the services to base routing decisions on.
+
+Shadow queries run on their own small thread pool, never on the services' bulkheads, and a
+sampled request is dropped when that pool is busy, so shadow traffic cannot add latency to,
+or take capacity from, real requests.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import random
+import urllib.error
+import urllib.request
+
+from geoproxy.latency import P2Quantile
+from geoproxy.loadgen import LatencyHistogram
+
+
+class ShadowStats:
+    """Comparison of a shadow service against the primary services of the sampled requests
+
+    Attributes:
+        requests (int): Number of shadow queries sent
+        errors (int): Number of shadow queries that failed or timed out
+        zero_results (int): Number of shadow queries without a result
+        faster (int): Number of shadow queries answered before the primary service's
+        agreements (int): Number of results within the agreement radius of the primary result
+        latency (LatencyHistogram): Latencies of the shadow queries
+        primary_latency (LatencyHistogram): Latencies of the primary services on the same
+                                            requests
+        max_distance (float): Largest distance in meters from a primary result
+
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.zero_results = 0
+        self.faster = 0
+        self.agreements = 0
+        self.latency = LatencyHistogram()
+        self.primary_latency = LatencyHistogram()
+        self._median_distance = P2Quantile(0.5)
+        self._p90_distance = P2Quantile(0.9)
+        self.max_distance = 0.0
+
+    def record(self, latency, primary_latency, result, distance=None, agrees=False):
+        """Records the outcome of a shadow query
+
+        Args:
+            latency (float): Seconds taken by the shadow query
+            primary_latency (float): Seconds taken by the primary service
+            result (None/int/tuple): None on error, 0 on zero results, otherwise the result
+            distance (float): Distance in meters from the primary result, None without result
+            agrees (bool): If the result is within the agreement radius of the primary result
+
+        """
+        self.requests += 1
+        self.latency.record(latency)
+        self.primary_latency.record(primary_latency)
+        if result is None:
+            self.errors += 1
+            return
+        if latency < primary_latency:
+            self.faster += 1
+        if result == 0:
+            self.zero_results += 1
+            return
+        self._median_distance.add(distance)
+        self._p90_distance.add(distance)
+        self.max_distance = max(self.max_distance, distance)
+        if agrees:
+            self.agreements += 1
+
+    def to_dict(self):
+        """Statistics as a dict, as reported on "/stats"
+
+        Returns:
+            dict: Query counts, the latency summaries of the shadow and primary queries (see
+                  LatencyHistogram.summary), and the median, 90th percentile and maximum
+                  distance in meters from the primary results
+
+        """
+        results = self.requests - self.errors - self.zero_results
+        median = self._median_distance.value()
+        p90 = self._p90_distance.value()
+        return {"requests": self.requests, "errors": self.errors,
+                "zero_results": self.zero_results, "faster": self.faster,
+                "agreement": round(self.agreements / results, 3) if results else None,
+                "latency": self.latency.summary((0.5, 0.99)),
+                "primary_latency": self.primary_latency.summary((0.5, 0.99)),
+                "distance": {"p50": round(median, 1) if median is not None else None,
+                             "p90": round(p90, 1) if p90 is not None else None,
+                             "max": round(self.max_distance, 1)}}
+
+
+class ShadowTraffic:
+    """Samples requests for shadow queries and runs them within a fixed concurrency budget
+
+    Sampling and statistics happen on the IOLoop thread, only the blocking HTTP request of a
+    shadow query runs on the shadow thread pool.
+
+    Attributes:
+        rate (float): Fraction of the requests answered by a remote service that are mirrored
+        concurrency (int): Maximum number of shadow queries in flight
+        timeout (float): Upstream timeout of a shadow query in seconds
+        radius (float): Maximum distance in meters between two agreeing results
+        executor (ThreadPoolExecutor): Thread pool for shadow queries
+        in_flight (int): Number of shadow queries in flight
+        sampled (int): Number of requests sampled
+        dropped (int): Number of shadow queries dropped because the budget was used up
+        services (dict): Map from service name to its ShadowStats
+
+    """
+
+    def __init__(self, rate, concurrency=2, timeout=3.0, radius=250.0):
+        """Constructor for the sampler
+
+        Args:
+            rate (float): Fraction of the requests answered by a remote service to mirror,
+                          between 0 and 1
+            concurrency (int): Maximum number of shadow queries in flight
+            timeout (float): Upstream timeout of a shadow query in seconds
+            radius (float): Maximum distance in meters between two agreeing results
+
+        """
+        self.rate = min(1.0, max(0.0, rate))
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.radius = radius
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                           thread_name_prefix="shadow")
+        self.in_flight = 0
+        self.sampled = 0
+        self.dropped = 0
+        self.services = {}
+        self.logger = logging.getLogger("ShadowTraffic")
+
+    def sample(self):
+        """Decides if a request is mirrored
+
+        Returns:
+            bool: If the request should be sent to the shadow services
+
+        """
+        if self.rate <= 0.0 or random.random() >= self.rate:
+            return False
+        self.sampled += 1
+        return True
+
+    def try_acquire(self):
+        """Takes a place in the concurrency budget, without waiting
+
+        Returns:
+            bool: If the shadow query may be sent, False if it is dropped
+
+        """
+        if self.in_flight >= self.concurrency:
+            self.dropped += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        """Returns a place in the concurrency budget
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def fetch(self, query):
+        """Sends a shadow query, run on the shadow thread pool
+
+        Unlike real queries, shadow queries are not retried, recorded in traces or counted
+        towards the services' adaptive timeouts.
+
+        Args:
+            query (string): Query string to third party API including API keys
+
+        Returns:
+            None/dict: JSON data as dict on query success, otherwise None
+
+        """
+        try:
+            response = urllib.request.urlopen(query, timeout=self.timeout).read()
+            return json.loads(response.decode('utf-8'))
+        except (OSError, ValueError) as error:
+            # URLError, HTTPError and socket.timeout are all OSErrors
+            self.logger.debug("Error in shadow query: %s", error)
+            return None
+
+    def record(self, service, latency, primary_latency, result, distance=None):
+        """Records the outcome of a shadow query
+
+        Args:
+            service (string): Name of the shadow service
+            latency (float): Seconds taken by the shadow query
+            primary_latency (float): Seconds taken by the primary service
+            result (None/int/tuple): None on error, 0 on zero results, otherwise the result
+            distance (float): Distance in meters from the primary result, None without result
+
+        """
+        stats = self.services.get(service)
+        if stats is None:
+            stats = self.services[service] = ShadowStats()
+        stats.record(latency, primary_latency, result, distance,
+                     distance is not None and distance <= self.radius)
+
+    def stats(self):
+        """Current state of shadow mode
+
+        Returns:
+            dict: Sample rate, requests sampled, queries in flight and dropped, and a map from
+                  service name to ShadowStats.to_dict()
+
+        """
+        return {"rate": self.rate, "sampled": self.sampled, "in_flight": self.in_flight,
+                "dropped": self.dropped,
+                "services": {service: stats.to_dict()
+                             for service, stats in self.services.items()}}
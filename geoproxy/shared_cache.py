@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""Cache of geocoding results shared by the worker processes of a host
+
+Each worker process has its own ResultCache, so running several workers per host keeps a copy
+of the hot results in each of them, and each worker only hits on the queries it has answered
+itself. A SharedResultCache is instead a fixed size hash table in a memory mapped file, read
+and written by every worker that maps it, which bounds the memory used by the cache however
+many workers there are. Entries carry a wall clock expiry, so a cache file kept on disk (rather
+than in /dev/shm) also survives restarts.
+
+The table is set associative: a key's hash picks a bucket of WAYS consecutive slots, and the
+key is stored in any slot of its bucket. A full bucket evicts its least recently used entry.
+Readers do not lock, each slot is guarded by a sequence counter (a seqlock) that writers make
+odd while they write, so a reader that sees an odd or changed counter reads the slot again.
+Writers of a bucket exclude each other with a POSIX record lock on the bucket's byte range.
+
+File layout (all integers are little endian):
+    header: magic (8 bytes), slot size (uint32), ways (uint32), slot count (uint64), padded
+            to HEADER_SIZE bytes
+    slots:  slot count x slot size bytes, each one sequence counter (uint64), key hash
+            (uint64), expiry (float64, 0 for none), last use (float64), key length (uint16),
+            value length (uint16), key (utf-8), value (JSON)
+
+"""
+
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from geoproxy.third_party_services.local import address_hash
+
+SHARED_CACHE_MAGIC = b"GPXSHMC1"
+HEADER_SIZE = 64
+# slots per bucket
+WAYS = 4
+# reads of a slot before a reader gives up on a writer and misses
+READ_ATTEMPTS = 8
+_HEADER = struct.Struct("<8sIIQ")
+_SEQUENCE = struct.Struct("<Q")
+_SLOT = struct.Struct("<QQddHH")
+# the slot header without its sequence counter, as written by put()
+_ENTRY = struct.Struct("<QddHH")
+_LAST_USE = struct.Struct("<d")
+_LAST_USE_OFFSET = 24
+
+
+class SharedResultCache:
+    """Bounded cache of geoproxy results in a memory mapped file, shared between processes
+
+    Has the interface of ResultCache. Each process opens the file itself, the first one to do
+    so creates it. The hit and miss counters are kept per process. Within a process, the cache
+    is only used from the IOLoop thread.
+
+    Attributes:
+        path (string): Path of the cache file
+        slots (int): Number of entries the cache holds
+        slot_size (int): Bytes per entry, including its key and value
+        ttl (float): Number of seconds an entry remains valid, None for no expiry
+        hits (int): Number of successful lookups in this process
+        misses (int): Number of failed lookups in this process
+        evictions (int): Number of live entries evicted by this process
+        oversize (int): Number of results not cached by this process because they do not
+                        fit in a slot
+
+    """
+
+    def __init__(self, path, slots=None, slot_size=512, ttl=None):
+        """Constructor, creates the cache file if it does not exist and maps it into memory
+
+        The slot count and size are only used to create the file, an existing file keeps the
+        geometry it was created with.
+
+        Args:
+            path (string): Path of the cache file, eg on /dev/shm to keep it in memory
+            slots (int): Number of entries the cache holds, rounded up to a multiple of WAYS,
+                         10000 if None
+            slot_size (int): Bytes per entry, rounded up to a multiple of 8
+            ttl (float): Number of seconds an entry remains valid, None for no expiry
+
+        Raises:
+            ValueError: If the file exists and is not a geoproxy shared cache
+
+        """
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.oversize = 0
+        self.logger = logging.getLogger("SharedResultCache")
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # the whole file is locked while it is created, so only one process creates it
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    slot_size = max(_SLOT.size + 8, (slot_size + 7) // 8 * 8)
+                    count = max(WAYS, ((slots or 10000) + WAYS - 1) // WAYS * WAYS)
+                    os.ftruncate(self._fd, HEADER_SIZE + count * slot_size)
+                    os.pwrite(self._fd,
+                              _HEADER.pack(SHARED_CACHE_MAGIC, slot_size, WAYS, count), 0)
+                header = os.pread(self._fd, _HEADER.size, 0)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            magic, self.slot_size, self._ways, self.slots = _HEADER.unpack(header)
+            if magic != SHARED_CACHE_MAGIC:
+                raise ValueError("{} is not a geoproxy shared cache".format(path))
+            self._mmap = mmap.mmap(self._fd, HEADER_SIZE + self.slots * self.slot_size)
+        except Exception:
+            os.close(self._fd)
+            raise
+        if slots is not None and self.slots != max(WAYS, (slots + WAYS - 1) // WAYS * WAYS):
+            self.logger.warning("Using the %d slots of the existing cache file %s",
+                                self.slots, path)
+        self._buckets = self.slots // self._ways
+        self._bucket_size = self._ways * self.slot_size
+        # the key hashes of a bucket's slots, read in one go to rule out most slots on a miss
+        self._bucket_hashes = struct.Struct(
+            "<Q" + "{}xQ".format(self.slot_size - 8) * (self._ways - 1))
+
+    def __len__(self):
+        now = time.time()
+        count = 0
+        for offset in range(HEADER_SIZE, HEADER_SIZE + self.slots * self.slot_size,
+                            self.slot_size):
+            _, _, expires_at, _, key_length, _ = _SLOT.unpack_from(self._mmap, offset)
+            if key_length and (not expires_at or expires_at > now):
+                count += 1
+        return count
+
+    def __contains__(self, key):
+        return self._find(key.encode("utf-8"))[0] is not None
+
+    def close(self):
+        """Unmaps and closes the cache file
+        """
+        self._mmap.close()
+        os.close(self._fd)
+
+    def _find(self, key):
+        """Reads the entry of a key
+
+        Args:
+            key (bytes): UTF-8 encoded cache key
+
+        Returns:
+            tuple: Offset of the key's slot and its value bytes, (None, None) if the key is
+                   missing or expired
+
+        """
+        buf = self._mmap
+        key_hash = address_hash(key)
+        base = HEADER_SIZE + (key_hash % self._buckets) * self._bucket_size
+        hashes = self._bucket_hashes.unpack_from(buf, base + _SEQUENCE.size)
+        if key_hash not in hashes:
+            return None, None
+        for offset in range(base, base + self._bucket_size, self.slot_size):
+            for _ in range(READ_ATTEMPTS):
+                sequence, entry_hash, expires_at, _, key_length, value_length = \
+                    _SLOT.unpack_from(buf, offset)
+                if sequence & 1:
+                    # a writer is filling the slot
+                    continue
+                if entry_hash != key_hash or key_length != len(key):
+                    break
+                start = offset + _SLOT.size
+                data = buf[start:start + key_length + value_length]
+                if _SEQUENCE.unpack_from(buf, offset)[0] != sequence:
+                    # the slot was rewritten while it was read
+                    continue
+                if data[:key_length] != key:
+                    break
+                if expires_at and expires_at <= time.time():
+                    return None, None
+                return offset, data[key_length:]
+        return None, None
+
+    def get(self, key):
+        """Looks up a result, refreshing its recency
+
+        Args:
+            key (string): Cache key
+
+        Returns:
+            None/dict: Cached result, None if missing or expired
+
+        """
+        offset, value = self._find(key.encode("utf-8"))
+        if offset is None:
+            self.misses += 1
+            return None
+        # recency only orders evictions, so it is updated without the bucket lock
+        _LAST_USE.pack_into(self._mmap, offset + _LAST_USE_OFFSET, time.time())
+        self.hits += 1
+        return json.loads(value)
+
+    def put(self, key, result):
+        """Stores a result, evicting the least recently used entry of its bucket if it is full
+
+        Results that do not fit in a slot with their key are not stored.
+
+        Args:
+            key (string): Cache key
+            result (dict): Result to store
+
+        """
+        key = key.encode("utf-8")
+        value = json.dumps(result, separators=(",", ":")).encode("utf-8")
+        if not key or _SLOT.size + len(key) + len(value) > self.slot_size:
+            self.oversize += 1
+            return
+        buf = self._mmap
+        key_hash = address_hash(key)
+        base = HEADER_SIZE + (key_hash % self._buckets) * self._bucket_size
+        now = time.time()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._bucket_size, base)
+        try:
+            # the key's own slot, or else an empty slot, or else the least recently used
+            target, target_rank = None, None
+            for offset in range(base, base + self._bucket_size, self.slot_size):
+                _, entry_hash, expires_at, last_use, key_length, _ = \
+                    _SLOT.unpack_from(buf, offset)
+                start = offset + _SLOT.size
+                if entry_hash == key_hash and buf[start:start + key_length] == key:
+                    target, target_rank = offset, None
+                    break
+                if not key_length or (expires_at and expires_at <= now):
+                    rank = -1.0
+                else:
+                    rank = last_use
+                if target is None or rank < target_rank:
+                    target, target_rank = offset, rank
+            if target_rank is not None and target_rank >= 0:
+                self.evictions += 1
+            # odd while writing, even if a writer died mid-write and left the counter odd
+            sequence = _SEQUENCE.unpack_from(buf, target)[0] | 1
+            _SEQUENCE.pack_into(buf, target, sequence)
+            _ENTRY.pack_into(buf, target + _SEQUENCE.size, key_hash,
+                             now + self.ttl if self.ttl else 0.0, now, len(key), len(value))
+            start = target + _SLOT.size
+            buf[start:start + len(key) + len(value)] = key + value
+            _SEQUENCE.pack_into(buf, target, sequence + 1)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._bucket_size, base)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from geoproxy.access_log import NonBlockingQueueHandler
+from geoproxy.access_log import SamplingFilter
+from geoproxy.access_log import configure_logging
+import logging
+import queue
+import unittest
+
+
+class MockHandler(logging.Handler):
+
+    def __init__(self):
+        super(MockHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestNonBlockingQueueHandler(unittest.TestCase):
+    def test_deferred_formatting(self):
+        log_queue = queue.Queue()
+        handler = NonBlockingQueueHandler(log_queue)
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "%s:%d:%s",
+                                   ("a", 1, [1, 2]), None)
+        handler.handle(record)
+        queued = log_queue.get_nowait()
+        # message is left unformatted, mutable arguments are converted to strings
+        self.assertEqual(queued.msg, "%s:%d:%s")
+        self.assertEqual(queued.args, ("a", 1, "[1, 2]"))
+        self.assertEqual(queued.getMessage(), "a:1:[1, 2]")
+
+    def test_drop_when_full(self):
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        for _ in range(3):
+            handler.handle(logging.LogRecord("test", logging.INFO, __file__, 1, "msg", (), None))
+        self.assertEqual(handler.dropped, 2)
+
+
+class TestSamplingFilter(unittest.TestCase):
+    def test_sampling(self):
+        debug = logging.LogRecord("test", logging.DEBUG, __file__, 1, "msg", (), None)
+        warning = logging.LogRecord("test", logging.WARNING, __file__, 1, "msg", (), None)
+        self.assertFalse(SamplingFilter(0.0).filter(debug))
+        self.assertTrue(SamplingFilter(0.0).filter(warning))
+        self.assertTrue(SamplingFilter(1.0).filter(debug))
+        kept = sum(SamplingFilter(0.5).filter(debug) for _ in range(1000))
+        self.assertTrue(300 < kept < 700)
+
+
+class TestConfigureLogging(unittest.TestCase):
+    def test_background_writer(self):
+        root = logging.getLogger()
+        saved_handlers, saved_level = list(root.handlers), root.level
+        mock_handler = MockHandler()
+        listener = configure_logging(level=logging.DEBUG, debug_sample_rate=0.0,
+                                     handlers=[mock_handler])
+        try:
+            logger = logging.getLogger("test_configure_logging")
+            logger.debug("sampled out")
+            logger.info("kept %s", "lazily")
+        finally:
+            listener.stop()
+            root.handlers = saved_handlers
+            root.setLevel(saved_level)
+        self.assertEqual(mock_handler.messages, ["kept lazily"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+from geoproxy.address import canonicalize_address
+from geoproxy.address import normalize_address
+import unittest
+
+
+class TestAddress(unittest.TestCase):
+    def test_normalize_address(self):
+        self.assertEqual(normalize_address("350 5th Ave,+New York"), "350 5th ave new york")
+        self.assertEqual(normalize_address("  350  5th   AVE. "), "350 5th ave")
+        self.assertEqual(normalize_address("Straße_1"), "straße 1")
+        self.assertEqual(normalize_address(""), "")
+
+    def test_canonicalize_address(self):
+        self.assertEqual(canonicalize_address("350 Fifth Avenue, New York, NY"),
+                         "350 5th ave ny")
+        self.assertEqual(canonicalize_address("350 5th Ave NY"), "350 5th ave ny")
+        self.assertEqual(canonicalize_address("1 North Main Street, Suite 2"),
+                         "1 n main st ste 2")
+        self.assertEqual(canonicalize_address("1 Main St, North Carolina"), "1 main st nc")
+        # single words that are also state names are left alone
+        self.assertEqual(canonicalize_address("Washington Street"), "washington st")
+        self.assertEqual(canonicalize_address(""), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+from geoproxy.admission import AdmissionController
+from geoproxy.admission import MonitoredThreadPoolExecutor
+import threading
+import time
+import unittest
+
+
+class MockExecutor:
+
+    def __init__(self, wait):
+        self.wait = wait
+
+    def queue_wait(self):
+        return self.wait
+
+
+class TestMonitoredThreadPoolExecutor(unittest.TestCase):
+    def test_queue_wait(self):
+        executor = MonitoredThreadPoolExecutor(max_workers=1)
+        self.assertEqual(executor.queue_depth(), 0)
+        self.assertEqual(executor.queue_wait(), 0.0)
+        event = threading.Event()
+        blocker = executor.submit(event.wait)
+        queued = executor.submit(lambda: 42)
+        time.sleep(0.02)
+        # the blocker has started, the second task is still waiting for the only thread
+        self.assertEqual(executor.queue_depth(), 1)
+        self.assertTrue(executor.queue_wait() >= 0.02)
+        event.set()
+        blocker.result()
+        self.assertEqual(queued.result(), 42)
+        self.assertEqual(executor.queue_depth(), 0)
+        executor.shutdown()
+
+    def test_cancelled_task(self):
+        executor = MonitoredThreadPoolExecutor(max_workers=1)
+        event = threading.Event()
+        self.addCleanup(event.set)
+        blocker = executor.submit(event.wait)
+        queued = executor.submit(lambda: 42)
+        time.sleep(0.02)
+        # a task cancelled before it starts no longer counts as waiting
+        self.assertTrue(queued.cancel())
+        self.assertEqual(executor.queue_depth(), 0)
+        self.assertEqual(executor.queue_wait(), 0.0)
+        executor.submit(lambda: 42)
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.assertEqual(executor.queue_depth(), 0)
+        event.set()
+        blocker.result()
+
+
+class TestAdmissionController(unittest.TestCase):
+    def test_unlimited(self):
+        admission = AdmissionController(MockExecutor(10.0))
+        for _ in range(100):
+            self.assertTrue(admission.try_acquire())
+        self.assertEqual(admission.in_flight, 100)
+        self.assertEqual(admission.rejected, 0)
+
+    def test_max_in_flight(self):
+        admission = AdmissionController(max_in_flight=2)
+        self.assertTrue(admission.try_acquire())
+        self.assertTrue(admission.try_acquire())
+        self.assertFalse(admission.try_acquire())
+        self.assertEqual(admission.rejected, 1)
+        admission.release()
+        self.assertTrue(admission.try_acquire())
+        self.assertEqual(admission.in_flight, 2)
+
+    def test_max_queue_wait(self):
+        executor = MockExecutor(0.0)
+        admission = AdmissionController(executor, max_queue_wait=0.1)
+        self.assertTrue(admission.try_acquire())
+        executor.wait = 0.2
+        self.assertFalse(admission.try_acquire())
+        executor.wait = 0.05
+        self.assertTrue(admission.try_acquire())
+
+    def test_codel(self):
+        admission = AdmissionController(max_queue_wait=0.1, codel=True, interval=1.0)
+        # below target
+        self.assertFalse(admission.should_shed(0.05, 0.0))
+        # above target, but not for a full interval yet
+        self.assertFalse(admission.should_shed(0.2, 1.0))
+        self.assertFalse(admission.should_shed(0.2, 1.5))
+        # standing queue for a full interval, start shedding
+        self.assertTrue(admission.should_shed(0.2, 2.0))
+        # subsequent drops are spaced out by interval / sqrt(count)
+        self.assertFalse(admission.should_shed(0.2, 2.5))
+        self.assertTrue(admission.should_shed(0.2, 3.0))
+        self.assertFalse(admission.should_shed(0.2, 3.5))
+        self.assertTrue(admission.should_shed(0.2, 3.8))
+        # queue drains, leave the shedding state
+        self.assertFalse(admission.should_shed(0.05, 4.0))
+        self.assertFalse(admission.dropping)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
 import json
+from geoproxy.api import GeoproxyArguments
 from geoproxy.api import GeoproxyRequestParser
 from geoproxy.api import GeoproxyResponse
+from geoproxy.api import service_orders
+from geoproxy.api import valid_result
+from geoproxy.encoding import unpackb
 import unittest
 
 
@@ -40,20 +44,23 @@ class TestAPI(unittest.TestCase):
         self.assertIsNone(req_parser.parse_bounding_coordinates("1.0,2.0;1.0,2.0"))
         # wrong num lat/long
         self.assertIsNone(req_parser.parse_bounding_coordinates("1.0,2.0,3.0|1.0,2.0"))
+        self.assertIsNone(req_parser.parse_bounding_coordinates("1.0,|3.0,4.0"))
         # right
         out = req_parser.parse_bounding_coordinates("1.0,2.0|3.0,4.0")
         self.assertIsNotNone(out)
         self.assertEqual(len(out), 4)
         self.assertEqual(out[1], 2.0)
 
-    def test_missing_elements(self):
-        req_parser = GeoproxyRequestParser(None, None)
-        out = req_parser.find_missing_elements([1, 2, 3], [2])
-        self.assertEqual(out, [1, 3])
-        out = req_parser.find_missing_elements([1, 2, 3], [1, 2, 3])
-        self.assertEqual(out, [])
-        out = req_parser.find_missing_elements([1, 2, 3], [1, 2, 3, 4])
-        self.assertEqual(out, [])
+    def test_service_orders(self):
+        orders = service_orders({"local": None, "google": None, "here": None})
+        self.assertEqual(orders[None], ["local", "google", "here"])
+        self.assertEqual(orders["here"], ["here", "local", "google"])
+        # requests share the orders rather than building their own
+        req_parser = GeoproxyRequestParser({"local": None, "google": None, "here": None},
+                                           GeoproxyResponse(), orders)
+        self.assertTrue(req_parser.parse(MockRequestHandler({"address": ["Addr"],
+                                                             "service": ["google"]})))
+        self.assertIs(req_parser.services, orders["google"])
 
     def test_google_parse(self):
         valid = {"address": ["Addr"], "service": ["google"], "bounds": ["1.0,2.0|3.0,4.0"]}
@@ -65,6 +72,7 @@ class TestAPI(unittest.TestCase):
         self.assertTrue(out)
         self.assertEqual(req_parser.address, "Addr")
         self.assertEqual(req_parser.services, ["google", "here"])
+        self.assertEqual(req_parser.requested_service, "google")
         self.assertEqual(req_parser.bounds.bottom_left.latitude, 1.0)
 
     def test_here_parse(self):
@@ -113,6 +121,74 @@ class TestAPI(unittest.TestCase):
         self.assertFalse(out)
         self.assertEqual(response.status, "INVALID_REQUEST")
 
+    def test_mode_parse(self):
+        response = GeoproxyResponse()
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        self.assertTrue(req_parser.parse(MockRequestHandler({"address": ["Addr"]})))
+        self.assertEqual(req_parser.mode, "fallback")
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        self.assertTrue(req_parser.parse(
+            MockRequestHandler({"address": ["Addr"], "mode": ["consensus"]})))
+        self.assertEqual(req_parser.mode, "consensus")
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        self.assertFalse(req_parser.parse(
+            MockRequestHandler({"address": ["Addr"], "mode": ["blah"]})))
+        self.assertEqual(response.status, "INVALID_REQUEST")
+
+    def test_tenant_parse(self):
+        response = GeoproxyResponse()
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        req_parser.tenant = "search"
+        self.assertTrue(req_parser.parse(MockRequestHandler({"address": ["Addr"]})))
+        self.assertEqual(req_parser.tenant, "search")
+        self.assertEqual(req_parser.lane, "interactive")
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        req_parser.tenant = "search"
+        self.assertTrue(req_parser.parse(MockRequestHandler(
+            {"address": ["Addr"], "priority": ["bulk"]})))
+        self.assertEqual(req_parser.lane, "bulk")
+        # clients cannot name their tenant, and without one cannot claim the interactive lane
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        self.assertTrue(req_parser.parse(MockRequestHandler(
+            {"address": ["Addr"], "tenant": ["reports"], "priority": ["interactive"]})))
+        self.assertIsNone(req_parser.tenant)
+        self.assertEqual(req_parser.lane, "bulk")
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        self.assertFalse(req_parser.parse(
+            MockRequestHandler({"address": ["Addr"], "priority": ["urgent"]})))
+        self.assertEqual(response.error, "Priority is invalid")
+
+    def test_limit_parse(self):
+        response = GeoproxyResponse()
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        self.assertTrue(req_parser.parse(MockRequestHandler({"address": ["Addr"]})))
+        self.assertEqual(req_parser.limit, 1)
+        req_parser = GeoproxyRequestParser({"google": None}, response)
+        self.assertTrue(req_parser.parse(MockRequestHandler({"address": ["Addr"], "limit": ["3"]})))
+        self.assertEqual(req_parser.limit, 3)
+        for limit in ("0", "11", "three"):
+            req_parser = GeoproxyRequestParser({"google": None}, response)
+            self.assertFalse(req_parser.parse(
+                MockRequestHandler({"address": ["Addr"], "limit": [limit]})))
+            self.assertEqual(response.error, "Limit is invalid")
+
+    def test_response_candidates(self):
+        gp = GeoproxyResponse()
+        gp.query = "Addr"
+        candidates = [{"lat": 1.0, "lon": 2.0, "resolved_address": "Addr string"},
+                      {"lat": 1.5, "lon": 2.0, "resolved_address": "Other"}]
+        gp.set_result("google", 1.0, 2.0, "Addr string", candidates)
+        self.assertEqual(gp.result['candidates'], candidates)
+        self.assertEqual(gp.to_json(), json.dumps(gp.to_dict()))
+        self.assertEqual(unpackb(gp.to_msgpack()), gp.to_dict())
+
+    def test_response_agreement(self):
+        gp = GeoproxyResponse()
+        gp.query = "Addr"
+        gp.set_result("google", 1.0, 2.0, "Addr string", agreement=0.5)
+        self.assertEqual(gp.result['agreement'], 0.5)
+        self.assertEqual(gp.to_json(), json.dumps(gp.to_dict()))
+
     def test_response(self):
         gp = GeoproxyResponse()
         self.assertIsNone(gp.query)
@@ -133,6 +209,48 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(len(json.loads(gp2.to_json()).keys()), 3)
         self.assertEqual(type(gp2.to_json()), str)
 
+    def test_response_json_compatible(self):
+        gp = GeoproxyResponse()
+        gp.set_error("Zero \"results\"", "ZERO_RESULTS")
+        self.assertEqual(gp.to_json(), json.dumps(gp.to_dict()))
+        gp2 = GeoproxyResponse()
+        gp2.query = "Caf\u00e9 St"
+        gp2.set_result("google", 1.0, -2.5, "Caf\u00e9 St")
+        self.assertEqual(gp2.to_json(), json.dumps(gp2.to_dict()))
+        gp3 = GeoproxyResponse()
+        self.assertEqual(gp3.to_json(), json.dumps(gp3.to_dict()))
+
+    def test_response_msgpack(self):
+        gp = GeoproxyResponse()
+        gp.set_error("message", "TYPE")
+        self.assertEqual(unpackb(gp.to_msgpack()), gp.to_dict())
+        gp2 = GeoproxyResponse()
+        gp2.query = "Addr"
+        gp2.set_result("google", 1.0, 2.0, "Addr string")
+        self.assertEqual(unpackb(gp2.to_msgpack()), json.loads(gp2.to_json()))
+
+    def test_valid_result(self):
+        result = {'source': "google", 'lat': 1.0, 'lon': 2, 'resolved_address': "Addr"}
+        self.assertTrue(valid_result(result))
+        self.assertTrue(valid_result(dict(result, agreement=0.5)))
+        self.assertTrue(valid_result(dict(result, candidates=[
+            {'lat': 1.0, 'lon': 2.0, 'resolved_address': "Addr"}])))
+        self.assertFalse(valid_result(None))
+        self.assertFalse(valid_result({'lat': 1.0}))
+        self.assertFalse(valid_result(dict(result, lat="1.0")))
+        self.assertFalse(valid_result(dict(result, lon=True)))
+        self.assertFalse(valid_result(dict(result, precision="locality")))
+        self.assertFalse(valid_result(dict(result, candidates=[{'lat': 1.0}])))
+        self.assertFalse(valid_result({'lat': 1.0, 'source': "google", 'lon': 2.0,
+                                       'resolved_address': "Addr"}))
+
+    def test_arguments_parse(self):
+        response = GeoproxyResponse()
+        req_parser = GeoproxyRequestParser({"google": None, "here": None}, response)
+        self.assertTrue(req_parser.parse(GeoproxyArguments({"address": "Addr", "service": "here"})))
+        self.assertEqual(req_parser.services, ["here", "google"])
+        self.assertEqual(GeoproxyArguments({"id": 1}).get_arguments("address"), [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+from geoproxy.batching import MicroBatcher
+from tornado.gen import multi
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+import unittest
+
+
+class TestMicroBatcher(AsyncTestCase):
+
+    def setUp(self):
+        super(TestMicroBatcher, self).setUp()
+        self.sent = []
+
+    async def send(self, items):
+        self.sent.append(items)
+        return [item.upper() for item in items]
+
+    @gen_test
+    async def test_window(self):
+        batcher = MicroBatcher(self.send, window=0.01, max_size=10)
+        results = await multi([batcher.submit("a"), batcher.submit("b"), batcher.submit("a")])
+        self.assertEqual(results, ["A", "B", "A"])
+        # identical items share an entry in the batch
+        self.assertEqual(self.sent, [["a", "b"]])
+        self.assertEqual(batcher.stats()["mean_size"], 2.0)
+
+    @gen_test
+    async def test_max_size(self):
+        batcher = MicroBatcher(self.send, window=10, max_size=2)
+        results = await multi([batcher.submit("a"), batcher.submit("b")])
+        self.assertEqual(results, ["A", "B"])
+        # the full batch is sent without waiting for the window
+        self.assertEqual(self.sent, [["a", "b"]])
+        self.assertEqual(batcher.stats()["pending"], 0)
+
+    @gen_test
+    async def test_failure(self):
+        async def send(items):
+            raise ValueError("Batch failed")
+        batcher = MicroBatcher(send, window=0)
+        results = await multi([batcher.submit("a"), batcher.submit("b")])
+        self.assertEqual(results, [None, None])
+        self.assertEqual(batcher.failures, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
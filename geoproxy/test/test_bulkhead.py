@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import asyncio
+from geoproxy.bulkhead import Bulkhead
+from geoproxy.bulkhead import Bulkheads
+import threading
+import time
+from tornado.ioloop import IOLoop
+import unittest
+
+
+class TestBulkhead(unittest.TestCase):
+
+    def test_capacity(self):
+        bulkhead = Bulkhead("google", max_workers=2, max_queue=1)
+        self.assertTrue(bulkhead.try_acquire())
+        self.assertTrue(bulkhead.try_acquire())
+        self.assertTrue(bulkhead.try_acquire())
+        self.assertEqual(bulkhead.saturation(), 1.0)
+        self.assertFalse(bulkhead.try_acquire())
+        self.assertEqual(bulkhead.rejected, 1)
+        bulkhead.release()
+        self.assertTrue(bulkhead.try_acquire())
+        stats = bulkhead.stats()
+        self.assertEqual(stats["in_flight"], 3)
+        self.assertEqual(stats["rejected"], 1)
+        bulkhead.executor.shutdown()
+
+    def test_isolation(self):
+        bulkheads = Bulkheads(["google", "here"], size=1, sizes={"here": 2})
+        self.assertEqual(bulkheads["google"].max_workers, 1)
+        self.assertEqual(bulkheads["here"].max_workers, 2)
+        event = threading.Event()
+        blocker = bulkheads["google"].submit(event.wait)
+        queued = bulkheads["google"].submit(lambda: "google")
+        # a stuck google thread does not hold up here
+        self.assertEqual(bulkheads["here"].submit(lambda: "here").result(timeout=1), "here")
+        time.sleep(0.02)
+        self.assertEqual(bulkheads.queue_depth(), 1)
+        self.assertTrue(bulkheads.queue_wait() >= 0.02)
+        self.assertEqual(bulkheads.stats()["google"]["queue_depth"], 1)
+        event.set()
+        blocker.result()
+        self.assertEqual(queued.result(), "google")
+        bulkheads.shutdown()
+
+    def test_fair(self):
+        bulkhead = Bulkhead("google", max_workers=1, max_queue=1, fair=True,
+                            tenant_weights={"search": 2})
+
+        async def scenario():
+            self.assertTrue(bulkhead.try_acquire("search"))
+            # the thread is taken, and the one queue slot is taken by a waiting request
+            waiting = asyncio.ensure_future(bulkhead.acquire("reports", "bulk"))
+            await asyncio.sleep(0)
+            self.assertFalse(await bulkhead.acquire("search", timeout=0.01))
+            self.assertEqual(bulkhead.rejected, 1)
+            self.assertEqual(bulkhead.queue_depth(), 1)
+            stats = bulkhead.stats()
+            self.assertEqual(stats["tenants"]["search"]["weight"], 2.0)
+            self.assertEqual(stats["tenants"]["default"]["waiting"], 1)
+            bulkhead.release()
+            self.assertTrue(await waiting)
+            self.assertEqual(bulkhead.in_flight, 1)
+
+        IOLoop.current().run_sync(scenario)
+        bulkhead.executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+from geoproxy.cache import ResultCache
+from geoproxy.cache import cache_key
+from geoproxy.geometry import BoundingBox
+from geoproxy.geometry import Coordinate
+import time
+import unittest
+
+
+class TestCache(unittest.TestCase):
+    def test_cache_key(self):
+        self.assertEqual(cache_key("350+5th+Ave,+New+York"), cache_key("350 5th ave new york"))
+        bb = BoundingBox()
+        bb.set_bl_tr(Coordinate(1.0, 2.0), Coordinate(3.0, 4.0))
+        self.assertEqual(cache_key("Addr", bb), "addr|1.0,2.0|3.0,4.0")
+        self.assertEqual(cache_key("Addr", limit=1), "addr")
+        self.assertEqual(cache_key("Addr", limit=3), "addr|limit=3")
+
+    def test_get_put(self):
+        cache = ResultCache(max_size=10)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", {"lat": 1.0})
+        self.assertEqual(cache.get("a"), {"lat": 1.0})
+        self.assertIn("a", cache)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_lru_eviction(self):
+        cache = ResultCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        # refresh a, so b is the least recently used
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        cache = ResultCache(max_size=10, ttl=0.01)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        cache = ResultCache(max_size=0)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+if __name__ == '__main__':
+    unittest.main()
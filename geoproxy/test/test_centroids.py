@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+from geoproxy.centroids import CentroidIndex
+from geoproxy.centroids import build_centroid_index
+from geoproxy.third_party_services.local import INDEX_MAGIC
+import unittest
+
+
+def write_centroid_index(directory):
+    csv_path = os.path.join(directory, "centroids.csv")
+    with open(csv_path, "w") as csv_file:
+        csv_file.write("POSTCODE,LOCALITY,REGION,LAT,LON\n")
+        csv_file.write("10118,New York,NY,40.7484,-73.9857\n")
+        csv_file.write("10001,New York,NY,40.7506,-73.9972\n")
+        csv_file.write("62701,Springfield,IL,39.8017,-89.6436\n")
+        csv_file.write(",Springfield,MA,42.1015,-72.5898\n")
+        csv_file.write("SW1A 1AA,London,,51.5010,-0.1416\n")
+        csv_file.write("2000,Sydney,NSW,-33.8688,151.2093\n")
+        csv_file.write("10115,Berlin,BE,52.5323,13.3846\n")
+        csv_file.write("10115,Harlem,NY,40.8116,-73.9465\n")
+        csv_file.write(",Washington,DC,38.9072,-77.0369\n")
+    index_path = os.path.join(directory, "centroids.idx")
+    build_centroid_index(csv_path, index_path)
+    return index_path
+
+
+class TestCentroidIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index = CentroidIndex(write_centroid_index(self.tmp_dir.name))
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+
+    def test_postal_code(self):
+        lat, lon, label, precision = self.index.locate("350 5th Ave, New York, NY 10118")
+        self.assertEqual((lat, lon, precision), (40.7484, -73.9857, "postal_code"))
+        self.assertEqual(label, "New York, NY 10118")
+        # postal codes of two words
+        self.assertEqual(self.index.locate("Buckingham Palace, London SW1A 1AA")[2],
+                         "London, SW1A 1AA")
+
+    def test_locality(self):
+        # the locality is located at the mean of its rows
+        lat, lon, label, precision = self.index.locate("1 Main St, New York")
+        self.assertAlmostEqual(lat, 40.7495)
+        self.assertEqual((label, precision), ("New York", "locality"))
+        # the region picks between localities of the same name
+        self.assertEqual(self.index.locate("1 Main St, Springfield, MA")[2], "Springfield, MA")
+        # a locality name shared by regions far apart is ambiguous without its region
+        self.assertIsNone(self.index.locate("1 Main St, Springfield"))
+        self.assertIsNone(self.index.locate("1 Main St, Boston 02108"))
+
+    def test_ambiguous_postal_code(self):
+        # 10115 is both in Berlin and in New York
+        self.assertIsNone(self.index.locate("Invalidenstr 117, 10115"))
+
+    def test_house_and_unit_numbers(self):
+        # the house number is not the postal code 2000 of Sydney
+        lat, lon, label, precision = self.index.locate("2000 Main St, Springfield, IL")
+        self.assertEqual((label, precision), ("Springfield, IL", "locality"))
+        self.assertEqual(self.index.locate("2000 Springfield IL")[2], "Springfield, IL")
+        self.assertEqual(self.index.locate("1 Main St, Apt 2000, Springfield, IL")[2],
+                         "Springfield, IL")
+        self.assertEqual(self.index.locate("1 Main St, Springfield, IL 62701")[3],
+                         "postal_code")
+
+    def test_street_name(self):
+        # the street is not the locality of Washington
+        self.assertEqual(self.index.locate("100 Washington St, Springfield, IL")[2],
+                         "Springfield, IL")
+        self.assertIsNone(self.index.locate("100 Washington St"))
+        self.assertEqual(self.index.locate("Washington, DC")[2], "Washington, DC")
+
+    def test_wrong_file_type(self):
+        with open(os.path.join(self.tmp_dir.name, "other.idx"), "wb") as index_file:
+            index_file.write(INDEX_MAGIC + bytes(16))
+        with self.assertRaises(ValueError):
+            CentroidIndex(os.path.join(self.tmp_dir.name, "other.idx"))
+
+
+if __name__ == '__main__':
+    unittest.main()
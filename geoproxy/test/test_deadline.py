@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+from geoproxy.deadline import Deadline
+from geoproxy.deadline import RetryPolicy
+import time
+import unittest
+
+
+class TestDeadline(unittest.TestCase):
+    def test_deadline(self):
+        deadline = Deadline(10.0)
+        self.assertEqual(deadline.budget, 10.0)
+        self.assertFalse(deadline.expired())
+        self.assertTrue(9.0 < deadline.remaining() <= 10.0)
+
+    def test_expired_deadline(self):
+        deadline = Deadline(0.0)
+        self.assertTrue(deadline.expired())
+        self.assertEqual(deadline.remaining(), 0.0)
+        # negative budgets are clamped
+        self.assertEqual(Deadline(-1.0).budget, 0.0)
+
+    def test_deadline_elapses(self):
+        deadline = Deadline(0.01)
+        time.sleep(0.02)
+        self.assertTrue(deadline.expired())
+
+    def test_share(self):
+        deadline = Deadline(10.0)
+        self.assertTrue(4.0 < deadline.share(2) <= 5.0)
+        self.assertTrue(9.0 < deadline.share(0) <= 10.0)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_defaults(self):
+        policy = RetryPolicy()
+        self.assertEqual(policy.max_attempts, 3)
+        # at least one attempt is always made
+        self.assertEqual(RetryPolicy(max_attempts=0).max_attempts, 1)
+
+    def test_backoff_bounds(self):
+        policy = RetryPolicy(base_delay=0.1, max_delay=0.3)
+        for _ in range(100):
+            self.assertTrue(0.0 <= policy.backoff(0) <= 0.1)
+            self.assertTrue(0.0 <= policy.backoff(1) <= 0.2)
+            # capped by max_delay
+            self.assertTrue(0.0 <= policy.backoff(5) <= 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+from geoproxy.encoding import MAX_DEPTH
+from geoproxy.encoding import accepts_msgpack
+from geoproxy.encoding import packb
+from geoproxy.encoding import unpackb
+import unittest
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_accepts_msgpack(self):
+        self.assertFalse(accepts_msgpack(None))
+        self.assertFalse(accepts_msgpack("*/*"))
+        self.assertFalse(accepts_msgpack("application/json"))
+        self.assertTrue(accepts_msgpack("application/msgpack"))
+        self.assertTrue(accepts_msgpack("application/x-msgpack, */*"))
+        self.assertTrue(accepts_msgpack("application/json;q=0.5, application/msgpack"))
+        self.assertFalse(accepts_msgpack("application/json, application/msgpack;q=0.5"))
+        self.assertFalse(accepts_msgpack("application/msgpack;q=0"))
+
+    def test_pack_known_bytes(self):
+        self.assertEqual(packb({"a": 1}), b"\x81\xa1a\x01")
+        self.assertEqual(packb([None, True, False]), b"\x93\xc0\xc3\xc2")
+        self.assertEqual(packb(-1), b"\xff")
+        self.assertEqual(packb(1.5), b"\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00")
+        self.assertEqual(packb(300), b"\xcd\x01\x2c")
+
+    def test_round_trip(self):
+        values = [0, 127, 128, 65536, 2 ** 40, -33, -200, -70000, -2 ** 40, 3.25, "", "x" * 40,
+                  "y" * 300, "z" * 70000, b"\x00\x01", list(range(20)),
+                  {str(i): i for i in range(20)}, {"nested": {"list": [1, "two", None]}}]
+        for value in values:
+            self.assertEqual(unpackb(packb(value)), value)
+
+    def test_invalid(self):
+        with self.assertRaises(TypeError):
+            packb(object())
+        with self.assertRaises(ValueError):
+            unpackb(b"\xa5abc")
+        with self.assertRaises(ValueError):
+            unpackb(b"\x01\x02")
+        # a map with an array key
+        with self.assertRaises(ValueError):
+            unpackb(b"\x81\x91\x01\x01")
+
+    def test_nesting(self):
+        value = None
+        for _ in range(MAX_DEPTH):
+            value = [value]
+        self.assertEqual(unpackb(packb(value)), value)
+        with self.assertRaises(ValueError):
+            unpackb(packb([value]))
+        with self.assertRaises(ValueError):
+            unpackb(b"\x91" * 100000 + b"\xc0")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import asyncio
+from geoproxy.fair_queue import FairScheduler
+from tornado.gen import multi
+from tornado.gen import sleep
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+import unittest
+
+
+class TestFairScheduler(AsyncTestCase):
+
+    async def drain(self, scheduler, requests):
+        """Queues the requests behind a held slot, then serves them one at a time
+        """
+        self.assertTrue(scheduler.try_acquire())
+        order = []
+
+        async def request(tenant, lane):
+            self.assertTrue(await scheduler.acquire(tenant, lane))
+            order.append((tenant, lane))
+            await sleep(0)
+            scheduler.release()
+
+        waiting = [asyncio.ensure_future(request(tenant, lane)) for tenant, lane in requests]
+        await sleep(0)
+        scheduler.release()
+        await multi(waiting)
+        return order
+
+    @gen_test
+    async def test_weighted_shares(self):
+        scheduler = FairScheduler(1, max_queue=100, weights={"search": 3, "reports": 1})
+        order = await self.drain(scheduler, [("reports", "interactive")] * 8 +
+                                 [("search", "interactive")] * 8)
+        # while both tenants are waiting, search gets three slots for every one of reports
+        first = [tenant for tenant, _ in order[:8]]
+        self.assertEqual(first.count("search"), 6)
+        self.assertEqual(first.count("reports"), 2)
+        stats = scheduler.stats()
+        self.assertEqual(stats["search"]["granted"]["interactive"], 8)
+        self.assertEqual(stats["reports"]["waiting"], 0)
+        self.assertTrue(stats["reports"]["max_wait"] >= stats["reports"]["mean_wait"])
+
+    @gen_test
+    async def test_lanes(self):
+        scheduler = FairScheduler(1, max_queue=100)
+        order = await self.drain(scheduler, [("a", "bulk")] * 3 + [("b", "interactive")] * 3)
+        self.assertEqual([lane for _, lane in order], ["interactive"] * 3 + ["bulk"] * 3)
+
+    @gen_test
+    async def test_burst_into_idle_capacity(self):
+        scheduler = FairScheduler(4, weights={"search": 3, "reports": 1})
+        # with nobody else asking, the lightest tenant may use every slot
+        for _ in range(4):
+            self.assertTrue(await scheduler.acquire("reports"))
+        self.assertFalse(scheduler.try_acquire("search"))
+        self.assertEqual(scheduler.in_use, 4)
+
+    @gen_test
+    async def test_rejections(self):
+        scheduler = FairScheduler(1, max_queue=1)
+        self.assertTrue(scheduler.try_acquire())
+        waiting = asyncio.ensure_future(scheduler.acquire("a", timeout=0.05))
+        await sleep(0)
+        # the queue is full
+        self.assertFalse(await scheduler.acquire("b", timeout=1))
+        self.assertFalse(await waiting)
+        self.assertEqual(scheduler.queue_depth(), 0)
+        stats = scheduler.stats()
+        # unknown tenants share the default tenant
+        self.assertEqual(list(stats), ["default"])
+        self.assertEqual(stats["default"]["rejected"], 1)
+        self.assertEqual(stats["default"]["timed_out"], 1)
+        # the timed out request does not take the released slot
+        scheduler.release()
+        self.assertEqual(scheduler.in_use, 0)
+        self.assertTrue(await scheduler.acquire("c"))
+
+
+if __name__ == '__main__':
+    unittest.main()
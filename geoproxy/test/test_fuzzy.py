@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from geoproxy.cache import cache_key
+from geoproxy.fuzzy import FuzzyIndex
+from geoproxy.fuzzy import address_numbers
+from geoproxy.fuzzy import trigrams
+from geoproxy.geometry import BoundingBox
+from geoproxy.geometry import Coordinate
+import unittest
+
+
+class TestFuzzyIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = FuzzyIndex()
+        self.empire_state = cache_key("350 5th Ave, New York, NY 10118")
+        self.google = cache_key("1600 Amphitheatre Parkway, Mountain View, CA")
+        self.index.add(self.empire_state)
+        self.index.add(self.google)
+
+    def match(self, address, bounds=None):
+        match = self.index.lookup(cache_key(address, bounds))
+        return match[0] if match else None
+
+    def test_trigrams(self):
+        self.assertEqual(trigrams("ab"), frozenset([" ab", "ab "]))
+        self.assertEqual(address_numbers("350 5th ave ny 10118"),
+                         (("350", "5th"), frozenset(["10118"])))
+
+    def test_abbreviations(self):
+        self.assertEqual(self.match("350 Fifth Avenue, New York"), self.empire_state)
+        self.assertEqual(self.match("350 5th Ave NY"), self.empire_state)
+
+    def test_typo(self):
+        self.assertEqual(self.match("1600 Amphitheater Pkwy, Mountain View, CA"), self.google)
+        self.assertIsNone(self.match("1600 Charleston Rd, Mountain View, CA"))
+
+    def test_numbers_must_match(self):
+        self.assertIsNone(self.match("350 6th Ave, New York"))
+        self.assertIsNone(self.match("530 5th Ave, New York"))
+        self.assertIsNone(self.match("5th Ave, New York"))
+        # postal codes are compared when both queries have one
+        self.assertIsNone(self.match("350 5th Ave, New York, NY 10001"))
+        self.assertEqual(self.match("350 5th Ave, New York 10118"), self.empire_state)
+
+    def test_other_places(self):
+        for cached, query in [
+                ("100 Main St, Springfield, MA", "100 Main St, Springfield, IL"),
+                ("100 S Main St", "100 N Main St"),
+                ("100 Main St", "100 Main Ave"),
+                ("100 Main St, Portland, ME", "100 Main St, Portland, OR"),
+                ("100 Main St, Albany, GA", "100 Main St, Albany, NY"),
+                ("100 Main St", "100 Maple St"),
+                ("100 Springfield, MA", "100 Springfield, IL")]:
+            self.index.add(cache_key(cached))
+            self.assertIsNone(self.match(query), query)
+        self.assertEqual(self.match("100 South Main Street"), cache_key("100 S Main St"))
+
+    def test_bounds_must_match(self):
+        bounds = BoundingBox()
+        bounds.set_bl_tr(Coordinate("40.0", "-74.0"), Coordinate("41.0", "-73.0"))
+        self.assertIsNone(self.match("350 Fifth Avenue, New York", bounds))
+
+    def test_eviction(self):
+        index = FuzzyIndex(max_size=2, max_group=1)
+        index.add(cache_key("1 Main St"))
+        index.add(cache_key("1 Maine Street"))
+        # both keys are in the same group, so the first was evicted from it
+        self.assertEqual(len(index), 1)
+        index.add(cache_key("2 Main St"))
+        index.add(cache_key("3 Main St"))
+        self.assertEqual(len(index), 2)
+        self.assertNotIn(cache_key("1 Maine Street"), index)
+        index.discard(cache_key("3 Main St"))
+        self.assertEqual(len(index), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
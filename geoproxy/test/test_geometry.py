@@ -2,6 +2,8 @@
 
 from geoproxy.geometry import Coordinate
 from geoproxy.geometry import BoundingBox
+from geoproxy.geometry import geohash
+from geoproxy.geometry import haversine_distance
 import unittest
 
 
@@ -35,6 +37,31 @@ class TestGeometry(unittest.TestCase):
         self.assertEqual(bb.top_left, coord1)
         self.assertEqual(bb.bottom_right, coord2)
 
+    def test_haversine_distance(self):
+        new_york = Coordinate(40.7128, -74.0060)
+        los_angeles = Coordinate(34.0522, -118.2437)
+        self.assertEqual(haversine_distance(new_york, new_york), 0.0)
+        self.assertAlmostEqual(haversine_distance(new_york, los_angeles) / 1000.0, 3936, delta=5)
+        self.assertAlmostEqual(haversine_distance(new_york, los_angeles),
+                               haversine_distance(los_angeles, new_york))
+        # antipodal points are half the circumference apart
+        self.assertAlmostEqual(haversine_distance(Coordinate(0, 0), Coordinate(0, 180)) / 1000.0,
+                               20015, delta=1)
+
+    def test_geohash(self):
+        self.assertEqual(geohash(57.64911, 10.40744, 11), "u4pruydqqvj")
+        self.assertEqual(geohash(40.7484, -73.9856, 4), "dr5r")
+        bb = BoundingBox()
+        bb.set_bl_tr(Coordinate(40.70, -74.02), Coordinate(40.80, -73.93))
+        self.assertEqual(bb.center(), Coordinate(40.75, -73.975))
+        # the box straddles the edge of dr5r
+        self.assertEqual(bb.geohash(6), "dr")
+        bb.set_bl_tr(Coordinate(40.748, -73.986), Coordinate(40.749, -73.985))
+        self.assertEqual(bb.geohash(6), "dr5ru")
+        # a box across the equator and the prime meridian is only contained by the earth
+        bb.set_bl_tr(Coordinate(-1.0, -1.0), Coordinate(1.0, 1.0))
+        self.assertEqual(bb.geohash(6), "")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,16 +1,72 @@
 #!/usr/bin/env python
 
+import importlib.util
 import json
+import os
+import subprocess
+import sys
+import tempfile
 from geoproxy import Geoproxy
+from geoproxy.cache import cache_key
+from geoproxy.encoding import packb
+from geoproxy.handlers.admin import AdminRequestHandler
+from geoproxy.encoding import unpackb
+from geoproxy.shared_cache import SharedResultCache
+from geoproxy.third_party_services.local import build_address_index
+from tornado.gen import multi
+from tornado.gen import sleep
+from tornado.httpserver import HTTPServer
 from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import bind_unused_port
+from tornado.testing import gen_test
+from tornado.websocket import websocket_connect
+import time
 import tornado
+import tornado.web
 import unittest
+import urllib.request
+
+# the example server, when the tests run from a source checkout
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "examples",
+                           "server.py")
+
+
+class HungUpstreamHandler(tornado.web.RequestHandler):
+
+    async def get(self):
+        await sleep(2.0)
+        self.write("{}")
+
+
+class StubBatchJobsHandler(tornado.web.RequestHandler):
+    """Stub of the Here batch geocoder, every job completes on its first status query
+    """
+    jobs = {}
+
+    def status(self, job_id, status):
+        self.write('<ns2:SearchBatch xmlns:ns2="http://www.navteq.com/lbsp/Search-Batch/1">'
+                   '<Response><MetaInfo><RequestId>{}</RequestId></MetaInfo>'
+                   '<Status>{}</Status></Response></ns2:SearchBatch>'.format(job_id, status))
+
+    def post(self):
+        job_id = "J{}".format(len(self.jobs))
+        self.jobs[job_id] = self.request.body.decode("utf-8").splitlines()[1:]
+        self.status(job_id, "accepted")
+
+    def get(self, job_id, result=None):
+        if not result:
+            self.status(job_id, "completed")
+            return
+        self.write("recId|SeqNumber|seqLength|displayLatitude|displayLongitude|locationLabel\n")
+        for record in self.jobs[job_id]:
+            record_id, search_text = record.split("|")
+            self.write("{}|1|1|40.{}|-73.9856|{}\n".format(record_id, record_id, search_text))
 
 
 class TestGeoproxy(AsyncHTTPTestCase):
 
     def get_app(self):
-        return Geoproxy("localhost", 8080, "1", "2", "3")
+        return Geoproxy("localhost", 8080, "1", "2", "3", cache_size=10000)
 
     def test_no_address(self):
         response = self.fetch('/geocode')
@@ -29,9 +85,589 @@ class TestGeoproxy(AsyncHTTPTestCase):
         print(response_json)
         self.assertEqual(response_json['status'], "UNKNOWN_ERROR")
 
+    def test_expired_deadline(self):
+        response = self.fetch('/geocode?address=101+North+St',
+                              headers={"X-Geoproxy-Deadline-Ms": "0"})
+        response_json = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(response_json['status'], "UNKNOWN_ERROR")
+        self.assertEqual(response_json['error'], "Request deadline exceeded")
+
+    def test_access_log(self):
+        with self.assertLogs("geoproxy.access", level="INFO") as logs:
+            self.fetch('/geocode')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("path=/geocode code=200 status=INVALID_REQUEST", logs.output[0])
+
+    def test_cached_result(self):
+        result = {"source": "google", "lat": 1.0, "lon": 2.0, "resolved_address": "101 North St"}
+        self._app.cache.put("101 north st", result)
+        response = self.fetch('/geocode?address=101+North+St')
+        response_json = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(response_json['status'], "OK")
+        self.assertEqual(response_json['result'], result)
+
+    def test_msgpack_response(self):
+        response = self.fetch('/geocode', headers={"Accept": "application/msgpack"})
+        self.assertEqual(response.headers['Content-Type'], "application/msgpack")
+        response_msgpack = unpackb(response.body)
+        self.assertEqual(response_msgpack['status'], "INVALID_REQUEST")
+        response = self.fetch('/geocode', headers={"Accept": "*/*"})
+        self.assertEqual(response.headers['Content-Type'], "application/json")
+
+    def test_stats(self):
+        self.fetch('/geocode')
+        response = self.fetch('/stats')
+        self.assertEqual(response.code, 200)
+        stats = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(sorted(stats['bulkheads'].keys()), ["google", "here"])
+        self.assertEqual(stats['bulkheads']['google']['max_workers'], 4)
+        self.assertEqual(stats['admission']['in_flight'], 0)
+
+    def test_profiling_disabled(self):
+        response = self.fetch('/admin/profile/cpu?seconds=0')
+        self.assertEqual(response.code, 404)
+
+    def test_admitted_request_released(self):
+        self.fetch('/geocode')
+        self.assertEqual(self._app.admission.in_flight, 0)
+        self.assertEqual(self._app.admission.rejected, 0)
+
+    @gen_test
+    async def test_websocket_queries(self):
+        result = {"source": "google", "lat": 1.0, "lon": 2.0, "resolved_address": "101 North St"}
+        self._app.cache.put("101 north st", result)
+        connection = await websocket_connect(self.get_url('/geocode/ws').replace("http", "ws"))
+        connection.write_message(json.dumps({"id": "a", "address": "101 North St"}))
+        connection.write_message(json.dumps({"id": 2}))
+        connection.write_message("not json")
+        replies = []
+        for _ in range(3):
+            replies.append(json.loads((await connection.read_message())))
+        connection.close()
+        replies = {reply['id']: reply for reply in replies}
+        self.assertEqual(replies['a']['status'], "OK")
+        self.assertEqual(replies['a']['result'], result)
+        self.assertEqual(replies[2]['status'], "INVALID_REQUEST")
+        self.assertEqual(replies[None]['status'], "INVALID_REQUEST")
+        self.assertEqual(self._app.admission.in_flight, 0)
+
+    @gen_test
+    async def test_websocket_msgpack_query(self):
+        result = {"source": "here", "lat": 1.0, "lon": 2.0, "resolved_address": "101 North St"}
+        self._app.cache.put("101 north st", result)
+        connection = await websocket_connect(self.get_url('/geocode/ws').replace("http", "ws"))
+        connection.write_message(packb({"id": 7, "address": "101 North St"}), binary=True)
+        reply = unpackb((await connection.read_message()))
+        connection.close()
+        self.assertEqual(list(reply.keys()), ["id", "query", "status", "result"])
+        self.assertEqual(reply['id'], 7)
+        self.assertEqual(reply['result'], result)
+
+    @gen_test
+    async def test_websocket_malformed_messages(self):
+        connection = await websocket_connect(self.get_url('/geocode/ws').replace("http", "ws"))
+        # deeply nested arrays, and a map with an array key
+        connection.write_message(b"\x91" * 100000 + b"\xc0", binary=True)
+        connection.write_message(b"\x81\x91\x01\x01", binary=True)
+        connection.write_message("[" * 100000 + "]" * 100000)
+        for binary in (True, True, False):
+            message = await connection.read_message()
+            reply = unpackb(message) if binary else json.loads(message)
+            self.assertEqual(reply['status'], "INVALID_REQUEST")
+        # the connection is still open
+        connection.write_message(json.dumps({"id": 1}))
+        self.assertEqual(json.loads(await connection.read_message())['id'], 1)
+        connection.close()
+
     # TODO(pickledgator): Figure out how to unittest third party API requests or mock them
     # without exposing private API keys
 
 
+class TestGeoproxyProfiling(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Geoproxy("localhost", 8080, "1", "2", "3", profiling=True, admin_token="secret")
+
+    def test_admin_token_required(self):
+        response = self.fetch('/admin/profile/cpu?seconds=0')
+        self.assertEqual(response.code, 403)
+        response = self.fetch('/admin/profile/cpu?seconds=0',
+                              headers={"X-Geoproxy-Admin-Token": "wrong"})
+        self.assertEqual(response.code, 403)
+
+    def test_cpu_profile(self):
+        headers = {"X-Geoproxy-Admin-Token": "secret"}
+        response = self.fetch('/admin/profile/cpu?seconds=0.05&interval=0.001', headers=headers)
+        self.assertEqual(response.code, 200)
+        self.assertIn("MainThread;", response.body.decode('utf-8'))
+        response = self.fetch('/admin/profile/cpu?seconds=0.01&format=pstats', headers=headers)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], "application/octet-stream")
+        response = self.fetch('/admin/profile/cpu?format=flame', headers=headers)
+        self.assertEqual(response.code, 400)
+
+    def test_memory_profile(self):
+        headers = {"X-Geoproxy-Admin-Token": "secret"}
+        response = self.fetch('/admin/profile/memory', headers=headers)
+        self.assertEqual(response.code, 409)
+        response = self.fetch('/admin/profile/memory', method="POST", body="", headers=headers)
+        self.assertEqual(response.code, 200)
+        try:
+            self.fetch('/geocode')
+            response = self.fetch('/admin/profile/memory?limit=5', headers=headers)
+            report = json.loads(response.body.decode('utf-8'))
+            self.assertTrue(report['current'] > 0)
+            self.assertTrue(len(report['top']) <= 5)
+        finally:
+            response = self.fetch('/admin/profile/memory', method="DELETE", headers=headers)
+        self.assertEqual(json.loads(response.body.decode('utf-8')), {"tracing": False})
+
+
+class TestGeoproxyLoadShedding(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Geoproxy("localhost", 8080, "1", "2", "3", max_in_flight=0, retry_after=2)
+
+    def test_shed_request(self):
+        response = self.fetch('/geocode?address=101+North+St')
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], "2")
+        response_json = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(response_json['status'], "UNAVAILABLE")
+        self.assertEqual(self._app.admission.rejected, 1)
+        self.assertEqual(self._app.admission.in_flight, 0)
+
+    @gen_test
+    async def test_shed_websocket_query(self):
+        connection = await websocket_connect(self.get_url('/geocode/ws').replace("http", "ws"))
+        connection.write_message(json.dumps({"id": 1, "address": "101 North St"}))
+        reply = json.loads((await connection.read_message()))
+        connection.close()
+        self.assertEqual(reply['id'], 1)
+        self.assertEqual(reply['status'], "UNAVAILABLE")
+
+
+class TestGeoproxyAdaptiveTimeout(AsyncHTTPTestCase):
+
+    def get_app(self):
+        sock, port = bind_unused_port()
+        self.upstream = HTTPServer(tornado.web.Application([(r"/.*", HungUpstreamHandler)]))
+        self.upstream.add_sockets([sock])
+        url = "http://127.0.0.1:{}/geocode".format(port)
+        return Geoproxy("localhost", 8080, "1", "2", "3", max_attempts=1,
+                        service_urls={"google": url, "here": url})
+
+    def tearDown(self):
+        self.upstream.stop()
+        super(TestGeoproxyAdaptiveTimeout, self).tearDown()
+
+    def test_hung_upstream_abandoned(self):
+        # both services usually answer within 10ms, so the timeout drops to the floor
+        for timeout in self._app.timeouts.values():
+            for _ in range(50):
+                timeout.observe(0.01)
+        start_time = time.monotonic()
+        response = self.fetch('/geocode?address=101+North+St')
+        elapsed = time.monotonic() - start_time
+        response_json = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(response_json['status'], "UNKNOWN_ERROR")
+        self.assertEqual(response_json['error'], "Error in third-party API requests")
+        self.assertTrue(elapsed < 1.0)
+        # the timed out requests were observed
+        stats = json.loads(self.fetch('/stats').body.decode('utf-8'))
+        self.assertEqual(stats['timeouts']['google']['timeout'], 0.05)
+
+
+class TestGeoproxyBatching(AsyncHTTPTestCase):
+
+    def get_app(self):
+        StubBatchJobsHandler.jobs = {}
+        sock, port = bind_unused_port()
+        self.upstream = HTTPServer(tornado.web.Application([
+            (r"/6.2/jobs", StubBatchJobsHandler),
+            (r"/6.2/jobs/(\w+)(/result)?", StubBatchJobsHandler)]))
+        self.upstream.add_sockets([sock])
+        url = "http://127.0.0.1:{}/6.2/jobs".format(port)
+        return Geoproxy("localhost", 8080, "1", "2", "3", service_urls={"here_batch": url},
+                        batch_services=["here", "google"], batch_window=0.05,
+                        batch_poll_interval=0.01)
+
+    def tearDown(self):
+        self.upstream.stop()
+        super(TestGeoproxyBatching, self).tearDown()
+
+    @gen_test
+    async def test_batched_queries(self):
+        addresses = ["1+Main+St", "2+Main+St", "1+Main+St"]
+        responses = await multi([self.http_client.fetch(self.get_url(
+            '/geocode?service=here&address={}'.format(address))) for address in addresses])
+        results = [json.loads(response.body.decode('utf-8')) for response in responses]
+        self.assertEqual([result['status'] for result in results], ["OK"] * 3)
+        self.assertEqual(results[0]['result']['resolved_address'], "1 Main St")
+        self.assertEqual(results[1]['result']['lat'], 40.1)
+        self.assertEqual(results[2]['result']['lat'], 40.0)
+        # one job for all three requests, and only google has no batch API
+        self.assertEqual(list(StubBatchJobsHandler.jobs.values()),
+                         [["0|1 Main St", "1|2 Main St"]])
+        stats = json.loads((await self.http_client.fetch(self.get_url('/stats'))).body)
+        self.assertEqual(list(stats['batchers']), ["here"])
+        self.assertEqual(stats['batchers']['here']['items'], 2)
+
+
+class ZeroResultsUpstreamHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.write('{"status": "ZERO_RESULTS", "results": []}')
+
+
+class TestGeoproxyFairScheduling(AsyncHTTPTestCase):
+
+    def get_app(self):
+        sock, port = bind_unused_port()
+        self.upstream = HTTPServer(tornado.web.Application([(r"/.*",
+                                                            ZeroResultsUpstreamHandler)]))
+        self.upstream.add_sockets([sock])
+        url = "http://127.0.0.1:{}/geocode".format(port)
+        return Geoproxy("localhost", 8080, "1", "2", "3", service_urls={"google": url},
+                        fair_scheduling=True, tenant_weights={"search": 3},
+                        tenant_tokens={"secret": "search"})
+
+    def tearDown(self):
+        self.upstream.stop()
+        super(TestGeoproxyFairScheduling, self).tearDown()
+
+    def test_tenant_stats(self):
+        response = self.fetch('/geocode?address=101+North+St&service=google',
+                              headers={"X-Geoproxy-Tenant-Token": "secret"})
+        self.assertEqual(json.loads(response.body.decode('utf-8'))['status'], "ZERO_RESULTS")
+        # unauthenticated requests cannot claim a tenant or the interactive lane
+        self.fetch('/geocode?address=101+North+St&service=google&tenant=search')
+        self.fetch('/geocode?address=101+North+St&service=google&priority=interactive',
+                   headers={"X-Geoproxy-Tenant-Token": "guess"})
+        stats = json.loads(self.fetch('/stats').body.decode('utf-8'))
+        tenants = stats['bulkheads']['google']['tenants']
+        self.assertEqual(tenants['search']['weight'], 3.0)
+        self.assertEqual(tenants['search']['granted'], {"interactive": 1, "bulk": 0})
+        self.assertEqual(tenants['default']['granted'], {"interactive": 0, "bulk": 2})
+
+
+class TwoServicesUpstreamHandler(tornado.web.RequestHandler):
+    """Stub of both geocoders, whose results for any address are about 1.1km apart
+    """
+
+    def get(self):
+        if self.get_argument("searchtext", None) is not None:
+            self.write({"Response": {"View": [{"Result": [{"Location": {
+                "DisplayPosition": {"Latitude": 40.01, "Longitude": -73.0},
+                "Address": {"Label": "Here"}}}]}]}})
+        else:
+            self.write({"status": "OK", "results": [{
+                "formatted_address": "Google",
+                "geometry": {"location": {"lat": 40.0, "lng": -73.0}}}]})
+
+
+class TestGeoproxyShadowTraffic(AsyncHTTPTestCase):
+
+    def get_app(self):
+        sock, port = bind_unused_port()
+        self.upstream = HTTPServer(tornado.web.Application([(r"/.*",
+                                                            TwoServicesUpstreamHandler)]))
+        self.upstream.add_sockets([sock])
+        url = "http://127.0.0.1:{}/geocode".format(port)
+        return Geoproxy("localhost", 8080, "1", "2", "3", service_urls={"google": url,
+                                                                        "here": url},
+                        shadow_rate=1.0)
+
+    def tearDown(self):
+        self.upstream.stop()
+        super(TestGeoproxyShadowTraffic, self).tearDown()
+
+    @gen_test
+    async def test_shadow_query(self):
+        response = await self.http_client.fetch(self.get_url(
+            '/geocode?address=101+North+St&service=google'))
+        response_json = json.loads(response.body.decode('utf-8'))
+        # the response only carries the primary result
+        self.assertEqual(response_json['result']['source'], "google")
+        for _ in range(100):
+            if self._app.shadow.services:
+                break
+            await sleep(0.01)
+        stats = json.loads((await self.http_client.fetch(self.get_url('/stats'))).body)
+        self.assertEqual(stats['shadow']['sampled'], 1)
+        here = stats['shadow']['services']['here']
+        self.assertEqual(here['requests'], 1)
+        self.assertEqual(here['errors'], 0)
+        self.assertEqual(here['agreement'], 0.0)
+        self.assertAlmostEqual(here['distance']['max'], 1111.9, delta=1)
+        self.assertEqual(list(stats['shadow']['services']), ["here"])
+
+
+class CandidatesUpstreamHandler(tornado.web.RequestHandler):
+    """Stub of the Here geocoder, which answers with more results than it is asked for
+    """
+    queries = []
+
+    def get(self):
+        self.queries.append(self.request.arguments)
+        self.write({"Response": {"MetaInfo": {}, "View": [{"Result": [{"Location": {
+            "DisplayPosition": {"Latitude": 40.0 + index, "Longitude": -73.0},
+            "Address": {"Label": "Here {}".format(index)}}} for index in range(5)]}]}})
+
+
+class TestGeoproxyCandidates(AsyncHTTPTestCase):
+
+    def get_app(self):
+        sock, port = bind_unused_port()
+        self.upstream = HTTPServer(tornado.web.Application([(r"/.*",
+                                                            CandidatesUpstreamHandler)]))
+        self.upstream.add_sockets([sock])
+        url = "http://127.0.0.1:{}/geocode".format(port)
+        return Geoproxy("localhost", 8080, "1", "2", "3", service_urls={"here": url})
+
+    def tearDown(self):
+        self.upstream.stop()
+        super(TestGeoproxyCandidates, self).tearDown()
+
+    def test_candidates(self):
+        response = self.fetch('/geocode?address=101+North+St&service=here&limit=2')
+        result = json.loads(response.body.decode('utf-8'))['result']
+        self.assertEqual(result['resolved_address'], "Here 0")
+        self.assertEqual([candidate['resolved_address'] for candidate in result['candidates']],
+                         ["Here 0", "Here 1"])
+        self.assertEqual(CandidatesUpstreamHandler.queries[-1]['maxresults'], [b"2"])
+        # the candidates are cached with the limit
+        response = self.fetch('/geocode?address=101+North+St&service=here')
+        result = json.loads(response.body.decode('utf-8'))['result']
+        self.assertNotIn('candidates', result)
+        self.assertEqual(CandidatesUpstreamHandler.queries[-1]['maxresults'], [b"1"])
+
+
+class RateLimitedKeyUpstreamHandler(tornado.web.RequestHandler):
+    """Stub of the Google geocoder, which rate limits the key "limited-key"
+    """
+
+    def get(self):
+        if self.get_argument("key") == "limited-key":
+            self.write({"status": "OVER_QUERY_LIMIT", "results": []})
+            return
+        self.write({"status": "OK", "results": [{
+            "formatted_address": "Google", "geometry": {"location": {"lat": 40.0, "lng": -73.0}}}]})
+
+
+class TestGeoproxyKeyRotation(AsyncHTTPTestCase):
+
+    def get_app(self):
+        sock, port = bind_unused_port()
+        self.upstream = HTTPServer(tornado.web.Application([(r"/.*",
+                                                            RateLimitedKeyUpstreamHandler)]))
+        self.upstream.add_sockets([sock])
+        url = "http://127.0.0.1:{}/geocode".format(port)
+        return Geoproxy("localhost", 8080, ["limited-key", "working-key"], "2", "3",
+                        service_urls={"google": url}, key_cooldown=60.0)
+
+    def tearDown(self):
+        self.upstream.stop()
+        super(TestGeoproxyKeyRotation, self).tearDown()
+
+    def test_rate_limited_key(self):
+        # the first query is rate limited, and retried with the other key
+        for number in range(3):
+            response = self.fetch('/geocode?address={}+North+St&service=google'.format(number))
+            self.assertEqual(json.loads(response.body.decode('utf-8'))['status'], "OK")
+        stats = json.loads(self.fetch('/stats').body.decode('utf-8'))
+        limited, working = stats['keys']['google']
+        self.assertEqual(limited['key'], "...-key")
+        self.assertEqual((limited['requests'], limited['rate_limited']), (1, 1))
+        self.assertGreater(limited['cooldown'], 0)
+        self.assertEqual((working['requests'], working['rate_limited']), (3, 0))
+
+
+class TestGeoproxySharedCache(AsyncHTTPTestCase):
+
+    def get_app(self):
+        sock, port = bind_unused_port()
+        self.upstream = HTTPServer(tornado.web.Application([(r"/.*",
+                                                            TwoServicesUpstreamHandler)]))
+        self.upstream.add_sockets([sock])
+        url = "http://127.0.0.1:{}/geocode".format(port)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmp_dir.name, "geoproxy.cache")
+        # a worker serves sockets bound before forking
+        worker_sock, self.worker_port = bind_unused_port()
+        return Geoproxy("localhost", 8080, "1", "2", "3", service_urls={"google": url},
+                        cache_size=10000, shared_cache_path=self.cache_path,
+                        sockets=[worker_sock])
+
+    def tearDown(self):
+        self.upstream.stop()
+        self._app.cache.close()
+        self.tmp_dir.cleanup()
+        super(TestGeoproxySharedCache, self).tearDown()
+
+    @gen_test
+    async def test_shared_result(self):
+        response = await self.http_client.fetch("http://127.0.0.1:{}/geocode?address={}".format(
+            self.worker_port, "101+North+St&service=google"))
+        self.assertEqual(json.loads(response.body.decode('utf-8'))['status'], "OK")
+        # another worker mapping the same file sees the result
+        other = SharedResultCache(self.cache_path)
+        self.assertEqual(other.get(cache_key("101+North+St"))["source"], "google")
+        other.close()
+        stats = json.loads((await self.http_client.fetch(self.get_url('/stats'))).body)
+        self.assertEqual(stats['cache']['size'], 1)
+        self.assertEqual(stats['cache']['capacity'], 10000)
+
+
+class TestGeoproxyJobs(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        sock, port = bind_unused_port()
+        self.upstream = HTTPServer(tornado.web.Application([(r"/.*",
+                                                            TwoServicesUpstreamHandler)]))
+        self.upstream.add_sockets([sock])
+        url = "http://127.0.0.1:{}/geocode".format(port)
+        return Geoproxy("localhost", 8080, "1", "2", "3", service_urls={"google": url,
+                                                                        "here": url},
+                        job_dir=self.tmp_dir.name, job_rate=0)
+
+    def tearDown(self):
+        self._app.job_queue.stop()
+        self.upstream.stop()
+        super(TestGeoproxyJobs, self).tearDown()
+        self.tmp_dir.cleanup()
+
+    def test_job(self):
+        response = self.fetch('/jobs?service=here', method="POST",
+                              body="1 Main St\n2 Main St\n3 Main St\n")
+        self.assertEqual(response.code, 201)
+        job = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(response.headers["Location"], "/jobs/{}".format(job['id']))
+        self.assertEqual(job['total'], 3)
+        for _ in range(100):
+            job = json.loads(self.fetch('/jobs/{}'.format(job['id'])).body.decode('utf-8'))
+            if job['state'] == "completed":
+                break
+            self.io_loop.run_sync(lambda: sleep(0.01))
+        self.assertEqual(job['state'], "completed")
+        self.assertEqual(job['succeeded'], 3)
+        response = self.fetch('/jobs/{}/results'.format(job['id']))
+        self.assertEqual(response.headers["X-Geoproxy-Job-State"], "completed")
+        lines = response.body.decode('utf-8').splitlines()
+        results = [json.loads(line) for line in lines]
+        self.assertEqual([result['query'] for result in results],
+                         ["1 Main St", "2 Main St", "3 Main St"])
+        self.assertEqual(results[0]['result']['source'], "here")
+        # downloads resume from a byte offset
+        response = self.fetch('/jobs/{}/results?offset={}'.format(job['id'],
+                                                                   len(lines[0]) + 1))
+        self.assertEqual(response.body.decode('utf-8').splitlines(), lines[1:])
+        self.assertEqual(self.fetch('/jobs/0123').code, 404)
+        stats = json.loads(self.fetch('/stats').body.decode('utf-8'))
+        self.assertEqual(stats['jobs']['lines'], 3)
+        # results removed under a download, eg by a deletion, are not found
+        store = self._app.job_queue.store
+        results_path = store.job_path(job['id'], store.RESULTS_FILE)
+        os.rename(results_path, results_path + ".moved")
+        self.assertEqual(self.fetch('/jobs/{}/results'.format(job['id'])).code, 404)
+        os.rename(results_path + ".moved", results_path)
+        # finished jobs can be deleted
+        self.assertEqual(self.fetch('/jobs/{}'.format(job['id']), method="DELETE").code, 204)
+        self.assertEqual(self.fetch('/jobs/{}'.format(job['id'])).code, 404)
+        self.assertEqual(self.fetch('/jobs/{}/results'.format(job['id'])).code, 404)
+
+
+class TestGeoproxyJobsToken(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        return Geoproxy("localhost", 8080, "1", "2", "3", job_dir=self.tmp_dir.name,
+                        admin_token="secret", job_max_jobs=1)
+
+    def tearDown(self):
+        self._app.job_queue.stop()
+        super(TestGeoproxyJobsToken, self).tearDown()
+        self.tmp_dir.cleanup()
+
+    def test_token(self):
+        # jobs are only accepted from operators
+        response = self.fetch('/jobs', method="POST", body="1 Main St\n")
+        self.assertEqual(response.code, 403)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+        headers = {AdminRequestHandler.TOKEN_HEADER: "secret"}
+        response = self.fetch('/jobs', method="POST", body="1 Main St\n", headers=headers)
+        self.assertEqual(response.code, 201)
+        job_id = json.loads(response.body.decode('utf-8'))['id']
+        self.assertEqual(self.fetch('/jobs/{}'.format(job_id)).code, 403)
+        self.assertEqual(self.fetch('/jobs/{}/results'.format(job_id)).code, 403)
+        # the store is full
+        response = self.fetch('/jobs', method="POST", body="2 Main St\n", headers=headers)
+        self.assertEqual(response.code, 429)
+
+
+class TestGeoproxyLocalIndex(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        csv_path = os.path.join(self.tmp_dir.name, "addresses.csv")
+        with open(csv_path, "w") as csv_file:
+            csv_file.write("LON,LAT,NUMBER,STREET,CITY,REGION,POSTCODE\n")
+            csv_file.write("-73.9856,40.7484,350,5th Ave,New York,NY,10118\n")
+        index_path = os.path.join(self.tmp_dir.name, "addresses.idx")
+        build_address_index(csv_path, index_path)
+        # nothing listens on the third party services' port, so they fail
+        sock, port = bind_unused_port()
+        sock.close()
+        url = "http://127.0.0.1:{}/geocode".format(port)
+        return Geoproxy("localhost", 8080, "1", "2", "3", local_index_path=index_path,
+                        max_attempts=1, service_urls={"google": url, "here": url})
+
+    def tearDown(self):
+        super(TestGeoproxyLocalIndex, self).tearDown()
+        self.tmp_dir.cleanup()
+
+    def test_local_result(self):
+        response = self.fetch('/geocode?address=350+5th+Ave,+New+York')
+        response_json = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(response_json['status'], "OK")
+        self.assertEqual(response_json['result']['source'], "local")
+        self.assertEqual(response_json['result']['lat'], 40.7484)
+
+    def test_local_miss(self):
+        # an address the index does not cover is not zero results
+        response = self.fetch('/geocode?address=101+North+St')
+        response_json = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(response_json['status'], "UNKNOWN_ERROR")
+        self.assertEqual(response_json['error'], "Error in third-party API requests")
+
+
+@unittest.skipUnless(importlib.util.find_spec("uvloop") and os.path.exists(SERVER_PATH),
+                     "requires uvloop and the example server")
+class TestServerUvloop(unittest.TestCase):
+
+    def test_starts(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        server = subprocess.Popen([sys.executable, SERVER_PATH, "-p", str(port), "--uvloop",
+                                   "--log-level", "ERROR"],
+                                  env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                self.assertIsNone(server.poll(), "the server exited")
+                try:
+                    response = urllib.request.urlopen("http://127.0.0.1:{}/stats".format(port))
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            else:
+                self.fail("the server did not start")
+            self.assertIn("bulkheads", json.loads(response.read().decode('utf-8')))
+        finally:
+            server.terminate()
+            server.wait()
+
+
 if __name__ == '__main__':
     unittest.main()
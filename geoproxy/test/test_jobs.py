@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import json
+import os
+import tempfile
+from geoproxy.jobs import JobQueue
+from geoproxy.jobs import JobStore
+from tornado.gen import sleep
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+import unittest
+
+
+class MockResolver:
+    available_services = {"google": None, "here": None}
+    service_orders = None
+
+    def __init__(self):
+        self.addresses = []
+
+    async def resolve(self, geo_proxy_request, geo_proxy_response, deadline):
+        self.addresses.append(geo_proxy_request.address)
+        geo_proxy_response.set_result("google", 1.0, 2.0, geo_proxy_request.address)
+
+
+class TestJobQueue(AsyncTestCase):
+
+    def setUp(self):
+        super(TestJobQueue, self).setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = JobStore(self.tmp_dir.name)
+        self.resolver = MockResolver()
+
+    def tearDown(self):
+        super(TestJobQueue, self).tearDown()
+        self.tmp_dir.cleanup()
+
+    def upload(self, *chunks):
+        upload = self.store.start_upload()
+        for chunk in chunks:
+            upload.write(chunk)
+        return upload
+
+    def read_results(self, job):
+        with open(self.store.job_path(job.id, JobStore.RESULTS_FILE)) as results_file:
+            return [json.loads(line) for line in results_file]
+
+    async def wait_for(self, job, state):
+        for _ in range(200):
+            if job.state == state:
+                return
+            await sleep(0.01)
+        self.fail("Job did not reach {}".format(state))
+
+    async def wait_for_idle(self, queue):
+        # a job is still running while its final state is saved
+        for _ in range(200):
+            if queue.stats()["running"] is None:
+                return
+            await sleep(0.01)
+        self.fail("Queue did not become idle")
+
+    @gen_test
+    async def test_process(self):
+        queue = JobQueue(self.store, self.resolver, rate=0, chunk_size=2)
+        queue.start()
+        # the last line has no line break, and the blank line keeps its place
+        job = await queue.create(self.upload(b"1 Main St\n2 Ma", b"in St\n\n4 Main St"),
+                                 service="here")
+        self.assertEqual(job.total, 4)
+        await self.wait_for(job, "completed")
+        queue.stop()
+        results = self.read_results(job)
+        self.assertEqual([result["status"] for result in results],
+                         ["OK", "OK", "INVALID_REQUEST", "OK"])
+        self.assertEqual(results[1]["result"]["resolved_address"], "2+Main+St")
+        self.assertEqual(job.to_dict()["progress"], 1.0)
+        self.assertEqual(job.succeeded, 3)
+        # the saved state matches
+        self.assertEqual(self.store.load()[0].to_dict(), job.to_dict())
+
+    @gen_test
+    async def test_resume(self):
+        queue = JobQueue(self.store, self.resolver, rate=0, chunk_size=2)
+        job = await queue.create(
+            self.upload(b"1 Main St\n2 Main St\n3 Main St\n4 Main St\n"))
+        lines, offset = self.store.read_lines(job, 2)
+        responses = await queue.resolve_line(job, lines[0]), await queue.resolve_line(job,
+                                                                                     lines[1])
+        self.store.checkpoint(job, [response.to_json() for response in responses], offset, 2)
+        job.state = "running"
+        self.store.save(job)
+        # a crash after writing part of the next chunk, and during another upload
+        with open(self.store.job_path(job.id, JobStore.RESULTS_FILE), "a") as results_file:
+            results_file.write('{"partial')
+        self.store.start_upload()
+
+        self.resolver.addresses = []
+        restarted = JobQueue(self.store, self.resolver, rate=0, chunk_size=2)
+        restarted.start()
+        self.assertEqual(list(restarted.jobs), [job.id])
+        job = restarted.jobs[job.id]
+        await self.wait_for(job, "completed")
+        restarted.stop()
+        # only the lines after the checkpoint were resolved again
+        self.assertEqual(self.resolver.addresses, ["3+Main+St", "4+Main+St"])
+        self.assertEqual([result["query"] for result in self.read_results(job)],
+                         ["1 Main St", "2 Main St", "3 Main St", "4 Main St"])
+        self.assertEqual(os.listdir(self.tmp_dir.name), [job.id])
+
+    @gen_test
+    async def test_rate(self):
+        queue = JobQueue(self.store, self.resolver, rate=100, chunk_size=10)
+        job = await queue.create(self.upload(b"a\nb\nc\nd\ne\n"))
+        start_time = self.io_loop.time()
+        queue.start()
+        await self.wait_for(job, "completed")
+        queue.stop()
+        # five lines started 10ms apart
+        self.assertTrue(self.io_loop.time() - start_time >= 0.04)
+        self.assertEqual(queue.stats()["lines"], 5)
+
+    @gen_test
+    async def test_max_jobs(self):
+        queue = JobQueue(self.store, self.resolver, rate=0, max_jobs=2)
+        first = queue.start_upload()
+        await queue.create(first)
+        # uploads in progress count towards the limit
+        second = queue.start_upload()
+        self.assertIsNone(queue.start_upload())
+        queue.abort_upload(second)
+        self.assertIsNotNone(queue.start_upload())
+
+    @gen_test
+    async def test_delete_and_expire(self):
+        queue = JobQueue(self.store, self.resolver, rate=0, retention=60)
+        queue.start()
+        finished = await queue.create(self.upload(b"1 Main St\n"))
+        await self.wait_for(finished, "completed")
+        recent = await queue.create(self.upload(b"2 Main St\n"))
+        await self.wait_for(recent, "completed")
+        await self.wait_for_idle(queue)
+        queue.stop()
+        finished.finished -= 120
+        await queue.expire()
+        self.assertEqual(list(queue.jobs), [recent.id])
+        self.assertEqual(os.listdir(self.tmp_dir.name), [recent.id])
+        self.assertEqual(queue.stats()["expired"], 1)
+        self.assertTrue(await queue.delete(recent.id))
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+from geoproxy.third_party_services.key_pool import DENIED
+from geoproxy.third_party_services.key_pool import KeyPool
+from geoproxy.third_party_services.key_pool import RATE_LIMITED
+from geoproxy.third_party_services.key_pool import mask_key
+import time
+import unittest
+
+
+class TestKeyPool(unittest.TestCase):
+
+    def test_least_recently_used(self):
+        pool = KeyPool(["a", "b", "c"])
+        self.assertEqual([pool.acquire() for _ in range(6)], ["a", "b", "c", "a", "b", "c"])
+        self.assertEqual([entry["requests"] for entry in pool.stats()], [2, 2, 2])
+
+    def test_weights(self):
+        pool = KeyPool(["a", "b"], weights=[3, 1])
+        keys = [pool.acquire() for _ in range(8)]
+        self.assertEqual(keys.count("a"), 6)
+        # the heavier key's queries are interleaved with the other's, not sent in a burst
+        self.assertEqual(keys[:4], ["a", "a", "b", "a"])
+
+    def test_rate_limited(self):
+        pool = KeyPool(["a", "b"], cooldown=60.0)
+        pool.report("a", RATE_LIMITED)
+        self.assertEqual([pool.acquire() for _ in range(3)], ["b", "b", "b"])
+        # queries already in flight with the key do not extend its cooldown
+        pool.report("a", RATE_LIMITED)
+        stats = pool.stats()
+        self.assertEqual(stats[0]["rate_limited"], 2)
+        self.assertEqual(pool.entries[0].strikes, 1)
+        self.assertAlmostEqual(stats[0]["cooldown"], 60.0, delta=1)
+        self.assertEqual(stats[1]["cooldown"], 0.0)
+
+    def test_cooldown_doubles(self):
+        pool = KeyPool(["a"], cooldown=0.01)
+        pool.report("a", RATE_LIMITED)
+        time.sleep(0.02)
+        pool.report("a", RATE_LIMITED)
+        self.assertGreater(pool.entries[0].disabled_until - time.monotonic(), 0.01)
+        time.sleep(0.03)
+        # an accepted query resets the cooldown
+        pool.report("a")
+        self.assertEqual(pool.entries[0].strikes, 0)
+
+    def test_denied(self):
+        pool = KeyPool(["a", "b"], denied_cooldown=60.0)
+        pool.report("b", DENIED)
+        self.assertEqual(pool.acquire(), "a")
+        self.assertEqual(pool.acquire(), "a")
+        self.assertEqual(pool.stats()[1]["denied"], 1)
+
+    def test_all_keys_out_of_rotation(self):
+        pool = KeyPool(["a", "b"], cooldown=60.0, denied_cooldown=3600.0)
+        pool.report("a", DENIED)
+        pool.report("b", RATE_LIMITED)
+        # the key that comes back first is still used
+        self.assertEqual(pool.acquire(), "b")
+
+    def test_invalid_pool(self):
+        with self.assertRaises(ValueError):
+            KeyPool([])
+        with self.assertRaises(ValueError):
+            KeyPool(["a", "a"])
+        with self.assertRaises(ValueError):
+            KeyPool(["a", "b"], weights=[1])
+        with self.assertRaises(ValueError):
+            KeyPool(["a"], weights=[0])
+
+    def test_mask_key(self):
+        self.assertEqual(mask_key("AIzaSyExampleKey1234"), "...1234")
+        self.assertEqual(mask_key(("app-id-12345678", "code")), "...5678")
+        self.assertEqual(mask_key("short"), "...")
+        self.assertEqual(mask_key(None), "...")
+        pool = KeyPool(["AIzaSyExampleKey1234"])
+        self.assertNotIn("AIza", str(pool.stats()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+from geoproxy.latency import AdaptiveTimeout
+from geoproxy.latency import P2Quantile
+import random
+import unittest
+
+
+class TestLatency(unittest.TestCase):
+
+    def test_p2_quantile(self):
+        generator = random.Random(42)
+        values = [generator.expovariate(10.0) for _ in range(20000)]
+        for p in (0.5, 0.9, 0.99):
+            estimator = P2Quantile(p)
+            self.assertIsNone(estimator.value())
+            for value in values:
+                estimator.add(value)
+            exact = sorted(values)[int(p * len(values))]
+            self.assertAlmostEqual(estimator.value(), exact, delta=0.05 * exact)
+
+    def test_p2_few_values(self):
+        estimator = P2Quantile(0.5)
+        for value in (3.0, 1.0, 2.0):
+            estimator.add(value)
+        self.assertEqual(estimator.value(), 2.0)
+
+    def test_adaptive_timeout(self):
+        timeout = AdaptiveTimeout(quantile=0.99, multiplier=2.0, floor=0.05, ceiling=3.0,
+                                  min_samples=20, window=100)
+        # no estimate yet, use the ceiling
+        self.assertEqual(timeout.timeout(), 3.0)
+        for _ in range(20):
+            timeout.observe(0.1)
+        self.assertAlmostEqual(timeout.timeout(), 0.2)
+        # clamped to the floor
+        for _ in range(100):
+            timeout.observe(0.001)
+        self.assertEqual(timeout.timeout(), 0.05)
+        # and to the ceiling
+        for _ in range(200):
+            timeout.observe(10.0)
+        self.assertEqual(timeout.timeout(), 3.0)
+        self.assertEqual(timeout.stats()["timeout"], 3.0)
+
+    def test_adaptive_timeout_follows_drift(self):
+        timeout = AdaptiveTimeout(quantile=0.9, multiplier=1.0, floor=0.0, ceiling=10.0,
+                                  min_samples=20, window=100)
+        for _ in range(100):
+            timeout.observe(0.1)
+        self.assertAlmostEqual(timeout.timeout(), 0.1)
+        for _ in range(120):
+            timeout.observe(0.5)
+        # the window of fast responses has been replaced
+        self.assertAlmostEqual(timeout.timeout(), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
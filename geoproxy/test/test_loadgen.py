@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+from geoproxy.loadgen import LatencyHistogram
+from geoproxy.loadgen import run_open_loop
+from tornado.gen import sleep
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import gen_test
+import tornado.web
+import unittest
+
+
+class SlowHandler(tornado.web.RequestHandler):
+
+    async def get(self):
+        await sleep(0.05)
+        if self.get_argument("fail", None):
+            self.set_status(503)
+        self.write("{}")
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram(significant_digits=2)
+        for millis in range(1, 1001):
+            histogram.record(millis / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        # within the histogram's 1% precision
+        self.assertAlmostEqual(histogram.percentile(0.5), 0.5, delta=0.005)
+        self.assertAlmostEqual(histogram.percentile(0.99), 0.99, delta=0.0099)
+        self.assertEqual(histogram.percentile(1.0), 1.0)
+        self.assertAlmostEqual(histogram.mean(), 0.5005)
+        summary = histogram.summary()
+        self.assertEqual(sorted(summary), ["max", "mean", "p50", "p90", "p99", "p99.9"])
+
+    def test_merge(self):
+        a = LatencyHistogram()
+        b = LatencyHistogram()
+        self.assertEqual(a.percentile(0.5), 0.0)
+        a.record(0.001)
+        b.record(10.0)
+        a.merge(b)
+        self.assertEqual(a.count, 2)
+        self.assertAlmostEqual(a.percentile(0.5), 0.001, delta=0.00001)
+        self.assertEqual(a.percentile(1.0), 10.0)
+
+
+class TestOpenLoop(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return tornado.web.Application([(r"/geocode", SlowHandler)])
+
+    @gen_test
+    async def test_fixed_rate(self):
+        intervals = []
+        report = await run_open_loop(self.get_url(""), ["/geocode?a=1", "/geocode?fail=1"],
+                                     rate=100, duration=0.3, interval=0.1,
+                                     on_interval=intervals.append)
+        self.assertEqual(report["sent"], 30)
+        self.assertEqual(report["requests"], 30)
+        self.assertEqual(report["errors"], 15)
+        self.assertTrue(report["p50"] >= 0.05)
+        self.assertTrue(len(intervals) >= 3)
+        self.assertEqual(sum(interval["requests"] for interval in intervals), 30)
+
+    @gen_test
+    async def test_coordinated_omission(self):
+        # a single connection serves one request at a time, requests queue behind it and the
+        # queueing is counted in their latency
+        report = await run_open_loop(self.get_url(""), ["/geocode"], rate=100, duration=0.1,
+                                     connections=1)
+        self.assertEqual(report["requests"], 10)
+        self.assertTrue(report["max"] > 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import json
+
+from geoproxy import Geoproxy
+from geoproxy.cache import ResultCache
+from geoproxy.peer_cache import HashRing
+from geoproxy.peer_cache import PeerCache
+from tornado.gen import sleep
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import bind_unused_port
+from tornado.testing import gen_test
+import unittest
+
+
+def find_key(ring, node):
+    """Finds a cache key owned by a node"""
+    for i in range(1000):
+        key = "address {}".format(i)
+        if ring.get_node(key) == node:
+            return key
+
+
+class TestHashRing(unittest.TestCase):
+    def test_empty_ring(self):
+        self.assertIsNone(HashRing([]).get_node("key"))
+
+    def test_distribution(self):
+        nodes = ["http://a:1", "http://b:1", "http://c:1"]
+        ring = HashRing(nodes)
+        counts = {node: 0 for node in nodes}
+        for i in range(3000):
+            counts[ring.get_node("key {}".format(i))] += 1
+        for count in counts.values():
+            self.assertTrue(count > 600)
+
+    def test_consistency(self):
+        ring = HashRing(["http://a:1", "http://b:1", "http://c:1"])
+        smaller = HashRing(["http://a:1", "http://b:1"])
+        for i in range(1000):
+            key = "key {}".format(i)
+            # only the keys owned by the removed node move
+            if ring.get_node(key) != "http://c:1":
+                self.assertEqual(ring.get_node(key), smaller.get_node(key))
+
+
+class TestPeerCache(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.node_a = self.get_url("")
+        # nothing listens on node b, so it behaves like a failed peer
+        sock, port = bind_unused_port()
+        sock.close()
+        self.node_b = "http://127.0.0.1:{}".format(port)
+        return Geoproxy("localhost", 8080, "1", "2", "3", cache_size=10000,
+                        peers=[self.node_a, self.node_b], self_url=self.node_a,
+                        peer_token="secret")
+
+    def create_node_b(self):
+        return PeerCache(self.node_b, [self.node_a], ResultCache(), timeout=1.0, token="secret")
+
+    @gen_test
+    async def test_share_between_peers(self):
+        node_b = self.create_node_b()
+        key = find_key(node_b.ring, self.node_a)
+        result = {"source": "google", "lat": 1.0, "lon": 2.0, "resolved_address": "Addr"}
+        # node b resolved a key owned by node a, it is replicated locally and pushed to a
+        node_b.put(key, result)
+        self.assertEqual(node_b.replica.get(key), result)
+        for _ in range(100):
+            if key in self._app.cache:
+                break
+            await sleep(0.01)
+        self.assertEqual(self._app.cache.get(key), result)
+        # a fresh node b fetches the entry from its owner on a miss
+        node_b = self.create_node_b()
+        fetched = await node_b.get(key)
+        self.assertEqual(fetched, result)
+        self.assertEqual(node_b.peer_hits, 1)
+        self.assertEqual(node_b.replica.get(key), result)
+        # a miss on the owner is not a peer failure
+        missing = await node_b.get(find_key(node_b.ring, self.node_a) + " missing")
+        self.assertIsNone(missing)
+        self.assertEqual(node_b.peer_errors, 0)
+
+    @gen_test
+    async def test_owned_key(self):
+        peer_cache = self._app.peer_cache
+        key = find_key(peer_cache.ring, self.node_a)
+        peer_cache.put(key, {"lat": 1.0})
+        self.assertEqual(self._app.cache.get(key), {"lat": 1.0})
+        # owned keys are only held in the local cache, which the handler checks first
+        result = await peer_cache.get(key)
+        self.assertIsNone(result)
+
+    @gen_test
+    async def test_failed_peer(self):
+        peer_cache = self._app.peer_cache
+        key = find_key(peer_cache.ring, self.node_b)
+        result = await peer_cache.get(key)
+        self.assertIsNone(result)
+        self.assertEqual(peer_cache.peer_errors, 1)
+        self.assertFalse(peer_cache.is_available(self.node_b))
+        # the failed peer is skipped during its cooldown
+        result = await peer_cache.get(key)
+        self.assertIsNone(result)
+        self.assertEqual(peer_cache.peer_errors, 1)
+
+    def test_peer_token(self):
+        response = self.fetch("/cache?key=addr")
+        self.assertEqual(response.code, 403)
+        response = self.fetch("/cache?key=addr", headers={PeerCache.TOKEN_HEADER: "secret"})
+        self.assertEqual(response.code, 404)
+        response = self.fetch("/cache?key=addr", method="PUT", body=json.dumps({"lat": 1}))
+        self.assertEqual(response.code, 403)
+        self.assertIsNone(self._app.cache.get("addr"))
+
+    def test_invalid_result(self):
+        headers = {PeerCache.TOKEN_HEADER: "secret"}
+        # a cache hit passes the result to set_result(), so peers cannot store other keys
+        for body in ('{"lat": 1}', '[]', json.dumps({"source": "google", "lat": 1.0, "lon": 2.0,
+                                                     "resolved_address": "Addr", "x": 1})):
+            response = self.fetch("/cache?key=addr", method="PUT", body=body, headers=headers)
+            self.assertEqual(response.code, 400)
+        self.assertIsNone(self._app.cache.get("addr"))
+        result = {"source": "google", "lat": 1.0, "lon": 2, "resolved_address": "Addr"}
+        response = self.fetch("/cache?key=addr", method="PUT", body=json.dumps(result),
+                              headers=headers)
+        self.assertEqual(response.code, 204)
+        self.assertEqual(self._app.cache.get("addr"), result)
+
+    def test_without_token(self):
+        # the cache is only shared with a secret
+        app = Geoproxy("localhost", 8080, "1", "2", "3", cache_size=10000,
+                       peers=[self.node_a, self.node_b], self_url=self.node_a, sockets=[])
+        self.assertIsNone(app.peer_cache)
+        self.assertIsNone(app.resolver.peer_cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
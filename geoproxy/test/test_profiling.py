@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import marshal
+from geoproxy.profiling import MemoryProfiler
+from geoproxy.profiling import SamplingProfiler
+from geoproxy.profiling import TracingProfiler
+import threading
+import unittest
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_sampling_profiler(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_loop, args=(stop,), name="Worker")
+        worker.start()
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        try:
+            stop.wait(0.05)
+        finally:
+            profiler.stop()
+            stop.set()
+            worker.join()
+        self.assertTrue(profiler.samples > 0)
+        lines = profiler.collapsed().splitlines()
+        self.assertTrue(any(line.startswith("Worker;") and "busy_loop (test_profiling.py:"
+                            in line for line in lines))
+        self.assertFalse(any(line.startswith("SamplingProfiler;") for line in lines))
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertTrue(int(count) >= 1)
+
+    def test_tracing_profiler(self):
+        profiler = TracingProfiler()
+        profiler.start()
+        sum(range(1000))
+        profiler.stop()
+        stats = marshal.loads(profiler.dump())
+        self.assertTrue(any(name == "<built-in method builtins.sum>"
+                            for _, _, name in stats.keys()))
+
+    def test_memory_profiler(self):
+        profiler = MemoryProfiler()
+        profiler.start(frames=2)
+        try:
+            self.assertTrue(profiler.tracing)
+            first = profiler.report(limit=5)
+            self.assertEqual(first["diff"], [])
+            retained = [bytearray(1024) for _ in range(100)]
+            second = profiler.report(limit=5)
+            self.assertTrue(second["current"] > 0)
+            self.assertTrue(len(second["diff"]) > 0)
+            self.assertTrue(any("test_profiling.py" in line for line in second["diff"]))
+            del retained
+        finally:
+            profiler.stop()
+        self.assertFalse(profiler.tracing)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+from geoproxy import Geoproxy
+from geoproxy.replay import StubUpstream
+from geoproxy.replay import TraceRecorder
+from geoproxy.replay import load_trace
+from geoproxy.replay import percentile
+from geoproxy.replay import run_load
+from geoproxy.replay import sanitize_query
+import json
+import os
+import tempfile
+from tornado.httpserver import HTTPServer
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import bind_unused_port
+from tornado.testing import gen_test
+import unittest
+
+GOOGLE_BODY = json.dumps({"status": "OK", "results": [
+    {"formatted_address": "Addr", "geometry": {"location": {"lat": 1.0, "lng": 2.0}}}]})
+
+
+class TestTrace(unittest.TestCase):
+    def test_sanitize_query(self):
+        self.assertEqual(
+            sanitize_query("https://host/geocode.json?searchtext=a+b&app_id=1&app_code=2"),
+            "/geocode.json?searchtext=a+b")
+        self.assertEqual(sanitize_query("/json?key=1&bounds=1,2|3,4&address=a"),
+                         "/json?address=a&bounds=1%2C2%7C3%2C4")
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 0.5), 0.0)
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1.0), 100)
+
+    def test_record_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "trace.jsonl.gz")
+            recorder = TraceRecorder(path)
+            recorder.record_request("/geocode?address=a")
+            recorder.record_upstream("google", "https://host/json?address=a&key=secret", 200,
+                                     GOOGLE_BODY, 0.1234567)
+            recorder.close()
+            entries = list(load_trace(path))
+        self.assertEqual(recorder.entries, 2)
+        self.assertEqual(entries[0], {"type": "request", "uri": "/geocode?address=a"})
+        self.assertEqual(entries[1]["query"], "/json?address=a")
+        self.assertEqual(entries[1]["latency"], 0.123457)
+        self.assertNotIn("secret", json.dumps(entries))
+
+
+class TestReplay(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.stub = StubUpstream([{"type": "upstream", "service": "google",
+                                   "query": "/json?address=350+5th+Ave", "code": 200,
+                                   "body": GOOGLE_BODY, "latency": 0.01}])
+        sock, port = bind_unused_port()
+        self.stub_server = HTTPServer(self.stub.create_app())
+        self.stub_server.add_sockets([sock])
+        self.stub_url = "http://127.0.0.1:{}".format(port)
+        self.trace_path = os.path.join(self.tmp_dir.name, "trace.jsonl.gz")
+        return Geoproxy("localhost", 8080, "1", "2", "3",
+                        service_urls={"google": self.stub_url + "/json"},
+                        trace_path=self.trace_path)
+
+    def tearDown(self):
+        self.stub_server.stop()
+        self._app.recorder.close()
+        super(TestReplay, self).tearDown()
+        self.tmp_dir.cleanup()
+
+    def test_stub_upstream(self):
+        response = self.fetch('/geocode?address=350+5th+Ave&service=google')
+        response_json = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(response_json['status'], "OK")
+        self.assertEqual(response_json['result']['source'], "google")
+        self.assertEqual(self.stub.calls, {"google": 1})
+        # the request and the upstream exchange were recorded
+        self._app.recorder.close()
+        entries = list(load_trace(self.trace_path))
+        self.assertEqual([entry["type"] for entry in entries], ["request", "upstream"])
+        self.assertEqual(entries[1]["query"], "/json?address=350+5th+Ave")
+        self.assertEqual(entries[1]["body"], GOOGLE_BODY)
+
+    def test_stub_miss(self):
+        response = self.fetch(self.stub_url + "/json?address=unknown", raise_error=False)
+        self.assertEqual(response.code, 404)
+        self.assertEqual(self.stub.misses, 1)
+
+    @gen_test
+    async def test_run_load(self):
+        report = await run_load(self.get_url(""), ["/geocode?address=350+5th+Ave&service=google"],
+                                concurrency=2, repeat=3, stub_url=self.stub_url)
+        self.assertEqual(report["requests"], 3)
+        self.assertEqual(report["errors"], 0)
+        self.assertTrue(report["rps"] > 0)
+        self.assertTrue(report["p50"] <= report["p99"])
+        self.assertTrue(report["upstream_calls"]["google"] >= 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import tempfile
+from geoproxy.api import GeoproxyRequestParser
+from geoproxy.api import GeoproxyResponse
+from geoproxy.bulkhead import Bulkheads
+from geoproxy.cache import ResultCache
+from geoproxy.centroids import CentroidIndex
+from geoproxy.centroids import build_centroid_index
+from geoproxy.deadline import Deadline
+from geoproxy.fuzzy import FuzzyIndex
+from geoproxy.geometry import BoundingBox
+from geoproxy.geometry import Coordinate
+from geoproxy.resolver import GeoproxyResolver
+from geoproxy.routing import RegionRouter
+from geoproxy.third_party_services.local import LocalServiceResponseParser
+from geoproxy.third_party_services.service_base import ThirdPartyServiceHelper
+from tornado.ioloop import IOLoop
+import unittest
+
+
+class MockRequestHandler:
+
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+
+    def get_arguments(self, key):
+        return self.dictionary.get(key, [])
+
+
+class MockServiceHelper(ThirdPartyServiceHelper):
+    is_remote = False
+
+    def __init__(self, response):
+        super(MockServiceHelper, self).__init__(LocalServiceResponseParser())
+        self.response = response
+
+    def build_query(self, address, bounds=None, limit=1):
+        self.query = address
+
+    def lookup(self, query):
+        return self.response
+
+
+def result(lat, lon, label="Addr"):
+    return {"status": "OK", "results": [{"label": label, "lat": lat, "lon": lon}]}
+
+
+class TestResolver(unittest.TestCase):
+
+    def resolve(self, services, arguments, bulkheads=None, centroids=None):
+        resolver = GeoproxyResolver(logging.getLogger("test"), bulkheads, services, cache=None,
+                                    centroids=centroids)
+        response = GeoproxyResponse()
+        request = GeoproxyRequestParser(services, response)
+        self.assertTrue(request.parse(MockRequestHandler(arguments)))
+        IOLoop.current().run_sync(lambda: resolver.resolve(request, response, Deadline(1.0)))
+        self.attempts = request.attempts
+        return response
+
+    def test_fallback(self):
+        services = {"a": MockServiceHelper({"status": "ZERO_RESULTS"}),
+                    "b": MockServiceHelper(result(1.0, 2.0))}
+        response = self.resolve(services, {"address": ["Addr"]})
+        self.assertEqual(response.status, "OK")
+        self.assertEqual(response.result["source"], "b")
+        self.assertNotIn("agreement", response.result)
+
+    def test_bulkhead_full(self):
+        remote = MockServiceHelper(None)
+        remote.is_remote = True
+        services = {"a": remote, "b": MockServiceHelper(result(1.0, 2.0))}
+        bulkheads = Bulkheads(["a"], size=1, max_queue=0)
+        self.assertTrue(bulkheads["a"].try_acquire())
+        response = self.resolve(services, {"address": ["Addr"]}, bulkheads)
+        # the saturated service is skipped without a request
+        self.assertEqual(response.result["source"], "b")
+        self.assertEqual(self.attempts, 0)
+        self.assertEqual(bulkheads["a"].rejected, 1)
+        bulkheads.shutdown()
+
+    def test_consensus(self):
+        services = {"a": MockServiceHelper(result(10.0, 10.0)),
+                    "b": MockServiceHelper(result(40.7484, -73.9856)),
+                    "c": MockServiceHelper(result(40.7485, -73.9857)),
+                    "d": MockServiceHelper(None)}
+        response = self.resolve(services, {"address": ["Addr"], "mode": ["consensus"]})
+        self.assertEqual(response.status, "OK")
+        self.assertEqual(response.result["source"], "b")
+        self.assertEqual(response.result["agreement"], 0.5)
+
+    def test_consensus_zero_results(self):
+        services = {"a": MockServiceHelper({"status": "ZERO_RESULTS"}),
+                    "b": MockServiceHelper(None)}
+        response = self.resolve(services, {"address": ["Addr"], "mode": ["consensus"]})
+        self.assertEqual(response.status, "ZERO_RESULTS")
+
+    def test_route(self):
+        services = {"local": MockServiceHelper(None), "a": MockServiceHelper(None),
+                    "b": MockServiceHelper(None)}
+        services["a"].is_remote = services["b"].is_remote = True
+        router = RegionRouter(min_samples=1, explore_rate=0.0)
+        resolver = GeoproxyResolver(logging.getLogger("test"), None, services, router=router)
+        bounds = BoundingBox()
+        bounds.set_bl_tr(Coordinate(40.70, -74.02), Coordinate(40.80, -73.93))
+        self.assertEqual(resolver.route(bounds, ["local", "a", "b"]), ["local", "a", "b"])
+        response = GeoproxyResponse()
+        request = GeoproxyRequestParser(services, response)
+        request.parse(MockRequestHandler({"address": ["Addr"],
+                                          "bounds": ["40.70,-74.02|40.80,-73.93"]}))
+        resolver.record_outcomes(request, response, [("local", False, 0.001),
+                                                     ("a", False, 0.2), ("b", True, 0.1)])
+        # the offline index keeps its place, the remote services are reordered
+        self.assertEqual(resolver.route(bounds, ["local", "a", "b"]), ["local", "b", "a"])
+        self.assertEqual(router.stats()["routed"], 1)
+
+    def test_centroid_fallback(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, "centroids.csv")
+            with open(csv_path, "w") as csv_file:
+                csv_file.write("POSTCODE,LOCALITY,REGION,LAT,LON\n")
+                csv_file.write("10118,New York,NY,40.7484,-73.9857\n")
+            build_centroid_index(csv_path, os.path.join(tmp_dir, "centroids.idx"))
+            centroids = CentroidIndex(os.path.join(tmp_dir, "centroids.idx"))
+            address = {"address": ["350 5th Ave, New York 10118"]}
+            response = self.resolve({"a": MockServiceHelper(None)}, address,
+                                    centroids=centroids)
+            self.assertEqual(response.result, {"source": "centroids", "lat": 40.7484,
+                                               "lon": -73.9857,
+                                               "resolved_address": "New York, NY 10118",
+                                               "precision": "postal_code"})
+            # a service that found nothing is trusted
+            response = self.resolve({"a": MockServiceHelper({"status": "ZERO_RESULTS"})},
+                                    address, centroids=centroids)
+            self.assertEqual(response.status, "ZERO_RESULTS")
+            response = self.resolve({"a": MockServiceHelper(None)}, {"address": ["Nowhere"]},
+                                    centroids=centroids)
+            self.assertEqual(response.status, "UNKNOWN_ERROR")
+            centroids.close()
+
+    def test_fuzzy_lookup(self):
+        services = {"a": MockServiceHelper(result(40.7484, -73.9856, "350 5th Ave"))}
+        resolver = GeoproxyResolver(logging.getLogger("test"), None, services,
+                                    cache=ResultCache(), fuzzy=FuzzyIndex(0.8))
+
+        def resolve(address):
+            response = GeoproxyResponse()
+            request = GeoproxyRequestParser(services, response)
+            self.assertTrue(request.parse(MockRequestHandler({"address": [address]})))
+            IOLoop.current().run_sync(lambda: resolver.resolve(request, response, Deadline(1.0)))
+            return request, response
+
+        resolve("350 5th Ave, New York")
+        services["a"].response = None
+        request, response = resolve("350 Fifth Avenue NY")
+        self.assertEqual(response.result["resolved_address"], "350 5th Ave")
+        self.assertEqual(response.result["match"], "fuzzy")
+        self.assertEqual((request.attempts, resolver.fuzzy_hits), (0, 1))
+        # other numbers are other places
+        request, response = resolve("350 6th Ave, New York")
+        self.assertEqual(response.status, "UNKNOWN_ERROR")
+        # the similar key's result was evicted, the key is dropped from the index
+        resolver.cache = ResultCache()
+        request, response = resolve("350 Fifth Avenue NY")
+        self.assertEqual(response.status, "UNKNOWN_ERROR")
+        self.assertEqual(len(resolver.fuzzy), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
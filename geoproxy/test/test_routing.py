@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from geoproxy.geometry import BoundingBox
+from geoproxy.geometry import Coordinate
+from geoproxy.routing import RegionRouter
+import unittest
+
+
+def bounds(bottom_left, top_right):
+    box = BoundingBox()
+    box.set_bl_tr(Coordinate(*bottom_left), Coordinate(*top_right))
+    return box
+
+
+class TestRegionRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = RegionRouter(precision=4, min_samples=5, explore_rate=0.0)
+        new_york = Coordinate(40.7484, -73.9856)
+        berlin = Coordinate(52.5163, 13.3777)
+        for _ in range(10):
+            # google answers in new york, here is faster and as good in berlin
+            self.router.record("google", new_york, True, 0.2)
+            self.router.record("here", new_york, False, 0.1)
+            self.router.record("google", berlin, True, 0.2)
+            self.router.record("here", berlin, True, 0.1)
+        self.new_york = bounds((40.70, -74.02), (40.80, -73.93))
+        self.berlin = bounds((52.50, 13.35), (52.53, 13.40))
+
+    def test_order(self):
+        self.assertEqual(self.router.order(self.new_york, ["here", "google"]),
+                         ["google", "here"])
+        self.assertEqual(self.router.order(self.berlin, ["google", "here"]), ["here", "google"])
+        # services without enough outcomes in the region follow in their original order
+        self.assertEqual(self.router.order(self.berlin, ["local", "google", "here"]),
+                         ["here", "google", "local"])
+        self.assertEqual(self.router.stats()["routed"], 3)
+
+    def test_explore(self):
+        router = RegionRouter(precision=4, min_samples=5, explore_rate=1.0)
+        router.regions = self.router.regions
+        # the demoted service is tried first, and its outcomes keep being recorded
+        self.assertEqual(router.order(self.new_york, ["google", "here"]), ["here", "google"])
+        self.assertEqual(router.stats()["explored"], 1)
+        for _ in range(60):
+            router.record("here", Coordinate(40.7484, -73.9856), True, 0.1)
+        router.explore_rate = 0.0
+        self.assertEqual(router.order(self.new_york, ["google", "here"]), ["here", "google"])
+
+    def test_coarser_region(self):
+        # no outcomes in the cell itself, the surrounding region is used
+        nearby = bounds((40.60, -73.80), (40.62, -73.78))
+        self.assertEqual(self.router.order(nearby, ["here", "google"]), ["google", "here"])
+        # nothing is known south of the equator
+        unknown = bounds((-33.9, 151.1), (-33.8, 151.2))
+        self.assertEqual(self.router.order(unknown, ["here", "google"]), ["here", "google"])
+        self.assertEqual(self.router.stats()["unrouted"], 1)
+
+    def test_max_regions(self):
+        router = RegionRouter(precision=4, max_regions=6)
+        router.record("google", Coordinate(40.7484, -73.9856), True, 0.1)
+        router.record("google", Coordinate(52.5163, 13.3777), True, 0.1)
+        # the least recently used cells are evicted, smallest first
+        self.assertEqual(len(router.regions), 6)
+        self.assertIn("u33d", router.regions)
+        self.assertNotIn("dr5r", router.regions)
+        self.assertIn("dr", router.regions)
+
+
+if __name__ == '__main__':
+    unittest.main()
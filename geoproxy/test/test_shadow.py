@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+from geoproxy.shadow import ShadowTraffic
+import unittest
+
+
+class TestShadowTraffic(unittest.TestCase):
+
+    def test_sample(self):
+        self.assertFalse(ShadowTraffic(0.0).sample())
+        shadow = ShadowTraffic(1.0)
+        self.assertTrue(shadow.sample())
+        self.assertEqual(shadow.sampled, 1)
+
+    def test_budget(self):
+        shadow = ShadowTraffic(1.0, concurrency=2)
+        self.assertTrue(shadow.try_acquire())
+        self.assertTrue(shadow.try_acquire())
+        # a full budget drops the query rather than queueing it
+        self.assertFalse(shadow.try_acquire())
+        shadow.release()
+        self.assertTrue(shadow.try_acquire())
+        self.assertEqual(shadow.stats()["dropped"], 1)
+        self.assertEqual(shadow.stats()["in_flight"], 2)
+
+    def test_record(self):
+        shadow = ShadowTraffic(1.0, radius=250.0)
+        shadow.record("here", 0.02, 0.05, (40.0, -73.0, "a"), 100.0)
+        shadow.record("here", 0.08, 0.05, (40.0, -73.0, "a"), 1000.0)
+        shadow.record("here", 0.01, 0.05, 0)
+        shadow.record("here", 3.0, 0.05, None)
+        stats = shadow.stats()["services"]["here"]
+        self.assertEqual(stats["requests"], 4)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(stats["zero_results"], 1)
+        # errors are never counted as faster
+        self.assertEqual(stats["faster"], 2)
+        self.assertEqual(stats["agreement"], 0.5)
+        self.assertEqual(stats["distance"]["max"], 1000.0)
+        self.assertAlmostEqual(stats["primary_latency"]["max"], 0.05)
+        self.assertAlmostEqual(stats["latency"]["max"], 3.0, delta=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
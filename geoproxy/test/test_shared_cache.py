@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+from geoproxy.shared_cache import _SEQUENCE
+from geoproxy.shared_cache import SharedResultCache
+import os
+import tempfile
+import time
+import unittest
+
+
+def result(index):
+    return {"source": "google", "lat": 40.0 + index, "lon": -73.0, "address": str(index)}
+
+
+class TestSharedResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "geoproxy.cache")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_put(self):
+        cache = SharedResultCache(self.path, slots=16)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", result(1))
+        cache.put("a", result(2))
+        self.assertEqual(cache.get("a"), result(2))
+        self.assertIn("a", cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+
+    def test_shared_between_instances(self):
+        cache = SharedResultCache(self.path, slots=16)
+        cache.put("a", result(1))
+        # a second mapping keeps the geometry the file was created with
+        other = SharedResultCache(self.path, slots=1024)
+        self.assertEqual(other.slots, 16)
+        self.assertEqual(other.get("a"), result(1))
+        other.put("b", result(2))
+        self.assertEqual(cache.get("b"), result(2))
+        cache.close()
+        other.close()
+
+    def test_shared_between_processes(self):
+        cache = SharedResultCache(self.path, slots=64)
+        pid = os.fork()
+        if pid == 0:
+            child = SharedResultCache(self.path)
+            for index in range(10):
+                child.put(str(index), result(index))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(cache.get("7"), result(7))
+        cache.close()
+
+    def test_concurrent_writer(self):
+        cache = SharedResultCache(self.path, slots=4)
+        cache.put("a", result(0))
+        pid = os.fork()
+        if pid == 0:
+            child = SharedResultCache(self.path)
+            give_up_time = time.monotonic() + 0.2
+            index = 0
+            while time.monotonic() < give_up_time:
+                index += 1
+                # values of different lengths, so a torn read would not decode
+                child.put("a", dict(result(index % 1000), address="x" * (index % 50)))
+            os._exit(0)
+        reads = 0
+        while os.waitpid(pid, os.WNOHANG) == (0, 0):
+            value = cache.get("a")
+            if value is not None:
+                self.assertEqual(value["source"], "google")
+                reads += 1
+        self.assertGreater(reads, 0)
+        cache.close()
+
+    def test_interrupted_writer(self):
+        cache = SharedResultCache(self.path, slots=4)
+        cache.put("a", result(1))
+        offset, _ = cache._find(b"a")
+        # a writer that died mid-write left the counter odd
+        _SEQUENCE.pack_into(cache._mmap, offset, 5)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", result(2))
+        self.assertEqual(_SEQUENCE.unpack_from(cache._mmap, offset)[0], 6)
+        self.assertEqual(cache.get("a"), result(2))
+        cache.close()
+
+    def test_eviction(self):
+        cache = SharedResultCache(self.path, slots=4)
+        # a single bucket of 4 slots
+        for index in range(4):
+            cache.put(str(index), result(index))
+            time.sleep(0.001)
+        cache.get("0")
+        cache.put("4", result(4))
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.evictions, 1)
+        # the least recently used entry was evicted, not the oldest
+        self.assertIsNone(cache.get("1"))
+        self.assertEqual(cache.get("0"), result(0))
+        cache.close()
+
+    def test_expiry(self):
+        cache = SharedResultCache(self.path, slots=4, ttl=0.01)
+        cache.put("a", result(1))
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_oversize(self):
+        cache = SharedResultCache(self.path, slots=4, slot_size=64)
+        cache.put("a", result(1))
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.oversize, 1)
+        cache.close()
+
+    def test_not_a_cache(self):
+        with open(self.path, "wb") as cache_file:
+            cache_file.write(b"x" * 128)
+        with self.assertRaises(ValueError):
+            SharedResultCache(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,14 +6,36 @@ from geoproxy.third_party_services.google_maps import GoogleMapsServiceHelper
 from geoproxy.third_party_services.google_maps import GoogleMapsServiceResponseParser
 from geoproxy.third_party_services.here import HereServiceHelper
 from geoproxy.third_party_services.here import HereServiceResponseParser
+from geoproxy.third_party_services.local import AddressIndex
+from geoproxy.third_party_services.local import LocalServiceHelper
+from geoproxy.third_party_services.local import LocalServiceResponseParser
+from geoproxy.third_party_services.local import build_address_index
 from geoproxy.third_party_services.service_base import ThirdPartyServiceHelper
 from geoproxy.third_party_services.service_base import ThirdPartyServiceResponseParser
+from geoproxy.third_party_services.service_base import decode_array_prefix
 from geoproxy.api import GeoproxyRequestParser
 import json
+import os
+import tempfile
 import unittest
 
 
 class TestThirdPartyServices(unittest.TestCase):
+    def test_decode_array_prefix(self):
+        body = ' { "a" : {"b": [1, 2]}, "c": [ {"d": [[0], {"e": [1, 2, 3]}]} ], "f": [}'
+        self.assertEqual(decode_array_prefix(body, ("c", 0, "d", 1, "e"), 2), [1, 2])
+        self.assertEqual(decode_array_prefix(body, ("c", 0, "d", 1, "e"), 5), [1, 2, 3])
+        self.assertEqual(decode_array_prefix(body, ("a", "b"), 1), [1])
+        self.assertIsNone(decode_array_prefix(body, ("c", 1), 1))
+        self.assertIsNone(decode_array_prefix(body, ("a",), 1))
+        self.assertEqual(decode_array_prefix('{"a": []}', ("a",), 1), [])
+        # the document is only decoded up to the last element
+        self.assertEqual(decode_array_prefix('{"a": [1, 2, oops', ("a",), 2), [1, 2])
+        with self.assertRaises(ValueError):
+            decode_array_prefix(body, ("f",), 1)
+        with self.assertRaises(ValueError):
+            decode_array_prefix(body, ("g",), 1)
+
     def test_service_helper(self):
         parser = ThirdPartyServiceResponseParser()
         a = ThirdPartyServiceHelper(parser)
@@ -24,6 +46,7 @@ class TestThirdPartyServices(unittest.TestCase):
         a = ThirdPartyServiceResponseParser()
         self.assertIsNotNone(a.logger)
         self.assertIsNone(a.address)
+        self.assertFalse(a.is_transient({}))
 
 
 class TestGoogleServices(unittest.TestCase):
@@ -44,6 +67,17 @@ class TestGoogleServices(unittest.TestCase):
             "&key=key&bounds=1.0,0.0|0.0,1.0"
         self.assertEqual(gmsh.query, string)
 
+    def test_google_maps_key_pool(self):
+        gmsh = GoogleMapsServiceHelper(["key1", "key2"], key_weights=[1, 1])
+        gmsh.build_query("query", None)
+        self.assertEqual(gmsh.key, "key1")
+        gmsh.build_query("query", None)
+        self.assertEqual(gmsh.key, "key2")
+        self.assertTrue(gmsh.query.endswith("&key=key2"))
+        self.assertEqual(gmsh.parser.key_error({"status": "OVER_QUERY_LIMIT"}), "rate_limited")
+        self.assertEqual(gmsh.parser.key_error({"status": "REQUEST_DENIED"}), "denied")
+        self.assertIsNone(gmsh.parser.key_error({"status": "OK"}))
+
     def test_google_maps_response_parser_valid(self):
         gmsrp = GoogleMapsServiceResponseParser()
         fake_response = {"status": "OK", "results": [
@@ -54,6 +88,19 @@ class TestGoogleServices(unittest.TestCase):
         self.assertEqual(out.latitude, 1.0)
         self.assertEqual(out.longitude, 2.0)
 
+    def test_google_maps_response_parser_decode(self):
+        gmsrp = GoogleMapsServiceResponseParser()
+        results = [{"formatted_address": str(index), "place_id": "id",
+                    "geometry": {"location": {"lat": index, "lng": 2.0}}}
+                   for index in range(3)]
+        body = json.dumps({"results": results, "status": "OK"}, indent=3)
+        self.assertEqual(gmsrp.decode(body), {"status": "OK", "results": results[:1]})
+        out = gmsrp.parse(gmsrp.decode(body, 5))
+        self.assertEqual(out.candidates, [(0.0, 2.0, "0"), (1.0, 2.0, "1"), (2.0, 2.0, "2")])
+        # the status of a response without results comes after them
+        body = json.dumps({"results": [], "status": "OVER_QUERY_LIMIT"})
+        self.assertEqual(gmsrp.decode(body)["status"], "OVER_QUERY_LIMIT")
+
     def test_google_maps_response_parser_no_results(self):
         gmsrp = GoogleMapsServiceResponseParser()
         fake_response = {"status": "ZERO_RESULTS", "results": []}
@@ -69,6 +116,12 @@ class TestGoogleServices(unittest.TestCase):
         out = gmsrp.parse(fake_response)
         self.assertIsNone(out)
 
+    def test_google_maps_response_parser_transient(self):
+        gmsrp = GoogleMapsServiceResponseParser()
+        self.assertTrue(gmsrp.is_transient({"status": "OVER_QUERY_LIMIT", "results": []}))
+        self.assertFalse(gmsrp.is_transient({"status": "REQUEST_DENIED", "results": []}))
+        self.assertIsNone(gmsrp.parse({"status": "OVER_QUERY_LIMIT", "results": []}))
+
 
 class TestHereServices(unittest.TestCase):
     def test_here_service_helper(self):
@@ -77,17 +130,18 @@ class TestHereServices(unittest.TestCase):
         self.assertEqual(type(hsh.parser), HereServiceResponseParser)
         hsh.build_query("query", None)
         string = "https://geocoder.cit.api.here.com/6.2/geocode.json?app_id=appid" \
-            "&app_code=appcode&searchtext=query"
+            "&app_code=appcode&searchtext=query&maxresults=1&responseattributes=none" \
+            "&locationattributes=-mapView,-mapReference,-additionalData,-addressDetails" \
+            "&addressattributes=-additionalData"
         self.assertEqual(hsh.query, string)
         bb = BoundingBox()
         coord1 = Coordinate("0.0", "0.0")
         coord2 = Coordinate("1.0", "1.0")
         bb = BoundingBox()
         bb.set_tl_br(coord1, coord2)
-        hsh.build_query("two+words", bb)
-        string = "https://geocoder.cit.api.here.com/6.2/geocode.json?app_id=appid" \
-            "&app_code=appcode&searchtext=two+words&bbox=0.0,0.0;1.0,1.0"
-        self.assertEqual(hsh.query, string)
+        hsh.build_query("two+words", bb, limit=5)
+        self.assertIn("&searchtext=two+words&maxresults=5&", hsh.query)
+        self.assertTrue(hsh.query.endswith("&bbox=0.0,0.0;1.0,1.0"))
 
     def test_here_response_parser_valid(self):
         hsrp = HereServiceResponseParser()
@@ -99,6 +153,24 @@ class TestHereServices(unittest.TestCase):
         self.assertEqual(out.latitude, 1.0)
         self.assertEqual(out.longitude, 2.0)
 
+    def test_here_response_parser_decode(self):
+        hsrp = HereServiceResponseParser()
+        results = [{"Relevance": 1.0, "Location": {"Address": {"Label": str(index)},
+                    "DisplayPosition": {"Latitude": index, "Longitude": 2.0}}}
+                   for index in range(3)]
+        body = json.dumps({"Response": {"MetaInfo": {"Timestamp": "2020-01-01T00:00:00"},
+                                        "View": [{"ViewId": 0, "Result": results}]}})
+        response = hsrp.decode(body, 2)
+        self.assertEqual(response["Response"]["View"][0]["Result"], results[:2])
+        out = hsrp.parse(response)
+        self.assertEqual(out.candidates, [(0, 2.0, "0"), (1, 2.0, "1")])
+        self.assertEqual((out.latitude, out.address), (0, "0"))
+        # responses without results are decoded in full
+        body = json.dumps({"Response": {"MetaInfo": {}, "View": []}})
+        self.assertEqual(hsrp.decode(body), json.loads(body))
+        with self.assertRaises(ValueError):
+            hsrp.decode('{"Response": {"View": [')
+
     def test_here_response_parser_no_results(self):
         hsrp = HereServiceResponseParser()
         fake_response = {"Response": {"View": []}}
@@ -114,6 +186,107 @@ class TestHereServices(unittest.TestCase):
         out = hsrp.parse(fake_response)
         self.assertIsNone(out)
 
+    def test_here_batch_job(self):
+        hsh = HereServiceHelper("id", "code", batch_url="http://stub/6.2/jobs")
+        self.assertTrue(hsh.supports_batch)
+        url, body = hsh.build_batch_job(["350+5th+Ave", "1|2 Main St"])
+        self.assertTrue(url.startswith("http://stub/6.2/jobs?app_id=id&app_code=code&action=run"))
+        self.assertEqual(body, b"recId|searchText\n0|350 5th Ave\n1|1 2 Main St")
+        self.assertEqual(hsh.build_batch_status_query("J1"),
+                         "http://stub/6.2/jobs/J1?app_id=id&app_code=code&action=status")
+        status = '<ns2:SearchBatch xmlns:ns2="http://www.navteq.com/lbsp/Search-Batch/1">' \
+            '<Response><MetaInfo><RequestId>J1</RequestId></MetaInfo>' \
+            '<Status>accepted</Status></Response></ns2:SearchBatch>'
+        self.assertEqual(hsh.parse_batch_status(status), ("J1", "accepted"))
+        self.assertEqual(hsh.parse_batch_status("not xml"), (None, None))
+
+    def test_here_key_pool(self):
+        hsh = HereServiceHelper(["id1", "id2"], ["code1", "code2"])
+        hsh.build_query("query", None)
+        self.assertEqual(hsh.key, ("id1", "code1"))
+        hsh.build_query("query", None)
+        self.assertIn("app_id=id2&app_code=code2", hsh.query)
+        # batch jobs are queried with the app that ran them
+        self.assertIn("app_id=id2&app_code=code2",
+                      hsh.build_batch_result_query("J1", ("id2", "code2")))
+        with self.assertRaises(ValueError):
+            HereServiceHelper(["id1", "id2"], ["code1"])
+
+    def test_here_batch_result(self):
+        hsh = HereServiceHelper("id", "code")
+        result = "recId|SeqNumber|seqLength|displayLatitude|displayLongitude|locationLabel\n" \
+            "0|1|2|40.7484|-73.9856|350 5th Ave\n" \
+            "0|2|2|40.0|-73.0|Other\n" \
+            "1|1|0|||\n"
+        responses = hsh.parse_batch_result(result, 3)
+        self.assertEqual(len(responses), 3)
+        out = hsh.parser.parse(responses[0])
+        self.assertEqual(out.address, "350 5th Ave")
+        self.assertEqual(out.latitude, 40.7484)
+        # unmatched records have zero results, missing records are errors
+        self.assertEqual(hsh.parser.parse(responses[1]), 0)
+        self.assertIsNone(responses[2])
+        self.assertEqual(hsh.parse_batch_result("", 2), [None, None])
+        self.assertIsNone(hsh.parse_batch_result("recId|searchText\n", 1))
+
+
+class TestLocalServices(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        csv_path = os.path.join(self.tmp_dir.name, "addresses.csv")
+        with open(csv_path, "w") as csv_file:
+            csv_file.write("LON,LAT,NUMBER,STREET,UNIT,CITY,DISTRICT,REGION,POSTCODE,ID,HASH\n")
+            csv_file.write("-73.9856,40.7484,350,5th Ave,,New York,,NY,10118,,\n")
+            csv_file.write("-122.0840,37.4220,1600,Amphitheatre Pkwy,,Mountain View,,CA,,,\n")
+            csv_file.write("bad,row,1,Nowhere St,,,,,,,\n")
+            # the same street address in two cities, and a duplicate row
+            csv_file.write("-89.6501,39.7817,100,Main St,,Springfield,,IL,,,\n")
+            csv_file.write("-72.5898,42.1015,100,Main St,,Springfield,,MA,,,\n")
+            csv_file.write("-73.9856,40.7484,350,5th Ave,,New York,,NY,,,\n")
+        self.index_path = os.path.join(self.tmp_dir.name, "addresses.idx")
+        self.count = build_address_index(csv_path, self.index_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_address_index(self):
+        # 4 keys for the first row (no postcode on the second, so 3 keys), bad row skipped,
+        # only the keys with the region for the Springfields, the others are ambiguous
+        self.assertEqual(self.count, 9)
+        index = AddressIndex(self.index_path)
+        self.assertEqual(len(index), 9)
+        lat, lon, label = index.lookup("350 5th Ave, New York")
+        self.assertEqual(lat, 40.7484)
+        self.assertEqual(lon, -73.9856)
+        self.assertEqual(label, "350 5th Ave, New York, NY 10118")
+        self.assertIsNotNone(index.lookup("350+5th+ave+new+york+ny+10118"))
+        self.assertIsNotNone(index.lookup("1600 Amphitheatre Pkwy"))
+        self.assertIsNone(index.lookup("351 5th Ave"))
+        self.assertIsNone(index.lookup("100 Main St"))
+        self.assertIsNone(index.lookup("100 Main St, Springfield"))
+        self.assertEqual(index.lookup("100 Main St, Springfield, IL")[2],
+                         "100 Main St, Springfield, IL")
+        index.close()
+
+    def test_invalid_index(self):
+        with open(self.index_path, "r+b") as index_file:
+            index_file.write(b"NOTANIDX")
+        with self.assertRaises(ValueError):
+            AddressIndex(self.index_path)
+
+    def test_local_service_helper(self):
+        lsh = LocalServiceHelper(self.index_path)
+        self.assertFalse(lsh.is_remote)
+        self.assertEqual(type(lsh.parser), LocalServiceResponseParser)
+        lsh.build_query("350+5th+Ave", None)
+        out = lsh.parser.parse(lsh.lookup(lsh.query))
+        self.assertIsNotNone(out)
+        self.assertEqual(out.latitude, 40.7484)
+        self.assertEqual(out.address, "350 5th Ave, New York, NY 10118")
+        # a miss is not zero results, the index only covers some addresses
+        lsh.build_query("Nowhere", None)
+        self.assertIsNone(lsh.lookup(lsh.query))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
+import json
+
+from geoproxy.third_party_services.key_pool import DENIED
+from geoproxy.third_party_services.key_pool import KeyPool
+from geoproxy.third_party_services.key_pool import RATE_LIMITED
 from geoproxy.third_party_services.service_base import ThirdPartyServiceHelper
 from geoproxy.third_party_services.service_base import ThirdPartyServiceResponseParser
+from geoproxy.third_party_services.service_base import decode_array_prefix
 
 """Collection of classes that are associated with the Google Maps Geocoding API
 
@@ -13,17 +19,27 @@ Link: https://developers.google.com/maps/documentation/geocoding/intro
 class GoogleMapsServiceHelper(ThirdPartyServiceHelper):
     """Container for google maps query and parser
     """
-    def __init__(self, google_maps_api_key):
+    BASE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+    def __init__(self, google_maps_api_key, base_url=None, key_weights=None, key_cooldown=1.0):
         """Constructor
 
         Args:
-            google_maps_api_key (string): API key for Google Maps API
+            google_maps_api_key (string/[string]): API key for Google Maps API, or a list of
+                                                   keys to rotate between
+            base_url (string): Geocoding endpoint, overridden to point at a stub for testing
+            key_weights ([float]): Relative share of the queries sent with each key (see
+                                   KeyPool), equal shares if None
+            key_cooldown (float): Seconds a key is out of rotation after it is rate limited
 
         """
         super(GoogleMapsServiceHelper, self).__init__(GoogleMapsServiceResponseParser())
-        self.google_maps_api_key = google_maps_api_key
+        keys = google_maps_api_key if isinstance(google_maps_api_key, (list, tuple)) \
+            else [google_maps_api_key]
+        self.key_pool = KeyPool(keys, key_weights, cooldown=key_cooldown)
+        self.base_url = base_url or self.BASE_URL
 
-    def build_query(self, address, bounds=None):
+    def build_query(self, address, bounds=None, limit=1):
         """Generates Google Maps API query string
 
         Sets the base class's query member on success.
@@ -31,11 +47,13 @@ class GoogleMapsServiceHelper(ThirdPartyServiceHelper):
         Args:
             address (string): Valid address to search for
             bounds (BoundingBox): Bounding box parameter to include (if used)
+            limit (int): Unused, the geocoder has no parameter limiting the number of results
+                         or their fields, so only the decoding of the response is limited
 
         """
         # TODO(pickledgator): Consider bubbling up exceptions here
-        self.query = "https://maps.googleapis.com/maps/api/geocode/json?address={}&key={}".format(
-            address, self.google_maps_api_key)
+        self.key = self.key_pool.acquire()
+        self.query = "{}?address={}&key={}".format(self.base_url, address, self.key)
         if bounds:
             # southwest, northeast
             self.query += "&bounds={},{}|{},{}".format(bounds.bottom_left.latitude,
@@ -47,15 +65,75 @@ class GoogleMapsServiceHelper(ThirdPartyServiceHelper):
 class GoogleMapsServiceResponseParser(ThirdPartyServiceResponseParser):
     """Parser specific to Google Maps Geocoder API responses
     """
+    # status codes that google documents as safe to retry
+    TRANSIENT_STATUSES = ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR")
+    # status codes caused by the API key, and whether the key is rate limited or not authorized
+    KEY_ERRORS = {"OVER_QUERY_LIMIT": RATE_LIMITED, "OVER_DAILY_LIMIT": DENIED,
+                  "REQUEST_DENIED": DENIED}
+
     def __init__(self):
         super(GoogleMapsServiceResponseParser, self).__init__()
 
+    def is_transient(self, response):
+        """Checks if the Google Maps Geocoder API response is a retryable error
+
+        Args:
+            response (dict): JSON response as dict
+
+        Returns:
+            bool: If the request should be retried
+
+        """
+        return response.get('status') in self.TRANSIENT_STATUSES
+
+    def key_error(self, response):
+        """Checks if the Google Maps Geocoder API response reports a problem with the API key
+
+        OVER_DAILY_LIMIT is reported for keys without billing or with an exhausted daily quota,
+        neither of which clears up within a few seconds, so it is handled like REQUEST_DENIED.
+
+        Args:
+            response (dict): JSON response as dict
+
+        Returns:
+            None/string: RATE_LIMITED or DENIED, None if the key was accepted
+
+        """
+        return self.KEY_ERRORS.get(response.get('status'))
+
+    def decode(self, body, limit=1):
+        """Decodes the status and the first results of a Google Maps Geocoder API response
+
+        Results are only returned along with the OK status, so a response with results is
+        decoded up to its first limit results only (the status comes after them). Responses
+        without results are small, and are decoded in full.
+
+        Args:
+            body (string): JSON response body
+            limit (int): Number of results that will be parsed
+
+        Returns:
+            dict: JSON response as dict, with at most limit results
+
+        Raises:
+            ValueError: If the body is not valid JSON
+
+        """
+        try:
+            results = decode_array_prefix(body, ("results",), limit)
+        except ValueError:
+            results = None
+        if results:
+            return {"status": "OK", "results": results}
+        return json.loads(body)
+
     def parse(self, response):
         """Parse method used to extract data from Google Maps Geocoder API response
 
-        NOTE: If more than one result is provided in the response, we are only parsing the
-        first result in that list. We are making an assumption that the third party geocoder
-        is ordering the results list by the highest likelihood.
+        NOTE: If more than one result is provided in the response, the first result in that
+        list populates the address and location, all of them populate the candidates. We are
+        making an assumption that the third party geocoder is ordering the results list by the
+        highest likelihood.
 
         Args:
             response (dict): JSON response as dict
@@ -75,16 +153,19 @@ class GoogleMapsServiceResponseParser(ThirdPartyServiceResponseParser):
                     self.logger.warning("Service returned zero results")
                     # TODO(pickledgator): This is fragile
                     return 0
-                self.logger.info("Service returned {} results for query".format(len(results)))
-                # process the first result, which is the highest match likelihood
-                self.address = results[0].get('formatted_address')
-                location = results[0].get('geometry').get('location')
-                self.latitude = float(location.get('lat'))
-                self.longitude = float(location.get('lng'))
+                self.logger.debug("Service returned %d results for query", len(results))
+                self.candidates = []
+                for result in results:
+                    location = result.get('geometry').get('location')
+                    self.candidates.append((float(location.get('lat')),
+                                            float(location.get('lng')),
+                                            result.get('formatted_address')))
+                # the first result is the highest match likelihood
+                self.latitude, self.longitude, self.address = self.candidates[0]
                 # TODO(pickledgator): This is fragile
                 return self
             except Exception as e:
-                self.logger.error("Error parsing response: {}".format(e))
+                self.logger.error("Error parsing response: %s", e)
         # catch empty results list
         elif response.get('status') == "ZERO_RESULTS":
             self.logger.warning("Service returned zero results")
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 
+import json
+import xml.etree.ElementTree as ElementTree
+
+from geoproxy.third_party_services.key_pool import KeyPool
 from geoproxy.third_party_services.service_base import ThirdPartyServiceHelper
 from geoproxy.third_party_services.service_base import ThirdPartyServiceResponseParser
+from geoproxy.third_party_services.service_base import decode_array_prefix
 
 """Collection of classes that are associated with the Here Geocoding API
 
 Link: https://developer.here.com/documentation/geocoder/topics/what-is.html
+Batch: https://developer.here.com/documentation/batch-geocoder/topics/introduction.html
 
 """
 
@@ -13,33 +19,72 @@ Link: https://developer.here.com/documentation/geocoder/topics/what-is.html
 class HereServiceHelper(ThirdPartyServiceHelper):
     """Container for Here query and parser
     """
-    def __init__(self, here_api_app_id, here_api_app_code):
+    BASE_URL = "https://geocoder.cit.api.here.com/6.2/geocode.json"
+    BATCH_URL = "https://batch.geocoder.cit.api.here.com/6.2/jobs"
+    # output columns requested from the batch geocoder
+    BATCH_COLUMNS = ("displayLatitude", "displayLongitude", "locationLabel")
+    # response, location and address attributes left out of responses, as they are not parsed
+    # (the match quality, parsed request, map view and address components)
+    RESPONSE_ATTRIBUTES = "none"
+    LOCATION_ATTRIBUTES = "-mapView,-mapReference,-additionalData,-addressDetails"
+    ADDRESS_ATTRIBUTES = "-additionalData"
+    # batch job states after which the job will not complete
+    BATCH_FAILED = ("cancelled", "failed", "deleted")
+    supports_batch = True
+
+    def __init__(self, here_api_app_id, here_api_app_code, base_url=None, batch_url=None,
+                 key_weights=None, key_cooldown=1.0):
         """Constructor
 
         Args:
-            here_api_app_id (string): API app id for Here
-            here_api_app_code (string): API app code for Here
+            here_api_app_id (string/[string]): API app id for Here, or a list of app ids to
+                                               rotate between
+            here_api_app_code (string/[string]): API app code for Here, or a list with the
+                                                 app code of each app id
+            base_url (string): Geocoding endpoint, overridden to point at a stub for testing
+            batch_url (string): Batch geocoding jobs endpoint, overridden to point at a stub
+                                for testing
+            key_weights ([float]): Relative share of the queries sent with each app (see
+                                   KeyPool), equal shares if None
+            key_cooldown (float): Seconds an app is out of rotation after it is rate limited
+
+        Raises:
+            ValueError: If the number of app ids and app codes differ
 
         """
         super(HereServiceHelper, self).__init__(HereServiceResponseParser())
-        self.here_api_app_id = here_api_app_id
-        self.here_api_app_code = here_api_app_code
+        app_ids = here_api_app_id if isinstance(here_api_app_id, (list, tuple)) \
+            else [here_api_app_id]
+        app_codes = here_api_app_code if isinstance(here_api_app_code, (list, tuple)) \
+            else [here_api_app_code]
+        if len(app_ids) != len(app_codes):
+            raise ValueError("Each Here app id needs an app code")
+        # the credentials of each app are a pair of (app id, app code)
+        self.key_pool = KeyPool(zip(app_ids, app_codes), key_weights, cooldown=key_cooldown)
+        self.base_url = base_url or self.BASE_URL
+        self.batch_url = batch_url or self.BATCH_URL
 
-    def build_query(self, address, bounds=None):
+    def build_query(self, address, bounds=None, limit=1):
         """Generates Here API query string
 
-        Sets the base class's query member on success.
+        Sets the base class's query member on success. The query asks for no more than limit
+        results, and for none of the attributes that the parser does not read.
 
         Args:
             address (string): Valid address to search for
             bounds (BoundingBox): Bounding box parameter to include (if used)
+            limit (int): Maximum number of results to return
 
         """
         # TODO(pickledgator): Consider bubbling up exceptions here
-        self.query = "https://geocoder.cit.api.here.com/6.2/geocode.json?app_id={}" \
-            "&app_code={}&searchtext={}".format(self.here_api_app_id,
-                                                self.here_api_app_code,
-                                                address)
+        self.key = self.key_pool.acquire()
+        self.query = "{}?app_id={}&app_code={}&searchtext={}".format(self.base_url,
+                                                                     self.key[0], self.key[1],
+                                                                     address)
+        self.query += "&maxresults={}&responseattributes={}&locationattributes={}" \
+                      "&addressattributes={}".format(limit, self.RESPONSE_ATTRIBUTES,
+                                                     self.LOCATION_ATTRIBUTES,
+                                                     self.ADDRESS_ATTRIBUTES)
         if bounds:
             # northwest, southeast
             self.query += "&bbox={},{};{},{}".format(bounds.top_left.latitude,
@@ -47,19 +92,179 @@ class HereServiceHelper(ThirdPartyServiceHelper):
                                                      bounds.bottom_right.latitude,
                                                      bounds.bottom_right.longitude)
 
+    def build_batch_job(self, addresses, key=None):
+        """Generates the request that starts a Here batch geocoding job
+
+        Each address becomes one record of the job's input, identified by its index.
+
+        Args:
+            addresses ([string]): Addresses to search for, as passed to build_query
+            key (tuple): Credentials to run the job with, the first in the key pool if None
+                         (the status and result of the job must be queried with the same)
+
+        Returns:
+            tuple: URL and body of the POST request
+
+        """
+        app_id, app_code = key or self.key_pool.entries[0].key
+        url = "{}?app_id={}&app_code={}&action=run&header=true&inDelim=%7C&outDelim=%7C" \
+              "&outCols={}&outputcombined=true".format(self.batch_url, app_id, app_code,
+                                                       ",".join(self.BATCH_COLUMNS))
+        lines = ["recId|searchText"]
+        for record_id, address in enumerate(addresses):
+            # addresses arrive in query string form, and must not break the record format
+            search_text = address.replace("+", " ").replace("|", " ").replace("\n", " ")
+            lines.append("{}|{}".format(record_id, search_text))
+        return url, "\n".join(lines).encode("utf-8")
+
+    def build_batch_status_query(self, job_id, key=None):
+        """Generates the query for the status of a batch job
+
+        Args:
+            job_id (string): Request id of the job
+            key (tuple): Credentials the job was run with, the first in the key pool if None
+
+        Returns:
+            string: Status query URL
+
+        """
+        app_id, app_code = key or self.key_pool.entries[0].key
+        return "{}/{}?app_id={}&app_code={}&action=status".format(
+            self.batch_url, job_id, app_id, app_code)
+
+    def build_batch_result_query(self, job_id, key=None):
+        """Generates the query for the (uncompressed) result file of a completed batch job
+
+        Args:
+            job_id (string): Request id of the job
+            key (tuple): Credentials the job was run with, the first in the key pool if None
+
+        Returns:
+            string: Result query URL
+
+        """
+        app_id, app_code = key or self.key_pool.entries[0].key
+        return "{}/{}/result?app_id={}&app_code={}&outputcompressed=false".format(
+            self.batch_url, job_id, app_id, app_code)
+
+    def parse_batch_status(self, response):
+        """Extracts the job id and status from a batch job response
+
+        Args:
+            response (string): XML response to a job submission or status query
+
+        Returns:
+            tuple: Request id and status of the job (eg "accepted", "running", "completed"),
+                   both None if the response cannot be parsed
+
+        """
+        try:
+            root = ElementTree.fromstring(response)
+        except ElementTree.ParseError:
+            return None, None
+        fields = {}
+        for element in root.iter():
+            # the root element is namespaced, the fields are not
+            tag = element.tag.rsplit("}", 1)[-1]
+            if tag in ("RequestId", "Status") and tag not in fields:
+                fields[tag] = (element.text or "").strip()
+        return fields.get("RequestId"), fields.get("Status")
+
+    def parse_batch_result(self, response, count):
+        """Splits the result file of a batch job into one geocoder response per record
+
+        The responses have the layout of the single query geocoder, so they can be parsed
+        by HereServiceResponseParser. Records listed without a match become responses with
+        zero results, and records missing from the file (eg a truncated file) become None, an
+        error, so that they fall back to the next service.
+
+        Args:
+            response (string): Result file, one "|" delimited line per match with a header
+            count (int): Number of records in the job
+
+        Returns:
+            [dict]: Geocoder response for each record, in record order, None for the records
+                    missing from the file
+
+        """
+        views = [None] * count
+        lines = response.splitlines()
+        if not lines:
+            return views
+        columns = lines[0].split("|")
+        try:
+            record_id_index = columns.index("recId")
+            latitude_index, longitude_index, label_index = (columns.index(column)
+                                                            for column in self.BATCH_COLUMNS)
+        except ValueError:
+            self.parser.logger.error("Batch result is missing columns: %s", lines[0])
+            return None
+        for line in lines[1:]:
+            values = line.split("|")
+            try:
+                record_id = int(values[record_id_index])
+            except (IndexError, ValueError):
+                continue
+            if not 0 <= record_id < count:
+                continue
+            if views[record_id] is None:
+                views[record_id] = []
+            try:
+                latitude = float(values[latitude_index])
+                longitude = float(values[longitude_index])
+            except (IndexError, ValueError):
+                # unmatched records have empty coordinates
+                continue
+            # records may have several matches, the first is the most relevant
+            if not views[record_id]:
+                views[record_id].append({"Result": [{"Location": {
+                    "DisplayPosition": {"Latitude": latitude, "Longitude": longitude},
+                    "Address": {"Label": values[label_index]}}}]})
+        return [{"Response": {"View": view}} if view is not None else None for view in views]
+
 
 class HereServiceResponseParser(ThirdPartyServiceResponseParser):
     """Parser specific to Here Geocoder API responses
     """
+    # position of the results in a response
+    RESULTS_PATH = ("Response", "View", 0, "Result")
+
     def __init__(self):
         super(HereServiceResponseParser, self).__init__()
 
+    def decode(self, body, limit=1):
+        """Decodes the first results of a Here Geocoder API response
+
+        Only the response's meta information and its first limit results are decoded, the
+        other results are not read. Responses without results are small, and are decoded in
+        full.
+
+        Args:
+            body (string): JSON response body
+            limit (int): Number of results that will be parsed
+
+        Returns:
+            dict: JSON response as dict, with at most limit results
+
+        Raises:
+            ValueError: If the body is not valid JSON
+
+        """
+        try:
+            results = decode_array_prefix(body, self.RESULTS_PATH, limit)
+        except ValueError:
+            results = None
+        if results:
+            return {"Response": {"View": [{"Result": results}]}}
+        return json.loads(body)
+
     def parse(self, response):
         """Parse method used to extract data from Here Geocoder API response
 
-        NOTE: If more than one result is provided in the response, we are only parsing the
-        first result in that list. We are making an assumption that the third party geocoder
-        is ordering the results list by the highest likelihood.
+        NOTE: If more than one result is provided in the response, the first result in that
+        list populates the address and location, all of them populate the candidates. We are
+        making an assumption that the third party geocoder is ordering the results list by the
+        highest likelihood.
 
         Args:
             response (dict): JSON response as dict
@@ -80,15 +285,18 @@ class HereServiceResponseParser(ThirdPartyServiceResponseParser):
                     # TODO(pickledgator): This is fragile
                     return 0
                 results = view[0].get('Result')
-                self.logger.info("Service returned {} results for query".format(len(results)))
-                # process the first result, which is the highest match likelihood
-                location = results[0].get('Location')
-                # Note: this field could have non-latin characters, we'll just pass them through
-                # and let the upstream process handle encoding/decoding
-                self.address = location.get("Address").get("Label")
-                self.latitude = location.get("DisplayPosition").get('Latitude')
-                self.longitude = location.get("DisplayPosition").get('Longitude')
+                self.logger.debug("Service returned %d results for query", len(results))
+                self.candidates = []
+                for result in results:
+                    location = result.get('Location')
+                    # Note: this field could have non-latin characters, we'll just pass them
+                    # through and let the upstream process handle encoding/decoding
+                    self.candidates.append((location.get("DisplayPosition").get('Latitude'),
+                                            location.get("DisplayPosition").get('Longitude'),
+                                            location.get("Address").get("Label")))
+                # the first result is the highest match likelihood
+                self.latitude, self.longitude, self.address = self.candidates[0]
                 return self
             except Exception as e:
-                self.logger.error("Error parsing response: {}".format(e))
+                self.logger.error("Error parsing response: %s", e)
         return None
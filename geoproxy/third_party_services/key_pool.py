@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+"""Pool of API credentials for a third party service
+
+A single API key caps a service's throughput at that key's quota and QPS limit. A KeyPool
+spreads a service's queries across several keys, in proportion to their weights (eg their
+quotas), and takes a key out of rotation when the service reports that it is rate limited or
+not authorized, until a cooldown has passed.
+
+"""
+
+# reasons for taking a key out of rotation
+RATE_LIMITED = "rate_limited"
+DENIED = "denied"
+
+
+class PooledKey:
+    """Usage and state of a key in a pool
+
+    Attributes:
+        key (string/tuple): Credentials, as used by the service helper
+        weight (float): Share of the queries sent with the key, relative to the other keys
+        current (float): Running credit of the weighted round robin
+        requests (int): Number of queries sent with the key
+        rate_limited (int): Number of rate limiting errors reported for the key
+        denied (int): Number of authorization errors reported for the key
+        strikes (int): Number of consecutive cooldowns for rate limiting
+        disabled_until (float): Monotonic time at which the key is back in rotation
+
+    """
+
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+        self.current = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+        self.denied = 0
+        self.strikes = 0
+        self.disabled_until = 0.0
+
+
+class KeyPool:
+    """Weighted rotation of the API keys of a service
+
+    Keys are handed out by smooth weighted round robin, so each key gets a share of the queries
+    proportional to its weight, evenly interleaved. With equal weights, this is least recently
+    used order. A key reported as rate limited is out of rotation for the cooldown, doubled for
+    each consecutive rate limiting error up to max_cooldown; a key reported as not authorized
+    is out of rotation for denied_cooldown. When every key is out of rotation, the key that
+    comes back first is used, so that queries still reach the service.
+
+    Keys are handed out on the IOLoop thread and on the services' bulkheads, so the pool is
+    locked.
+
+    Attributes:
+        cooldown (float): Seconds a key is out of rotation after its first rate limiting error
+        max_cooldown (float): Longest cooldown for rate limiting in seconds
+        denied_cooldown (float): Seconds a key is out of rotation after an authorization error
+        entries ([PooledKey]): Keys of the pool, in the order they were given
+
+    """
+
+    def __init__(self, keys, weights=None, cooldown=1.0, max_cooldown=3600.0,
+                 denied_cooldown=3600.0):
+        """Constructor for the pool
+
+        Args:
+            keys ([string/tuple]): Credentials of the service, at least one
+            weights ([float]): Relative share of the queries sent with each key, eg its quota,
+                               equal shares if None
+            cooldown (float): Seconds a key is out of rotation after its first rate limiting
+                              error
+            max_cooldown (float): Longest cooldown for rate limiting in seconds
+            denied_cooldown (float): Seconds a key is out of rotation after an authorization
+                                     error
+
+        Raises:
+            ValueError: If there are no keys, duplicate keys, or a weight for each key is not
+                        a positive number
+
+        """
+        keys = list(keys)
+        weights = list(weights) if weights is not None else [1.0] * len(keys)
+        if not keys:
+            raise ValueError("A key pool needs at least one key")
+        if len(weights) != len(keys) or any(weight <= 0 for weight in weights):
+            raise ValueError("Each key needs a positive weight")
+        self.entries = [PooledKey(key, float(weight)) for key, weight in zip(keys, weights)]
+        self._entries = {entry.key: entry for entry in self.entries}
+        if len(self._entries) != len(self.entries):
+            raise ValueError("Keys in a pool must be unique")
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.denied_cooldown = denied_cooldown
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger("KeyPool")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def acquire(self):
+        """Picks the key to send the next query with
+
+        Returns:
+            string/tuple: Credentials to use
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            chosen = None
+            total = 0.0
+            for entry in self.entries:
+                if entry.disabled_until > now:
+                    continue
+                entry.current += entry.weight
+                total += entry.weight
+                if chosen is None or entry.current > chosen.current:
+                    chosen = entry
+            if chosen is None:
+                # every key is out of rotation, use the one that comes back first
+                chosen = min(self.entries, key=lambda entry: entry.disabled_until)
+            else:
+                chosen.current -= total
+            chosen.requests += 1
+            return chosen.key
+
+    def report(self, key, error=None):
+        """Reports the outcome of a query sent with a key
+
+        Args:
+            key (string/tuple): Credentials the query was sent with
+            error (string): RATE_LIMITED or DENIED to take the key out of rotation, None if
+                            the service accepted the key
+
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if error is None:
+                if entry.disabled_until <= now:
+                    entry.strikes = 0
+                return
+            if error == DENIED:
+                entry.denied += 1
+                delay = self.denied_cooldown
+            else:
+                entry.rate_limited += 1
+                if entry.disabled_until > now:
+                    # queries in flight when the key was taken out of rotation
+                    return
+                delay = min(self.max_cooldown, self.cooldown * 2 ** entry.strikes)
+                entry.strikes += 1
+            entry.disabled_until = max(entry.disabled_until, now + delay)
+            # the key rejoins the rotation without the credit it built up
+            entry.current = 0.0
+        self.logger.warning("Key %s is out of rotation for %.1fs (%s)", mask_key(key), delay,
+                            error)
+
+    def stats(self):
+        """Usage of each key, without the credentials themselves
+
+        Returns:
+            [dict]: For each key, its masked credentials, weight, number of queries and errors,
+                    and the seconds until it is back in rotation (0 if it is in rotation)
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [{"key": mask_key(entry.key), "weight": entry.weight,
+                     "requests": entry.requests, "rate_limited": entry.rate_limited,
+                     "denied": entry.denied,
+                     "cooldown": round(max(0.0, entry.disabled_until - now), 1)}
+                    for entry in self.entries]
+
+
+def mask_key(key):
+    """Hides all but the end of a key, so that it can be logged and reported
+
+    Args:
+        key (string/tuple): Credentials, the first element of a tuple identifies them
+
+    Returns:
+        string: Last 4 characters of the key, prefixed with "..."
+
+    """
+    if isinstance(key, tuple):
+        key = key[0]
+    text = str(key)
+    return "..." + text[-4:] if len(text) > 8 else "..."
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+import csv
+import hashlib
+import mmap
+import struct
+
+from geoproxy.address import normalize_address
+from geoproxy.geometry import Coordinate
+from geoproxy.geometry import haversine_distance
+from geoproxy.third_party_services.service_base import ThirdPartyServiceHelper
+from geoproxy.third_party_services.service_base import ThirdPartyServiceResponseParser
+
+"""Collection of classes that are associated with the local, offline address index
+
+The index is built ahead of time from an OpenAddresses-style CSV (see build_address_index) and
+memory mapped at startup, so loading it costs nothing regardless of its size, and lookups are
+a binary search over a sorted hash table that only touches a handful of pages.
+
+Index file layout (all integers are little endian):
+    header:  magic (8 bytes), entry count (uint64), records offset (uint64)
+    table:   entry count x (key hash (uint64), record offset (uint64)), sorted by key hash
+    records: key length (uint16), label length (uint16), latitude (float64),
+             longitude (float64), key (utf-8), label (utf-8)
+
+"""
+
+INDEX_MAGIC = b"GPXADDR1"
+_HEADER = struct.Struct("<8sQQ")
+_ENTRY = struct.Struct("<QQ")
+_RECORD = struct.Struct("<HHdd")
+
+# meters between two rows of the same key beyond which they are different places
+SAME_PLACE_DISTANCE = 1000.0
+
+
+def address_hash(key):
+    """Stable 64 bit hash of a normalized address key
+
+    Python's built-in hash() is randomized per process, so a fixed digest is used instead to
+    keep the on-disk table valid across processes.
+
+    Args:
+        key (bytes): UTF-8 encoded normalized address
+
+    Returns:
+        int: 64 bit hash of the key
+
+    """
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def build_address_index(csv_path, index_path):
+    """Builds an address index file from an OpenAddresses-style CSV
+
+    The CSV must have a header row containing at least the LON, LAT, NUMBER and STREET columns,
+    and may contain CITY, REGION and POSTCODE columns (column names are case insensitive). Each
+    row is indexed under several keys of increasing specificity, eg "350 5th ave",
+    "350 5th ave new york", "350 5th ave new york ny" and "350 5th ave new york ny 10118", so
+    that queries do not have to match the dataset's exact level of detail. When two rows
+    produce the same key within SAME_PLACE_DISTANCE of each other (eg duplicate rows), the
+    first row wins. When they are further apart (eg "100 main st" in two cities), the key is
+    ambiguous and left out of the index, so that such queries fall through to the remote
+    services instead of being answered with an arbitrary one of the places.
+
+    Args:
+        csv_path (string): Path to the input CSV
+        index_path (string): Path of the index file to write
+
+    Returns:
+        int: Number of keys written to the index
+
+    """
+    records = {}
+    ambiguous = set()
+    with open(csv_path, newline='', encoding='utf-8') as csv_file:
+        reader = csv.DictReader(csv_file)
+        for row in reader:
+            row = {k.strip().upper(): (v or "").strip() for k, v in row.items() if k}
+            try:
+                lat = float(row["LAT"])
+                lon = float(row["LON"])
+            except (KeyError, ValueError):
+                continue
+            number, street = row.get("NUMBER", ""), row.get("STREET", "")
+            if not street:
+                continue
+            city, region, postcode = row.get("CITY", ""), row.get("REGION", ""), \
+                row.get("POSTCODE", "")
+            label = " ".join(part for part in (number, street) if part)
+            locality = " ".join(part for part in (region, postcode) if part)
+            label = ", ".join(part for part in (label, city, locality) if part)
+            # index the street address alone, then with each available locality component
+            parts = [number, street]
+            keys = [normalize_address(" ".join(parts))]
+            for extra in (city, region, postcode):
+                if extra:
+                    parts.append(extra)
+                    keys.append(normalize_address(" ".join(parts)))
+            for key in keys:
+                key = key.encode("utf-8")
+                if not key:
+                    continue
+                if key not in records:
+                    records[key] = (lat, lon, label.encode("utf-8"))
+                elif haversine_distance(Coordinate(*records[key][:2]),
+                                        Coordinate(lat, lon)) > SAME_PLACE_DISTANCE:
+                    ambiguous.add(key)
+    for key in ambiguous:
+        del records[key]
+    return write_index(records, index_path)
+
+
+def write_index(records, index_path, magic=INDEX_MAGIC):
+    """Writes an index file in the address index layout
+
+    Args:
+        records (dict): Map from key (bytes) to (latitude, longitude, label (bytes))
+        index_path (string): Path of the index file to write
+        magic (bytes): 8 byte file type identifier
+
+    Returns:
+        int: Number of keys written to the index
+
+    """
+    entries = sorted((address_hash(key), key) for key in records)
+    records_offset = _HEADER.size + _ENTRY.size * len(entries)
+    with open(index_path, "wb") as index_file:
+        index_file.write(_HEADER.pack(magic, len(entries), records_offset))
+        offset = records_offset
+        for key_hash, key in entries:
+            index_file.write(_ENTRY.pack(key_hash, offset))
+            offset += _RECORD.size + len(key) + len(records[key][2])
+        for _, key in entries:
+            lat, lon, label = records[key]
+            index_file.write(_RECORD.pack(len(key), len(label), lat, lon))
+            index_file.write(key)
+            index_file.write(label)
+    return len(entries)
+
+
+class AddressIndex:
+    """Read-only, memory mapped view of an address index file
+
+    Attributes:
+        path (string): Path of the index file
+        count (int): Number of keys in the index
+
+    """
+
+    def __init__(self, path, magic=INDEX_MAGIC):
+        """Constructor, maps the index file into memory
+
+        Args:
+            path (string): Path of the index file
+            magic (bytes): 8 byte file type identifier expected in the header
+
+        Raises:
+            ValueError: If the file is not a geoproxy address index
+
+        """
+        self.path = path
+        with open(path, "rb") as index_file:
+            self._mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_magic, self.count, self._records_offset = _HEADER.unpack_from(self._mmap, 0)
+        if header_magic != magic:
+            self._mmap.close()
+            raise ValueError("{} is not a geoproxy address index".format(path))
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        """Unmaps the index file
+        """
+        self._mmap.close()
+
+    def lookup(self, address):
+        """Looks up the coordinates of an address
+
+        Args:
+            address (string): Free-form address, normalized before the lookup
+
+        Returns:
+            None/tuple: (latitude, longitude, label) if the address is indexed, otherwise None
+
+        """
+        return self.lookup_key(normalize_address(address).encode("utf-8"))
+
+    def lookup_key(self, key):
+        """Looks up the coordinates of an index key
+
+        Args:
+            key (bytes): Key exactly as indexed
+
+        Returns:
+            None/tuple: (latitude, longitude, label) if the key is indexed, otherwise None
+
+        """
+        key_hash = address_hash(key)
+        buf = self._mmap
+        unpack_entry = _ENTRY.unpack_from
+        # binary search for the first table entry with a matching hash
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if unpack_entry(buf, _HEADER.size + middle * _ENTRY.size)[0] < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        # walk every entry sharing the hash, in case of collisions
+        while low < self.count:
+            entry_hash, offset = unpack_entry(buf, _HEADER.size + low * _ENTRY.size)
+            if entry_hash != key_hash:
+                break
+            key_length, label_length, lat, lon = _RECORD.unpack_from(buf, offset)
+            start = offset + _RECORD.size
+            if buf[start:start + key_length] == key:
+                start += key_length
+                return lat, lon, buf[start:start + label_length].decode("utf-8")
+            low += 1
+        return None
+
+
+class LocalServiceHelper(ThirdPartyServiceHelper):
+    """Container for local address index query and parser
+
+    Unlike the other helpers, this service does not make network requests, the query is the
+    address itself and it is answered directly by lookup().
+
+    Attributes:
+        index (AddressIndex): Memory mapped address index
+
+    """
+    is_remote = False
+
+    def __init__(self, index_path):
+        """Constructor
+
+        Args:
+            index_path (string): Path of an index file created by build_address_index
+
+        """
+        super(LocalServiceHelper, self).__init__(LocalServiceResponseParser())
+        self.index = AddressIndex(index_path)
+
+    def build_query(self, address, bounds=None, limit=1):
+        """Sets the base class's query member to the address to look up
+
+        Args:
+            address (string): Valid address to search for
+            bounds (BoundingBox): Unused, the local index does not support viewport biasing
+            limit (int): Unused, the local index has a single result per address
+
+        """
+        self.query = address
+
+    def lookup(self, query):
+        """Answers a query from the local address index
+
+        Args:
+            query (string): Query string set by build_query()
+
+        Returns:
+            None/dict: None if the address is not in the index, which only means the index
+                       does not cover it, so the next service is queried, otherwise a response
+                       in the same shape as a JSON third party response
+
+        """
+        result = self.index.lookup(query)
+        if result is None:
+            return None
+        lat, lon, label = result
+        return {"status": "OK", "results": [{"label": label, "lat": lat, "lon": lon}]}
+
+
+class LocalServiceResponseParser(ThirdPartyServiceResponseParser):
+    """Parser specific to local address index responses
+    """
+    def __init__(self):
+        super(LocalServiceResponseParser, self).__init__()
+
+    def parse(self, response):
+        """Parse method used to extract data from a local address index response
+
+        Args:
+            response (dict): Response from LocalServiceHelper.lookup()
+
+        Returns:
+            None/0/ThirdPartyServiceResponseParser: None if error, 0 is zero results, otherwise
+                                                    parser object with populated fields
+
+        """
+        self.response_raw = response
+        if response.get('status') == "OK":
+            result = response['results'][0]
+            self.address = result['label']
+            self.latitude = result['lat']
+            self.longitude = result['lon']
+            self.candidates = [(self.latitude, self.longitude, self.address)]
+            return self
+        elif response.get('status') == "ZERO_RESULTS":
+            return 0
+        return None
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import json
 import logging
+import re
 
 """Base classes for third party services
 
@@ -9,17 +11,139 @@ be implemented on top of these base classes.
 
 """
 
+_decode_value = json.JSONDecoder().raw_decode
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _skip_whitespace(text, index):
+    return _WHITESPACE.match(text, index).end()
+
+
+def _find_member(text, index, name):
+    """Index of the value of an object's member, None if the object has no such member
+    """
+    if text[index:index + 1] != "{":
+        return None
+    index = _skip_whitespace(text, index + 1)
+    while text[index:index + 1] == '"':
+        member, index = _decode_value(text, index)
+        index = _skip_whitespace(text, index)
+        if text[index:index + 1] != ":":
+            return None
+        index = _skip_whitespace(text, index + 1)
+        if member == name:
+            return index
+        _, index = _decode_value(text, index)
+        index = _skip_whitespace(text, index)
+        if text[index:index + 1] != ",":
+            return None
+        index = _skip_whitespace(text, index + 1)
+    return None
+
+
+def _find_element(text, index, position):
+    """Index of an array's element, None if the array is shorter
+    """
+    if text[index:index + 1] != "[":
+        return None
+    index = _skip_whitespace(text, index + 1)
+    if text[index:index + 1] == "]":
+        return None
+    for _ in range(position):
+        _, index = _decode_value(text, index)
+        index = _skip_whitespace(text, index)
+        if text[index:index + 1] != ",":
+            return None
+        index = _skip_whitespace(text, index + 1)
+    return index
+
+
+def decode_array_prefix(text, path, limit):
+    """Decodes the first elements of an array nested in a JSON document
+
+    The document is decoded incrementally, only the members and elements before the array on
+    its path and the first limit elements of the array are decoded, the rest of the document
+    is not read.
+
+    Args:
+        text (string): JSON document
+        path (tuple): Member names and element positions leading to the array, eg
+                      ("Response", "View", 0, "Result")
+        limit (int): Maximum number of elements decoded
+
+    Returns:
+        None/list: First elements of the array, None if the document has no array on the path
+
+    Raises:
+        ValueError: If the document is not valid JSON up to the last element decoded
+
+    """
+    index = _skip_whitespace(text, 0)
+    for step in path:
+        if isinstance(step, str):
+            index = _find_member(text, index, step)
+        else:
+            index = _find_element(text, index, step)
+        if index is None:
+            return None
+    if text[index:index + 1] != "[":
+        return None
+    elements = []
+    index = _skip_whitespace(text, index + 1)
+    if text[index:index + 1] == "]":
+        return elements
+    while len(elements) < limit:
+        element, index = _decode_value(text, index)
+        elements.append(element)
+        index = _skip_whitespace(text, index)
+        if text[index:index + 1] != ",":
+            break
+        index = _skip_whitespace(text, index + 1)
+    return elements
+
+
+class TransientServiceError(Exception):
+    """Raised when a third party service fails in a way that is worth retrying
+
+    Examples include HTTP 5xx responses, rate limiting and socket timeouts.
+
+    """
+    pass
+
 
 class ThirdPartyServiceHelper(object):
     """A container that has both a valid query string and a parser
 
+    Services that are answered in-process rather than over the network set is_remote to
+    False and implement lookup(), which the request handler calls directly instead of tasking
+    an HTTP request on the executor.
+
+    Services with a batch API set supports_batch to True and implement the build_batch_* and
+    parse_batch_* methods, so that concurrent queries can be sent to them as a single batch
+    job (see MicroBatcher).
+
+    Services with API keys hold them in a key_pool, and set key to the credentials that
+    build_query put in the query, so that the outcome of the query can be reported to the pool.
+
+    build_query takes the number of results wanted as its limit argument, and services that
+    can be told how many results to return (and which of their fields) ask for no more.
+
     Attributes:
         query (string): Valid query string to be sent to the third party service
+        key (string/tuple): Credentials used in the query, None without a key pool
+        key_pool (KeyPool): API keys of the service, None if it does not use keys
         parser (ThirdPartyServiceResponseParser): Parser associated with third party service
+        is_remote (bool): If the query is an HTTP request to a remote service
+        supports_batch (bool): If the service accepts batch jobs
 
     """
+    is_remote = True
+    supports_batch = False
+    key_pool = None
+
     def __init__(self, parser):
         self.query = None
+        self.key = None
         self.parser = parser
 
     def build_query(self):
@@ -27,6 +151,11 @@ class ThirdPartyServiceHelper(object):
         """
         pass
 
+    def lookup(self, query):
+        """Virtual method for lookup, only used by services that are not remote
+        """
+        pass
+
     def __str__(self):
         return "ThirdPartyGeocoderHelper:\nQuery: {}".format(self.query)
 
@@ -43,6 +172,8 @@ class ThirdPartyServiceResponseParser(object):
         latitude (float): Parsed latitude from the third party service response
         longitude (float): Parsed longitude from the third party service response
         results (string): Number of results from the third party service response
+        candidates ([tuple]): (latitude, longitude, address) of each result parsed, most
+                              likely first
         response_raw (string): Complete response from the third party service response (for debug)
         logger (logging.logger): Logger instance
 
@@ -53,6 +184,7 @@ class ThirdPartyServiceResponseParser(object):
         self.latitude = None
         self.longitude = None
         self.results = 0
+        self.candidates = []
         self.response_raw = None
         self.logger = logging.getLogger(self.__class__.__name__)
 
@@ -60,3 +192,52 @@ class ThirdPartyServiceResponseParser(object):
         """Virtual method for parse
         """
         pass
+
+    def decode(self, body, limit=1):
+        """Decodes the body of a third party response into the dict passed to parse()
+
+        Services whose responses carry many results, or large results, should override this
+        method to decode only the first limit results (see decode_array_prefix).
+
+        Args:
+            body (string): JSON response body
+            limit (int): Number of results that will be parsed
+
+        Returns:
+            dict: JSON response as dict
+
+        Raises:
+            ValueError: If the body is not valid JSON
+
+        """
+        return json.loads(body)
+
+    def is_transient(self, response):
+        """Checks if a third party response reports an error that is worth retrying
+
+        Services that signal rate limiting or temporary failures inside a successful HTTP
+        response body should override this method.
+
+        Args:
+            response (dict): JSON response as dict
+
+        Returns:
+            bool: If the request should be retried
+
+        """
+        return False
+
+    def key_error(self, response):
+        """Checks if a third party response reports a problem with the API key of the query
+
+        Services that signal rate limiting or authorization errors inside a successful HTTP
+        response body should override this method.
+
+        Args:
+            response (dict): JSON response as dict
+
+        Returns:
+            None/string: RATE_LIMITED or DENIED (see KeyPool), None if the key was accepted
+
+        """
+        return None
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from geoproxy.cache import ResultCache
+from geoproxy.cache import cache_key
+from geoproxy.shared_cache import SharedResultCache
+
+
+def make_result(index):
+    """Result of the size that a third party service typically returns
+    """
+    return {"source": "google", "lat": 40.7484 + index * 1e-6, "lon": -73.9856,
+            "address": "{} 5th Ave, New York, NY 10118, USA".format(index)}
+
+
+def measure(cache, keys, lookups, seed=0):
+    """Times the puts and the hit and miss lookups of a cache
+
+    Returns:
+        tuple: Microseconds per put, per hit and per miss
+
+    """
+    start_time = time.perf_counter()
+    for index, key in enumerate(keys):
+        cache.put(key, make_result(index))
+    put = (time.perf_counter() - start_time) / len(keys)
+    hits = random.Random(seed).choices(keys, k=lookups)
+    start_time = time.perf_counter()
+    for key in hits:
+        cache.get(key)
+    hit = (time.perf_counter() - start_time) / lookups
+    misses = [key + " missing" for key in hits]
+    start_time = time.perf_counter()
+    for key in misses:
+        cache.get(key)
+    miss = (time.perf_counter() - start_time) / lookups
+    return put * 1e6, hit * 1e6, miss * 1e6
+
+
+def main():
+    # Parse arguments from the command line
+    parser = argparse.ArgumentParser(
+        description="Measures the cost of cache lookups, in process and in a shared cache file")
+    parser.add_argument("-n", "--entries", default=10000, type=int,
+                        help="Number of results cached (default: 10000)")
+    parser.add_argument("-l", "--lookups", default=100000, type=int,
+                        help="Number of lookups timed (default: 100000)")
+    parser.add_argument("-w", "--workers", default=4, type=int,
+                        help="Number of processes using the shared cache at once (default: 4)")
+    parser.add_argument("--slot-size", default=512, type=int,
+                        help="Bytes per result in the shared cache (default: 512)")
+    parser.add_argument("--path", default=None,
+                        help="Path of the shared cache file (default: a temporary file)")
+    args = parser.parse_args()
+
+    keys = [cache_key("{} 5th Ave, New York, NY".format(index)) for index in range(args.entries)]
+    tmp_dir = tempfile.TemporaryDirectory()
+    path = args.path or os.path.join(tmp_dir.name, "geoproxy.cache")
+    print("{:<28} {:>10} {:>10} {:>10}".format("cache (us per operation)", "put", "hit", "miss"))
+    print("{:<28} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+        "ResultCache", *measure(ResultCache(args.entries), keys, args.lookups)))
+    # twice as many slots as entries, so that no bucket overflows
+    shared = SharedResultCache(path, slots=2 * args.entries, slot_size=args.slot_size)
+    print("{:<28} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+        "SharedResultCache", *measure(shared, keys, args.lookups)))
+
+    # every worker writes and reads the same keys at once
+    pipes = []
+    for worker in range(args.workers):
+        read_fd, write_fd = os.pipe()
+        if os.fork() == 0:
+            os.close(read_fd)
+            timings = measure(SharedResultCache(path), keys, args.lookups, seed=worker)
+            os.write(write_fd, " ".join(str(timing) for timing in timings).encode("utf-8"))
+            os._exit(0)
+        os.close(write_fd)
+        pipes.append(read_fd)
+    timings = []
+    for read_fd in pipes:
+        timings.append([float(timing) for timing in os.read(read_fd, 1024).split()])
+        os.close(read_fd)
+        os.wait()
+    print("{:<28} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+        "SharedResultCache x{}".format(args.workers),
+        *(sum(column) / len(column) for column in zip(*timings))))
+    print("Shared cache: {} of {} slots used, {} hits in the parent, {} evictions".format(
+        len(shared), shared.slots, shared.hits, shared.evictions))
+    shared.close()
+    tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
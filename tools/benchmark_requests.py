@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import time
+import tracemalloc
+
+from geoproxy.api import GeoproxyArguments
+from geoproxy.api import GeoproxyRequestParser
+from geoproxy.api import GeoproxyResponse
+from geoproxy.api import service_orders
+
+# the parser only reads the names of the available services
+SERVICES = {"local": None, "google": None, "here": None}
+
+CASES = [
+    ("address", {"address": "350 5th Ave, New York"}),
+    ("service and bounds", {"address": "350 5th Ave, New York", "service": "here",
+                            "bounds": "40.70,-74.02|40.80,-73.93"}),
+]
+
+
+def handle(arguments, orders):
+    """Parses a request and encodes its response, the per-request work outside the resolver
+
+    Returns:
+        GeoproxyRequestParser: The parsed request
+
+    """
+    geo_proxy_response = GeoproxyResponse()
+    geo_proxy_request = GeoproxyRequestParser(SERVICES, geo_proxy_response, orders)
+    geo_proxy_request.parse(arguments)
+    geo_proxy_response.set_result("here", 40.7484, -73.9856, "350 5th Ave, New York, NY 10118")
+    geo_proxy_response.to_json()
+    return geo_proxy_request
+
+
+def measure(arguments, orders, requests, repeats):
+    """Times the requests, then measures the memory they allocate and retain
+
+    Returns:
+        tuple: Microseconds of CPU per request (best of the repeats), peak bytes allocated
+               while handling a request, and bytes retained per parsed request
+
+    """
+    cpu = None
+    for _ in range(repeats):
+        start_time = time.process_time()
+        for _ in range(requests):
+            handle(arguments, orders)
+        elapsed = (time.process_time() - start_time) / requests
+        cpu = elapsed if cpu is None else min(cpu, elapsed)
+    # warm up any caches before tracing
+    handle(arguments, orders)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    handle(arguments, orders)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    # requests kept alive, eg while they wait on upstream services
+    kept = [handle(arguments, orders) for _ in range(1000)]
+    retained = (tracemalloc.get_traced_memory()[0] - base) / len(kept)
+    tracemalloc.stop()
+    return cpu * 1e6, peak, retained
+
+
+def main():
+    # Parse arguments from the command line
+    parser = argparse.ArgumentParser(
+        description="Measures the CPU time and memory of parsing requests and encoding responses")
+    parser.add_argument("-n", "--requests", default=100000, type=int,
+                        help="Number of requests timed per repeat (default: 100000)")
+    parser.add_argument("-r", "--repeats", default=5, type=int,
+                        help="Number of timed repeats, the best is reported (default: 5)")
+    parser.add_argument("--no-precomputed-orders", action="store_true",
+                        help="Build the service orders on every request, as before they were \
+                              precomputed by the resolver")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    orders = None if args.no_precomputed_orders else service_orders(SERVICES)
+    print("{:<20} {:>12} {:>12} {:>14}".format("request", "us of CPU", "peak bytes",
+                                               "retained bytes"))
+    for name, arguments in CASES:
+        cpu, peak, retained = measure(GeoproxyArguments(arguments), orders, args.requests,
+                                      args.repeats)
+        print("{:<20} {:>12.2f} {:>12d} {:>14.0f}".format(name, cpu, peak, retained))
+
+
+if __name__ == "__main__":
+    main()
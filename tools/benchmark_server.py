@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+from geoproxy.third_party_services.local import build_address_index
+
+# the server answers from a one address offline index, so no third party is queried
+ADDRESS = "350 5th Ave, New York"
+
+
+def build_index(directory):
+    """Writes the offline index the server answers from
+
+    Returns:
+        string: Path of the index file
+
+    """
+    csv_path = os.path.join(directory, "addresses.csv")
+    with open(csv_path, "w") as csv_file:
+        csv_file.write("LON,LAT,NUMBER,STREET,CITY,REGION,POSTCODE\n")
+        csv_file.write("-73.9856,40.7484,350,5th Ave,New York,NY,10118\n")
+    index_path = os.path.join(directory, "addresses.idx")
+    build_address_index(csv_path, index_path)
+    return index_path
+
+
+def process_cpu(pid):
+    """Seconds of CPU used by a process so far, user and system, from /proc (Linux only)
+    """
+    with open("/proc/{}/stat".format(pid)) as stat_file:
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def drive(url, requests, concurrency):
+    """Sends requests from concurrency connections at once, each as soon as the last completed
+    """
+    client = AsyncHTTPClient(max_clients=concurrency)
+
+    async def connection(count):
+        for _ in range(count):
+            response = await client.fetch(url)
+            if json.loads(response.body.decode("utf-8"))["status"] != "OK":
+                raise RuntimeError("Unexpected response: {}".format(response.body))
+
+    await asyncio.gather(*[connection(requests // concurrency) for _ in range(concurrency)])
+
+
+def main():
+    # Parse arguments from the command line, the others are passed on to the server
+    parser = argparse.ArgumentParser(
+        description="Measures the server's throughput and CPU time per request, eg with and \
+                     without --uvloop, any other argument is passed on to the server")
+    parser.add_argument("-n", "--requests", default=4000, type=int,
+                        help="Number of requests timed per repeat (default: 4000)")
+    parser.add_argument("-c", "--concurrency", default=8, type=int,
+                        help="Number of requests in flight at once (default: 8)")
+    parser.add_argument("-r", "--repeats", default=3, type=int,
+                        help="Number of timed repeats, the best is reported (default: 3)")
+    parser.add_argument("-p", "--port", default=18080, type=int,
+                        help="Port to run the server on (default: 18080)")
+    parser.add_argument("--server", default=os.path.join(os.path.dirname(__file__), "..",
+                                                         "examples", "server.py"),
+                        help="Path of the example server (default: examples/server.py)")
+    args, server_args = parser.parse_known_args()
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    # without the cache, every request goes through the resolver
+    server = subprocess.Popen([sys.executable, args.server, "-p", str(args.port),
+                               "-i", build_index(tmp_dir.name), "--cache-size", "0",
+                               "--log-level", "ERROR"] + server_args,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = "http://localhost:{}/geocode?address={}&service=local".format(
+        args.port, urllib.parse.quote_plus(ADDRESS))
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(url).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            print("The server did not start")
+            return
+        # warm up
+        IOLoop.current().run_sync(lambda: drive(url, args.requests // 10, args.concurrency))
+        runs = []
+        for _ in range(args.repeats):
+            start_cpu, start_time = process_cpu(server.pid), time.monotonic()
+            IOLoop.current().run_sync(lambda: drive(url, args.requests, args.concurrency))
+            runs.append(((process_cpu(server.pid) - start_cpu) / args.requests * 1e6,
+                         args.requests / (time.monotonic() - start_time)))
+    finally:
+        server.terminate()
+        server.wait()
+        tmp_dir.cleanup()
+    print("Server CPU per request: {:.0f} us (runs: {}), throughput: {:.0f} requests/s".format(
+        min(run[0] for run in runs), ", ".join("{:.0f}".format(run[0]) for run in runs),
+        max(run[1] for run in runs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+
+from geoproxy.third_party_services.local import build_address_index
+
+
+def main():
+    # Parse arguments from the command line
+    parser = argparse.ArgumentParser(
+        description="Builds an offline address index from an OpenAddresses-style CSV")
+    parser.add_argument("-i", "--input", required=True,
+                        help="Input CSV with LON, LAT, NUMBER, STREET, CITY, REGION and \
+                              POSTCODE columns")
+    parser.add_argument("-o", "--output", required=True, help="Path of the index file to write")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    count = build_address_index(args.input, args.output)
+    print("Indexed {} keys into {} in {:0.2f} seconds".format(
+        count, args.output, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+
+from geoproxy.centroids import MAX_SPREAD, build_centroid_index
+
+
+def main():
+    # Parse arguments from the command line
+    parser = argparse.ArgumentParser(
+        description="Builds a postal code and locality centroid index from a CSV")
+    parser.add_argument("-i", "--input", required=True,
+                        help="Input CSV with LAT, LON, POSTCODE, LOCALITY and REGION columns")
+    parser.add_argument("-o", "--output", required=True, help="Path of the index file to write")
+    parser.add_argument("--max-spread", type=float, default=MAX_SPREAD,
+                        help="Distance in meters beyond which a key's rows are ambiguous and "
+                             "the key is left out (default: %(default)s)")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    count = build_centroid_index(args.input, args.output, args.max_spread)
+    print("Indexed {} keys into {} in {:0.2f} seconds".format(
+        count, args.output, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+from tornado.ioloop import IOLoop
+
+from geoproxy.replay import StubUpstream
+from geoproxy.replay import load_trace
+from geoproxy.replay import run_load
+
+logging.basicConfig(
+    format="[%(asctime)s][%(name)s](%(levelname)s) %(message)s", level=logging.INFO)
+
+
+def stub(args):
+    """Serves the third party responses recorded in a trace
+    """
+    stub_upstream = StubUpstream(load_trace(args.trace), latency_scale=args.latency_scale)
+    stub_upstream.create_app().listen(args.port, address=args.address)
+    print("Serving {} recorded queries on {}:{}".format(
+        len(stub_upstream.responses), args.address, args.port))
+    print("Start the proxy with --google-url http://{0}:{1}/maps/api/geocode/json "
+          "--here-url http://{0}:{1}/6.2/geocode.json".format(args.address, args.port))
+    try:
+        IOLoop.current().start()
+    except KeyboardInterrupt:
+        IOLoop.current().stop()
+
+
+def load(args):
+    """Replays the request mix recorded in a trace against a geoproxy server
+    """
+    uris = [entry["uri"] for entry in load_trace(args.trace) if entry.get("type") == "request"]
+    if not uris:
+        print("No requests recorded in {}".format(args.trace))
+        return
+    report = IOLoop.current().run_sync(lambda: run_load(
+        args.proxy, uris, concurrency=args.concurrency, repeat=args.repeat,
+        stub_url=args.stub))
+    print("Requests:       {}".format(report["requests"]))
+    print("Errors:         {}".format(report["errors"]))
+    print("Throughput:     {:0.1f} requests/s".format(report["rps"]))
+    print("Latency p50:    {:0.2f} ms".format(1000.0 * report["p50"]))
+    print("Latency p99:    {:0.2f} ms".format(1000.0 * report["p99"]))
+    if report["upstream_calls"] is not None:
+        print("Upstream calls: {}".format(report["upstream_calls"]))
+
+
+def main():
+    # Parse arguments from the command line
+    parser = argparse.ArgumentParser(
+        description="Replays traces recorded by a geoproxy server started with --record")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    stub_parser = subparsers.add_parser("stub", help="Serve recorded third party responses")
+    stub_parser.add_argument("trace", help="Path of the recorded trace")
+    stub_parser.add_argument("-a", "--address", default="localhost",
+                             help="IP address the stub binds to (default: localhost)")
+    stub_parser.add_argument("-p", "--port", default=9090, type=int,
+                             help="Port the stub binds to (default: 9090)")
+    stub_parser.add_argument("-l", "--latency-scale", default=1.0, type=float,
+                             help="Multiplier applied to recorded latencies (default: 1.0)")
+    stub_parser.set_defaults(func=stub)
+
+    load_parser = subparsers.add_parser("load", help="Replay recorded requests against a proxy")
+    load_parser.add_argument("trace", help="Path of the recorded trace")
+    load_parser.add_argument("--proxy", default="http://localhost:8080",
+                             help="Base URL of the geoproxy server (default: \
+                                   http://localhost:8080)")
+    load_parser.add_argument("--stub", default=None,
+                             help="Base URL of the stub, to report upstream call counts")
+    load_parser.add_argument("-c", "--concurrency", default=10, type=int,
+                             help="Number of concurrent requests (default: 10)")
+    load_parser.add_argument("-r", "--repeat", default=1, type=int,
+                             help="Number of times to replay the request mix (default: 1)")
+    load_parser.set_defaults(func=load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()